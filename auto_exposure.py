@@ -0,0 +1,110 @@
+"""
+auto_exposure.py
+
+Automatic integration time control. The peak of a spectrum rises linearly with integration time above the dark level,
+so after each acquisition the counts per microsecond are fitted from the recent unsaturated acquisitions and the
+integration time that puts the peak at the target fraction of the detector's saturation level is predicted directly.
+That usually converges in two or three acquisitions instead of the many it takes to hand-tune the integration time.
+
+A saturated spectrum only says the peak is at least the saturation level, so the next time is cut to what would put
+a peak of exactly that level on target, and cut by a further factor of four for every saturated acquisition after that.
+
+All of this only holds for continuous sources (a lamp, the ambient light, a spectrum taken without firing the laser).
+The emission of a laser shot is over within microseconds, so as long as the integration window takes the pulse in, the
+peak stays the same whatever the integration time: a longer window only adds dark counts, a shorter one ends up
+missing the pulse. For laser shots check_pulse() only grades the shot and the integration time is left alone.
+
+"""
+import numpy as np
+
+DEFAULT_TARGET = 0.8 # Fraction of the saturation level to aim the highest peak at
+DEFAULT_TOLERANCE = 0.05
+SATURATED = 0.98 # Peaks above this fraction of the saturation level are treated as clipped
+MIN_SIGNAL = 0.01 # Peaks less than this fraction above the dark level are treated as no signal at all
+MAX_STEP = 10.0 # Largest factor the integration time is changed by in one step, unless saturated
+SATURATED_STEP = 4.0 # Extra factor the integration time is cut by for each saturated acquisition after the first
+WEAK_PULSE = 0.05 # Laser shots whose peak is less than this fraction above the dark level are graded weak
+
+class AutoExposure():
+    """Predicts the integration time (in microseconds) that fills the detector to the target fraction.
+
+    limits are the (minimum, maximum) integration times of the spectrometer and saturation its maximum count.
+    """
+    def __init__(self, limits, saturation=65535, target=DEFAULT_TARGET, tolerance=DEFAULT_TOLERANCE, history=4):
+        self.limits = (int(limits[0]), int(limits[1]))
+        self.saturation = float(saturation)
+        self.target = target
+        self.tolerance = tolerance
+        self.history = history
+        self.reset()
+
+    def reset(self):
+        """Forgets the acquisitions seen so far, e.g. after the sample or the laser settings have changed."""
+        self.points = [] # (integration time, peak above dark) of recent unsaturated acquisitions
+        self.saturated = 0 # Saturated acquisitions in a row
+        self.fill = None # Peak of the last acquisition as a fraction of the saturation level
+        self.pulse = None # Grade of the last laser shot, see check_pulse
+
+    def clamp(self, t):
+        return int(min(max(round(t), self.limits[0]), self.limits[1]))
+
+    def observe(self, t, intensities):
+        """Takes the spectrum acquired with integration time t and returns (converged, next integration time)."""
+        intensities = np.asarray(intensities)
+        peak = float(intensities.max())
+        dark = float(np.median(intensities)) # Most pixels of an emission spectrum see no line
+        self.fill = peak / self.saturation
+        goal = self.target * self.saturation
+
+        if self.fill >= SATURATED:
+            self.saturated += 1
+            self.points = []
+            bound = t * (goal - dark) / max(peak - dark, 1.0) # The time if the peak were exactly at saturation
+            return False, self.clamp(bound / SATURATED_STEP ** (self.saturated - 1))
+        self.saturated = 0
+
+        if abs(self.fill - self.target) <= self.tolerance:
+            return True, t
+        signal = peak - dark
+        if signal < MIN_SIGNAL * self.saturation:
+            return False, self.clamp(t * MAX_STEP)
+
+        self.points = [p for p in self.points if p[0] != t][-(self.history - 1):] + [(t, signal)]
+        times = np.array([p[0] for p in self.points], dtype=np.float64)
+        signals = np.array([p[1] for p in self.points])
+        rate = float(np.dot(times, signals) / np.dot(times, times)) # Least squares slope through the origin
+        predicted = (goal - dark) / rate
+        return False, self.clamp(min(max(predicted, t / MAX_STEP), t * MAX_STEP))
+
+    def check_pulse(self, intensities):
+        """Grades a laser shot "saturated", "weak" or "ok" by its peak. Never changes the integration time, see above;
+        a shot is brought on target with the laser energy or the trigger delay instead."""
+        intensities = np.asarray(intensities)
+        peak = float(intensities.max())
+        self.fill = peak / self.saturation
+        if self.fill >= SATURATED:
+            self.pulse = "saturated"
+        elif peak - float(np.median(intensities)) < WEAK_PULSE * self.saturation:
+            self.pulse = "weak"
+        else:
+            self.pulse = "ok"
+        return self.pulse
+
+    def converge(self, acquire, t, max_steps=8):
+        """Runs acquire(integration time) -> intensities until the peak is on target or max_steps acquisitions have
+        been made. Returns (integration time, acquisitions made, converged). Stops early if the prediction is stuck at
+        one of the limits."""
+        for step in range(1, max_steps + 1):
+            converged, next_t = self.observe(t, acquire(t))
+            if converged:
+                return t, step, True
+            if next_t == t:
+                return t, step, False
+            t = next_t
+        return t, max_steps, False
+
+def for_spectrometer(spec, **kwargs):
+    """Creates an AutoExposure with the limits and saturation level of a seabreeze Spectrometer, kept as .spec."""
+    control = AutoExposure(spec.integration_time_micros_limits, getattr(spec, "max_intensity", 65535), **kwargs)
+    control.spec = spec
+    return control
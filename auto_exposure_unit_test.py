@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+import auto_exposure
+import testing_utils
+
+class ContinuousSource():
+    """A lamp: the counts above dark grow linearly with the integration time (in microseconds), up to saturation."""
+    def __init__(self, counts_per_micro):
+        self.rate = counts_per_micro
+        self.template = np.exp(-0.5 * ((np.arange(512) - 200) / 3.0) ** 2)
+        self.acquisitions = 0
+
+    def acquire(self, t):
+        self.acquisitions += 1
+        return np.clip(1500 + self.rate * t * self.template, 0, 65535)
+
+class TestAutoExposure(unittest.TestCase):
+    def test_converges_on_a_continuous_source(self):
+        source = ContinuousSource(0.5)
+        control = auto_exposure.AutoExposure((1000, 65000000))
+        t, steps, converged = control.converge(source.acquire, 6000)
+        self.assertTrue(converged)
+        self.assertLessEqual(steps, 3)
+        self.assertAlmostEqual(control.fill, auto_exposure.DEFAULT_TARGET, delta=auto_exposure.DEFAULT_TOLERANCE)
+
+        source = ContinuousSource(50.0) # Saturated at the starting time: cut, then predicted
+        control.reset()
+        t, steps, converged = control.converge(source.acquire, 6000)
+        self.assertTrue(converged)
+        self.assertLess(t, 6000)
+        self.assertAlmostEqual(t, (0.8 * 65535 - 1500) / 50.0, delta=0.1 * t)
+
+    def test_laser_shots_are_only_graded(self):
+        spec = testing_utils.SimulatedSpectrometer() # Lines at full strength whatever the integration time
+        control = auto_exposure.for_spectrometer(spec)
+        self.assertEqual(control.check_pulse(spec.intensities()), "ok")
+        self.assertAlmostEqual(control.fill, 26500 / 65535.0, delta=0.01)
+        dark = testing_utils.SimulatedSpectrometer(testing_utils.SimulatedLaser()) # Laser never fired
+        self.assertEqual(control.check_pulse(dark.intensities()), "weak")
+        spec.max_intensity = 20000
+        control = auto_exposure.for_spectrometer(spec)
+        self.assertEqual(control.check_pulse(spec.intensities()), "saturated")
+        self.assertEqual(control.points, []) # The integration time model is untouched
+
+if __name__ == "__main__":
+    unittest.main()
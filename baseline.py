@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+"""
+baseline.py
+
+Estimates the broad continuum (mostly bremsstrahlung from the plasma) under LIBS emission lines so it can be removed.
+Three methods, all of which take a single spectrum or a shots x pixels batch:
+    ASLS     asymmetric least squares (Eilers & Boelens): a smooth curve that points above it (lines) pull up only weakly
+    SNIP     statistics-sensitive nonlinear iterative peak clipping, which clips peaks narrower than a given width
+    Rolling  a rolling minimum/maximum (morphological opening) smoothed with a moving average of the same width
+
+ASLS solves the banded system (W + lam D'D) z = W y a few times per spectrum with new weights W. The penalty band lam D'D
+only depends on the number of pixels and lam, so it is built once and cached; each iteration just adds the weights to
+its diagonal and solves the banded system in O(pixels), with scipy's solveh_banded (a LAPACK banded Cholesky) when
+scipy is installed. Without scipy (as on the BeagleBone) a numpy block cyclic reduction solves every spectrum of a
+batch at once in log2(pixels) vectorized passes, so pass whole bursts rather than single spectra where possible. Setting
+decimate > 1 fits the baseline to every decimate'th pixel (taking the minimum of each block) and interpolates it back,
+which is much faster and loses little for a continuum that is broad compared to the pixel spacing.
+
+SNIP and the rolling filter have no per-pixel Python loops and are cheap enough for every shot of a burst everywhere.
+
+Usage:
+    python3 baseline.py bench [SHOTS]
+
+"""
+import sys
+import time
+
+import numpy as np
+
+try:
+    from scipy.linalg import solveh_banded
+except ImportError:
+    solveh_banded = None
+
+def _as_batch(spectra):
+    data = np.asarray(spectra, dtype=np.float64)
+    return (data[np.newaxis], True) if data.ndim == 1 else (data, False)
+
+def second_difference_penalty(n, lam):
+    """Lower bands (diagonal, first and second subdiagonal) of lam * D'D, D being the second difference matrix."""
+    diagonal = np.zeros(n)
+    diagonal[:-2] += 1
+    diagonal[1:-1] += 4
+    diagonal[2:] += 1
+    first = np.zeros(n - 1)
+    first[:n - 2] -= 2
+    first[1:] -= 2
+    second = np.ones(n - 2)
+    return lam * diagonal, lam * first, lam * second
+
+def _block_product(a, b):
+    """Products of stacks of 2 x 2 blocks laid out as (2, 2, ...) arrays, with other blocks or with (2, ...) vectors."""
+    if b.ndim < a.ndim:
+        return a[:, 0] * b[0] + a[:, 1] * b[1]
+    return a[:, 0, np.newaxis] * b[0] + a[:, 1, np.newaxis] * b[1]
+
+def _block_inverse(m):
+    determinant = m[0, 0] * m[1, 1] - m[0, 1] * m[1, 0]
+    return np.array([[m[1, 1], -m[0, 1]], [-m[1, 0], m[0, 0]]]) / determinant
+
+def _padded(blocks, length):
+    """Blocks along the last axis with a zero block before and zeros after, length + 1 long: [..., :length] lines up
+    entry k with block k - 1 and [..., 1:] with block k."""
+    out = np.zeros(blocks.shape[:-1] + (length + 1,))
+    out[..., 1:1 + blocks.shape[-1]] = blocks
+    return out
+
+def _cyclic_reduction(lower, diagonal, upper, rhs):
+    """Solves a block tridiagonal system by eliminating the odd blocks, solving the half sized system left for the even
+    ones and substituting back. No pivoting is needed: the Schur complements of a positive definite matrix stay so."""
+    m = diagonal.shape[-1]
+    if m == 1:
+        return _block_product(_block_inverse(diagonal), rhs)
+    kept = (m + 1) // 2
+    inverse = _block_inverse(diagonal[..., 1::2])
+    lower_odd, upper_odd, rhs_odd = lower[..., 1::2], upper[..., 1::2], rhs[..., 1::2]
+    padded = [_padded(b, kept) for b in (inverse, lower_odd, upper_odd, rhs_odd)]
+    (inverse_before, lower_before, upper_before, rhs_before) = [p[..., :kept] for p in padded]
+    (inverse_after, lower_after, upper_after, rhs_after) = [p[..., 1:] for p in padded]
+    alpha = _block_product(lower[..., 0::2], inverse_before)
+    gamma = _block_product(upper[..., 0::2], inverse_after)
+    x = np.empty_like(rhs)
+    x[..., 0::2] = _cyclic_reduction(
+        -_block_product(alpha, lower_before),
+        diagonal[..., 0::2] - _block_product(alpha, upper_before) - _block_product(gamma, lower_after),
+        -_block_product(gamma, upper_after),
+        rhs[..., 0::2] - _block_product(alpha, rhs_before) - _block_product(gamma, rhs_after))
+    following = _padded(x[..., 2::2], m // 2)[..., 1:]
+    x[..., 1::2] = _block_product(inverse, rhs_odd - _block_product(lower_odd, x[..., 0:2 * (m // 2):2]) -
+                                  _block_product(upper_odd, following))
+    return x
+
+def solve_pentadiagonal(diagonal, first, second, rhs):
+    """Solves symmetric positive definite pentadiagonal systems, one per row of diagonal and rhs (a single 1-D system is
+    fine too) sharing the first and second subdiagonals. Pairing the unknowns makes the matrix block tridiagonal with
+    2 x 2 blocks, which _cyclic_reduction solves with numpy operations over all blocks and rows at once."""
+    diagonal, rhs = np.asarray(diagonal, dtype=np.float64), np.asarray(rhs, dtype=np.float64)
+    single = rhs.ndim == 1
+    diagonal, rhs = np.atleast_2d(diagonal), np.atleast_2d(rhs)
+    rows, n = rhs.shape
+    m = (n + 1) // 2
+    a = np.ones((rows, 2 * m)) # An odd n gets an extra, decoupled unknown with a 1 on the diagonal
+    a[:, :n] = diagonal
+    b = np.zeros(2 * m)
+    b[:n - 1] = first
+    c = np.zeros(2 * m)
+    c[:n - 2] = second
+    r = np.zeros((rows, 2 * m))
+    r[:, :n] = rhs
+    block_diagonal = np.empty((2, 2, rows, m))
+    block_diagonal[0, 0] = a[:, 0::2]
+    block_diagonal[1, 1] = a[:, 1::2]
+    block_diagonal[0, 1] = block_diagonal[1, 0] = b[0::2]
+    lower = np.zeros((2, 2, rows, m)) # Block k couples unknowns 2k, 2k + 1 to 2k - 2, 2k - 1
+    lower[0, 0, :, 1:] = c[0:2 * m - 2:2]
+    lower[0, 1, :, 1:] = b[1:2 * m - 2:2]
+    lower[1, 1, :, 1:] = c[1:2 * m - 2:2]
+    upper = np.zeros((2, 2, rows, m))
+    upper[..., :-1] = lower[..., 1:].transpose(1, 0, 2, 3)
+    x = _cyclic_reduction(lower, block_diagonal, upper, r.reshape(rows, m, 2).transpose(2, 0, 1))
+    x = x.transpose(1, 2, 0).reshape(rows, 2 * m)[:, :n]
+    return x[0] if single else x
+
+class ASLS():
+    """Asymmetric least squares baseline. lam sets the stiffness, p the weight of points above the baseline."""
+    name = "asls"
+
+    def __init__(self, lam=1e6, p=0.01, iterations=10, decimate=1):
+        self.lam = lam
+        self.p = p
+        self.iterations = iterations
+        self.decimate = decimate
+        self.penalty = None # Cached bands of lam * D'D
+        self.band = None # Banded matrix in solveh_banded's lower form, refilled every iteration
+
+    def _prepare(self, n):
+        if self.penalty is None or len(self.penalty[0]) != n:
+            lam = self.lam / self.decimate ** 4 # Keeps the stiffness per nm the same when fitting fewer points
+            self.penalty = second_difference_penalty(n, lam)
+            self.band = np.zeros((3, n))
+            self.band[1, :-1] = self.penalty[1]
+            self.band[2, :-2] = self.penalty[2]
+
+    def _solve(self, weights, rhs):
+        diagonal = self.penalty[0] + weights
+        if solveh_banded is None:
+            return solve_pentadiagonal(diagonal, self.penalty[1], self.penalty[2], rhs)
+        out = np.empty_like(rhs)
+        for i in range(len(rhs)):
+            self.band[0] = diagonal[i]
+            out[i] = solveh_banded(self.band, rhs[i], lower=True, check_finite=False)
+        return out
+
+    def fit(self, data):
+        """Baselines of a shots x pixels batch, iterating until the weights of every shot have settled."""
+        shots, n = data.shape
+        x = data
+        if self.decimate > 1:
+            blocks = n // self.decimate
+            x = data[:, :blocks * self.decimate].reshape(shots, blocks, self.decimate).min(axis=2)
+        self._prepare(x.shape[1])
+        weights = np.ones(x.shape)
+        for i in range(self.iterations):
+            z = self._solve(weights, weights * x)
+            new = np.where(x > z, self.p, 1.0 - self.p)
+            if np.array_equal(new, weights):
+                break
+            weights = new
+        if self.decimate > 1:
+            centres = (np.arange(x.shape[1]) + 0.5) * self.decimate - 0.5
+            z = np.array([np.interp(np.arange(n), centres, row) for row in z])
+        return z
+
+    def estimate(self, spectra):
+        data, single = _as_batch(spectra)
+        out = self.fit(data)
+        return out[0] if single else out
+
+class SNIP():
+    """SNIP clipping over windows up to width pixels, on the log-log-square root transformed spectrum so that lines of
+    very different heights are clipped alike."""
+    name = "snip"
+
+    def __init__(self, width=40, transform=True):
+        self.width = width
+        self.transform = transform
+
+    def estimate(self, spectra):
+        data, single = _as_batch(spectra)
+        v = data.copy()
+        if self.transform:
+            offset = np.minimum(v.min(axis=1, keepdims=True), 0.0)
+            v -= offset
+            v = np.log(np.log(np.sqrt(v + 1) + 1) + 1)
+        n = v.shape[1]
+        for k in range(1, min(self.width, (n - 1) // 2) + 1):
+            mean = (v[:, :n - 2 * k] + v[:, 2 * k:]) * 0.5
+            np.minimum(v[:, k:n - k], mean, out=v[:, k:n - k])
+        if self.transform:
+            v = (np.exp(np.exp(v) - 1) - 1) ** 2 - 1
+            v += offset
+        return v[0] if single else v
+
+def rolling(data, width, op):
+    """Centred rolling minimum (op=np.minimum) or maximum (op=np.maximum) along the last axis, edges padded with the end
+    values. Uses van Herk/Gil-Werman prefix and suffix scans within blocks, so the cost does not depend on width."""
+    half = width // 2
+    width = 2 * half + 1
+    shots, n = data.shape
+    blocks = -(-(n + 2 * half) // width)
+    padded = np.empty((shots, blocks * width))
+    padded[:, half:half + n] = data
+    padded[:, :half] = data[:, :1]
+    padded[:, half + n:] = data[:, -1:]
+    b = padded.reshape(shots, blocks, width)
+    prefix = op.accumulate(b, axis=2).reshape(shots, -1)
+    suffix = op.accumulate(b[:, :, ::-1], axis=2)[:, :, ::-1].reshape(shots, -1)
+    return op(suffix[:, :n], prefix[:, width - 1:width - 1 + n])
+
+class Rolling():
+    """Morphological opening (rolling minimum then rolling maximum) over width pixels, then a moving average over the
+    same width to smooth the steps."""
+    name = "rolling"
+
+    def __init__(self, width=101):
+        self.width = width
+
+    def estimate(self, spectra):
+        data, single = _as_batch(spectra)
+        opened = rolling(rolling(data, self.width, np.minimum), self.width, np.maximum)
+        half = self.width // 2
+        padded = np.concatenate([np.repeat(opened[:, :1], half + 1, axis=1), opened,
+                                 np.repeat(opened[:, -1:], half, axis=1)], axis=1)
+        c = np.cumsum(padded, axis=1)
+        smooth = (c[:, 2 * half + 1:] - c[:, :-2 * half - 1]) / (2 * half + 1)
+        return smooth[0] if single else smooth
+
+METHODS = dict((m.name, m) for m in (ASLS, SNIP, Rolling))
+
+def estimate(spectra, method="snip", **params):
+    """Baseline of a spectrum or batch of spectra with the named method."""
+    return METHODS[method](**params).estimate(spectra)
+
+def subtract(spectra, method="snip", **params):
+    """Returns spectra with their baseline removed."""
+    return np.asarray(spectra, dtype=np.float64) - estimate(spectra, method, **params)
+
+def bench(shots=20):
+    import spectrum_codec
+    wavelengths, spectra = spectrum_codec._synthetic_shots(shots)
+    x = np.arange(len(wavelengths))
+    continuum = 1500 + 800 * np.exp(-((x - 1800) / 900.0) ** 2) + 4000 * np.exp(-((wavelengths - 500) / 250.0) ** 2)
+    spectra = spectra - 1500 - 800 * np.exp(-((x - 1800) / 900.0) ** 2) + continuum
+    budget = 100.0 # ms per shot at 10Hz
+    print("solver: " + ("scipy solveh_banded" if solveh_banded is not None else "numpy cyclic reduction"))
+    for label, method in (("asls", ASLS()), ("asls decimate=4", ASLS(decimate=4)), ("snip", SNIP()), ("rolling", Rolling())):
+        start = time.perf_counter()
+        for s in spectra:
+            method.estimate(s)
+        single = 1000 * (time.perf_counter() - start) / shots
+        start = time.perf_counter()
+        baselines = method.estimate(spectra)
+        batch = 1000 * (time.perf_counter() - start) / shots
+        error = np.abs(baselines - continuum).mean()
+        print(label.ljust(16) + ": " + str(round(single, 2)) + " ms/shot, " + str(round(batch, 2)) + " ms/shot batched, " +
+              str(round(100 * single / budget, 1)) + "% of a 10Hz shot, mean error " + str(round(error, 1)) + " counts")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
+    else:
+        print(__doc__)
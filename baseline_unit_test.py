@@ -0,0 +1,80 @@
+import unittest
+import numpy as np
+import baseline
+
+PIXELS = 2000
+
+def continuum():
+    """A smooth quadratic continuum, rising then falling, as bremsstrahlung does across the spectrometer range."""
+    x = np.arange(PIXELS) / PIXELS
+    return 1000 + 2400 * x - 2000 * x ** 2
+
+def lines(width=2.0):
+    """Narrow emission lines of very different heights on a zero baseline."""
+    x = np.arange(PIXELS)
+    out = np.zeros(PIXELS)
+    for centre, height in ((150, 3000), (420, 200), (700, 12000), (1111, 800), (1500, 5000), (1850, 400)):
+        out += height * np.exp(-0.5 * ((x - centre) / width) ** 2)
+    return out
+
+def interior(values, margin=150):
+    return values[margin:-margin]
+
+class TestBaseline(unittest.TestCase):
+    def test_pentadiagonal_solver(self):
+        rng = np.random.RandomState(1)
+        for n in (3, 4, 9, 64, 101):
+            diagonal, first, second = baseline.second_difference_penalty(n, 1e3)
+            weights = rng.uniform(0.01, 1.0, (3, n))
+            rhs = rng.uniform(0, 1000, (3, n))
+            solved = baseline.solve_pentadiagonal(diagonal + weights, first, second, rhs)
+            for row in range(3):
+                dense = np.diag(diagonal + weights[row]) + np.diag(first, -1) + np.diag(first, 1) + \
+                        np.diag(second, -2) + np.diag(second, 2)
+                np.testing.assert_allclose(solved[row], np.linalg.solve(dense, rhs[row]), rtol=1e-8, atol=1e-6)
+            np.testing.assert_allclose(baseline.solve_pentadiagonal(diagonal + weights[0], first, second, rhs[0]),
+                                       solved[0])
+
+    def test_asls_recovers_the_continuum(self):
+        truth = continuum()
+        spectra = np.array([truth + lines(), truth + 0.5 * lines(3.0)])
+        for method in (baseline.ASLS(lam=1e7, p=0.001), baseline.ASLS(lam=1e7, p=0.001, decimate=4)):
+            estimated = method.estimate(spectra)
+            self.assertLess(np.abs(estimated - truth).max(), 25) # Under 1% of the continuum
+            np.testing.assert_allclose(method.estimate(spectra[1]), estimated[1]) # One spectrum as a batch of one
+        corrected = baseline.subtract(spectra[0], "asls", lam=1e7, p=0.001)
+        self.assertAlmostEqual(corrected[700], 12000, delta=30) # The lines keep their heights
+        self.assertAlmostEqual(corrected[420], 200, delta=30)
+
+    def test_asls_leaves_a_flat_baseline(self):
+        flat = np.full(PIXELS, 1500.0)
+        np.testing.assert_allclose(baseline.ASLS().estimate(flat), flat)
+
+    def test_snip_recovers_the_continuum(self):
+        truth = continuum()
+        estimated = baseline.SNIP(width=20).estimate(truth + lines())
+        self.assertLess(np.abs(interior(estimated - truth)).max(), 10)
+        estimated = baseline.SNIP(width=20, transform=False).estimate(truth - 2000 + lines()) # Negative counts too
+        self.assertLess(np.abs(interior(estimated - truth + 2000)).max(), 10)
+
+    def test_rolling_extremes(self):
+        data = np.random.RandomState(2).uniform(0, 100, (2, 50))
+        for width in (1, 3, 7, 51):
+            half = width // 2
+            padded = np.concatenate([np.repeat(data[:, :1], half, axis=1), data, np.repeat(data[:, -1:], half, axis=1)],
+                                    axis=1)
+            windows = np.array([padded[:, i:i + 2 * half + 1] for i in range(50)]).transpose(1, 0, 2)
+            np.testing.assert_array_equal(baseline.rolling(data, width, np.minimum), windows.min(axis=2))
+            np.testing.assert_array_equal(baseline.rolling(data, width, np.maximum), windows.max(axis=2))
+
+    def test_rolling_recovers_a_linear_continuum(self):
+        truth = 1000 + 0.75 * np.arange(PIXELS)
+        estimated = baseline.Rolling(width=51).estimate(np.array([truth + lines(), truth]))
+        np.testing.assert_allclose(interior(estimated[1]), interior(truth)) # An opening keeps straight lines exactly
+        self.assertLess(np.abs(interior(estimated[0] - truth)).max(), 10) # Only the foot of each line on the rising side is left
+
+    def test_unknown_method(self):
+        self.assertRaises(KeyError, baseline.estimate, continuum(), "polynomial")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+"""
+clock.py
+
+The time source libs_cli and core_ui sleep and timestamp with, so that timing-heavy code can be tested without waiting.
+
+RealClock is the system clock. VirtualClock is a deterministic scheduler for tests: time only moves when every thread
+it manages is asleep, and then jumps straight to the earliest wake-up. Its threads (the one that created the clock, and
+any started with start_thread) run one at a time, handing over only in sleep() and join(), so an interleaving of, say,
+the sampling thread and the laser firing is exactly reproducible and a 2 s sleep costs microseconds.
+
+Threads managed by a VirtualClock must not block on anything else (locks held across a sleep, queues, real I/O waits),
+since the other threads cannot run until they call sleep() or join(); a VirtualClockDeadlock is raised if every thread
+is waiting on a join that can never finish.
+
+"""
+import heapq
+import itertools
+import threading
+import time
+
+class RealClock():
+    """The system clock, with threads started and joined as usual."""
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def start_thread(self, target, args=(), name=None, daemon=None):
+        thread = threading.Thread(target=target, args=args, name=name, daemon=daemon)
+        thread.start()
+        return thread
+
+    def join(self, thread, timeout=None):
+        thread.join(timeout)
+
+class VirtualClockDeadlock(RuntimeError):
+    pass
+
+class _Task():
+    def __init__(self, name):
+        self.name = name
+        self.finished = False
+        self.joiners = []
+        self.error = None
+
+class VirtualClock():
+    """Virtual time starting at start seconds (monotonic) and epoch + start (wall clock, for timestamps)."""
+    def __init__(self, start=0.0, epoch=1600000000.0):
+        self.now = float(start)
+        self.epoch = epoch
+        self.cond = threading.Condition()
+        self.ready = [] # Heap of (wake time, sequence, task)
+        self.sequence = itertools.count()
+        self.tasks = {} # Thread ident to task
+        self.running = self._register("main")
+        self.deadlock = False
+        self.sleeps = 0 # Calls to sleep(), for tests
+
+    def _register(self, name):
+        task = _Task(name)
+        self.tasks[threading.get_ident()] = task
+        return task
+
+    def _current(self):
+        task = self.tasks.get(threading.get_ident())
+        if task is None:
+            raise RuntimeError("Thread " + threading.current_thread().name + " is not managed by this VirtualClock, " +
+                               "start it with start_thread()")
+        return task
+
+    def _schedule(self, task, at):
+        heapq.heappush(self.ready, (at, next(self.sequence), task))
+
+    def _switch(self):
+        """Hands over to the next task to wake up, advancing time to its wake time. Called with cond held."""
+        if not self.ready:
+            self.running = None
+            self.deadlock = any(not t.finished for t in self.tasks.values())
+            self.cond.notify_all()
+            return
+        at, n, task = heapq.heappop(self.ready)
+        self.now = max(self.now, at)
+        self.running = task
+        self.cond.notify_all()
+
+    def _wait_turn(self, task):
+        while self.running is not task:
+            if self.deadlock:
+                raise VirtualClockDeadlock("Every thread of the virtual clock is waiting on a join")
+            self.cond.wait()
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        with self.cond:
+            task = self._current()
+            self.sleeps += 1
+            self._schedule(task, self.now + max(seconds, 0.0))
+            self._switch()
+            self._wait_turn(task)
+
+    def advance(self, seconds):
+        """Lets the other threads run until virtual time has moved on by seconds."""
+        self.sleep(seconds)
+
+    def start_thread(self, target, args=(), name=None, daemon=True):
+        """Starts target(*args) on a thread managed by the clock. It first runs when the calling thread sleeps or joins."""
+        task = _Task(name or getattr(target, "__name__", "thread"))
+        started = threading.Event()
+
+        def run():
+            with self.cond:
+                self.tasks[threading.get_ident()] = task
+                started.set()
+                self._wait_turn(task)
+            try:
+                target(*args)
+            except BaseException as e:
+                task.error = e
+            finally:
+                with self.cond:
+                    task.finished = True
+                    if task.joiners:
+                        self.ready = [e for e in self.ready if e[2] not in task.joiners] # Cancel join timeouts
+                        heapq.heapify(self.ready)
+                        for joiner in task.joiners:
+                            self._schedule(joiner, self.now)
+                    self._switch()
+
+        with self.cond:
+            self._schedule(task, self.now)
+        thread = threading.Thread(target=run, name=task.name, daemon=daemon)
+        thread.task = task
+        thread.start()
+        started.wait()
+        return thread
+
+    def join(self, thread, timeout=None):
+        """Waits for a thread started with start_thread to finish, re-raising any exception it ended with."""
+        task = thread.task
+        with self.cond:
+            if not task.finished:
+                me = self._current()
+                task.joiners.append(me)
+                if timeout is not None:
+                    self._schedule(me, self.now + timeout)
+                self._switch()
+                self._wait_turn(me)
+                task.joiners.remove(me)
+        if task.finished:
+            thread.join()
+        if task.error is not None:
+            raise task.error
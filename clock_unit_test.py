@@ -0,0 +1,62 @@
+import unittest
+import time
+import clock
+import testing_utils
+
+class TestVirtualClock(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+
+    def test_threads_interleave_in_time_order(self):
+        log = []
+        def worker(name, period):
+            for i in range(3):
+                self.clock.sleep(period)
+                log.append((self.clock.monotonic(), name))
+        start = time.perf_counter()
+        a = self.clock.start_thread(worker, ("a", 1.0))
+        b = self.clock.start_thread(worker, ("b", 1.5))
+        self.clock.join(a)
+        self.clock.join(b)
+        self.assertEqual(log, [(1.0, "a"), (1.5, "b"), (2.0, "a"), (3.0, "b"), (3.0, "a"), (4.5, "b")])
+        self.assertEqual(self.clock.time(), self.clock.epoch + 4.5)
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+    def test_join_timeout(self):
+        t = self.clock.start_thread(self.clock.sleep, (10.0,))
+        self.clock.join(t, timeout=2.0)
+        self.assertEqual(self.clock.monotonic(), 2.0)
+        self.clock.join(t, timeout=20.0) # Returns as soon as the thread ends
+        self.assertEqual(self.clock.monotonic(), 10.0)
+
+    def test_errors_are_raised_by_join(self):
+        def fail():
+            self.clock.sleep(1)
+            raise ValueError("spectrometer unplugged")
+        t = self.clock.start_thread(fail)
+        with self.assertRaises(ValueError):
+            self.clock.join(t)
+
+    def test_deadlock_is_detected(self):
+        threads = []
+        threads.append(self.clock.start_thread(lambda: self.clock.join(threads[0])))
+        with self.assertRaises(clock.VirtualClockDeadlock):
+            self.clock.join(threads[0])
+
+    def test_fire_and_integration_race(self):
+        """The laser command and the integration start race as in do_sample: the shot only shows up if the laser fires
+        after the sampling thread has started integrating and before the integration ends."""
+        for latency_us in range(0, 12000, 250):
+            for integration_us in (1000, 3000, 6000, 10000):
+                c = clock.VirtualClock()
+                laser = testing_utils.SimulatedLaser(latency_us / 1e6, c.sleep, c.monotonic)
+                spec = testing_utils.SimulatedSpectrometer(laser, sleep=c.sleep)
+                spec.integration_time_micros(integration_us)
+                result = []
+                t = c.start_thread(lambda: result.append(spec.intensities()))
+                laser.fire()
+                c.join(t)
+                self.assertEqual(result[0].max() > 5000, 0 < latency_us <= integration_us, (latency_us, integration_us))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,31 +1,35 @@
+import time
+started = time.perf_counter()
 import tkinter as tk
 from tkinter import messagebox
 from tkinter import filedialog
-import seabreeze
-from seabreeze.spectrometers import Spectrometer
-import matplotlib.pyplot as plt
-import matplotlib
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import laser_control
 import random
-import pandas as pd
 import numpy as np
 import threading
-import time
+import queue
+from argparse import ArgumentParser
 import interface_config
+from spectrum_view import SpectrumView
+from device_manager import DeviceManager
+from clock import RealClock
 if interface_config.ON_BBB:
 	import Adafruit_BBIO.GPIO as GPIO # Adafruit library for safe GPIO control
 else:
 	from debug import DummyGPIO as GPIO
-from testing_utils import generate_dummy_spectra
+# matplotlib, pandas, seabreeze and laser_control are slow to import on the BeagleBone, so they are only imported once
+# the window is up (see build_plot and start_background_tasks) or when first needed.
 
+parser = ArgumentParser(description="GUI for the FLAME-T spectrometer and MicroJewel laser.")
+parser.add_argument("--subscribe", help="View the live spectrum stream of a remote libs_cli (started with --stream) at HOST[:PORT].", metavar="ADDRESS", default=None)
+parser.add_argument("--startup-time", help="Print how long the window and the plot took to appear, then exit (see scripts/startup_bench.py).", action="store_true", default=False)
+args = parser.parse_args()
 
-# laser = laser_control.Laser()
+laser = None  # the laser_control.Laser, created by start_background_tasks once laser_control is imported
+clock = RealClock()  # sleeps and background threads of the laser code go through this, see clock.py
 
 root = tk.Tk()
 root.resizable(0, 0)
 root.title("Spectrometer Tool")
-matplotlib.use("TkAgg")
 
 device_name = tk.StringVar()
 device_name.set('No Device Detected')
@@ -58,7 +62,14 @@ dark_count_var = tk.IntVar()
 dark_count_var.set(0)
 sync_fire_var = tk.IntVar()
 sync_fire_var.set(0)
-devices = seabreeze.spectrometers.list_devices()
+auto_exposure_var = tk.IntVar()
+auto_exposure_var.set(0)
+exposure_target_var = tk.StringVar()
+exposure_target_var.set('0.8')
+exposure_control = None  # auto_exposure.AutoExposure of the connected spectrometer
+device_events = queue.Queue() # Device manager events, handled on the Tk thread by poll_devices
+device_manager = DeviceManager(on_change=lambda kind, added, removed: device_events.put((kind, added, removed)))
+unplugged_serial = None # Serial number of the spectrometer that was unplugged, so the same one is reconnected
 
 
 # laser control variables
@@ -103,65 +114,232 @@ fet_drop_var.set('N/A')
 fet_src_var = tk.StringVar()
 fet_src_var.set('N/A')
 
-fig = plt.Figure(figsize=(5, 5), dpi=100)
-spectra_plot = fig.add_subplot(111)
-spectra_plot.set_ylabel('Intensity')
-spectra_plot.set_xlabel('Wavelength [nm]')
-spectra_plot.set_title('Observed Emission Spectra')
-
-emission_data = pd.DataFrame(data=None, columns=['Wavelength [nm]', 'Intensity'])
+fig = None
+spectra_plot = None
+canvas = None
+
+spectrum = SpectrumView()  # the spectrum being shown, cropped to wavelengths above 300nm
+spectrum_line = None
+raw_wavelengths = None  # wavelengths of the connected spectrometer
+shown_wavelengths = None  # wavelengths spectrum was last set to, after processing
+pipeline = None  # spectral_pipeline.Pipeline applied to every acquisition, see load_pipeline
+last_raw = None  # (wavelengths, intensities) of the last acquisition before processing, see find_similar
+recent_spectra = None  # spectrum_ring.SpectrumRing of the last acquisitions before processing, see open_recent_shots
+watchdog = None  # laser_watchdog.LaserWatchdog fed by acquireData, see start_background_tasks
+watchdog_var = tk.StringVar()
+watchdog_var.set('Off')
+processing_var = tk.StringVar()
+processing_var.set('Off')
+
+
+def build_plot():  # called once the rest of the window is on screen
+	global plt, FigureCanvasTkAgg, fig, spectra_plot, canvas
+	import matplotlib
+	matplotlib.use("TkAgg")
+	import matplotlib.pyplot as plt
+	from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+	fig = plt.Figure(figsize=(5, 5), dpi=100)
+	spectra_plot = fig.add_subplot(111)
+	spectra_plot.set_ylabel('Intensity')
+	spectra_plot.set_xlabel('Wavelength [nm]')
+	spectra_plot.set_title('Observed Emission Spectra')
+	spectra_plot.plot(0, 0)  # the spectrometer is connected once the device manager finds it, see poll_devices
+	plot_placeholder.destroy()
+	canvas = FigureCanvasTkAgg(fig, master=root)
+	canvas.get_tk_widget().grid(row=1, column=0, columnspan=2, rowspan=16)  # plot initial data
 
 
 def update_plot():  # take a fresh sample from source
 	global spec_range
 	global spec_intensity
-	global emission_data
-	dark_spec = pd.DataFrame(data=None, columns=['Wavelength [nm]', 'Intensity'])
-	if not devices:
+	if spec is None:
 		ref = messagebox.askyesno('ERROR', "Error: No device detected. \nUse Testing Data?")
 		if ref:  # refresh with sample data
-			emission_data = generate_dummy_spectra(central_spectra=(random.randint(300, 500), random.randint(500, 700),
-												   random.randint(700, 900)))
-			spectra_plot.clear()
-			spectra_plot.set_ylabel('Intensity')
-			spectra_plot.set_xlabel('Wavelength [nm]')
-			spectra_plot.set_title('Observed Emission Spectra')
-			spectra_plot.plot(emission_data.iloc[0:, 0], emission_data.iloc[0:, 1])
-			canvas.draw()
+			from testing_utils import generate_dummy_spectra
+			dummy = generate_dummy_spectra(central_spectra=(random.randint(300, 500), random.randint(500, 700),
+										   random.randint(700, 900)))
+			show_spectrum(dummy.iloc[0:, 0].values, dummy.iloc[0:, 1].values)
 
 
 	else:
 		spec.trigger_mode(trigger_mode)  # set trigger mode
 		spec.integration_time_micros(int_time)  # set integration_time
-		emission_data = \
-			pd.DataFrame(data=np.asarray([spec.wavelengths(), spec.intensities(correct_dark_counts = (dark_count_var.get() == 1))]).transpose(),
-						 columns=['Wavelength [nm]', 'Intensity'])
-		# filter data from under 300nm
-		emission_data = emission_data[emission_data > 300]
-		# update plot
+		intensities = spec.intensities(correct_dark_counts = (dark_count_var.get() == 1))
+		show_spectrum(raw_wavelengths, intensities)
+		if auto_exposure_var.get() == 1:
+			adjust_exposure(intensities)
+
+		# update settings bar
+		pixel_var.set(spec.pixels)
+		integration_limits_var.set(spec.integration_time_micros_limits)
+
+
+def show_spectrum(wavelengths, intensities):  # runs the pipeline, if one is loaded, and plots the result
+	global shown_wavelengths, last_raw, recent_spectra
+	last_raw = (wavelengths, intensities)
+	import spectrum_ring
+	if recent_spectra is None:
+		recent_spectra = spectrum_ring.SpectrumRing()
+	recent_spectra.push(wavelengths, intensities, clock.time(), int_time)
+	if pipeline is not None:
+		import spectral_pipeline
+		try:
+			wavelengths, intensities = pipeline.process(np.array(intensities, dtype=np.float64), wavelengths)
+			processing_var.set(str(round(1000 * pipeline.last_call, 2)) + ' ms')  # this spectrum, not the running average
+		except spectral_pipeline.PipelineError as e:
+			processing_var.set('Error')
+			messagebox.showerror("ERROR", "Processing failed: " + str(e))
+	if wavelengths is not shown_wavelengths:
+		spectrum.set_wavelengths(wavelengths)
+		shown_wavelengths = wavelengths
+	spectrum.update(intensities)
+	feed_waterfall(spectrum.wavelengths, spectrum.intensities)
+	draw_spectrum()
+
+
+def load_pipeline():  # loads a processing pipeline configuration, or turns processing off if one is loaded
+	global pipeline
+	import spectral_pipeline
+	if pipeline is not None:
+		pipeline = None
+		processing_var.set('Off')
+		pipeline_button['text'] = 'Load Pipeline'
+		return
+	name = filedialog.askopenfilename(initialdir="./", title="Select pipeline configuration",
+									  filetypes=(("Pipeline configuration", "*.json"), ("all files", "*.*")))
+	if not name:
+		return
+	try:
+		pipeline = spectral_pipeline.Pipeline.load(name)
+	except (OSError, ValueError, spectral_pipeline.PipelineError) as e:
+		messagebox.showerror("ERROR", "Could not load pipeline: " + str(e))
+		return
+	if spec is not None:
+		spectral_pipeline.configure_for(pipeline, spec)
+	processing_var.set('Loaded')
+	pipeline_button['text'] = 'Clear Pipeline'
+
+
+def adjust_exposure(intensities):  # sets the integration time for the next acquisition from the raw one just taken
+	global exposure_control
+	import auto_exposure
+	if exposure_control is None or exposure_control.spec is not spec:
+		exposure_control = auto_exposure.for_spectrometer(spec)
+	try:
+		target = float(exposure_target_var.get())
+		if 0 < target < 1:
+			exposure_control.target = target
+	except ValueError:
+		pass
+	converged, t = exposure_control.observe(int_time, intensities)
+	if not converged:
+		int_time_entry.set(str(t))  # update_integration_time picks this up
+
+
+def draw_spectrum():  # plots the region of interest of spectrum, reusing the line from the last frame if it is still there
+	global spectrum_line
+	if spectrum_line is None or spectrum_line not in spectra_plot.lines:
 		spectra_plot.clear()
 		spectra_plot.set_ylabel('Intensity')
 		spectra_plot.set_xlabel('Wavelength [nm]')
 		spectra_plot.set_title('Observed Emission Spectra')
-		spectra_plot.plot(emission_data.iloc[0:, 0], emission_data.iloc[0:, 1])
+		spectrum_line, = spectra_plot.plot(spectrum.x, spectrum.y)
+	else:
+		spectrum_line.set_data(spectrum.x, spectrum.y)
+	spectra_plot.relim()
+	spectra_plot.autoscale_view()
+	canvas.draw()
+	max_intensity_var.set(spectrum.max())
 
-		canvas.draw()
 
-		# update settings bar
-		pixel_var.set(spec.pixels)
-		integration_limits_var.set(spec.integration_time_micros_limits)
-		max_intensity_var.set(emission_data['Intensity'].max())
+def connect_device(device):
+	global spec, raw_wavelengths
+	from seabreeze.spectrometers import Spectrometer
+	try:
+		spec = Spectrometer(device)
+		raw_wavelengths = spec.wavelengths()
+	except Exception as e:
+		device_name.set('Error: ' + str(e))
+		return
+	device_name.set(spec.serial_number)
+	if pipeline is not None:
+		import spectral_pipeline
+		spectral_pipeline.configure_for(pipeline, spec)
+	update_plot()
+
+
+def connect_group(devices):  # opens every spectrometer as one, acquired together and stitched, see device_group.py
+	global spec, raw_wavelengths
+	import device_group
+	try:
+		spec = device_group.open_all(devices, clock)
+		raw_wavelengths = spec.wavelengths()
+	except Exception as e:
+		device_name.set('Error: ' + str(e))
+		return
+	device_name.set(spec.serial_number)
+	if pipeline is not None:
+		import spectral_pipeline
+		spectral_pipeline.configure_for(pipeline, spec)
+	update_plot()
 
 
 def reconnect_device():
-	global spec
-	if seabreeze.spectrometers.list_devices():
-		spec = seabreeze.spectrometers.Spectrometer.from_first_available()
-		device_name.set(spec.serial_number)
+	device_manager.refresh()
+	if spec is not None:
+		return
+	devices = device_manager.spectrometers()
+	if devices and all_devices_var.get() == 1:
+		connect_group(devices)
+	elif devices:
+		connect_device(devices[0])
 	else:
 		messagebox.showerror("ERROR", "ERROR: No Device Detected")
 
 
+def toggle_all_devices():  # switches between the first spectrometer and all of them
+	global spec
+	if spec is not None:
+		spec.close()
+		spec = None
+	reconnect_device()
+
+
+def device_changed(kind, added, removed):
+	global spec, unplugged_serial
+	if kind != "spectrometer":
+		return
+	if spec is not None and hasattr(spec, 'serial_numbers') and set(spec.serial_numbers) & set(removed):
+		spec.close()  # a group is reopened whole, with whichever spectrometers are plugged in then
+		spec = None
+		device_name.set('Unplugged: ' + ', '.join(set(removed)))
+	if spec is None and added and all_devices_var.get() == 1:
+		connect_group(device_manager.spectrometers())
+		return
+	if spec is not None and spec.serial_number in removed:
+		unplugged_serial = spec.serial_number
+		try:
+			spec.close()
+		except Exception:
+			pass
+		spec = None
+		device_name.set('Unplugged: ' + unplugged_serial)
+	if spec is None and added:
+		devices = dict((d.serial_number, d) for d in device_manager.spectrometers())
+		serial = unplugged_serial if unplugged_serial in added else added[0]
+		if serial in devices:
+			connect_device(devices[serial])
+
+
+def poll_devices():  # device manager callbacks arrive on its scanning thread, Tk must only be touched from this one
+	while True:
+		try:
+			device_changed(*device_events.get_nowait())
+		except queue.Empty:
+			break
+	root.after(250, poll_devices)
+
+
 def save_settings():
 	pass
 
@@ -180,14 +358,16 @@ def export_plot():
 
 
 def export_csv():
-	global emission_data
+	if spectrum.count == 0:
+		messagebox.showerror("ERROR", "ERROR: No spectrum to export")
+		return
 	try:
 		name = filedialog.asksaveasfilename(initialdir="./",
 											title="Select file",
 											filetypes=(("CSV data", "*.csv"), ("all files", "*.*")),
 											defaultextension='.csv')
 		if name:
-			emission_data.to_csv(name, index=None, header=True)
+			spectrum.to_dataframe().to_csv(name, index=None, header=True)
 		else:
 			pass
 	except ValueError:
@@ -247,7 +427,7 @@ def arm_laser():
 def fire_laser():
 	if sync_fire_var.get() == 1:
 		threading.Thread(target=update_plot)
-	time.sleep(.001)
+	clock.sleep(.001)
 	laser.fire_laser()
 
 
@@ -259,35 +439,57 @@ def emergency_stop():
 def acquireData():
 	while True:
 		status_var.set(str(laser.get_status()))
-		fet_temp_var.set(str(laser.fet_temp_check()))
-		fet_voltage_var.set(str(laser.fet_voltage_check()))
-		diode_current_var.set(str(laser.diode_current_check()))
+		readings = {"fet_temp": laser.fet_temp_check(), "fet_voltage": laser.fet_voltage_check(),
+					"diode_current": laser.diode_current_check()}
+		watchdog.observe(readings)  # trips, cutting the laser power, in this thread as soon as a reading is over its limit
+		fet_temp_var.set(str(readings["fet_temp"]))
+		fet_voltage_var.set(str(readings["fet_voltage"]))
+		diode_current_var.set(str(readings["diode_current"]))
 		resonator_temp_var.set(str(laser.resonator_temp_check()))
-		time.sleep(.01)
+		clock.sleep(.01)
+
+
+def poll_watchdog():  # the watchdog trips on the telemetry thread, the button and status are updated from this one
+	global laser_on
+	if watchdog.tripped is not None:
+		if laser_on:
+			laser_on = False
+			laser_onoff_switch['text'] = "Turn on laser"
+	watchdog_var.set(watchdog.status())  # Stopped if its checking thread died, No telemetry until acquireData reports
+	root.after(250, poll_watchdog)
 
 
-threading.Thread(target = acquireData).start()
+def reset_watchdog():
+	if watchdog.tripped is not None:
+		print("Watchdog reset after: " + watchdog.tripped.reason)
+	watchdog.reset()
+
+
+def start_background_tasks():
+	global laser_control, laser, watchdog
+	import laser_control
+	import laser_watchdog
+	try:
+		laser = laser_control.Laser()
+	except Exception as e:  # no laser attached: the watchdog shows No telemetry rather than OK
+		print("Could not connect to the laser: " + str(e))
+	watchdog = laser_watchdog.LaserWatchdog(lambda: laser, GPIO, interface_config.Laser_GPIO_pin, clock)
+	watchdog.start(poll=False)  # acquireData reads the telemetry, the watchdog only checks that it keeps arriving
+	if laser is not None:
+		clock.start_thread(acquireData)
+	poll_watchdog()
 
 
 # Spectrometer UI ______________________________________________________________________________________________________
-if not devices:
-	spectra_plot.plot(0, 0)
-else:
-	spec = seabreeze.spectrometers.Spectrometer.from_first_available()
-	emission_data = \
-		pd.DataFrame(data=np.asarray([spec.wavelengths(), spec.intensities()]).transpose(),
-					 columns=['Wavelength [nm]', 'Intensity'])
-	spectra_plot.plot(emission_data.iloc[0:, 0], emission_data.iloc[0:, 1])
-	device_name.set(spec.serial_number)
-canvas = FigureCanvasTkAgg(fig, master=root)
-canvas.get_tk_widget().grid(row=1, column=0, columnspan=2, rowspan=16)  # plot initial data
+device_name.set('Searching...')
+plot_placeholder = tk.Frame(root, width=500, height=500)  # same size as the plot, which replaces it in build_plot
+plot_placeholder.grid(row=1, column=0, columnspan=2, rowspan=16)
 
 tk.Label(root, text="Connected Device:").grid(row=0, column=0)
 tk.Label(root, textvariable=device_name, bg="White", relief=tk.GROOVE).grid(row=0, column=1, sticky="NSEW")
 
 reconnect = tk.Button(root, text="Reconnect Device", command=reconnect_device)
 reconnect.grid(row=0, column=2, columnspan=2, sticky="NSEW")
-reconnect.config(state=tk.DISABLED)
 
 tk.Label(text="Sampling Controls", relief=tk.GROOVE).grid(row=1, columnspan=2, column=2, sticky="NSEW")
 
@@ -389,6 +591,11 @@ emergency_stop_control.grid(row=13, column=7, columnspan=2, rowspan=1, sticky="N
 fire_control = tk.Button(text='Fire', bg='red', command = fire_laser)
 fire_control.grid(row=14, column=7, columnspan=2, rowspan=1, sticky="NSEW")
 
+tk.Label(text="Watchdog", relief=tk.GROOVE).grid(row=15, column=7, sticky="NSEW")
+tk.Label(textvariable=watchdog_var, relief=tk.FLAT, bg='gray', wraplength=150).grid(row=15, column=8, sticky="NSEW")
+watchdog_reset = tk.Button(text='Reset watchdog', command = reset_watchdog)
+watchdog_reset.grid(row=16, column=7, columnspan=2, rowspan=1, sticky="NSEW")
+
 tk.Label(root, text="Laser Status", relief=tk.FLAT).grid(row=0, column=7, columnspan=2, sticky="NSEW")
 
 tk.Label(root, text="Thermals", relief=tk.GROOVE).grid(row=1, column=7, columnspan=2, sticky="NSEW")
@@ -442,6 +649,377 @@ tk.Label(root, text="FET Source", relief=tk.GROOVE).grid(row=10, column=7, stick
 tk.Label(root, textvariable=fet_src_var, bg="Gray", relief=tk.FLAT, width=10).grid(row=10, column=8, sticky="NSEW")
 
 
+# Remote stream viewer _________________________________________________________________________________________________
+
+stream_rate_var = tk.StringVar()
+stream_rate_var.set('N/A')
+stream_latency_var = tk.StringVar()
+stream_latency_var.set('N/A')
+stream_frame = None  # (header, intensities) of the newest frame received, consumed by update_stream_plot
+stream_subscriber = None
+stream_line = None
+
+tk.Label(root, text="Stream Rate [frames/s]", relief=tk.GROOVE).grid(row=13, column=2, sticky="NSEW")
+tk.Label(root, textvariable=stream_rate_var, bg='gray', relief=tk.FLAT).grid(row=13, column=3, sticky="NSEW")
+
+tk.Label(root, text="Stream Latency [ms]", relief=tk.GROOVE).grid(row=14, column=2, sticky="NSEW")
+tk.Label(root, textvariable=stream_latency_var, bg='gray', relief=tk.FLAT).grid(row=14, column=3, sticky="NSEW")
+
+
+def receive_stream():
+	"""Reads frames from the publisher on a background thread. Only the newest frame is kept for drawing."""
+	global stream_frame
+	while True:
+		try:
+			header, intensities = stream_subscriber.read_frame()
+		except (OSError, ValueError):
+			status_var.set('Stream disconnected')
+			return
+		stream_frame = header, intensities.copy()
+
+
+def update_stream_plot():
+	"""Draws the newest streamed spectrum. Runs on the Tk thread every 50ms."""
+	global stream_frame, stream_line
+	frame = stream_frame
+	stream_frame = None
+	if frame is not None and stream_subscriber.wavelengths is not None:
+		header, intensities = frame
+		if stream_line is None or stream_line not in spectra_plot.lines:
+			spectra_plot.clear()
+			spectra_plot.set_ylabel('Intensity')
+			spectra_plot.set_xlabel('Wavelength [nm]')
+			spectra_plot.set_title('Streamed Emission Spectra')
+			stream_line, = spectra_plot.plot(stream_subscriber.wavelengths, intensities)
+		else:
+			stream_line.set_data(stream_subscriber.wavelengths, intensities)
+		spectra_plot.relim()
+		spectra_plot.autoscale_view()
+		canvas.draw_idle()
+		sample_var.set(header.shot_id)
+		max_intensity_var.set(intensities.max())
+		pixel_var.set(header.count)
+		if stream_subscriber.frame_rate():
+			stream_rate_var.set(round(stream_subscriber.frame_rate(), 1))
+		stream_latency_var.set(round(1000 * stream_subscriber.latency(), 2))
+	root.after(50, update_stream_plot)
+
+
+# Run browser __________________________________________________________________________________________________________
+
+run_prefetcher = None
+run_line = None
+run_name_var = tk.StringVar()
+run_name_var.set('')
+
+
+def open_run_browser():
+	"""Opens a run archive or samples directory and shows a slider to scrub through its shots."""
+	global run_prefetcher, run_line
+	import os
+	import run_archive
+	name = filedialog.askopenfilename(initialdir="./",
+									  title="Open run archive, or any sample in a samples directory",
+									  filetypes=(("Run archive", "*.lsr"), ("Samples", "*.pickle *.lsc"), ("all files", "*.*")))
+	if not name:
+		return
+	if not name.endswith(run_archive.EXTENSION):
+		name = os.path.dirname(name)
+	try:
+		run = run_archive.open_run(name)
+	except (OSError, ValueError) as e:
+		messagebox.showerror("ERROR", "Could not open run: " + str(e))
+		return
+	if not len(run):
+		messagebox.showerror("ERROR", "No shots found in " + name)
+		return
+	if run_prefetcher:
+		run_prefetcher.close()
+	run_prefetcher = run_archive.ShotPrefetcher(run)
+	run_line = None
+
+	window = tk.Toplevel(root)
+	window.title("Run: " + os.path.basename(name) + " (" + str(len(run)) + " shots)")
+	tk.Label(window, textvariable=run_name_var, width=60).pack(fill=tk.X)
+	tk.Scale(window, from_=0, to=len(run) - 1, orient=tk.HORIZONTAL, length=600, command=show_run_shot).pack(fill=tk.X)
+	show_run_shot(0)
+
+
+def show_run_shot(value):
+	"""Plots shot number value of the open run."""
+	global run_line
+	i = int(value)
+	run = run_prefetcher.run
+	timestamp, intensities = run_prefetcher.get(i)
+	if run_line is None or run_line not in spectra_plot.lines:
+		spectra_plot.clear()
+		spectra_plot.set_ylabel('Intensity')
+		spectra_plot.set_xlabel('Wavelength [nm]')
+		spectra_plot.set_title('Observed Emission Spectra')
+		run_line, = spectra_plot.plot(run.wavelengths, intensities)
+	else:
+		run_line.set_ydata(intensities)
+	spectra_plot.relim()
+	spectra_plot.autoscale_view()
+	canvas.draw_idle()
+	run_name_var.set(run.name(i) + "  (" + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)) + ")")
+	sample_var.set(str(i + 1) + " / " + str(len(run)))
+	max_intensity_var.set(intensities.max())
+
+
+open_run_button = tk.Button(root, text='Open Run', command=open_run_browser)
+open_run_button.grid(row=15, column=2, columnspan=2, sticky="NSEW")
+
+
+# Waterfall view _______________________________________________________________________________________________________
+
+waterfall_live = None  # waterfall.WaterfallImage that update_plot adds every acquired spectrum to
+waterfall_live_wavelengths = None
+
+
+def feed_waterfall(wavelengths, intensities):
+	global waterfall_live, waterfall_live_wavelengths
+	import waterfall
+	if waterfall_live is None or waterfall_live.pixels != len(intensities):
+		waterfall_live = waterfall.WaterfallImage(len(intensities))
+		waterfall_live_wavelengths = np.asarray(wavelengths)
+	waterfall_live.append(intensities)
+
+
+class WaterfallWindow():
+	"""Shot vs. wavelength image of the open run, or of the shots acquired live when no run is open.
+	Zooming in with the toolbar re-bins just the visible window at full resolution."""
+	def __init__(self, run=None):
+		from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
+		import waterfall
+		self.run = run
+		self.binner = waterfall.WaterfallBinner(run) if run is not None else None
+		self.pending = False
+		self.window = tk.Toplevel(root)
+		self.window.title("Waterfall: " + ("live" if run is None else str(len(run)) + " shots"))
+		self.fig = plt.Figure(figsize=(8, 5), dpi=100)
+		self.ax = self.fig.add_subplot(111)
+		self.ax.set_xlabel('Wavelength [nm]')
+		self.ax.set_ylabel('Shot')
+		self.canvas = FigureCanvasTkAgg(self.fig, master=self.window)
+		NavigationToolbar2Tk(self.canvas, self.window)
+		self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+		self.image = None
+		if run is not None:
+			self.wavelengths = np.asarray(run.wavelengths)
+			self.show(self.binner.image((0, len(run)), (0, len(self.wavelengths)), *self.screen_size()), 0, len(run),
+					  0, len(self.wavelengths))
+			self.ax.callbacks.connect('xlim_changed', self.on_zoom)
+			self.ax.callbacks.connect('ylim_changed', self.on_zoom)
+		else:
+			self.refresh_live()
+
+	def screen_size(self):
+		"""Size of the axes in screen pixels, which is the most detail worth binning to."""
+		bbox = self.ax.get_window_extent()
+		return max(int(bbox.height), 100), max(int(bbox.width), 100)
+
+	def show(self, data, s0, s1, p0, p1):
+		extent = (self.wavelengths[p0], self.wavelengths[p1 - 1], s1, s0)
+		if self.image is None:
+			self.image = self.ax.imshow(data, aspect='auto', extent=extent, interpolation='nearest')
+			self.ax.set_autoscale_on(False)
+		else:
+			self.image.set_data(data)
+			self.image.set_extent(extent)
+			self.image.set_clim(data.min(), data.max())
+		self.canvas.draw_idle()
+
+	def on_zoom(self, ax):
+		if not self.pending:  # x and y limits change together, only re-bin once
+			self.pending = True
+			root.after_idle(self.rebin)
+
+	def rebin(self):
+		self.pending = False
+		x0, x1 = sorted(self.ax.get_xlim())
+		y0, y1 = sorted(self.ax.get_ylim())
+		p0 = max(0, int(np.searchsorted(self.wavelengths, x0)) - 1)
+		p1 = min(len(self.wavelengths), int(np.searchsorted(self.wavelengths, x1)) + 1)
+		s0 = max(0, int(y0))
+		s1 = min(len(self.run), int(np.ceil(y1)))
+		if s1 > s0 and p1 > p0:
+			self.show(self.binner.image((s0, s1), (p0, p1), *self.screen_size()), s0, s1, p0, p1)
+
+	def refresh_live(self):
+		if not self.window.winfo_exists():
+			return
+		if waterfall_live is not None and waterfall_live.shots:
+			self.wavelengths = waterfall_live_wavelengths[::waterfall_live.fc]
+			self.ax.set_ylim(waterfall_live.shots, 0)
+			self.ax.set_xlim(self.wavelengths[0], self.wavelengths[-1])
+			self.show(waterfall_live.image(), 0, waterfall_live.shots, 0, len(self.wavelengths))
+		self.window.after(500, self.refresh_live)
+
+
+def open_waterfall():
+	WaterfallWindow(run_prefetcher.run if run_prefetcher else None)
+
+
+waterfall_button = tk.Button(root, text='Waterfall', command=open_waterfall)
+waterfall_button.grid(row=16, column=2, columnspan=2, sticky="NSEW")
+
+tk.Checkbutton(root, text="Auto Exposure, target fill:", variable=auto_exposure_var, relief=tk.FLAT)\
+	.grid(row=17, column=2, sticky="NSEW")
+tk.Entry(root, textvariable=exposure_target_var, relief=tk.FLAT, bg="white").grid(row=17, column=3, sticky="NSEW")
+
+pipeline_button = tk.Button(root, text='Load Pipeline', command=load_pipeline)
+pipeline_button.grid(row=18, column=2, sticky="NSEW")
+tk.Label(root, textvariable=processing_var, bg='gray', relief=tk.FLAT).grid(row=18, column=3, sticky="NSEW")
+
+
+
+# Similarity search ____________________________________________________________________________________________________
+
+SAMPLES_PATH = "samples/"
+INDEX_PATH = "index/"
+sample_index = None  # spectral_index.SpectralIndex of SAMPLES_PATH, loaded by the first search
+
+
+def get_sample_index():  # loads (or builds) the index the first time and adds any samples saved since
+	global sample_index
+	import spectral_index
+	if sample_index is None:
+		try:
+			sample_index = spectral_index.SpectralIndex.load(INDEX_PATH)
+		except (OSError, ValueError, KeyError, spectral_index.SpectralIndexError):
+			sample_index, failed = spectral_index.build(SAMPLES_PATH, INDEX_PATH)
+			return sample_index
+	sample_index.update(SAMPLES_PATH)
+	return sample_index
+
+
+def find_similar():  # lists the saved samples most similar to the spectrum on screen
+	if last_raw is None:
+		messagebox.showerror("ERROR", "ERROR: No spectrum to search for")
+		return
+	try:
+		index = get_sample_index()
+	except OSError as e:
+		messagebox.showerror("ERROR", "Could not load the sample index: " + str(e))
+		return
+	start = time.perf_counter()
+	results = index.search(last_raw[0], last_raw[1], 10)
+	elapsed = time.perf_counter() - start
+
+	window = tk.Toplevel(root)
+	window.title("Similar samples (" + str(len(index)) + " searched in " + str(round(1000 * elapsed, 1)) + " ms)")
+	listbox = tk.Listbox(window, width=60, height=len(results) or 1, font='TkFixedFont')
+	for name, similarity in results:
+		listbox.insert(tk.END, "{:.4f}  {}".format(similarity, name))
+	listbox.pack(fill=tk.BOTH, expand=True)
+	listbox.bind('<Double-Button-1>', lambda e: overlay_sample(results[listbox.curselection()[0]][0]) if listbox.curselection() else None)
+	tk.Label(window, text="Double click a sample to overlay it on the plot").pack(fill=tk.X)
+
+
+def overlay_sample(name):  # draws a saved sample over the current spectrum, until the plot is next cleared
+	import spectrum_codec
+	try:
+		wavelengths, intensities = spectrum_codec.load_sample(SAMPLES_PATH + name)
+	except (OSError, ValueError, EOFError, spectrum_codec.CodecError) as e:
+		messagebox.showerror("ERROR", "Could not read " + name + ": " + str(e))
+		return
+	spectra_plot.plot(wavelengths, intensities, '--', linewidth=0.8, label=name)
+	spectra_plot.legend(loc='upper right', fontsize='small')
+	canvas.draw_idle()
+
+
+similar_button = tk.Button(root, text='Find Similar', command=find_similar)
+similar_button.grid(row=19, column=2, columnspan=2, sticky="NSEW")
+
+all_devices_var = tk.IntVar()
+all_devices_var.set(0)
+tk.Checkbutton(root, text="Use all spectrometers (stitched)", variable=all_devices_var, command=toggle_all_devices,
+			   relief=tk.FLAT).grid(row=20, column=2, columnspan=2, sticky="NSEW")
+
+
+# Recent shots _________________________________________________________________________________________________________
+
+recent_listbox = None
+
+
+def open_recent_shots():  # lists the shots kept in memory, to overlay, diff or export without reloading them
+	global recent_listbox
+	if recent_spectra is None or not len(recent_spectra):
+		messagebox.showerror("ERROR", "ERROR: No shots taken yet")
+		return
+	window = tk.Toplevel(root)
+	window.title("Recent shots (last " + str(recent_spectra.capacity) + " kept)")
+	recent_listbox = tk.Listbox(window, width=60, height=15, font='TkFixedFont', selectmode=tk.EXTENDED)
+	recent_listbox.pack(fill=tk.BOTH, expand=True)
+	buttons = tk.Frame(window)
+	buttons.pack(fill=tk.X)
+	for text, command in (('Refresh', refresh_recent_shots), ('Overlay', overlay_recent_shots),
+						  ('Diff', diff_recent_shots), ('Export', export_recent_shot), ('Save All', dump_recent_shots)):
+		tk.Button(buttons, text=text, command=command).pack(side=tk.LEFT, fill=tk.X, expand=True)
+	tk.Label(window, text="Diff plots the first selected shot minus the second (or minus the newest)").pack(fill=tk.X)
+	refresh_recent_shots()
+
+
+def refresh_recent_shots():
+	recent_listbox.delete(0, tk.END)
+	for line in recent_spectra.lines(recent_spectra.capacity):
+		recent_listbox.insert(tk.END, line)
+
+
+def selected_recent_shots():  # ages of the selected shots, newest first
+	return [int(i) for i in recent_listbox.curselection()]
+
+
+def overlay_recent_shots():  # draws the selected shots over the current spectrum, until the plot is next cleared
+	for age in selected_recent_shots():
+		spectra_plot.plot(recent_spectra.wavelengths, recent_spectra.spectrum(age), '--', linewidth=0.8,
+						  label="shot -" + str(age))
+	spectra_plot.legend(loc='upper right', fontsize='small')
+	canvas.draw_idle()
+
+
+def diff_recent_shots():
+	ages = selected_recent_shots()
+	if not ages:
+		return
+	a, b = (ages[0], ages[1]) if len(ages) > 1 else (ages[0], 0)
+	spectra_plot.plot(recent_spectra.wavelengths, recent_spectra.diff(a, b), linewidth=0.8,
+					  label="shot -" + str(a) + " minus shot -" + str(b))
+	spectra_plot.legend(loc='upper right', fontsize='small')
+	canvas.draw_idle()
+
+
+def export_recent_shot():
+	ages = selected_recent_shots()
+	if not ages:
+		return
+	name = filedialog.asksaveasfilename(initialdir="./", title="Export shot -" + str(ages[0]),
+										filetypes=(("CSV data", "*.csv"), ("Compressed sample", "*.lsc"),
+												   ("Pickled sample", "*.pickle")), defaultextension='.csv')
+	if name:
+		try:
+			recent_spectra.export(ages[0], name)
+		except OSError as e:
+			messagebox.showerror("ERROR", "Could not export: " + str(e))
+
+
+def dump_recent_shots():  # writes every shot kept to a run archive, which Open Run can browse
+	import run_archive
+	name = filedialog.asksaveasfilename(initialdir="./", title="Save recent shots as a run",
+										filetypes=(("Run archive", "*" + run_archive.EXTENSION),),
+										defaultextension=run_archive.EXTENSION)
+	if name:
+		try:
+			recent_spectra.dump(name)
+		except OSError as e:
+			messagebox.showerror("ERROR", "Could not save: " + str(e))
+
+
+recent_button = tk.Button(root, text='Recent Shots', command=open_recent_shots)
+recent_button.grid(row=21, column=2, columnspan=2, sticky="NSEW")
+
+
 def update_integration_time(a, b, c):
 	global int_time
 	if not int_time_entry:
@@ -478,6 +1056,26 @@ def update_trigger_mode(a, b, c):
 
 trigger_mode_entry.trace_variable('w', update_trigger_mode)
 int_time_entry.trace_variable('w', update_integration_time)
-update_plot()
+root.update()  # show the window now, the slow part of startup happens below with it already on screen
+if args.startup_time:
+	print("First window: " + str(round(time.perf_counter() - started, 3)) + " s")
+build_plot()
+root.update()
+if args.startup_time:
+	print("Plot ready: " + str(round(time.perf_counter() - started, 3)) + " s")
+	root.destroy()
+	raise SystemExit
+if args.subscribe:
+	import spectrum_stream
+	stream_subscriber = spectrum_stream.SpectrumSubscriber(*spectrum_stream.parse_address(args.subscribe))
+	device_name.set('Stream: ' + args.subscribe)
+	refresh.config(state=tk.DISABLED)
+	threading.Thread(target=receive_stream, name="stream-receive-thread", daemon=True).start()
+	update_stream_plot()
+else:
+	device_manager.start()
+	poll_devices()
+start_background_tasks()
 
 root.mainloop()
+device_manager.stop()
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+delay_series.py
+
+Time-resolved (gate delay) acquisition. The delay from the laser pulse to the start of the spectrometer's integration is
+stepped across a range, a number of shots is taken at each delay, and the spectra go into a delays x shots x pixels
+array allocated up front, so the evolution of the plasma (the continuum dying away, lines rising and decaying) is
+mapped in one pass instead of one 'spectrometer set trigger_delay' and 'do_libs_burst' per delay. The array is float32,
+which holds the spectrometer's 16 bit counts exactly, and at most MAX_BYTES (64 MB, about 4600 shots of 3648 pixels) so
+a long series cannot run the BeagleBone out of memory.
+
+The delay is applied by libs_cli.set_trigger_delay: in EXT_EDGE mode it goes into the spectrometer's trigger delay
+register (0.5 us steps, see flame_registers.trigger_delay_cycles); in NORMAL mode do_sample starts the acquisition that
+long after firing the laser, which is only as precise as the host's sleep and USB latency. Either way the delay each
+shot actually got is recorded next to it, and that is what profiles are plotted against.
+
+A series is saved as a .npz file with the arrays wavelengths, delays (requested, us), achieved (us, delays x shots, NaN
+for shots not taken), timestamps (delays x shots) and spectra (delays x shots x pixels).
+
+Usage:
+    python3 delay_series.py info SERIES.npz
+    python3 delay_series.py profile SERIES.npz WAVELENGTH [WIDTH]   (line intensity against achieved delay)
+    python3 delay_series.py bench
+
+"""
+import sys
+import time
+
+import numpy as np
+
+EXTENSION = ".npz"
+MAX_BYTES = 64 << 20 # Largest spectra array a DelaySeries allocates
+
+def delay_steps(start, stop, step):
+    """start, start + step, ... up to and including stop, in microseconds."""
+    if step <= 0 or stop < start or start < 0:
+        raise ValueError("Delay range must have 0 <= start <= stop and a positive step")
+    return np.arange(start, stop + step / 2, step)
+
+def check_size(delays, shots, pixels):
+    """Raises ValueError if a series of delays x shots spectra of pixels would take more than MAX_BYTES."""
+    size = delays * shots * pixels * np.dtype(np.float32).itemsize
+    if size > MAX_BYTES:
+        raise ValueError("A delay series of " + str(delays) + " delays x " + str(shots) + " shots needs " +
+                         str(size >> 20) + " MB, more than the " + str(MAX_BYTES >> 20) + " MB allowed. Take fewer "
+                         "delays or shots.")
+
+class DelaySeries():
+    """Spectra of shots per delay, with the delay each one actually got. Shots not taken yet have an achieved delay
+    of NaN and zero spectra."""
+    def __init__(self, wavelengths, delays, shots):
+        self.wavelengths = np.array(wavelengths, dtype=np.float64)
+        self.delays = np.array(delays, dtype=np.float64)
+        self.shots = int(shots)
+        if self.shots < 1 or not len(self.delays):
+            raise ValueError("A delay series needs at least one delay and one shot per delay")
+        check_size(len(self.delays), self.shots, len(self.wavelengths))
+        shape = (len(self.delays), self.shots)
+        self.spectra = np.zeros(shape + (len(self.wavelengths),), dtype=np.float32)
+        self.achieved = np.full(shape, np.nan)
+        self.timestamps = np.full(shape, np.nan)
+
+    def __len__(self):
+        """Shots taken so far."""
+        return int(np.count_nonzero(~np.isnan(self.achieved)))
+
+    def record(self, i, j, intensities, achieved, timestamp):
+        """Stores shot j at delay i, taken achieved microseconds after the laser pulse."""
+        self.spectra[i, j] = intensities
+        self.achieved[i, j] = achieved
+        self.timestamps[i, j] = timestamp
+
+    def cube(self):
+        """delays x pixels mean spectrum of the shots taken at each delay (zero where none were)."""
+        taken = (~np.isnan(self.achieved)).sum(axis=1)
+        return self.spectra.sum(axis=1, dtype=np.float64) / np.maximum(taken, 1)[:, np.newaxis]
+
+    def mean_delays(self):
+        """Mean achieved delay at each delay step (NaN where no shot was taken)."""
+        taken = ~np.isnan(self.achieved)
+        with np.errstate(invalid="ignore"):
+            return np.where(taken, self.achieved, 0.0).sum(axis=1) / taken.sum(axis=1)
+
+    def profile(self, wavelength, width=1.0):
+        """(mean achieved delay, line intensity) per delay step: the counts within width/2 nm of wavelength above each
+        mean spectrum's median, summed."""
+        window = np.abs(self.wavelengths - wavelength) <= width / 2
+        if not window.any():
+            raise ValueError("No pixels within " + str(width / 2) + " nm of " + str(wavelength) + " nm")
+        cube = self.cube()
+        return self.mean_delays(), (cube[:, window] - np.median(cube, axis=1)[:, np.newaxis]).sum(axis=1)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            np.savez(f, wavelengths=self.wavelengths, delays=self.delays, achieved=self.achieved,
+                     timestamps=self.timestamps, spectra=self.spectra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            series = cls(data["wavelengths"], data["delays"], data["achieved"].shape[1])
+            series.spectra[...] = data["spectra"]
+            series.achieved[...] = data["achieved"]
+            series.timestamps[...] = data["timestamps"]
+        return series
+
+def acquire(series, set_delay, take_shot, abort=None, log=print):
+    """Fills series delay by delay. set_delay(delay) applies a delay before its shots; take_shot() returns
+    (intensities, achieved delay, timestamp), or None if the shot failed and should be left out. Stops between shots
+    if abort (a threading.Event) is set. Returns the number of shots recorded."""
+    recorded = 0
+    for i, delay in enumerate(series.delays):
+        set_delay(delay)
+        for j in range(series.shots):
+            if abort is not None and abort.is_set():
+                log("!!! Delay series aborted after " + str(recorded) + " shots.")
+                return recorded
+            shot = take_shot()
+            if shot is not None:
+                series.record(i, j, *shot)
+                recorded += 1
+        log("*** Delay " + str(delay) + " us done (" + str(i + 1) + " of " + str(len(series.delays)) + ")")
+    return recorded
+
+def bench(delays=20, shots=10, decay=20e-6):
+    import testing_utils
+    from clock import VirtualClock
+    clock = VirtualClock()
+    laser = testing_utils.SimulatedLaser(0.0, clock.sleep, clock.monotonic)
+    spec = testing_utils.SimulatedSpectrometer(laser, sleep=clock.sleep, decay=decay, now=clock.monotonic)
+    spec.integration_time_micros(1000)
+    series = DelaySeries(spec.wavelengths(), delay_steps(0, 5 * (delays - 1), 5), shots)
+    settings = {}
+
+    def take_shot(): # The NORMAL mode software delay of libs_cli.do_sample
+        laser.fire()
+        clock.sleep(settings["delay"] / 1e6)
+        achieved = 1e6 * (clock.monotonic() - laser.last_fire)
+        return spec.intensities(), achieved, clock.time()
+
+    start = time.perf_counter()
+    acquire(series, lambda d: settings.update(delay=d), take_shot, log=lambda line: None)
+    elapsed = time.perf_counter() - start
+    print(str(len(series)) + " shots (" + str(delays) + " delays x " + str(shots) + ", " + str(spec.pixels) +
+          " pixels) in " + str(round(elapsed, 3)) + " s of simulation, " +
+          str(round(series.spectra.nbytes / 1e6, 1)) + " MB allocated once")
+    start = time.perf_counter()
+    achieved, intensity = series.profile(testing_utils.SIMULATED_LINES[0][0])
+    print("profile: " + str(round(1e3 * (time.perf_counter() - start), 2)) + " ms")
+    fit = np.polyfit(achieved[intensity > 0], np.log(intensity[intensity > 0]), 1)
+    print("fitted decay: " + str(round(-1 / fit[0], 1)) + " us (simulated " + str(1e6 * decay) + " us)")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "info":
+        series = DelaySeries.load(sys.argv[2])
+        print(str(len(series.delays)) + " delays from " + str(series.delays[0]) + " to " + str(series.delays[-1]) +
+              " us, " + str(series.shots) + " shots each, " + str(len(series)) + " taken, " +
+              str(len(series.wavelengths)) + " pixels")
+    elif len(sys.argv) >= 4 and sys.argv[1] == "profile":
+        series = DelaySeries.load(sys.argv[2])
+        achieved, intensity = series.profile(float(sys.argv[3]), float(sys.argv[4]) if len(sys.argv) > 4 else 1.0)
+        for requested, d, value in zip(series.delays, achieved, intensity):
+            print(str(requested) + "\t" + str(round(d, 2)) + "\t" + str(round(value, 1)))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench()
+    else:
+        print(__doc__)
@@ -0,0 +1,51 @@
+import unittest
+import os
+import tempfile
+import threading
+import numpy as np
+import delay_series
+
+class TestDelaySeries(unittest.TestCase):
+    def setUp(self):
+        self.wavelengths = np.linspace(500, 600, 101)
+        self.series = delay_series.DelaySeries(self.wavelengths, delay_series.delay_steps(0, 2, 1), 3)
+
+    def test_missing_shots_are_left_out(self):
+        shots = iter([(np.full(101, 10.0), 0.4, 1.0), None, (np.full(101, 20.0), 0.6, 2.0)] + [None] * 6)
+        recorded = delay_series.acquire(self.series, lambda d: None, lambda: next(shots), log=lambda line: None)
+        self.assertEqual((recorded, len(self.series)), (2, 2))
+        np.testing.assert_allclose(self.series.cube()[0], 15.0)
+        np.testing.assert_allclose(self.series.cube()[1:], 0.0)
+        self.assertAlmostEqual(self.series.mean_delays()[0], 0.5)
+        self.assertTrue(np.isnan(self.series.mean_delays()[1]))
+
+    def test_abort_and_reload(self):
+        abort = threading.Event()
+        delays = []
+        def take_shot():
+            if len(delays) == 2:
+                abort.set()
+            spectrum = 100.0 * np.exp(-0.5 * ((self.wavelengths - 550) / 2) ** 2) / (1 + len(delays))
+            return spectrum, delays[-1], 0.0
+        recorded = delay_series.acquire(self.series, delays.append, take_shot, abort, log=lambda line: None)
+        self.assertEqual(recorded, 4) # The shot that set abort is kept
+        path = os.path.join(tempfile.mkdtemp(), "series.npz")
+        self.series.save(path)
+        loaded = delay_series.DelaySeries.load(path)
+        np.testing.assert_array_equal(loaded.spectra, self.series.spectra)
+        np.testing.assert_array_equal(loaded.achieved, self.series.achieved)
+        achieved, intensity = loaded.profile(550, 10)
+        np.testing.assert_allclose(achieved[:2], [0, 1])
+        self.assertAlmostEqual(intensity[0] / intensity[1], 1.5)
+        self.assertRaises(ValueError, delay_series.delay_steps, 5, 1, 1)
+
+    def test_size_is_bounded(self):
+        self.assertEqual(self.series.spectra.dtype, np.float32)
+        pixels = 3648
+        shots = delay_series.MAX_BYTES // (4 * pixels * 10)
+        delay_series.check_size(10, shots, pixels)
+        self.assertRaises(ValueError, delay_series.check_size, 10, shots + 1, pixels)
+        self.assertRaises(ValueError, delay_series.DelaySeries, np.zeros(pixels), np.arange(100), 1000)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""
+device_group.py
+
+Several spectrometers covering adjacent wavelength ranges, used as one. A DeviceGroup has the parts of the seabreeze
+Spectrometer interface libs_cli and core_ui use (wavelengths, intensities, spectrum, integration_time_micros,
+trigger_mode, ...), so it can stand in for a single spectrometer anywhere, e.g. in do_sample.
+
+Each acquisition starts one thread per device, so all of them are integrating at the same time and one laser shot
+(the trigger of acquire_all) lands in every integration window. The group only waits for the slowest device, so the added
+latency over acquiring from one device is the cost of starting the threads and stitching, well under a millisecond.
+
+The readouts are stitched onto one uniform grid (the finest pixel spacing of the devices) by linear interpolation. Where
+two devices overlap, their contributions are cross-faded linearly across the overlap, so there is no step where one
+device's range ends. The interpolation indices and blend weights only depend on the wavelength calibrations and are
+computed once, so stitching a shot is a few array operations per device.
+
+Usage:
+    python3 device_group.py bench [SHOTS]   (latency of a simulated group compared with a single device)
+
+"""
+import sys
+import time
+
+import numpy as np
+
+from clock import RealClock
+
+ARM_POLL = 0.0002 # Seconds between checks that every device has started acquiring
+ARM_DELAY = 0.001 # Seconds between the last device starting and the trigger, for the USB request to reach it
+
+class Stitcher():
+    """Merges spectra from devices with the given wavelength calibrations (each sorted ascending) onto one grid."""
+    def __init__(self, calibrations, step=None):
+        self.calibrations = [np.asarray(w, dtype=np.float64) for w in calibrations]
+        if step is None:
+            step = min(float(np.median(np.diff(w))) for w in self.calibrations)
+        start = min(w[0] for w in self.calibrations)
+        stop = max(w[-1] for w in self.calibrations)
+        self.grid = np.arange(start, stop + step / 2, step)
+        ranges = sorted((w[0], w[-1], i) for i, w in enumerate(self.calibrations))
+
+        self.parts = [] # (device, grid slice, left pixel, fraction, weight) for each device
+        total = np.zeros(len(self.grid))
+        for i, w in enumerate(self.calibrations):
+            lo = int(np.searchsorted(self.grid, w[0], side="left"))
+            hi = int(np.searchsorted(self.grid, w[-1], side="right"))
+            x = self.grid[lo:hi]
+            left = np.clip(np.searchsorted(w, x, side="right") - 1, 0, len(w) - 2)
+            fraction = (x - w[left]) / (w[left + 1] - w[left])
+            weight = np.ones(hi - lo)
+            for a, b, j in ranges: # Fade out towards the ends that overlap another device
+                if j == i:
+                    continue
+                overlap_lo, overlap_hi = max(a, w[0]), min(b, w[-1])
+                if overlap_hi <= overlap_lo:
+                    continue
+                inside = (x >= overlap_lo) & (x <= overlap_hi)
+                ramp = (x[inside] - overlap_lo) / (overlap_hi - overlap_lo)
+                weight[inside] *= ramp if a < w[0] else 1.0 - ramp # Rising where the other device is below us
+            self.parts.append((i, slice(lo, hi), left, fraction, weight))
+            total[lo:hi] += weight
+        total[total == 0] = 1.0
+        self.parts = [(i, s, left, fraction, weight / total[s]) for i, s, left, fraction, weight in self.parts]
+        self.out = np.zeros(len(self.grid))
+
+    def stitch(self, spectra):
+        """Stitches one spectrum per device (in the order of the calibrations). Returns the intensities on self.grid,
+        in an array that is reused by the next call."""
+        self.out[:] = 0.0
+        for i, s, left, fraction, weight in self.parts:
+            y = np.asarray(spectra[i], dtype=np.float64)
+            a = y[left]
+            self.out[s] += (a + (y[left + 1] - a) * fraction) * weight
+        return self.out
+
+class DeviceGroup():
+    """Spectrometers acquired together and stitched into one spectrum, ordered by their first wavelength."""
+    def __init__(self, spectrometers, clock=None, step=None):
+        if not spectrometers:
+            raise ValueError("A device group needs at least one spectrometer")
+        self.clock = clock or RealClock()
+        self.devices = sorted(spectrometers, key=lambda s: s.wavelengths()[0])
+        self.stitcher = Stitcher([s.wavelengths() for s in self.devices], step)
+        self.serial_numbers = [s.serial_number for s in self.devices]
+        self.serial_number = "+".join(self.serial_numbers)
+        self.model = "group of " + str(len(self.devices))
+        self.pixels = len(self.stitcher.grid)
+        self.integration_time_micros_limits = (max(s.integration_time_micros_limits[0] for s in self.devices),
+                                               min(s.integration_time_micros_limits[1] for s in self.devices))
+        self.max_intensity = min(getattr(s, "max_intensity", 65535) for s in self.devices)
+        self.done = None # Clock time the last device finished reading out, in the last acquisition
+        self.last_latency = None # Seconds from then to the stitched spectrum being ready
+
+    def wavelengths(self):
+        return self.stitcher.grid
+
+    def integration_time_micros(self, micros):
+        for s in self.devices:
+            s.integration_time_micros(micros)
+
+    def trigger_mode(self, mode):
+        for s in self.devices:
+            s.trigger_mode(mode)
+
+    def acquire_all(self, trigger=None, **kwargs):
+        """Starts an acquisition on every device at once, calls trigger() (e.g. laser.fire) once they have all started,
+        and returns the raw intensities of each device. kwargs are passed on to Spectrometer.intensities."""
+        results = [None] * len(self.devices)
+        errors = []
+        armed = []
+
+        def read(i, spec):
+            armed.append(i)
+            try:
+                results[i] = spec.intensities(**kwargs)
+            except Exception as e:
+                errors.append(e)
+            finished.append(self.clock.monotonic())
+
+        finished = []
+        threads = [self.clock.start_thread(read, (i, s), name="group-" + str(s.serial_number))
+                   for i, s in enumerate(self.devices)]
+        if trigger is not None:
+            while len(armed) < len(threads):
+                self.clock.sleep(ARM_POLL)
+            self.clock.sleep(ARM_DELAY)
+            trigger()
+        for t in threads:
+            self.clock.join(t)
+        if errors:
+            raise errors[0]
+        self.done = max(finished)
+        return results
+
+    def intensities(self, trigger=None, **kwargs):
+        """Acquires from every device at once and returns the stitched intensities (a new array)."""
+        spectra = self.acquire_all(trigger, **kwargs)
+        out = self.stitcher.stitch(spectra).copy()
+        self.last_latency = self.clock.monotonic() - self.done
+        return out
+
+    def spectrum(self, trigger=None, **kwargs):
+        return self.stitcher.grid, self.intensities(trigger, **kwargs)
+
+    def close(self):
+        for s in self.devices:
+            try:
+                s.close()
+            except Exception:
+                pass
+
+def open_all(devices, clock=None):
+    """Opens every seabreeze device in devices as a DeviceGroup."""
+    from seabreeze.spectrometers import Spectrometer
+    return DeviceGroup([Spectrometer(d) for d in devices], clock)
+
+def bench(shots=200):
+    import testing_utils
+    from clock import VirtualClock
+    laser = testing_utils.SimulatedLaser()
+    specs = []
+    for i, start in enumerate((200.0, 450.0, 700.0)): # Three units with 50nm overlaps, like a broadband setup
+        s = testing_utils.SimulatedSpectrometer(laser, serial_number="SIM0000" + str(i + 1), seed=i,
+                                                wavelengths=np.linspace(start, start + 300.0, 2048))
+        s.integration_time_micros(10000)
+        specs.append(s)
+
+    single = []
+    for n in range(shots):
+        start = time.perf_counter()
+        specs[0].intensities()
+        single.append(time.perf_counter() - start)
+    for count in (1, 3):
+        group = DeviceGroup(specs[:count])
+        times, stitching = [], []
+        for n in range(shots):
+            start = time.perf_counter()
+            group.intensities()
+            times.append(time.perf_counter() - start)
+        print(str(count) + " device group  : " + str(round(1e3 * (np.median(times) - np.median(single)), 3)) +
+              " ms added per acquisition over a single device (median of " + str(shots) + ", 10ms integration)")
+    start = time.perf_counter()
+    spectra = group.acquire_all()
+    for n in range(1000):
+        group.stitcher.stitch(spectra)
+    print("stitching       : " + str(round(1e3 * (time.perf_counter() - start) / 1000, 3)) + " ms for " +
+          str(group.pixels) + " output pixels")
+
+    clock = VirtualClock()
+    laser = testing_utils.SimulatedLaser(0.002, clock.sleep, clock.monotonic)
+    for s in specs:
+        s.laser, s.sleep = laser, clock.sleep
+    group = DeviceGroup(specs, clock)
+    hit = [raw.max() > 5000 for raw in group.acquire_all(trigger=laser.fire)]
+    print("one simulated laser shot seen by " + str(sum(hit)) + " of " + str(len(hit)) + " devices")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    else:
+        print(__doc__)
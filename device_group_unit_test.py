@@ -0,0 +1,115 @@
+import unittest
+import contextlib
+import io
+import types
+import numpy as np
+import clock
+import device_group
+import flame_registers_unit_test
+import testing_utils
+
+missing = None
+try:
+    import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+class RegisterSpectrometer(testing_utils.SimulatedSpectrometer):
+    """A simulated spectrometer with a FLAME-T register file behind raw_usb_bus_access, and a record of close()."""
+    def __init__(self, serial_number, wavelengths):
+        testing_utils.SimulatedSpectrometer.__init__(self, serial_number=serial_number, wavelengths=wavelengths)
+        self.f = flame_registers_unit_test.FakeSpectrometer().f
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestDeviceGroup(unittest.TestCase):
+    def setUp(self):
+        self.calibrations = [np.linspace(400, 700, 1500), np.linspace(200, 450, 1000) ** 1.001 / 200 ** 0.001]
+
+    def test_stitching_blends_overlap(self):
+        stitcher = device_group.Stitcher(self.calibrations)
+        smooth = [0.5 * w + 100 for w in self.calibrations]
+        np.testing.assert_allclose(stitcher.stitch(smooth), 0.5 * stitcher.grid + 100)
+        # A constant offset between the devices is faded across the overlap instead of stepping
+        out = stitcher.stitch([np.full(1500, 10.0), np.zeros(1000)])
+        overlap = (stitcher.grid > 400) & (stitcher.grid < self.calibrations[1][-1])
+        self.assertTrue(np.all(np.diff(out[overlap]) >= 0))
+        self.assertEqual(out[0], 0.0)
+        self.assertEqual(out[-1], 10.0)
+
+    def test_devices_integrate_together(self):
+        c = clock.VirtualClock()
+        laser = testing_utils.SimulatedLaser(0.002, c.sleep, c.monotonic)
+        specs = [testing_utils.SimulatedSpectrometer(laser, sleep=c.sleep, serial_number=str(i), wavelengths=w)
+                 for i, w in enumerate(self.calibrations)]
+        group = device_group.DeviceGroup(specs, c)
+        self.assertEqual(group.serial_numbers, ["1", "0"]) # Sorted by wavelength
+        group.integration_time_micros(10000)
+        raw = group.acquire_all(trigger=laser.fire)
+        self.assertEqual(laser.shots, 1)
+        self.assertTrue(all(r.max() > 5000 for r in raw)) # Both saw the one shot
+        self.assertAlmostEqual(c.monotonic(), 0.010) # In parallel, not one integration after the other
+        wavelengths, intensities = group.spectrum()
+        self.assertEqual(len(wavelengths), len(intensities))
+
+@unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
+class TestGroupCommands(unittest.TestCase):
+    def setUp(self):
+        self.specs = [RegisterSpectrometer("SIM0000" + str(i + 1), np.linspace(start, start + 300.0, 1000))
+                      for i, start in enumerate((200.0, 450.0))]
+        libs_cli.command_log = io.StringIO()
+        libs_cli.register_caches.clear()
+        self.stdout = io.StringIO()
+        self.output = contextlib.redirect_stdout(self.stdout)
+        self.output.__enter__()
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+        libs_cli.spectrometer = None
+        libs_cli.sample_mode = "NORMAL"
+        libs_cli.set_trigger_delay(None, 0)
+        libs_cli.register_caches.clear()
+
+    def test_register_commands_go_to_every_device(self):
+        libs_cli.spectrometer = device_group.DeviceGroup(self.specs)
+        libs_cli.handle_command("spectrometer query_settings")
+        libs_cli.handle_command("spectrometer dump_registers")
+        out = self.stdout.getvalue()
+        self.assertEqual(out.count("Pixel Count: 3648"), 2)
+        self.assertEqual(out.count("... Dumping settings register:"), 2)
+        self.assertLess(out.index("... Spectrometer SIM00001:"), out.index("... Spectrometer SIM00002:"))
+
+        libs_cli.sample_mode = "EXT_EDGE"
+        libs_cli.handle_command("spectrometer set trigger_delay 250")
+        self.assertEqual([s.f.raw_usb_bus_access.registers[0x28] for s in self.specs], [500, 500])
+        before = len(self.stdout.getvalue())
+        libs_cli.handle_command("spectrometer diff_registers")
+        self.assertEqual(self.stdout.getvalue()[before:].count("hardware_trigger_delay: 121 -> 500"), 2)
+
+    def test_failed_connect_closes_the_opened_devices(self):
+        class OpenError(Exception):
+            pass
+        def open_device(d):
+            if d == "busy":
+                raise OpenError("Device busy")
+            return self.specs[d]
+        saved = (libs_cli.seabreeze, libs_cli.SeaBreezeError, libs_cli.device_manager, libs_cli.drivers_loaded.is_set())
+        libs_cli.seabreeze = types.SimpleNamespace(spectrometers=types.SimpleNamespace(
+            list_devices=lambda: [0, "busy", 1], Spectrometer=open_device))
+        libs_cli.SeaBreezeError = OpenError
+        libs_cli.device_manager = None
+        libs_cli.drivers_loaded.set()
+        try:
+            self.assertIsNone(libs_cli.connect_all_spectrometers())
+            self.assertEqual([s.closed for s in self.specs], [True, False])
+            self.assertIn("!!! Device busy", self.stdout.getvalue())
+        finally:
+            libs_cli.seabreeze, libs_cli.SeaBreezeError, libs_cli.device_manager, loaded = saved
+            if not loaded:
+                libs_cli.drivers_loaded.clear()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+device_manager.py
+
+Background discovery of USB spectrometers and serial ports (for the laser). Enumerating devices can take a long time,
+so it is done on a background thread and the results are cached: spectrometers() and serial_ports() return straight
+away, with whatever was found by the last scan. Devices appearing or disappearing between scans are reported through
+callbacks, and a watched spectrometer is reopened automatically when it is plugged back in.
+
+"""
+import threading
+import time
+
+class DeviceManager():
+    """Keeps lists of connected spectrometers and serial ports up to date.
+
+    on_change(kind, added, removed) is called from the scanning thread whenever a scan finds a difference, where kind is
+    "spectrometer" or "serial" and added/removed are lists of serial numbers or port names. list_spectrometers,
+    list_ports and open_spectrometer replace the seabreeze and pyserial calls, e.g. with simulated devices.
+    """
+    def __init__(self, interval=2.0, ttl=5.0, on_change=None, list_spectrometers=None, list_ports=None,
+                 open_spectrometer=None):
+        self.interval = interval
+        self.ttl = ttl
+        self.on_change = on_change
+        self._list_spectrometers = list_spectrometers or _seabreeze_devices
+        self._list_ports = list_ports or _serial_ports
+        self._open_spectrometer = open_spectrometer or _open_seabreeze
+        self._spectrometers = {} # serial number -> seabreeze device
+        self._ports = {} # port name -> ListPortInfo
+        self._scanned = 0.0 # time.monotonic() of the last completed scan
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._scan_done = threading.Condition(self._lock)
+        self._running = False
+        self._thread = None
+        self._watches = {} # serial number -> callback(spectrometer, error), see watch_spectrometer
+
+    def start(self):
+        """Starts scanning on a background thread. Returns self."""
+        if not self._running:
+            self._running = True
+            self._thread = threading.Thread(target=self._scan_loop, name="device-scan-thread", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._wake.set()
+
+    def refresh(self):
+        """Asks the scanning thread to scan again now, without waiting for it."""
+        self._wake.set()
+
+    def wait_for_scan(self, timeout=None):
+        """Blocks until a scan newer than the cached one has completed. Returns False on timeout."""
+        with self._scan_done:
+            scanned = self._scanned
+            self._wake.set()
+            return self._scan_done.wait_for(lambda: self._scanned != scanned, timeout)
+
+    def stale(self):
+        return time.monotonic() - self._scanned > self.ttl
+
+    def spectrometers(self):
+        """Returns the seabreeze devices found by the last scan, without blocking. Triggers a rescan if the results are
+        older than ttl seconds."""
+        if self.stale():
+            self.refresh()
+        with self._lock:
+            return list(self._spectrometers.values())
+
+    def serial_ports(self):
+        """Returns the serial ports found by the last scan, without blocking."""
+        if self.stale():
+            self.refresh()
+        with self._lock:
+            return list(self._ports.values())
+
+    def watch_spectrometer(self, serial_number, callback):
+        """Reopens the spectrometer with this serial number whenever it is plugged back in and calls
+        callback(spectrometer, error) from the scanning thread: spectrometer is the new Spectrometer object, or None with
+        the exception in error if it could not be opened."""
+        with self._lock:
+            self._watches[serial_number] = callback
+
+    def unwatch_spectrometer(self, serial_number):
+        with self._lock:
+            self._watches.pop(serial_number, None)
+
+    def scan(self):
+        """Scans once, updating the caches and firing callbacks. Called by the scanning thread. A list that cannot be
+        read this time keeps its previous contents, rather than reporting every device as unplugged."""
+        devices = self._safe(self._list_spectrometers)
+        found = None
+        if devices is not None:
+            found = {}
+            for d in devices:
+                try:
+                    found[d.serial_number] = d
+                except Exception:
+                    continue # Device went away in the middle of the scan
+        found_ports = self._safe(self._list_ports)
+
+        with self._lock:
+            spectrometers = self._spectrometers if found is None else found
+            ports = self._ports if found_ports is None else dict((p.device, p) for p in found_ports)
+            added_specs = sorted(set(spectrometers) - set(self._spectrometers))
+            removed_specs = sorted(set(self._spectrometers) - set(spectrometers))
+            added_ports = sorted(set(ports) - set(self._ports))
+            removed_ports = sorted(set(self._ports) - set(ports))
+            first_scan = self._scanned == 0.0
+            self._spectrometers = spectrometers
+            self._ports = ports
+            self._scanned = time.monotonic()
+            watches = dict((s, self._watches[s]) for s in added_specs if s in self._watches)
+            self._scan_done.notify_all()
+
+        if self.on_change:
+            if added_specs or removed_specs:
+                self.on_change("spectrometer", added_specs, removed_specs)
+            if added_ports or removed_ports:
+                self.on_change("serial", added_ports, removed_ports)
+        if not first_scan:
+            for serial_number, callback in watches.items():
+                self._reconnect(spectrometers[serial_number], callback)
+
+    def _reconnect(self, device, callback):
+        try:
+            spec = self._open_spectrometer(device)
+        except Exception as e:
+            callback(None, e)
+            return
+        callback(spec, None)
+
+    @staticmethod
+    def _safe(lister):
+        try:
+            return lister()
+        except Exception:
+            return None
+
+    def _scan_loop(self):
+        while self._running:
+            self.scan()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+def _seabreeze_devices():
+    import seabreeze.spectrometers
+    return seabreeze.spectrometers.list_devices()
+
+def _open_seabreeze(device):
+    from seabreeze.spectrometers import Spectrometer
+    return Spectrometer(device)
+
+def _serial_ports():
+    import serial.tools.list_ports
+    return serial.tools.list_ports.comports()
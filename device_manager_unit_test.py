@@ -0,0 +1,167 @@
+import unittest
+import collections
+import contextlib
+import io
+import threading
+import device_manager
+import testing_utils
+
+missing = None
+try:
+    import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+Port = collections.namedtuple("Port", "device description")
+
+class SimulatedDevice():
+    """A seabreeze device entry for a SimulatedSpectrometer that can be plugged in and out."""
+    def __init__(self, serial_number):
+        self.serial_number = serial_number
+
+class ClosingSpectrometer(testing_utils.SimulatedSpectrometer):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class VanishingDevice():
+    """A device unplugged in the middle of a scan: reading its serial number fails."""
+    @property
+    def serial_number(self):
+        raise OSError("No such device")
+
+class TestDeviceManager(unittest.TestCase):
+    def setUp(self):
+        self.devices = []
+        self.ports = []
+        self.changes = []
+        self.fail_listing = False
+        self.fail_open = False
+        self.opened = []
+        self.manager = device_manager.DeviceManager(interval=0.01, on_change=self.on_change,
+                                                    list_spectrometers=self.list_spectrometers,
+                                                    list_ports=lambda: list(self.ports), open_spectrometer=self.open)
+
+    def tearDown(self):
+        self.manager.stop()
+
+    def on_change(self, kind, added, removed):
+        self.changes.append((kind, added, removed))
+
+    def list_spectrometers(self):
+        if self.fail_listing:
+            raise RuntimeError("USB enumeration failed")
+        return list(self.devices)
+
+    def open(self, device):
+        if self.fail_open:
+            raise OSError("Device busy")
+        spec = ClosingSpectrometer(serial_number=device.serial_number)
+        self.opened.append(spec)
+        return spec
+
+    def test_connect_and_disconnect(self):
+        self.devices.append(SimulatedDevice("SIM00001"))
+        self.ports.append(Port("/dev/ttyUSB0", "laser"))
+        self.manager.scan()
+        self.assertEqual(self.changes, [("spectrometer", ["SIM00001"], []), ("serial", ["/dev/ttyUSB0"], [])])
+        self.assertEqual([d.serial_number for d in self.manager.spectrometers()], ["SIM00001"])
+        self.assertEqual([p.device for p in self.manager.serial_ports()], ["/dev/ttyUSB0"])
+
+        self.devices.append(SimulatedDevice("SIM00002"))
+        self.devices.append(VanishingDevice())
+        self.ports.pop()
+        self.manager.scan()
+        self.assertEqual(self.changes[2:], [("spectrometer", ["SIM00002"], []), ("serial", [], ["/dev/ttyUSB0"])])
+
+        self.fail_listing = True # A failed enumeration is not every device being unplugged
+        self.manager.scan()
+        self.assertEqual(len(self.changes), 4)
+        self.assertEqual(len(self.manager.spectrometers()), 2)
+        self.fail_listing = False
+        self.devices = []
+        self.manager.scan()
+        self.assertEqual(self.changes[4:], [("spectrometer", [], ["SIM00001", "SIM00002"])])
+        self.assertEqual(self.manager.spectrometers(), [])
+
+    def test_reconnect(self):
+        callbacks = []
+        self.devices.append(SimulatedDevice("SIM00001"))
+        self.manager.watch_spectrometer("SIM00001", lambda spec, error: callbacks.append((spec, error)))
+        self.manager.scan()
+        self.assertEqual(callbacks, []) # Already there on the first scan, nothing to reopen
+
+        self.devices = []
+        self.manager.scan()
+        self.devices.append(SimulatedDevice("SIM00001"))
+        self.manager.scan()
+        self.assertEqual(callbacks, [(self.opened[0], None)])
+        wavelengths, intensities = callbacks[0][0].spectrum() # The reopened spectrometer works
+        self.assertEqual(len(intensities), 3648)
+
+        self.devices = []
+        self.manager.scan()
+        self.fail_open = True
+        self.devices.append(SimulatedDevice("SIM00001"))
+        self.manager.scan()
+        self.assertIsNone(callbacks[1][0])
+        self.assertIsInstance(callbacks[1][1], OSError)
+
+        self.manager.unwatch_spectrometer("SIM00001")
+        self.devices = []
+        self.manager.scan()
+        self.devices.append(SimulatedDevice("SIM00001"))
+        self.manager.scan()
+        self.assertEqual(len(callbacks), 2)
+
+    @unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
+    def test_cli_only_reopens_the_active_spectrometer(self):
+        saved = (libs_cli.device_manager, libs_cli.spectrometer, libs_cli.watched_serial, libs_cli.output_listeners[:])
+        lines = []
+        libs_cli.output_listeners[:] = [lines.append]
+        libs_cli.device_manager = self.manager
+        libs_cli.command_log = io.StringIO()
+        self.manager.on_change = libs_cli.device_change
+        self.devices = [SimulatedDevice("SIM00001"), SimulatedDevice("SIM00002")]
+        self.manager.scan()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                libs_cli.watch_spectrometer(ClosingSpectrometer(serial_number="SIM00001"))
+                libs_cli.spectrometer = ClosingSpectrometer(serial_number="SIM00002")
+                libs_cli.watch_spectrometer(libs_cli.spectrometer) # Replaces the first one
+                self.assertEqual(list(self.manager._watches), ["SIM00002"])
+
+                self.devices = []
+                self.manager.scan() # Unplugged
+                self.devices = [SimulatedDevice("SIM00001"), SimulatedDevice("SIM00002")]
+                self.manager.scan() # Plugged back in
+                self.assertEqual([s.serial_number for s in self.opened], ["SIM00002"])
+                self.assertIs(libs_cli.spectrometer, self.opened[0])
+                self.assertEqual(lines[-1], "*** Spectrometer SIM00002 reconnected.")
+
+                stale = ClosingSpectrometer(serial_number="SIM00001") # Opened just before the watch was replaced
+                libs_cli._spectrometer_replugged("SIM00001", stale, None)
+                self.assertTrue(stale.closed)
+                self.assertIs(libs_cli.spectrometer, self.opened[0])
+
+                libs_cli.unwatch_spectrometer()
+                self.assertEqual(self.manager._watches, {})
+                self.assertIsNone(libs_cli.watched_serial)
+        finally:
+            libs_cli.device_manager, libs_cli.spectrometer, libs_cli.watched_serial, listeners = saved
+            libs_cli.output_listeners[:] = listeners
+
+    def test_background_scanning(self):
+        plugged = threading.Event()
+        self.manager.on_change = lambda kind, added, removed: plugged.set() if added == ["SIM00003"] else None
+        self.manager.start()
+        self.assertTrue(self.manager.wait_for_scan(5))
+        self.assertFalse(self.manager.stale())
+        self.devices.append(SimulatedDevice("SIM00003"))
+        self.assertTrue(plugged.wait(5))
+        self.assertEqual([d.serial_number for d in self.manager.spectrometers()], ["SIM00003"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,52 +1,187 @@
 import unittest
-from unittest.mock import Mock
-from ujlaser.lasercontrol import Laser, LaserCommandError, LaserStatusResponse
-import time
-import libs_cli
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+from unittest import mock
+import numpy as np
+import clock
+import flame_registers_unit_test
+import sample_catalog
+import testing_utils
 
+missing = None
+try:
+    import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+@unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
 class TestDoSample(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        libs_cli.clock = self.clock
+        libs_cli.command_log = io.StringIO()
+        libs_cli.SAMPLES_PATH = tempfile.mkdtemp() + "/"
+        libs_cli.CATALOG_PATH = tempfile.mkdtemp() + "/catalog.sqlite"
+        libs_cli.sample_mode = "NORMAL"
+        libs_cli.sample_format = "pickle"
+        libs_cli.integration_time = 6000
+        libs_cli.quality_gate = None
+        libs_cli.recent_spectra = None
+        libs_cli.sample_catalog = None
+        libs_cli.catalog_failure = None
+        libs_cli.auto_exposure_enabled = False
+        libs_cli.exposure_control = None
+        libs_cli.set_trigger_delay(None, 0)
+        self.output = contextlib.redirect_stdout(io.StringIO())
+        self.output.__enter__()
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+        libs_cli.clock = clock.RealClock()
+
+    def hardware(self, latency=0.002, decay=None):
+        laser = testing_utils.SimulatedLaser(latency, self.clock.sleep, self.clock.monotonic)
+        return testing_utils.SimulatedSpectrometer(laser, sleep=self.clock.sleep, decay=decay, now=self.clock.monotonic), laser
+
     def test_typical_sample(self):
-        spec = MockSpec()
-        libs_cli.command_log = MockLog()
-        assert libs_cli.do_sample(spec, "RANDOM", 5, 4, 10) == None
-        libs_cli.do_sample(spec, "NORMAL", 5, 4, 10)
-    def test_command_loop(self):
-        libs_cli.command_log = MockLog()
-        libs_cli.laser = MockLaser()
-        libs_cli.command_loop()
-class MockSpec():
-    def __init__(self):
-        global stage_sleep_time, sleep_time
-        sleep_time = 1
-        stage_sleep_time = 1
-    def integration_time_micros(self, micros):
-        global stage_sleep_time, sleep_time
-        sleep_time = stage_sleep_time
-        stage_sleep_time = micros
-    def spectrum(self):
-        global sleep_time
-        print("Spectrometer sampling with duration "+ str(sleep_time))
-        time.sleep(sleep_time)
-        print("Finished spectrometer sampling with duration " + str(sleep_time))
-        sleep_time = stage_sleep_time
-        return [1,2,3], [1,2,3]
-
-
-class MockLog():
-    def write(self, text):
-        print(text)
-class MockLaser():
-    def set_rep_rate(self, rate):
-        print("Rep rate set to : " + str(rate))
-
-    def set_burst_count(self, rate):
-        print("Bust count set to : " + str(rate))
-    def connect(self, port):
-        print("Connected to port: " + str(port))
-    def status(self):
-        return "Status"
-    def emergency_stop(self):
-        print("Laser stopped")
+        spec, laser = self.hardware()
+        libs_cli.do_sample(spec, laser)
+        # Three FIFO clears, the settling delay, the integration, then the callback's 2 s sleep
+        self.assertAlmostEqual(self.clock.monotonic(), 3 * 0.006 + 0.5 + 0.006 + 2)
+        self.assertEqual(laser.shots, 1)
+        self.assertEqual(os.listdir(libs_cli.SAMPLES_PATH), [str(self.clock.time()) + "_SAMPLE.pickle"])
+        self.assertGreater(libs_cli._intensities.max(), 5000)
+
+    def test_software_trigger_delay(self):
+        spec, laser = self.hardware()
+        libs_cli.do_sample(spec, laser)
+        self.assertAlmostEqual(libs_cli.last_trigger_delay, -2000) # Integration started as the fire command was sent
+        self.assertEqual(libs_cli.set_trigger_delay(spec, 250.2), 250.0)
+        libs_cli.do_sample(spec, laser)
+        self.assertAlmostEqual(libs_cli.last_trigger_delay, 250.0)
+        self.assertRaises(ValueError, libs_cli.set_trigger_delay, spec, 40000)
+
+    def test_trigger_delay_follows_the_sample_mode(self):
+        spec, laser = self.hardware()
+        spec.f = flame_registers_unit_test.FakeSpectrometer().f
+        registers = spec.f.raw_usb_bus_access.registers
+        with mock.patch.object(libs_cli, "do_trigger"): # No trigger line here; the simulated spectrometer ignores it
+            libs_cli.sample_mode = "EXT_EDGE" # Switched without set_sample_mode: the register was never written
+            libs_cli.acquire_shot(spec, laser)
+            self.assertIsNone(libs_cli.last_trigger_delay)
+
+            libs_cli.sample_mode = "NORMAL"
+            libs_cli.set_trigger_delay(spec, 250)
+            self.assertEqual(registers[0x28], 0x28 * 3 + 1)
+            self.assertTrue(libs_cli.set_sample_mode(spec, "EXT_EDGE"))
+            self.assertEqual(registers[0x28], 500)
+            self.assertEqual(libs_cli.software_trigger_delay, 0)
+            libs_cli.acquire_shot(spec, laser)
+            self.assertEqual(libs_cli.last_trigger_delay, 250)
+
+        self.assertTrue(libs_cli.set_sample_mode(spec, "NORMAL"))
+        self.assertEqual(libs_cli.software_trigger_delay, 250)
+        libs_cli.do_sample(spec, laser)
+        self.assertAlmostEqual(libs_cli.last_trigger_delay, 250.0)
+
+    def test_delay_series(self):
+        spec, laser = self.hardware(latency=0, decay=20e-6)
+        libs_cli.set_trigger_delay(spec, 7)
+        series = libs_cli.do_delay_series(spec, laser, [0, 10, 20, 40], 2)
+        self.assertEqual(libs_cli.trigger_delay, 7)
+        self.assertEqual(laser.shots, 8)
+        self.assertEqual(len([n for n in os.listdir(libs_cli.SAMPLES_PATH) if n.endswith("_SERIES.npz")]), 1)
+        np.testing.assert_allclose(series.achieved, [[0, 0], [10, 10], [20, 20], [40, 40]])
+        achieved, intensity = series.profile(589.0)
+        self.assertTrue(np.all(np.diff(intensity) < 0))
+
+    def test_samples_are_catalogued(self):
+        spec, laser = self.hardware()
+        libs_cli.integration_time = 8000
+        libs_cli.do_sample(spec, laser)
+        libs_cli.integration_time = 1000 # Misses the shot, saved flagged
+        libs_cli.do_sample(spec, laser)
+        rows = libs_cli.get_sample_catalog().find()
+        self.assertEqual([(r["integration_time"], r["flagged"], r["serial"], r["source"]) for r in rows],
+                         [(1000, 1, "SIM00001", "libs"), (8000, 0, "SIM00001", "libs")])
+        self.assertEqual(rows[1]["line_count"], len(testing_utils.SIMULATED_LINES))
+        self.assertAlmostEqual(rows[1]["trigger_delay"], -2000)
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            libs_cli.handle_command("find line=589 integration_time>=6000")
+        self.assertIn(rows[1]["name"], out.getvalue())
+        self.assertIn("*** 1 samples found", out.getvalue())
+
+    def test_unsupported_catalog_is_reported_once(self):
+        spec, laser = self.hardware()
+        db = sqlite3.connect(libs_cli.CATALOG_PATH)
+        db.execute("PRAGMA user_version=99") # Written by a newer libs_cli
+        db.close()
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            libs_cli.do_sample(spec, laser)
+            libs_cli.do_sample(spec, laser)
+        errors = [l for l in out.getvalue().splitlines() if l.startswith("!!!")]
+        self.assertEqual(errors, ["!!! Samples are saved but not catalogued (" + libs_cli.CATALOG_PATH + "): " +
+                                  "Unsupported catalog version 99"])
+        self.assertEqual(len([n for n in os.listdir(libs_cli.SAMPLES_PATH) if n.endswith("_SAMPLE.pickle")]), 2)
+
+    def test_named_samples_keep_their_acquisition_time(self):
+        spec, laser = self.hardware()
+        self.clock.sleep(10)
+        taken = self.clock.time()
+        libs_cli.get_spectrum(spec, "named.pickle") # Nothing in the name to take the time from
+        rows = libs_cli.get_sample_catalog().find([("timestamp", ">=", sample_catalog.parse_time(str(taken - 1)))])
+        self.assertEqual([(r["name"], r["source"]) for r in rows], [("named.pickle", "spectrum")])
+        self.assertAlmostEqual(rows[0]["timestamp"], taken + 0.006) # Taken once the integration was over
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            libs_cli.handle_command("find since=" + str(taken - 1))
+        self.assertIn("named.pickle", out.getvalue())
+
+    def test_unavailable_mode(self):
+        spec, laser = self.hardware()
+        libs_cli.sample_mode = "RANDOM"
+        self.assertIsNone(libs_cli.do_sample(spec, laser))
+        self.assertEqual(os.listdir(libs_cli.SAMPLES_PATH), [])
+
+    def test_laser_firing_outside_integration_is_flagged(self):
+        spec, laser = self.hardware(latency=0.004)
+        libs_cli.integration_time = 1000 # Over before the fire command reaches the laser
+        libs_cli.do_sample(spec, laser)
+        self.assertEqual(len(os.listdir(libs_cli.SAMPLES_PATH)), 1)
+        self.assertIn("_FLAGGED", os.listdir(libs_cli.SAMPLES_PATH)[0])
+        self.assertEqual(libs_cli.quality_gate.reasons["no_peak"], 1)
+        self.assertEqual(libs_cli.recent_spectra.get(0)[1]["flags"], 1)
+
+    def test_exposure_checks_leave_the_integration_time(self):
+        spec, laser = self.hardware()
+        libs_cli.auto_exposure_enabled = True
+        libs_cli.integration_time = 12314
+        for i in range(10): # A laser shot's peak does not grow with the integration time, so nothing to chase
+            libs_cli.do_sample(spec, laser)
+        self.assertEqual(libs_cli.integration_time, 12314)
+        self.assertEqual(laser.shots, 10)
+        self.assertEqual(libs_cli.exposure_control.pulse, "ok")
+        self.assertNotIn("!!! Shot saturated", libs_cli.command_log.getvalue())
+
+        spec.max_intensity = 20000 # The 589 nm line now clips
+        libs_cli.exposure_control = None
+        libs_cli.do_sample(spec, laser)
+        libs_cli.do_sample(spec, laser)
+        self.assertEqual(libs_cli.integration_time, 12314) # Not cut until the window misses the pulse
+        self.assertEqual(libs_cli.command_log.getvalue().count("!!! Shot saturated"), 1) # Told once, not every shot
+        self.assertEqual(laser.shots, 12)
+
+    def test_burst_sequences(self):
+        spec, laser = self.hardware()
+        libs_cli.sample_format = "lsc"
+        self.assertEqual(libs_cli.do_burst(spec, laser, 200), 200)
+        self.assertEqual(laser.shots, 200)
+        self.assertEqual(len(os.listdir(libs_cli.SAMPLES_PATH)), 200)
+        self.assertEqual(libs_cli.quality_gate.failed, 0)
+        self.assertEqual(len(libs_cli.recent_spectra), 200)
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,195 @@
+"""
+flame_registers.py
+
+Register access for the FLAME-T over seabreeze's raw USB bus access (spec.f.raw_usb_bus_access).
+
+Reading the settings registers one at a time costs a USB write and a USB read per register. read_snapshot() instead
+sends every read request in one write and collects all of the replies in one read, then decodes them (plus the 0xFE
+status query) into a RegisterSnapshot. RegisterCache keeps the settings registers of the last snapshot until a register
+write invalidates them; the volatile registers and the status are read again every time. diff_snapshots() shows what
+changed between two snapshots.
+
+Register names are from the Ocean Optics USB4000/FLAME-T OEM data sheet.
+"""
+import binascii
+import collections
+import struct
+import time
+
+READ_REGISTER = 0x6B
+WRITE_REGISTER = 0x6A
+QUERY_STATUS = 0xFE
+
+REGISTERS = collections.OrderedDict([
+    (0x00, "master_clock_divisor"),
+    (0x04, "fpga_firmware_version"),
+    (0x08, "strobe_timer_divisor"),
+    (0x0C, "strobe_base_clock_divisor"),
+    (0x10, "integration_base_clock_divisor"),
+    (0x14, "base_clock"),
+    (0x18, "integration_clock_timer"),
+    (0x28, "hardware_trigger_delay"),
+    (0x2C, "trigger_mode"),
+    (0x38, "single_strobe_high_delay"),
+    (0x3C, "single_strobe_low_delay"),
+    (0x40, "lamp_enable"),
+    (0x48, "gpio_mux"),
+    (0x50, "gpio_output_enable"),
+    (0x54, "gpio_data"),
+    (0x74, "offset_value"),
+    (0x78, "offset_control"),
+    (0x7C, "fpga_programmed"),
+    (0x80, "max_saturation_level"),
+])
+VOLATILE_REGISTERS = [0x54] # gpio_data follows the levels on the GPIO pins, so it is never cached
+TRIGGER_DELAY_REGISTER = 0x28
+TRIGGER_DELAY_CYCLE = 0.5 # Microseconds per count of the trigger delay register (the trigger clock runs at 2 MHz)
+MAX_TRIGGER_DELAY = 0xFFFF * TRIGGER_DELAY_CYCLE
+
+STATUS_FORMAT = struct.Struct("<HI?BcB?BxxBx")
+SpectrometerStatus = collections.namedtuple("SpectrometerStatus", "pixel_count integration_time lamp_enable trigger_mode "
+                                            "spectral_status spectra_packets power_down packet_count usb_speed")
+
+class RegisterError(Exception):
+    pass
+
+class RegisterSnapshot():
+    """Values of all settings registers plus the status query, read at one point in time."""
+    def __init__(self, registers, status, timestamp=None):
+        self.registers = registers # {address: value}
+        self.status = status
+        self.time = time.time() if timestamp is None else timestamp
+
+    def __getitem__(self, name):
+        for address, n in REGISTERS.items():
+            if n == name:
+                return self.registers[address]
+        raise KeyError(name)
+
+    def lines(self):
+        """Human readable dump, one register per line: address, value and name. The value is the decoded 16 bit number in
+        hex, most significant byte first, where the old dump_settings_register printed the reply bytes as they came
+        (little-endian, so 1 was 0100)."""
+        out = []
+        for address, value in self.registers.items():
+            out.append("%02x\t%04x\t%s" % (address, value, REGISTERS.get(address, "")))
+        return out
+
+def _bus(spec):
+    return spec.f.raw_usb_bus_access
+
+def _decode_replies(addresses, output):
+    """Splits a batched reply into {address: value}. Raises RegisterError if it does not line up with the requests."""
+    if len(output) < 3 * len(addresses):
+        raise RegisterError("Short batched register read: " + str(len(output)) + " bytes")
+    values = collections.OrderedDict()
+    for n, address in enumerate(addresses):
+        reply = bytes(output[3 * n:3 * n + 3])
+        if reply[0] != address:
+            raise RegisterError("Register reply out of order: expected %02x got %s" % (address, binascii.hexlify(reply)))
+        values[address] = struct.unpack("<H", reply[1:3])[0]
+    return values
+
+def read_registers_batched(spec, addresses=None):
+    """Reads registers with one USB write and one USB read."""
+    addresses = list(REGISTERS) if addresses is None else list(addresses)
+    request = b"".join(struct.pack("<BB", READ_REGISTER, a) for a in addresses)
+    _bus(spec).raw_usb_write(request, 'primary_out')
+    output = _bus(spec).raw_usb_read(endpoint='primary_in', buffer_length=3 * len(addresses))
+    return _decode_replies(addresses, output)
+
+def read_registers_single(spec, addresses=None):
+    """Reads registers one USB round trip at a time. Slow, but works on any firmware."""
+    addresses = list(REGISTERS) if addresses is None else list(addresses)
+    values = collections.OrderedDict()
+    for a in addresses:
+        _bus(spec).raw_usb_write(struct.pack("<BB", READ_REGISTER, a), 'primary_out')
+        output = _bus(spec).raw_usb_read(endpoint='primary_in', buffer_length=3)
+        values[a] = struct.unpack("<H", bytes(output[1:3]))[0]
+    return values
+
+def read_status(spec):
+    _bus(spec).raw_usb_write(struct.pack("<B", QUERY_STATUS), 'primary_out')
+    output = _bus(spec).raw_usb_read(endpoint='primary_in', buffer_length=16)
+    return SpectrometerStatus(*STATUS_FORMAT.unpack(bytes(output)))
+
+def write_register(spec, address, value):
+    _bus(spec).raw_usb_write(struct.pack("<BBH", WRITE_REGISTER, address, value), 'primary_out')
+
+def trigger_delay_cycles(micros):
+    """Trigger delay register value for a delay in microseconds, and the delay (in microseconds) it actually gives."""
+    cycles = int(round(micros / TRIGGER_DELAY_CYCLE))
+    if not 0 <= cycles <= 0xFFFF:
+        raise ValueError("Trigger delay must be between 0 and " + str(MAX_TRIGGER_DELAY) + " microseconds")
+    return cycles, cycles * TRIGGER_DELAY_CYCLE
+
+def diff_snapshots(old, new):
+    """Returns [(name, old value, new value)] for every register or status field that differs."""
+    changes = []
+    for address, value in new.registers.items():
+        if old.registers.get(address) != value:
+            changes.append((REGISTERS.get(address, "%02x" % address), old.registers.get(address), value))
+    for field in SpectrometerStatus._fields:
+        a, b = getattr(old.status, field), getattr(new.status, field)
+        if a != b:
+            changes.append((field, a, b))
+    return changes
+
+class RegisterCache():
+    """Caches the register snapshot of one spectrometer. Writes made through write_register() invalidate it; code that
+    changes settings through seabreeze directly should call invalidate()."""
+    def __init__(self, spec):
+        self.spec = spec
+        self.current = None
+        self.previous = None # Snapshot from before the last invalidation, for diffing
+        self.batched = True # Cleared if the firmware does not answer batched reads correctly
+        self.transactions = 0
+
+    def snapshot(self, refresh=False):
+        """Returns a snapshot with the cached settings registers, reading them first if there are none or refresh is set.
+        The volatile registers and the status are always read."""
+        if self.current is None or refresh:
+            registers = self._read(list(REGISTERS))
+            status = self._read_status()
+            if self.current is not None:
+                self.previous = self.current
+        else:
+            registers = collections.OrderedDict(self.current.registers)
+            registers.update(self._read(VOLATILE_REGISTERS))
+            status = self._read_status()
+        self.current = RegisterSnapshot(registers, status)
+        return self.current
+
+    def _read(self, addresses):
+        if self.batched:
+            try:
+                registers = read_registers_batched(self.spec, addresses)
+                self.transactions += 2
+                return registers
+            except Exception: # Garbled replies (RegisterError), or USB errors from firmware that rejects batched requests
+                self.batched = False
+        registers = read_registers_single(self.spec, addresses)
+        self.transactions += 2 * len(addresses)
+        return registers
+
+    def _read_status(self):
+        status = read_status(self.spec)
+        self.transactions += 2
+        return status
+
+    def invalidate(self):
+        if self.current is not None:
+            self.previous = self.current
+        self.current = None
+
+    def write_register(self, address, value):
+        write_register(self.spec, address, value)
+        self.transactions += 1
+        self.invalidate()
+
+    def diff(self):
+        """Reads a fresh snapshot and returns its differences from the one before it ([] if there is no earlier one)."""
+        new = self.snapshot(refresh=self.current is not None)
+        if self.previous is None:
+            return []
+        return diff_snapshots(self.previous, new)
@@ -0,0 +1,96 @@
+import unittest
+import collections
+import struct
+import flame_registers
+
+class USBError(Exception):
+    """Stands in for the SeaBreezeError a USB transfer fails with."""
+
+class FakeBus():
+    """The FLAME-T end of raw_usb_bus_access: answers register reads and writes and the status query from a register
+    file. batched is "ok", "garbled" (replies to batched reads come back out of order) or "error" (they time out)."""
+    def __init__(self, batched="ok"):
+        self.batched = batched
+        self.registers = collections.OrderedDict((a, a * 3 + 1) for a in flame_registers.REGISTERS)
+        self.status = flame_registers.SpectrometerStatus(3648, 6000, False, 0, b"\x00", 15, False, 7, 0x80)
+        self.pending = b""
+        self.writes = 0
+        self.reads = 0
+
+    def raw_usb_write(self, data, endpoint):
+        self.writes += 1
+        data = bytes(data)
+        if data[0] == flame_registers.QUERY_STATUS:
+            self.pending = flame_registers.STATUS_FORMAT.pack(*self.status)
+        elif data[0] == flame_registers.WRITE_REGISTER:
+            address, value = struct.unpack("<BH", data[1:4])
+            self.registers[address] = value
+        else:
+            addresses = list(data[1::2])
+            if len(addresses) > 1 and self.batched == "error":
+                raise USBError("Data transfer error")
+            replies = [struct.pack("<BH", a, self.registers[a]) for a in addresses]
+            if len(addresses) > 1 and self.batched == "garbled":
+                replies.reverse()
+            self.pending = b"".join(replies)
+
+    def raw_usb_read(self, endpoint, buffer_length):
+        self.reads += 1
+        out, self.pending = self.pending[:buffer_length], self.pending[buffer_length:]
+        return out
+
+class FakeSpectrometer():
+    def __init__(self, batched="ok"):
+        self.f = collections.namedtuple("Features", "raw_usb_bus_access")(FakeBus(batched))
+
+class TestFlameRegisters(unittest.TestCase):
+    def test_batched_and_single_reads_agree(self):
+        spec = FakeSpectrometer()
+        batched = flame_registers.read_registers_batched(spec)
+        self.assertEqual(batched, spec.f.raw_usb_bus_access.registers)
+        self.assertEqual((spec.f.raw_usb_bus_access.writes, spec.f.raw_usb_bus_access.reads), (1, 1))
+        self.assertEqual(flame_registers.read_registers_single(spec), batched)
+        self.assertEqual(flame_registers.read_status(spec).pixel_count, 3648)
+        self.assertRaises(flame_registers.RegisterError, flame_registers.read_registers_batched,
+                          FakeSpectrometer("garbled"))
+
+    def test_trigger_delay_cycles(self):
+        self.assertEqual(flame_registers.trigger_delay_cycles(250.2), (500, 250.0))
+        self.assertEqual(flame_registers.trigger_delay_cycles(flame_registers.MAX_TRIGGER_DELAY), (0xFFFF, 32767.5))
+        self.assertRaises(ValueError, flame_registers.trigger_delay_cycles, -1)
+        self.assertRaises(ValueError, flame_registers.trigger_delay_cycles, 40000)
+
+    def test_cache_rereads_volatile_state(self):
+        spec = FakeSpectrometer()
+        bus = spec.f.raw_usb_bus_access
+        cache = flame_registers.RegisterCache(spec)
+        first = cache.snapshot()
+        self.assertEqual(first["hardware_trigger_delay"], 0x28 * 3 + 1)
+        self.assertEqual(cache.transactions, 4)
+
+        bus.registers[0x54] = 0x0F # GPIO pins changed
+        bus.registers[0x2C] = 3 # A setting changed behind the cache's back
+        bus.status = bus.status._replace(packet_count=8)
+        second = cache.snapshot()
+        self.assertEqual(second["gpio_data"], 0x0F)
+        self.assertEqual(second.status.packet_count, 8)
+        self.assertEqual(second["trigger_mode"], first["trigger_mode"]) # Settings stay cached
+        self.assertEqual(cache.transactions, 8)
+        self.assertEqual(cache.snapshot(refresh=True)["trigger_mode"], 3)
+
+        cache.write_register(flame_registers.TRIGGER_DELAY_REGISTER, 500)
+        self.assertEqual(bus.registers[0x28], 500)
+        self.assertEqual(cache.diff(), [("hardware_trigger_delay", 0x28 * 3 + 1, 500)])
+
+    def test_fallback_to_single_reads(self):
+        for mode in ("garbled", "error"):
+            spec = FakeSpectrometer(mode)
+            cache = flame_registers.RegisterCache(spec)
+            snapshot = cache.snapshot()
+            self.assertFalse(cache.batched, mode)
+            self.assertEqual(snapshot.registers, spec.f.raw_usb_bus_access.registers)
+            self.assertEqual(cache.transactions, 2 * len(flame_registers.REGISTERS) + 2)
+            self.assertEqual(snapshot.lines()[0], "00\t0001\tmaster_clock_divisor")
+
+if __name__ == "__main__":
+    unittest.main()
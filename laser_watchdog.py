@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+"""
+laser_watchdog.py
+
+Thermal and electrical safety watchdog for the laser. It keeps an eye on the laser's telemetry (FET temperature, FET
+voltage, diode current, shot count) and as soon as a reading is past its limit it trips: the laser enable GPIO
+(interface_config.Laser_GPIO_pin, which switches the 48V converter feeding the laser) is driven low first, since that is
+local and immediate, then emergency_stop() is sent over the serial port. Each trip is logged with the reading that
+caused it and how long the reaction took.
+
+Telemetry comes either from the watchdog's own polling thread, which reads the laser every poll_period seconds, or from
+whatever already polls it (core_ui's acquireData) calling observe(). Either way a reading past its limit trips the
+watchdog in the thread that delivered it, so the reaction time is bounded by the polling period plus two telemetry reads
+(the one already under way when the limit is crossed, which still returns the old value, and the next one).
+A separate checking thread trips it if no reading has arrived for max_age seconds, so a hung serial port or a laser
+that stops answering cannot leave it blind, and neither can a laser getter that raises: that trips it as well.
+
+Once tripped, the watchdog stays tripped (and ignores further readings) until reset(). With enable, the watchdog also
+owns the pin: power_on() drives it high unless the watchdog is tripped, and power_off() drives it low (libs_cli calls
+them on 'laser arm' and 'laser disarm', since nothing else there switches the converter on). Starting or resetting the
+watchdog never powers the laser. Without enable it only ever drives the pin low and switching the laser back on is left
+to its owner (core_ui's laser button).
+
+Usage:
+    python3 laser_watchdog.py bench [TRIALS]   (reaction latency against the simulated laser)
+
+"""
+import collections
+import sys
+import threading
+import time
+
+from clock import RealClock
+
+# Telemetry quantities, with the laser methods that read them: ujlaser's Laser (libs_cli), then laser_control (core_ui)
+QUANTITIES = collections.OrderedDict([
+    ("fet_temp", ("get_fet_temp", "fet_temp_check")),
+    ("fet_voltage", ("get_fet_voltage", "fet_voltage_check")),
+    ("diode_current", ("get_diode_current", "diode_current_check")),
+    ("shot_count", ("get_system_shot_count", "shot_count_check")),
+])
+DEFAULT_LIMITS = {"fet_temp": 60.0, "fet_voltage": None, "diode_current": None, "shot_count": None} # None: unchecked
+UNITS = {"fet_temp": "C", "fet_voltage": "V", "diode_current": "A", "shot_count": "shots"}
+
+Trip = collections.namedtuple("Trip", "time reason reading latency stop_latency")
+Trip.__doc__ = """A watchdog trip: wall clock time, what tripped it, the telemetry at the time, seconds from the reading
+(or from the telemetry deadline) to the GPIO being driven low, and to emergency_stop() returning."""
+
+def read_telemetry(laser, quantities=None):
+    """Reads quantities (default all) from the laser with whichever of their methods it has. Returns {name: float}."""
+    readings = {}
+    for name in quantities or QUANTITIES:
+        for method in QUANTITIES[name]:
+            if hasattr(laser, method):
+                readings[name] = float(getattr(laser, method)())
+                break
+    return readings
+
+class LaserWatchdog():
+    """Trips when a reading goes over its limit. laser is the laser, or a function returning the current one (or None),
+    so that libs_cli's watchdog follows the serialized wrapper libs_cli puts around it. gpio is the GPIO module."""
+    def __init__(self, laser, gpio, pin, clock=None, poll_period=0.1, max_age=1.0, limits=None, log=print, log_path=None,
+                 enable=False):
+        self.laser = laser
+        self.gpio = gpio
+        self.pin = pin
+        self.enable = enable
+        self.clock = clock or RealClock()
+        self.poll_period = poll_period
+        self.max_age = max_age
+        self.limits = dict(DEFAULT_LIMITS)
+        for name, value in (limits or {}).items():
+            self.set_limit(name, value)
+        self.log = log
+        self.log_path = log_path
+        self.readings = {}
+        self.received = 0 # Readings taken in since start()
+        self.last_reading = None # clock.monotonic() of the last reading
+        self.tripped = None # The Trip that is in effect, until reset()
+        self.trip_lock = threading.Lock() # Only held to claim a trip, so the polling and checking threads cannot both trip
+        self.trips = []
+        self.running = False
+        self.threads = []
+
+    def set_limit(self, name, value):
+        """Sets the upper limit on a quantity; None (or "off") stops checking it."""
+        if name not in QUANTITIES:
+            raise ValueError("Unknown quantity " + name + ", expected one of " + ", ".join(QUANTITIES))
+        self.limits[name] = None if value is None or value == "off" else float(value)
+
+    def _laser(self):
+        return self.laser() if callable(self.laser) else self.laser
+
+    def _checked_laser(self):
+        """The current laser for the watchdog's own threads. A getter that raises leaves the watchdog unable to reach the
+        laser, which trips it."""
+        try:
+            return self._laser()
+        except Exception as e:
+            self.trip("laser unavailable: " + (str(e) or type(e).__name__), self.clock.monotonic())
+            return None
+
+    def alive(self):
+        """True while started and none of its threads has died."""
+        return self.running and bool(self.threads) and all(t.is_alive() for t in self.threads)
+
+    def status(self):
+        """One line for a UI: TRIPPED with the reason, Stopped if its threads are not running, No telemetry until the
+        first reading arrives, else OK."""
+        if self.tripped is not None:
+            return "TRIPPED: " + self.tripped.reason
+        if not self.alive():
+            return "Stopped"
+        if not self.received:
+            return "No telemetry"
+        return "OK"
+
+    def start(self, poll=True):
+        """Starts the checking thread and, if poll, the polling thread. Without poll, telemetry must come from observe()."""
+        if self.running:
+            return
+        self.running = True
+        self.received = 0
+        self.gpio.setup(self.pin, self.gpio.OUT)
+        self.last_reading = self.clock.monotonic() # The first reading is due within max_age of starting
+        self.threads = [self.clock.start_thread(self._check_loop, name="watchdog-check", daemon=True)]
+        if poll:
+            self.threads.append(self.clock.start_thread(self._poll_loop, name="watchdog-poll", daemon=True))
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            self.clock.join(t, self.max_age + self.poll_period)
+        self.threads = []
+
+    def reset(self):
+        """Clears a trip so the laser can be enabled again with power_on(). Readings are checked again from the next
+        one."""
+        self.tripped = None
+        self.last_reading = self.clock.monotonic()
+
+    def power_on(self):
+        """With enable, drives the pin high unless the watchdog is tripped. Returns True if it did."""
+        with self.trip_lock: # A trip claimed meanwhile drives the pin low after this, never before
+            if not self.enable or self.tripped is not None:
+                return False
+            self.gpio.setup(self.pin, self.gpio.OUT)
+            self.gpio.output(self.pin, self.gpio.HIGH)
+            return True
+
+    def power_off(self):
+        """Drives the pin low."""
+        self.gpio.setup(self.pin, self.gpio.OUT)
+        self.gpio.output(self.pin, self.gpio.LOW)
+
+    def violations(self, readings):
+        """[(quantity, value, limit)] for every reading over its limit."""
+        return [(name, readings[name], limit) for name, limit in self.limits.items()
+                if limit is not None and name in readings and readings[name] > limit]
+
+    def observe(self, readings):
+        """Takes in telemetry readings ({quantity: value}) and trips if any is over its limit. Returns the Trip if it did."""
+        now = self.clock.monotonic()
+        self.readings = dict(readings)
+        self.received += 1
+        self.last_reading = now
+        over = self.violations(self.readings)
+        if over and self.tripped is None:
+            reason = ", ".join(name + " " + str(value) + " " + UNITS[name] + " > " + str(limit)
+                               for name, value, limit in over)
+            return self.trip(reason, now)
+        return None
+
+    def trip(self, reason, since):
+        """Disables the laser: GPIO low, then emergency_stop(). since is the clock.monotonic() the reaction is timed from."""
+        with self.trip_lock:
+            if self.tripped is not None:
+                return None
+            self.tripped = Trip(self.clock.time(), reason, dict(self.readings), None, None) # Completed below
+        self.gpio.output(self.pin, self.gpio.LOW)
+        latency = self.clock.monotonic() - since
+        error = None
+        try:
+            laser = self._laser()
+            if laser is not None:
+                laser.emergency_stop()
+        except Exception as e: # The GPIO has already cut the power, keep going
+            error = e
+        trip = Trip(self.clock.time(), reason, dict(self.readings), latency, self.clock.monotonic() - since)
+        self.tripped = trip
+        self.trips.append(trip)
+        line = "!!! Laser watchdog tripped: " + reason + ". Laser disabled in " + str(round(1e3 * latency, 2)) + \
+            " ms, stopped in " + str(round(1e3 * trip.stop_latency, 2)) + " ms" + \
+            ("" if error is None else " (emergency stop failed: " + str(error) + ")") + \
+            ". Readings: " + ", ".join(k + "=" + str(v) for k, v in sorted(trip.reading.items()))
+        self.log(line)
+        if self.log_path is not None:
+            try:
+                with open(self.log_path, "a") as f:
+                    f.write(str(trip.time) + " " + line + "\n")
+            except OSError:
+                pass
+        return trip
+
+    def _poll_loop(self):
+        while self.running:
+            laser = self._checked_laser()
+            if laser is not None:
+                try:
+                    self.observe(read_telemetry(laser, [n for n, limit in self.limits.items() if limit is not None]))
+                except Exception: # Missing readings are caught by the checking thread once they are max_age old
+                    pass
+            self.clock.sleep(self.poll_period)
+
+    def _check_loop(self):
+        while self.running:
+            age = self.clock.monotonic() - self.last_reading
+            if age > self.max_age and self.tripped is None and self._checked_laser() is not None:
+                self.trip("no telemetry for " + str(round(age, 2)) + " s", self.last_reading + self.max_age)
+            self.clock.sleep(min(self.poll_period, self.max_age) / 2)
+
+    def report(self):
+        """Lines describing the limits, the latest readings and the trips, for the CLI."""
+        lines = ["Watchdog " + ("running" if self.running else "stopped") + ", " +
+                 ("TRIPPED: " + self.tripped.reason if self.tripped else "not tripped") +
+                 " (poll every " + str(self.poll_period) + " s, telemetry timeout " + str(self.max_age) + " s)"]
+        for name in QUANTITIES:
+            limit = self.limits[name]
+            lines.append("\t" + name + ": " + str(self.readings.get(name, "-")) + " (limit " +
+                         ("off" if limit is None else str(limit) + " " + UNITS[name]) + ")")
+        for trip in self.trips[-5:]:
+            lines.append("\t" + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(trip.time)) + "  " + trip.reason +
+                         "  (" + str(round(1e3 * trip.latency, 2)) + " ms)")
+        return lines
+
+class _RecordingGPIO():
+    """GPIO stand-in for the bench: remembers each pin's level and when it was last driven low."""
+    OUT = "OUT"
+    LOW = "LOW"
+    HIGH = "HIGH"
+
+    def __init__(self, now):
+        self.now = now
+        self.low_at = {}
+        self.levels = {}
+
+    def setup(self, pin, mode):
+        pass
+
+    def output(self, pin, value):
+        self.levels[pin] = value
+        if value == self.LOW:
+            self.low_at[pin] = self.now()
+
+def bench(trials=50, poll_period=0.01, read_latency=0.002):
+    """Real-time reaction latency: the simulated laser's FET temperature is raised past the limit at a random point and
+    the time until the GPIO goes low is measured."""
+    import random
+    import testing_utils
+    clock = RealClock()
+    gpio = _RecordingGPIO(clock.monotonic)
+    laser = testing_utils.SimulatedLaser(now=clock.monotonic, telemetry_latency=read_latency)
+    watchdog = LaserWatchdog(laser, gpio, "P9_42", clock, poll_period, max_age=1.0, log=lambda line: None)
+    watchdog.start()
+    latencies = []
+    for i in range(trials):
+        laser.fet_temp = 30.0
+        time.sleep(2 * (poll_period + read_latency)) # Let any read of the old value finish
+        watchdog.reset()
+        time.sleep(random.uniform(0, poll_period))
+        crossed = clock.monotonic()
+        laser.fet_temp = 75.0
+        while watchdog.tripped is None:
+            time.sleep(0.0005)
+        latencies.append(gpio.low_at["P9_42"] - crossed)
+    watchdog.stop()
+    latencies.sort()
+    print(str(trials) + " trips, polling every " + str(1e3 * poll_period) + " ms with " + str(1e3 * read_latency) +
+          " ms telemetry reads: median " + str(round(1e3 * latencies[len(latencies) // 2], 2)) + " ms, worst " +
+          str(round(1e3 * latencies[-1], 2)) + " ms (bound " + str(round(1e3 * (poll_period + 2 * read_latency), 2)) +
+          " ms plus scheduling)")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+    else:
+        print(__doc__)
@@ -0,0 +1,162 @@
+import unittest
+import contextlib
+import io
+import tempfile
+import threading
+import time
+import clock
+import laser_watchdog
+import testing_utils
+
+missing = None
+try:
+    import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+class BrokenLaser(testing_utils.SimulatedLaser):
+    def get_fet_temp(self):
+        raise IOError("No reply from the laser")
+
+class TestLaserWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.clock = clock.VirtualClock()
+        self.gpio = laser_watchdog._RecordingGPIO(self.clock.monotonic)
+        self.lines = []
+
+    def watchdog(self, laser, **kwargs):
+        return laser_watchdog.LaserWatchdog(laser, self.gpio, "P9_42", self.clock, poll_period=0.01, max_age=0.5,
+                                            log=self.lines.append, **kwargs)
+
+    def test_trips_within_bound(self):
+        laser = testing_utils.SimulatedLaser(sleep=self.clock.sleep, now=self.clock.monotonic, telemetry_latency=0.002)
+        watchdog = self.watchdog(laser, limits={"diode_current": 120})
+        watchdog.start()
+        self.clock.sleep(0.1053)
+        self.assertIsNone(watchdog.tripped)
+        crossed = self.clock.monotonic()
+        laser.fet_temp = 75.0
+        self.clock.sleep(0.1)
+        watchdog.stop()
+        self.assertEqual(len(watchdog.trips), 1)
+        self.assertIn("fet_temp 75.0 C > 60.0", watchdog.tripped.reason)
+        self.assertEqual(watchdog.tripped.reading, {"fet_temp": 75.0, "diode_current": 100.0})
+        self.assertLessEqual(self.gpio.low_at["P9_42"] - crossed, 0.01 + 2 * 0.004) # Two reads of two quantities
+        self.assertLessEqual(self.gpio.low_at["P9_42"], laser.stopped_at) # Power is cut before the serial stop
+        self.assertEqual(len(self.lines), 1)
+
+    def test_trips_when_telemetry_stops(self):
+        watchdog = self.watchdog(BrokenLaser(sleep=self.clock.sleep, now=self.clock.monotonic))
+        watchdog.start()
+        self.clock.sleep(1.0)
+        watchdog.stop()
+        self.assertIn("no telemetry", watchdog.tripped.reason)
+        self.assertGreater(self.gpio.low_at["P9_42"], 0.5)
+        self.assertLessEqual(watchdog.tripped.latency, 0.005)
+
+    def test_trips_when_the_laser_getter_fails(self):
+        def laser():
+            raise NameError("name 'laser' is not defined")
+        watchdog = self.watchdog(laser)
+        watchdog.start()
+        self.clock.sleep(0.05)
+        self.assertEqual(watchdog.status(), "TRIPPED: laser unavailable: name 'laser' is not defined")
+        self.assertTrue(watchdog.alive()) # Both threads keep running
+        watchdog.stop()
+        self.assertEqual(self.gpio.levels["P9_42"], "LOW")
+        self.assertIn("emergency stop failed", self.lines[0])
+
+    def test_status(self):
+        watchdog = self.watchdog(None)
+        self.assertEqual(watchdog.status(), "Stopped")
+        watchdog.start(poll=False)
+        self.assertEqual(watchdog.status(), "No telemetry")
+        watchdog.observe({"fet_temp": 30.0})
+        self.assertEqual(watchdog.status(), "OK")
+        watchdog.stop()
+        self.assertEqual(watchdog.status(), "Stopped")
+
+    def test_observed_telemetry_and_reset(self):
+        watchdog = self.watchdog(None, enable=True)
+        watchdog.start(poll=False)
+        self.assertNotEqual(self.gpio.levels.get("P9_42"), "HIGH") # Only an explicit power_on() enables the laser
+        self.assertTrue(watchdog.power_on())
+        self.assertEqual(self.gpio.levels["P9_42"], "HIGH")
+        self.assertRaises(ValueError, watchdog.set_limit, "resonator_temp", 50)
+        watchdog.set_limit("fet_temp", "off")
+        watchdog.set_limit("shot_count", 1e6)
+        self.assertIsNone(watchdog.observe({"fet_temp": 90.0, "shot_count": 10}))
+        self.assertIsNotNone(watchdog.observe({"shot_count": 1000001}))
+        self.assertEqual(self.gpio.levels["P9_42"], "LOW")
+        self.assertIsNone(watchdog.observe({"shot_count": 1000002})) # Already tripped
+        self.assertFalse(watchdog.power_on())
+        watchdog.reset()
+        self.assertEqual(self.gpio.levels["P9_42"], "LOW")
+        self.assertTrue(watchdog.power_on())
+        self.assertIsNotNone(watchdog.observe({"shot_count": 1000003}))
+        self.assertEqual(len(watchdog.trips), 2)
+        self.assertEqual(self.gpio.levels["P9_42"], "LOW")
+        watchdog.stop()
+        self.assertFalse(self.watchdog(None).power_on()) # Without enable the pin is someone else's
+
+@unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
+class TestCliLaserPower(unittest.TestCase):
+    def setUp(self):
+        self.gpio = laser_watchdog._RecordingGPIO(time.monotonic)
+        self.saved_gpio = libs_cli.GPIO
+        libs_cli.GPIO = self.gpio
+        libs_cli.watchdog = None
+        libs_cli.command_log = io.StringIO()
+        libs_cli.LOG_PATH = tempfile.mkdtemp() + "/" # Trips are logged to WATCHDOG.log there
+        libs_cli.laser = libs_cli.serialize_laser(testing_utils.SimulatedLaser())
+        self.stdout = io.StringIO()
+        self.output = contextlib.redirect_stdout(self.stdout)
+        self.output.__enter__()
+
+    def tearDown(self):
+        self.output.__exit__(None, None, None)
+        libs_cli.GPIO = self.saved_gpio
+        libs_cli.watchdog = None
+        libs_cli.laser = None
+
+    def test_enable_line_follows_arm_and_disarm(self):
+        pin = libs_cli.interface_config.Laser_GPIO_pin
+        watchdog = libs_cli.get_watchdog()
+        watchdog.start(poll=False)
+        self.assertNotIn(pin, self.gpio.levels) # Connecting and starting the watchdog leave the laser unpowered
+        libs_cli.handle_command("laser arm")
+        self.assertEqual(self.gpio.levels[pin], "HIGH")
+        self.assertTrue(libs_cli.laser.armed)
+        libs_cli.handle_command("laser disarm")
+        self.assertEqual(self.gpio.levels[pin], "LOW")
+
+        watchdog.trip("fet_temp 75.0 C > 60.0", time.monotonic())
+        libs_cli.handle_command("laser arm")
+        self.assertEqual(self.gpio.levels[pin], "LOW")
+        self.assertFalse(libs_cli.laser.armed)
+        self.assertIn("!!! Laser watchdog tripped: fet_temp 75.0 C > 60.0", self.stdout.getvalue())
+        libs_cli.handle_command("watchdog reset")
+        self.assertEqual(self.gpio.levels[pin], "LOW")
+        libs_cli.handle_command("laser arm")
+        self.assertEqual(self.gpio.levels[pin], "HIGH")
+        watchdog.stop()
+
+    def test_watchdog_waits_for_laser_commands(self):
+        held = threading.Event()
+        released = []
+        def busy(): # A laser command from the command path
+            with libs_cli.laser_lock:
+                held.set()
+                time.sleep(0.05)
+                released.append(time.monotonic())
+        t = threading.Thread(target=busy)
+        t.start()
+        held.wait()
+        laser_watchdog.read_telemetry(libs_cli.get_watchdog()._laser())
+        read = time.monotonic()
+        t.join()
+        self.assertGreaterEqual(read, released[0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,260 @@
+"""
+libs_async.py
+
+asyncio event loop core for libs_cli. CLI input, spectrometer acquisition, laser I/O, telemetry polling and sample
+persistence each run as their own task or executor, so a long burst keeps running while the operator issues commands
+such as 'status' or 'laser stop'. Blocking hardware calls never run on the event loop thread itself, and the input task
+never waits for a command to finish (except 'exit'), so 'laser stop' is read even while a slow command is running.
+A command asking a question (e.g. the file name of 'spectrometer spectrum') gets the next line typed as its answer.
+
+"""
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Commands that can take a long time and are run as a cancellable acquisition task
+ACQUISITION_COMMANDS = ["do_libs_sample", "do_libs_burst", "do_delay_series", "spectrometer auto_exposure"]
+# Short commands that use the spectrometer, and so wait for a running acquisition to be done with it
+SPECTROMETER_COMMANDS = ["spectrometer", "pipeline dark", "do_trigger"]
+
+def matches(parts, commands):
+    """True if the command line split into parts is one of commands, given by its first word or first two words."""
+    return bool(parts) and (parts[0] in commands or " ".join(parts[0:2]) in commands)
+
+class SerializedLaser():
+    """Wraps a Laser so that calls from the different executors never talk over each other on the serial port.
+    emergency_stop() only waits stop_timeout seconds for the port. If another thread is stuck in the middle of a laser
+    command, on_stall (e.g. libs_cli.laser_power_off, which cuts the laser's power) is called so the laser still stops
+    within a bounded time, and the serial stop is sent as soon as the port is free, never in the middle of another
+    command."""
+    def __init__(self, laser, lock, stop_timeout, on_stall=None):
+        self._laser = laser
+        self._lock = lock
+        self._stop_timeout = stop_timeout
+        self._on_stall = on_stall
+
+    def __getattr__(self, name):
+        attr = getattr(self._laser, name)
+        if not callable(attr):
+            return attr
+        def locked_call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked_call
+
+    def emergency_stop(self):
+        if not self._lock.acquire(timeout=self._stop_timeout):
+            if self._on_stall is not None:
+                self._on_stall()
+            self._lock.acquire()
+        try:
+            return self._laser.emergency_stop()
+        finally:
+            self._lock.release()
+
+class LibsEventLoop():
+    """Runs the libs_cli command set on an asyncio event loop.
+
+    cli is the libs_cli module (passed in so that running libs_cli as __main__ does not import a second copy of it).
+    """
+    def __init__(self, cli, telemetry_period=1.0, stop_timeout=0.05):
+        self.cli = cli
+        self.telemetry_period = telemetry_period
+        self.stop_timeout = stop_timeout
+        self.loop = asyncio.new_event_loop()
+        self.laser_lock = cli.laser_lock # Shared with libs_cli's own laser users, such as the watchdog
+        self.spectrometer_lock = threading.Lock() # Held by the acquisition and by short commands using the spectrometer
+
+        self.input_executor = ThreadPoolExecutor(1) # input() blocks, so it gets a thread of its own
+        self.command_executor = ThreadPoolExecutor(1) # Short commands, run one at a time in the order they were typed
+        self.spectrometer_executor = ThreadPoolExecutor(1) # Short spectrometer commands, which may wait for the acquisition
+        self.acquisition_executor = ThreadPoolExecutor(1) # Samples and bursts
+        self.laser_executor = ThreadPoolExecutor(1) # Telemetry polling
+        self.stop_executor = ThreadPoolExecutor(1) # Reserved for emergency stops so they never queue behind anything
+        self.persist_executor = ThreadPoolExecutor(1) # Disk writes
+
+        self.acquisition = None # asyncio future of the acquisition currently running, if any
+        self.commands = set() # asyncio tasks of the short commands (and stops) that have not finished yet
+        self.prompts = collections.deque() # concurrent.futures.Future of each command waiting for an answer, oldest first
+        self.input_closed = False
+        self.last_stop_latency = None
+
+    def run(self):
+        """Runs the event loop until the user exits. Blocks."""
+        asyncio.set_event_loop(self.loop)
+        self.cli.sample_writer = self.persist
+        self.cli.prompt_input = self.ask
+        tasks = [asyncio.ensure_future(self._input_task(), loop=self.loop),
+                 asyncio.ensure_future(self._telemetry_task(), loop=self.loop)]
+        try:
+            self.loop.run_until_complete(tasks[0])
+        finally:
+            for t in tasks:
+                t.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.close_input()
+            if self.commands:
+                self.loop.run_until_complete(asyncio.wait(list(self.commands)))
+            self.shutdown()
+
+    def shutdown(self):
+        """Waits for pending disk writes and stops every executor."""
+        self.cli.sample_writer = None
+        self.cli.prompt_input = None
+        self.persist_executor.shutdown(wait=True)
+        for e in (self.command_executor, self.spectrometer_executor, self.acquisition_executor, self.laser_executor,
+                  self.stop_executor):
+            e.shutdown(wait=True)
+        self.input_executor.shutdown(wait=False) # input() may still be blocked waiting on the terminal
+        self.loop.close()
+
+    async def _input_task(self):
+        while self.cli.running:
+            try:
+                c = await self.loop.run_in_executor(self.input_executor, input, "?")
+            except EOFError:
+                self.close_input()
+                c = "exit"
+            c = c.strip()
+            if self.prompts and c != "laser stop":
+                self.prompts.popleft().set_result(c) # Logged by libs_cli.ask
+                continue
+            self.cli.log_input("?" + c)
+            await self.dispatch(c)
+
+    def ask(self, text):
+        """prompt_input hook for libs_cli, called on a command's thread: the next line typed answers the question instead
+        of being run as a command ('laser stop' excepted). Raises EOFError if input has ended."""
+        answer = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(self._add_prompt, answer)
+        print(text, end="", flush=True)
+        return answer.result()
+
+    def _add_prompt(self, answer):
+        if self.input_closed:
+            answer.set_exception(EOFError("No more input to answer the prompt with"))
+        else:
+            self.prompts.append(answer)
+
+    def close_input(self):
+        """Called once no more lines will be read: fails every prompt still waiting for an answer."""
+        self.input_closed = True
+        while self.prompts:
+            self.prompts.popleft().set_exception(EOFError("No more input to answer the prompt with"))
+
+    async def dispatch(self, c):
+        """Routes a single command line to the right task or executor. Only 'exit' is waited for, everything else keeps
+        running after dispatch returns (see self.commands and self.acquisition)."""
+        parts = c.split()
+        if c == "laser stop":
+            self._start(self.stop_laser())
+        elif c == "cancel":
+            self.cancel_acquisition()
+        elif matches(parts, ACQUISITION_COMMANDS):
+            if self.busy():
+                self.cli.print_cli("!!! An acquisition is already running. Use 'cancel' or 'laser stop' to end it first.")
+                return
+            self.acquisition = self.loop.run_in_executor(self.acquisition_executor, self._locked, self.spectrometer_lock,
+                                                         self.cli.handle_command, c)
+            self.acquisition.add_done_callback(self._acquisition_done)
+        elif c in ("exit", "quit"):
+            if self.busy():
+                self.cancel_acquisition()
+                await asyncio.wait([self.acquisition])
+            await self.run_command(self.command_executor, c)
+        elif matches(parts, SPECTROMETER_COMMANDS):
+            self._start(self.run_command(self.spectrometer_executor, c, self.spectrometer_lock))
+        else:
+            self._start(self.run_command(self.command_executor, c))
+
+    def _start(self, coro):
+        task = asyncio.ensure_future(coro, loop=self.loop)
+        self.commands.add(task)
+        task.add_done_callback(self.commands.discard)
+        return task
+
+    async def run_command(self, executor, c, lock=None):
+        """Runs a short command on executor, holding lock if given. A command that fails is reported, not raised, so
+        it cannot take the event loop down with it."""
+        try:
+            await self.loop.run_in_executor(executor, self._locked, lock, self.cli.handle_command, c)
+        except Exception as e:
+            self.cli.print_cli("!!! Command '" + c + "' failed: " + type(e).__name__ + ": " + str(e))
+        self._wrap_laser()
+
+    def _locked(self, lock, function, *args):
+        if lock is None:
+            return function(*args)
+        if not lock.acquire(blocking=False):
+            self.cli.print_cli("*** Waiting for the spectrometer...")
+            lock.acquire()
+        try:
+            return function(*args)
+        finally:
+            lock.release()
+
+    def busy(self):
+        """Returns True if an acquisition is in progress."""
+        return self.acquisition is not None and not self.acquisition.done()
+
+    def cancel_acquisition(self):
+        """Asks the running acquisition to stop. The shot in progress is allowed to finish and be saved."""
+        self.cli.sample_abort.set()
+        if self.busy():
+            self.cli.print_cli("*** Cancelling acquisition after the current shot...")
+
+    def _acquisition_done(self, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            self.cli.print_cli("!!! Acquisition failed: " + type(fut.exception()).__name__ + ": " + str(fut.exception()))
+        self._wrap_laser()
+
+    async def stop_laser(self):
+        """Stops the laser from the dedicated stop executor and ends any running acquisition."""
+        self.cli.sample_abort.set()
+        if self.cli.check_laser(self.cli.laser):
+            return
+        self._wrap_laser()
+        start = time.monotonic()
+        try:
+            await self.loop.run_in_executor(self.stop_executor, self.cli.laser.emergency_stop)
+        except Exception as e:
+            self.cli.print_cli("!!! Emergency stop failed: " + type(e).__name__ + ": " + str(e))
+            return
+        self.last_stop_latency = time.monotonic() - start
+        self.cli.print_cli("*** Laser stopped (" + str(round(self.last_stop_latency * 1000, 1)) + " ms)")
+
+    def _wrap_laser(self):
+        if self.cli.laser is not None and not isinstance(self.cli.laser, SerializedLaser):
+            self.cli.laser = SerializedLaser(self.cli.laser, self.laser_lock, self.stop_timeout, self.cli.laser_power_off)
+
+    async def _telemetry_task(self):
+        while True:
+            self._wrap_laser()
+            laser = self.cli.laser
+            if laser is not None:
+                try:
+                    readings = await self.loop.run_in_executor(self.laser_executor, self._read_telemetry, laser)
+                    self.cli.telemetry.update(readings)
+                except Exception as e:
+                    self.cli.debug_log("Telemetry poll failed: " + str(e))
+            await asyncio.sleep(self.telemetry_period)
+
+    @staticmethod
+    def _read_telemetry(laser):
+        return {"fet_temp": laser.get_fet_temp(),
+                "diode_current": laser.get_diode_current(),
+                "shot_count": laser.get_system_shot_count(),
+                "time": time.time()}
+
+    def persist(self, filename, data, settings=None, timestamp=None):
+        """sample_writer hook for libs_cli: queues the write on the disk executor."""
+        self.persist_executor.submit(self._write, filename, data, settings, timestamp)
+
+    def _write(self, filename, data, settings=None, timestamp=None):
+        try:
+            self.cli.write_sample_file(filename, data, settings, timestamp)
+        except OSError as e:
+            self.cli.print_cli("!!! Failed to save " + filename + ": " + str(e))
@@ -0,0 +1,198 @@
+import unittest
+import asyncio
+import contextlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+from unittest import mock
+import clock
+import libs_async
+import testing_utils
+
+missing = None
+try:
+    import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+SPEEDUP = 100
+
+class FastClock(clock.RealClock):
+    """The system clock with every sleep SPEEDUP times shorter, so the 2.5 s of settling in a sample takes 25 ms. The
+    event loop's executors are real threads, which a clock.VirtualClock cannot schedule."""
+    def sleep(self, seconds):
+        time.sleep(seconds / SPEEDUP)
+
+class FaultyLaser(testing_utils.SimulatedLaser):
+    def get_diode_current(self):
+        raise RuntimeError("no answer from the laser")
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.001)
+
+class TestSerializedLaser(unittest.TestCase):
+    def test_stop_waits_for_the_port_and_cuts_power_meanwhile(self):
+        laser = testing_utils.SimulatedLaser()
+        lock = threading.RLock()
+        stalls = []
+        wrapped = libs_async.SerializedLaser(laser, lock, 0.01, lambda: stalls.append(time.perf_counter()))
+        wrapped.arm()
+        self.assertTrue(laser.armed)
+
+        held = threading.Event()
+        released = []
+        def busy(): # Another thread in the middle of a slow laser command
+            with lock:
+                held.set()
+                time.sleep(0.1)
+                released.append(time.perf_counter())
+        t = threading.Thread(target=busy)
+        t.start()
+        held.wait()
+        start = time.perf_counter()
+        wrapped.emergency_stop()
+        t.join()
+        self.assertEqual(len(stalls), 1)
+        self.assertLess(stalls[0] - start, 0.05) # Power cut within about stop_timeout
+        self.assertGreaterEqual(laser.stopped_at, released[0]) # The serial stop only once the port was free
+        self.assertFalse(laser.armed)
+
+        wrapped.emergency_stop() # Free port: no power cut
+        self.assertEqual(len(stalls), 1)
+
+@unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
+class TestLibsEventLoop(unittest.TestCase):
+    def setUp(self):
+        libs_cli.clock = FastClock()
+        libs_cli.command_log = io.StringIO()
+        libs_cli.SAMPLES_PATH = tempfile.mkdtemp() + "/"
+        libs_cli.CATALOG_PATH = tempfile.mkdtemp() + "/catalog.sqlite"
+        libs_cli.running = True
+        libs_cli.sample_mode = "NORMAL"
+        libs_cli.sample_format = "pickle"
+        libs_cli.integration_time = 6000
+        libs_cli.quality_gate = None
+        libs_cli.recent_spectra = None
+        libs_cli.sample_catalog = None
+        libs_cli.auto_exposure_enabled = False
+        libs_cli.set_trigger_delay(None, 0)
+        self.laser = testing_utils.SimulatedLaser(0.002, libs_cli.clock.sleep)
+        libs_cli.laser = self.laser
+        libs_cli.spectrometer = testing_utils.SimulatedSpectrometer(self.laser)
+        self.events = libs_async.LibsEventLoop(libs_cli, telemetry_period=0.01)
+        self.stdout = io.StringIO()
+        self.output = contextlib.redirect_stdout(self.stdout)
+        self.output.__enter__()
+
+    def tearDown(self):
+        if not self.events.loop.is_closed():
+            self.finish()
+        self.events.shutdown()
+        self.output.__exit__(None, None, None)
+        libs_cli.clock = clock.RealClock()
+        libs_cli.laser = None
+        libs_cli.spectrometer = None
+        libs_cli.prompt_input = None
+
+    def run_loop(self, coro):
+        return self.events.loop.run_until_complete(coro)
+
+    def finish(self):
+        """Runs the loop until every command and the acquisition have finished."""
+        pending = list(self.events.commands)
+        if self.events.acquisition is not None:
+            pending.append(self.events.acquisition)
+        if pending:
+            self.run_loop(asyncio.wait(pending, timeout=10))
+
+    def saved(self):
+        return [n for n in os.listdir(libs_cli.SAMPLES_PATH) if n.endswith("_SAMPLE.pickle")]
+
+    def test_dispatch_runs_commands_alongside_acquisition(self):
+        self.run_loop(self.events.dispatch("do_libs_burst 3"))
+        self.assertTrue(self.events.busy())
+        self.run_loop(self.events.dispatch("status"))
+        self.run_loop(asyncio.wait(list(self.events.commands)))
+        self.assertTrue(self.events.busy()) # status did not wait for the burst
+        self.assertIn("Simulated laser", self.stdout.getvalue())
+        self.run_loop(self.events.dispatch("do_libs_sample"))
+        self.assertIn("!!! An acquisition is already running", self.stdout.getvalue())
+        self.finish()
+        self.assertEqual(self.laser.shots, 3)
+        self.assertEqual(len(self.saved()), 3)
+        self.assertIsInstance(libs_cli.laser, libs_async.SerializedLaser)
+
+    def test_spectrometer_commands_wait_for_the_acquisition(self):
+        self.run_loop(self.events.dispatch("do_libs_burst 2"))
+        self.run_loop(self.events.dispatch("spectrometer set integration_time 8000"))
+        self.finish()
+        self.assertIn("*** Waiting for the spectrometer...", self.stdout.getvalue())
+        log = self.stdout.getvalue()
+        self.assertLess(log.rindex("Burst sample 2 of 2"), log.index("Integration time set to 8000"))
+        self.assertEqual(len(self.saved()), 2)
+
+    def test_cancel_and_stop(self):
+        self.run_loop(self.events.dispatch("do_libs_burst 100"))
+        self.run_loop(asyncio.sleep(0.1))
+        self.run_loop(self.events.dispatch("cancel"))
+        self.finish()
+        self.assertIn("!!! Burst aborted", self.stdout.getvalue())
+        self.assertLess(self.laser.shots, 100)
+
+        shots = self.laser.shots
+        self.run_loop(self.events.dispatch("do_libs_burst 100"))
+        self.run_loop(asyncio.sleep(0.1))
+        self.run_loop(self.events.dispatch("laser stop"))
+        self.finish()
+        self.assertIsNotNone(self.laser.stopped_at)
+        self.assertLess(self.events.last_stop_latency, 0.5)
+        self.assertLess(self.laser.shots - shots, 100)
+        self.assertIn("*** Laser stopped", self.stdout.getvalue())
+
+    def test_failing_command_is_reported(self):
+        libs_cli.laser = FaultyLaser()
+        self.run_loop(self.events.dispatch("laser get diode_current"))
+        self.finish()
+        self.assertIn("!!! Command 'laser get diode_current' failed: RuntimeError: no answer from the laser",
+                      self.stdout.getvalue())
+        self.run_loop(self.events.dispatch("status")) # The loop is still usable
+        self.finish()
+        self.assertIn("Laser:", self.stdout.getvalue())
+
+    def test_prompt_takes_the_next_line(self):
+        lines = queue.Queue()
+        libs_cli.prompt_input = self.events.ask
+        def feed():
+            lines.put("spectrometer spectrum")
+            wait_for(lambda: self.events.prompts)
+            lines.put("laser stop") # Still run as a command while the prompt waits
+            wait_for(lambda: self.laser.stopped_at is not None)
+            lines.put("named.pickle")
+            wait_for(lambda: os.path.exists(libs_cli.SAMPLES_PATH + "named.pickle"))
+            lines.put("exit")
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        with mock.patch("builtins.input", lambda prompt: lines.get(timeout=10)):
+            self.run_loop(self.events._input_task())
+        feeder.join()
+        self.assertFalse(libs_cli.running)
+        self.assertIn("?:named.pickle", libs_cli.command_log.getvalue())
+
+    def test_persist_finishes_on_shutdown(self):
+        data = libs_cli.spectrometer.spectrum()
+        filename = libs_cli.SAMPLES_PATH + "persisted.pickle"
+        self.events.persist(filename, data, {"source": "spectrum"})
+        self.events.shutdown()
+        self.assertTrue(os.path.exists(filename))
+        self.assertEqual(libs_cli.get_sample_catalog().names(), {"persisted.pickle"})
+
+if __name__ == "__main__":
+    unittest.main()
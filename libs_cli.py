@@ -6,7 +6,6 @@ This is a command line interface to run a minimal LIBS test using an OceanOptics
 run on a BeagleBone Black.
 
 """
-import struct
 import pathlib
 import readline
 import threading
@@ -15,37 +14,104 @@ import time
 import pickle
 import platform
 import serial
-import binascii
+import serial.tools.list_ports
 import math
-
-import seabreeze
-seabreeze.use('cseabreeze') # Select the cseabreeze backend for consistency
-from seabreeze.spectrometers import Spectrometer
-from seabreeze.cseabreeze._wrapper import SeaBreezeError
+import sys
 
 if platform.system() == "Linux":
     import Adafruit_BBIO.GPIO as GPIO
 else:
     from gpio_spoof import DummyGPIO as GPIO # This is for debugging purposes
 
-from ujlaser.lasercontrol import Laser, LaserCommandError
+import flame_registers
+import interface_config
+from clock import RealClock
+from device_manager import DeviceManager
 
 running = True
 verbose = False
 spectrometer = None
 laser = None
 devices = []
+clock = RealClock() # Sleeps, timestamps and sampling threads go through this; tests swap in a clock.VirtualClock
+device_manager = None # DeviceManager scanning for spectrometers and serial ports in the background, started by main()
+watched_serial = None # Serial number of the spectrometer the device manager reopens when it is plugged back in
 
 command_log = None # File handle to the log file that we will store list of command queries
 SD_CARD_PATH = './sample/'  # needs to be set before testing
 LOG_PATH = "logs/"
 SAMPLES_PATH = "samples/"
+INDEX_PATH = "index/" # spectral_index.SpectralIndex of the saved samples, see the 'search' command
+CATALOG_PATH = INDEX_PATH + "catalog.sqlite" # sample_catalog.Catalog of the saved samples, see the 'find' command
 
 # Global settings variables
 laserSingleShot = True
 sample_mode = "NORMAL"
 external_trigger_pin = "P8_26"
 integration_time = 6000
+trigger_delay = 0 # Microseconds from the laser pulse to the start of integration, see set_trigger_delay
+software_trigger_delay = 0 # The part of trigger_delay that do_sample waits for itself (in NORMAL mode there is no hardware trigger)
+last_trigger_delay = None # Delay the last sample actually got, in microseconds (negative if integration started before the pulse)
+programmed_trigger_delay = None # (spectrometer, microseconds) last written to the trigger delay register, see set_trigger_delay
+sample_format = "pickle" # "pickle" or "lsc" (compressed, see spectrum_codec.py)
+SAMPLE_FORMATS = {"pickle": ".pickle", "lsc": ".lsc"} # spectrum_codec.EXTENSION, without importing numpy at startup
+
+sample_abort = threading.Event() # Set by 'laser stop' to end a running burst between shots
+sample_writer = None # Optional callable(path, data, settings) used to hand samples off to a background writer (see libs_async)
+prompt_input = None # Optional callable(text) that reads the answer to a prompt instead of input(), see ask()
+telemetry = {} # Latest laser telemetry readings, filled in by the telemetry task in libs_async
+output_listeners = [] # Callables that get a copy of every line printed with cli_print (see libs_server)
+register_caches = {} # flame_registers.RegisterCache of each connected spectrometer, by serial number
+stream_publisher = None # spectrum_stream.SpectrumPublisher that every acquired spectrum is sent to, if streaming is enabled
+exposure_control = None # auto_exposure.AutoExposure of the connected spectrometer
+auto_exposure_enabled = False # Check the exposure of every sample, see 'set auto_exposure' and adjust_exposure()
+pipeline = None # spectral_pipeline.Pipeline that spectra go through before they are streamed, see 'pipeline load'
+quality_gate = None # shot_quality.QualityGate that every shot is checked by before it is saved, see 'quality'
+sample_index = None # spectral_index.SpectralIndex, loaded by the first 'search' and kept up to date as samples are saved
+sample_catalog = None # sample_catalog.Catalog at CATALOG_PATH, opened by the first save or 'find'
+catalog_failure = None # Last error cataloguing a sample failed with, told to the operator once rather than every sample
+recent_spectra = None # spectrum_ring.SpectrumRing of the last RECENT_CAPACITY shots, see the 'recent' command
+RECENT_CAPACITY = 256
+watchdog = None # laser_watchdog.LaserWatchdog, started when a laser connects, see the 'watchdog' command
+laser_lock = threading.RLock() # Held for every laser command, so the command path, the watchdog and telemetry take turns on the serial port
+LASER_STOP_TIMEOUT = 0.05 # Seconds 'laser stop' waits for the serial port before cutting the laser's power
+
+# The hardware drivers are imported by load_drivers() after the arguments are parsed, on a background thread, since
+# importing seabreeze alone takes several seconds on the BeagleBone. Until then the exception types are placeholders.
+class DriversNotLoaded(Exception):
+    pass
+
+seabreeze = None
+Spectrometer = None
+SeaBreezeError = DriversNotLoaded
+Laser = None
+LaserCommandError = DriversNotLoaded
+drivers_loaded = threading.Event()
+drivers_lock = threading.Lock()
+
+def load_drivers():
+    """Imports seabreeze (selecting the cseabreeze backend) and the laser driver, if that has not been done yet."""
+    global seabreeze, Spectrometer, SeaBreezeError, Laser, LaserCommandError
+    with drivers_lock:
+        if drivers_loaded.is_set():
+            return
+        import seabreeze
+        seabreeze.use('cseabreeze') # Select the cseabreeze backend for consistency
+        import seabreeze.spectrometers
+        from seabreeze.spectrometers import Spectrometer
+        from seabreeze.cseabreeze._wrapper import SeaBreezeError
+        from ujlaser.lasercontrol import Laser, LaserCommandError
+        drivers_loaded.set()
+
+def start_hardware():
+    """Loads the drivers and starts looking for devices. Run on a background thread by main() so the prompt comes up
+    straight away."""
+    try:
+        load_drivers()
+    except ImportError as e:
+        print_cli("!!! Could not load the hardware drivers: " + str(e))
+        return
+    device_manager.start()
 
 def check_laser(laser, complain=True):
     """Helper function that prints an error message if the laser has not been connected yet. Returns True if the laser is NOT connected."""
@@ -59,42 +125,155 @@ def check_spectrometer(spec, complain=True):
     """Helper function that prints an error message if the spectrometer has not been connected yet. Returns True if the spectrometer is NOT connected."""
     if spec == None:
         if complain:
-            print("!!! This command requires the spectrometer to be connected! Use 'connect_spectrometer' first!")
+            print_cli("!!! This command requires the spectrometer to be connected! Use 'spectrometer connect' first!")
         return True
     return False
 
-def dump_settings_register(spec):
+def get_register_cache(spec):
+    """Returns the register cache for spec, creating a new one if the spectrometer has changed."""
+    cache = register_caches.get(spec.serial_number)
+    if cache is None or cache.spec is not spec:
+        cache = register_caches[spec.serial_number] = flame_registers.RegisterCache(spec)
+    return cache
+
+def spectrometer_devices(spec):
+    """The spectrometers whose registers stand behind spec: each device of a DeviceGroup (see device_group.py), or spec
+    itself."""
+    return getattr(spec, "devices", [spec])
+
+def for_each_device(spec, f, *args):
+    """Calls f(device, *args) for every device of spec, naming each one first if spec is a DeviceGroup."""
+    for device in spectrometer_devices(spec):
+        if device is not spec:
+            print_cli("... Spectrometer " + device.serial_number + ":")
+        f(device, *args)
+
+def get_exposure_control(spec):
+    """Returns the auto exposure model for spec, creating a new one if the spectrometer has changed."""
+    global exposure_control
+    import auto_exposure
+    if exposure_control is None or exposure_control.spec is not spec:
+        exposure_control = auto_exposure.for_spectrometer(spec)
+    return exposure_control
+
+def get_quality_gate(spec):
+    """Returns the shot quality gate, creating it the first time. Its thresholds are kept if the spectrometer changes,
+    only the saturation level is updated."""
+    global quality_gate
+    import shot_quality
+    if quality_gate is None:
+        quality_gate = shot_quality.for_spectrometer(spec)
+    elif quality_gate.spec is not spec:
+        quality_gate.spec = spec
+        quality_gate.saturation = getattr(spec, "max_intensity", 65535)
+        quality_gate.previous = None
+    return quality_gate
+
+def gate_shot(spec, intensities, filename):
+    """Checks a shot against the quality thresholds. Returns the filename to save it as, with a flag added if it failed
+    and failed shots are flagged, or None if it should be dropped."""
+    import shot_quality
+    gate = get_quality_gate(spec)
+    m, reasons = gate.check(intensities)
+    if not reasons:
+        return filename
+    details = ", ".join(reasons) + " (saturated pixels " + str(int(m["saturated"])) + ", peak ratio " + \
+        str(round(m["peak_ratio"], 1)) + ", correlation with last shot " + str(round(m["correlation"], 6)) + ")"
+    if not gate.keep(reasons):
+        print_cli("!!! Shot dropped: " + details)
+        return None
+    if gate.action == "flag":
+        print_cli("!!! Shot flagged: " + details)
+        return shot_quality.flagged_name(filename)
+    return filename
+
+def run_auto_exposure(spec, target=None):
+    """Takes spectra without the laser, adjusting the integration time until the highest peak is at the target
+    fraction of the saturation level."""
+    control = get_exposure_control(spec)
+    if target is not None:
+        control.target = target
+    control.reset()
+
+    def acquire(t):
+        spec.integration_time_micros(t)
+        spec.intensities() # May still have been integrated with the old time
+        return spec.intensities()
+
+    t, steps, converged = control.converge(acquire, integration_time)
+    set_integration_time(spec, t)
+    if converged:
+        print_cli("*** Auto exposure converged in " + str(steps) + " acquisitions, peak at " + str(round(100 * control.fill, 1)) + "% of saturation.")
+    else:
+        print_cli("!!! Auto exposure did not converge after " + str(steps) + " acquisitions, peak at " + str(round(100 * control.fill, 1)) + "% of saturation.")
+
+def adjust_exposure(spec, intensities):
+    """Used between samples when auto exposure is on. A laser shot is no brighter for a longer integration time (see
+    auto_exposure.py), so the integration time is left alone and the operator is told when shots start to saturate or
+    come out weak."""
+    control = get_exposure_control(spec)
+    previous = control.pulse
+    grade = control.check_pulse(intensities)
+    if grade == previous:
+        return
+    fill = str(round(100 * control.fill, 1)) + "% of saturation"
+    if grade == "saturated":
+        print_cli("!!! Shot saturated (peak at " + fill + "). Lower the laser energy or lengthen the trigger delay; " +
+                  "cutting the integration time would only miss the pulse.")
+    elif grade == "weak":
+        print_cli("!!! Weak shot (peak at " + fill + "). Raise the laser energy, shorten the trigger delay, or check " +
+                  "that the integration window takes in the pulse.")
+    elif previous is not None:
+        print_cli("*** Shots back on target (peak at " + fill + ").")
+
+def invalidate_registers():
+    """Call after changing a spectrometer setting so the next register read comes from the device."""
+    for cache in register_caches.values():
+        cache.invalidate()
+
+def dump_settings_register(spec, refresh=False):
     print_cli("... Dumping settings register:")
-    for i in (b'\x00', b'\x04', b'\x08', b'\x0C', b'\x10', b'\x14', b'\x18', b'\x28', b'\x2C', b'\x38', b'\x3C', b'\x40', b'\x48', b'\x50', b'\x54', b'\x74', b'\x78', b'\x7C', b'\x80'):
-        spec.f.raw_usb_bus_access.raw_usb_write(struct.pack(">ss",b'\x6B',i),'primary_out')
-        output = spec.f.raw_usb_bus_access.raw_usb_read(endpoint='primary_in', buffer_length=3)
-        print_cli((binascii.hexlify(i)).decode("ascii") + "\t" + (binascii.hexlify(output[1:])).decode("ascii"))
+    for line in get_register_cache(spec).snapshot(refresh).lines():
+        print_cli(line)
 
-def query_settings(spec):
+def query_settings(spec, refresh=False):
     print_cli("Querying Spectrometer Settings...")
-    spec.f.raw_usb_bus_access.raw_usb_write(struct.pack(">s",b'\xFE'),'primary_out')
-    output = spec.f.raw_usb_bus_access.raw_usb_read(endpoint='primary_in', buffer_length=16)
-    pixel_count, integration_time, lamp_enable, trigger_mode, spectral_status, spectra_packets, power_down, packet_count, comm_speed = struct.unpack("<HI?BcB?BxxBx", output) 
-    print_cli("Pixel Count: " + str(pixel_count))
-    print_cli("Integration_time: " + str(integration_time))
-    print_cli("Lamp Enable: " + str(lamp_enable))
-    print_cli("Trigger Mode: " + str(trigger_mode))
-    print_cli("Spectrum Status: " + str(spectral_status))
-    print_cli("Spectra packets: " + str(spectra_packets))
-    print_cli("Power Down Flags: " + str(power_down))
-    print_cli("Packet Count: " + str(packet_count))
-    print_cli("USB Speed: " + str(comm_speed))
+    status = get_register_cache(spec).snapshot(refresh).status
+    print_cli("Pixel Count: " + str(status.pixel_count))
+    print_cli("Integration_time: " + str(status.integration_time))
+    print_cli("Lamp Enable: " + str(status.lamp_enable))
+    print_cli("Trigger Mode: " + str(status.trigger_mode))
+    print_cli("Spectrum Status: " + str(status.spectral_status))
+    print_cli("Spectra packets: " + str(status.spectra_packets))
+    print_cli("Power Down Flags: " + str(status.power_down))
+    print_cli("Packet Count: " + str(status.packet_count))
+    print_cli("USB Speed: " + str(status.usb_speed))
+
+def diff_settings_register(spec):
+    """Prints the registers that changed since the previous snapshot."""
+    changes = get_register_cache(spec).diff()
+    if not changes:
+        print_cli("No register changes since the previous snapshot.")
+    for name, old, new in changes:
+        print_cli(name + ": " + str(old) + " -> " + str(new))
 
 def auto_connect_spectrometer():
     """Use seabreeze to autodetect and connect to a spectrometer. Returns a Spectrometer object on success, None otherwise"""
     global devices
 
-    if devices == []:
+    load_drivers()
+    if device_manager is None:
         devices = seabreeze.spectrometers.list_devices()
+    else:
+        devices = device_manager.spectrometers()
+        if devices == []: # Nothing cached yet, or the cache is out of date. Give the scanner a moment.
+            device_manager.wait_for_scan(5)
+            devices = device_manager.spectrometers()
     if devices != []:
         try:
             spec = seabreeze.spectrometers.Spectrometer(devices[0])
             print_cli("*** Found spectrometer, serial number: " + spec.serial_number)
+            watch_spectrometer(spec)
             return spec
         except SeaBreezeError as e:
             print_cli("!!! " + str(e))
@@ -102,22 +281,139 @@ def auto_connect_spectrometer():
             print_cli("Unknown Error")
     print_cli("!!! No spectrometer autodetected!")
 
+def connect_spectrometer(serial_number):
+    """Connects to the spectrometer with the given serial number. Returns a Spectrometer object on success, None otherwise"""
+    load_drivers()
+    try:
+        spec = Spectrometer.from_serial_number(serial_number)
+        print_cli("*** Connected to spectrometer, serial number: " + spec.serial_number)
+        watch_spectrometer(spec)
+        return spec
+    except SeaBreezeError as e:
+        print_cli("!!! " + str(e))
+    print_cli("!!! Could not connect to spectrometer " + serial_number + "!")
+
+def connect_all_spectrometers():
+    """Opens every detected spectrometer as one DeviceGroup (see device_group.py), acquired together and stitched into
+    one spectrum. Returns the group, or None if no spectrometer could be opened."""
+    load_drivers()
+    import device_group
+    devices = device_manager.spectrometers() if device_manager is not None else seabreeze.spectrometers.list_devices()
+    if devices == []:
+        print_cli("!!! No spectrometer autodetected!")
+        return None
+    opened = []
+    try:
+        for d in devices:
+            opened.append(seabreeze.spectrometers.Spectrometer(d))
+        group = device_group.DeviceGroup(opened, clock)
+    except SeaBreezeError as e:
+        for spec in opened: # Release the ones that did open, or they stay claimed until libs_cli exits
+            try:
+                spec.close()
+            except Exception:
+                pass
+        print_cli("!!! " + str(e))
+        return None
+    grid = group.wavelengths()
+    print_cli("*** Connected " + str(len(group.devices)) + " spectrometers (" + ", ".join(group.serial_numbers) + "), stitched from " +
+              str(round(grid[0], 1)) + " to " + str(round(grid[-1], 1)) + " nm.")
+    return group
+
+def watch_spectrometer(spec):
+    """Has the device manager reconnect spec automatically if it is unplugged and plugged back in, instead of the
+    spectrometer watched before."""
+    global watched_serial
+    unwatch_spectrometer()
+    if device_manager is not None:
+        watched_serial = spec.serial_number
+        device_manager.watch_spectrometer(spec.serial_number, lambda s, e: _spectrometer_replugged(spec.serial_number, s, e))
+
+def unwatch_spectrometer():
+    """Stops reconnecting the watched spectrometer, once it is replaced or libs_cli exits."""
+    global watched_serial
+    if device_manager is not None and watched_serial is not None:
+        device_manager.unwatch_spectrometer(watched_serial)
+    watched_serial = None
+
+def _spectrometer_replugged(serial_number, spec, error):
+    global spectrometer
+    if serial_number != watched_serial or spectrometer is not None: # No longer the active spectrometer
+        try:
+            if spec is not None:
+                spec.close()
+        except Exception:
+            pass
+        return
+    if spec is None:
+        print_cli("!!! Spectrometer was plugged back in but could not be reopened: " + str(error))
+        return
+    try:
+        spec.integration_time_micros(integration_time)
+        spec.trigger_mode(0 if sample_mode == "NORMAL" else 3)
+    except SeaBreezeError as e:
+        print_cli("!!! Could not restore spectrometer settings: " + str(e))
+    spectrometer = spec
+    print_cli("*** Spectrometer " + spec.serial_number + " reconnected.")
+
+def device_change(kind, added, removed):
+    """Called by the device manager when devices are plugged in or unplugged."""
+    global spectrometer
+    for name in added:
+        debug_log(kind + " plugged in: " + name)
+    for name in removed:
+        debug_log(kind + " unplugged: " + name)
+    if kind == "spectrometer" and spectrometer is not None and set(getattr(spectrometer, "serial_numbers", [])) & set(removed):
+        print_cli("!!! A spectrometer of the group (" + ", ".join(set(spectrometer.serial_numbers) & set(removed)) + ") was unplugged! Use 'spectrometer connect all' once it is back.")
+        spectrometer.close()
+        spectrometer = None
+    elif kind == "spectrometer" and spectrometer is not None and spectrometer.serial_number in removed:
+        print_cli("!!! Spectrometer " + spectrometer.serial_number + " was unplugged! It will be reconnected when it is plugged back in.")
+        try:
+            spectrometer.close()
+        except Exception:
+            pass
+        spectrometer = None
+
+def connect_laser(port):
+    """Connects to the laser on the given serial port and prints its settings. Returns a Laser object on success, None otherwise"""
+    load_drivers()
+    l = Laser()
+    print_cli("Connecting to laser...")
+    l.connect(port)
+    print_cli("Refreshing settings...")
+    l.refresh_parameters()
+    s = l.get_status()
+    if not s:
+        cli_print("!!! Failed to connect to laser!")
+        return None
+    cli_print("Laser Status:")
+    cli_print("ID: " + l.get_laser_ID() + "\n")
+    cli_print(str(s))
+    print_cli("Rep rate: " + str(l.repRate) + "Hz")
+    print_cli("Pulse width: " + str(l.pulseWidth) + "s")
+    print_cli("Pulse mode: " + str(l.pulseMode))
+    print_cli("Burst count: " + str(l.burstCount))
+    return l
+
 def load_data(filename):
     """Prints the data in files. Not added in yet"""
-    with open(SD_CARD_PATH+filename, 'rb') as file:
-        data = pickle.load(file)
-        print_cli(data)
+    import spectrum_codec
+    data = spectrum_codec.load_sample(SD_CARD_PATH+filename)
+    print_cli(str(data))
 
 def save_sample_csv(filename, wavelengths, intensities):
-    debug_log("Saving sample as CSV: " + filename + "; len(wavelengths) = " + len(wavelengths) + ", len(intensities) = " + len(intensities))
+    debug_log("Saving sample as CSV: " + filename + "; len(wavelengths) = " + str(len(wavelengths)) + ", len(intensities) = " + str(len(intensities)))
     with open(filename, "w") as f:
         f.write("Wavelengths,Intensities\n")
         for i in range(0,len(wavelengths)):
-                f.write(str(wavelengths)+","+str(intensities)+"\n")
-        f.close()
+                f.write(str(wavelengths[i])+","+str(intensities[i])+"\n")
 
 def user_select_port():
-    ports = serial.tools.list_ports.comports()
+    if device_manager is not None:
+        ports = device_manager.serial_ports()
+    else:
+        ports = serial.tools.list_ports.comports()
     if len(ports) == 0:
         print_cli("No serial ports detected!")
         return
@@ -126,9 +422,7 @@ def user_select_port():
         print_cli("\t" + str(i+1) + ") " + str(p))
 
     try:
-        i = input("Select a port or 0 to cancel: ")
-        log_input(i)
-        i = int(i)
+        i = int(ask("Select a port or 0 to cancel: "))
     except ValueError:
         i = -1
 
@@ -143,8 +437,10 @@ def user_select_port():
 # Please use the below function when printing to the command line. This will both print to the command line and print it to the log file.
 def cli_print(txt):
     global command_log
-    command_log.write(str(int(time.time())) + ">: " + txt + "\n")
+    command_log.write(str(int(clock.time())) + ">: " + txt + "\n")
     print(txt)
+    for listener in output_listeners:
+        listener(txt)
 
 # This is a helper function because I'm REALLY lazy and don't feel like getting Python's runtime errors. I know this is an atrocity. Not sorry.
 def print_cli(txt):
@@ -153,27 +449,54 @@ def print_cli(txt):
 # Print to the log file. Will print to CLI if verbose mode is enabled.
 def debug_log(txt):
     global command_log, verbose
-    command_log.write(str(time.time()) + "D:" + txt + "\n")
+    command_log.write(str(clock.time()) + "D:" + txt + "\n")
     if verbose:
         print("D: " + txt)
 
 # Writes user input/commands to the command log file.
 def log_input(txt):
     global command_log
-    command_log.write(str(int(time.time())) + "?:" + txt + "\n")
+    command_log.write(str(round(clock.time(), 3)) + "?:" + txt + "\n") # Milliseconds, for log_replay.py's pacing
+
+def ask(text):
+    """Asks the operator a question in the middle of a command and returns the answer, which is logged. The answer comes
+    from prompt_input when something else owns the terminal (libs_async reads it on a thread of its own)."""
+    answer = (prompt_input or input)(text)
+    log_input(answer)
+    return answer
+
+def laser_power_off():
+    """Drives the laser enable line (interface_config.Laser_GPIO_pin) low, which switches off the converter powering the
+    laser. This is the stop of last resort, for when the serial port is busy and emergency_stop() cannot go out."""
+    GPIO.setup(interface_config.Laser_GPIO_pin, GPIO.OUT)
+    GPIO.output(interface_config.Laser_GPIO_pin, GPIO.LOW)
+    print_cli("!!! Laser port busy, cut the laser's power. Use 'laser arm' to power it again.")
+
+def serialize_laser(l):
+    """Wraps l in a libs_async.SerializedLaser on laser_lock, so that every thread using the laser (commands from the
+    CLI or libs_server, the watchdog, libs_async's telemetry) takes its turn on the serial port."""
+    import libs_async
+    if l is None or isinstance(l, libs_async.SerializedLaser):
+        return l
+    return libs_async.SerializedLaser(l, laser_lock, LASER_STOP_TIMEOUT, laser_power_off)
 
 def set_trigger_delay(spec, t):
-    """Sets the trigger delay of the spectrometer. Can be from 0 to 32.7ms in increments of 500ns. t is in microseconds"""
-    global sample_mode
+    """Sets the delay from the laser pulse to the start of integration. Can be from 0 to 32.7ms in increments of 500ns. t is
+    in microseconds. In NORMAL mode do_sample waits that long after firing the laser before acquiring; in the external
+    trigger modes it goes into the spectrometer's trigger delay register. set_sample_mode applies it again for the new
+    mode. Returns the delay that will be applied."""
+    global trigger_delay, software_trigger_delay, programmed_trigger_delay
+    t_clock_cycles, t = flame_registers.trigger_delay_cycles(t) # 500ns per clock cycle b/c the clock runs at 2MHz
     if sample_mode == "NORMAL":
         software_trigger_delay = t
-    else: 
-        t_nano_seconds = t * 1000 #convert micro->nano seconds
-        t_clock_cycles = t//500 # number of clock cycles to wait. 500ns per clock cycle b/c the clock runs at 2MHz
-        data = struct.pack("<ssH",b'\x6A',b'\x28',t_clock_cycles)
-        spec.f.raw_usb_bus_access.raw_usb_write(data,'primary_out')
-        # self.spec.f.spectrometer.set_delay_microseconds(t)
-    
+    else:
+        for device in spectrometer_devices(spec):
+            get_register_cache(device).write_register(flame_registers.TRIGGER_DELAY_REGISTER, t_clock_cycles)
+        programmed_trigger_delay = (spec, t)
+        software_trigger_delay = 0
+    trigger_delay = t
+    return t
+
 def set_external_trigger_pin(pin):
     """Sets the GPIO pin to use for external triggering."""
     global external_trigger_pin
@@ -198,7 +521,9 @@ def set_sample_mode(spec, mode):
 
     try:
         spec.trigger_mode(i)
+        invalidate_registers()
         print_cli("*** Spectrometer trigger mode set to " + mode + " (" + str(i) + ")")
+        set_trigger_delay(spec, trigger_delay) # Moves the delay between the register and the software wait
         return True
     except SeaBreezeError as e:
         print_cli("!!! " + str(e))
@@ -209,6 +534,7 @@ def set_integration_time(spec, time):
     """Sets the integration time of the spectrometer. Returns True on success, False otherwise."""
     global integration_time
     spec.integration_time_micros(time)
+    invalidate_registers()
     integration_time = time
 
     print_cli("*** Integration time set to " + str(time) + " microseconds.")
@@ -216,25 +542,34 @@ def set_integration_time(spec, time):
 
 def do_trigger(pin):
     GPIO.output(pin, GPIO.LOW)
-    time.sleep(0.01)  # delay for spectrum, can be removed or edited if tested
+    clock.sleep(0.01)  # delay for spectrum, can be removed or edited if tested
     GPIO.output(pin, GPIO.HIGH)
 
 
+EXT_TRIGGER_ARM_DELAY = 0.01 # Seconds between requesting a spectrum and sending the trigger edge it waits for
+
 _wavelengths = None
 _intensities = None
+_integration_start = None # clock.monotonic() when the last spectrum was requested
 def _spectrometer_callback(spec):
-    global _wavelengths, _intensities
+    global _wavelengths, _intensities, _integration_start
     print_cli("Spectrometer callback")
+    _integration_start = clock.monotonic()
     _wavelengths, _intensities = spec.spectrum()
-    time.sleep(2)
+    clock.sleep(2)
 
-def do_sample(spec, laser):
-    """Performs a LIBS sample using the current spectrometer and laser settings."""
-    global sample_mode, _wavelengths, _intensities, integration_time
-    wavelengths = []
-    intensities = []
+def acquire_shot(spec, laser):
+    """Fires the laser and acquires the spectrum of the shot, using the current spectrometer and laser settings. Returns
+    (wavelengths, intensities), or None if the shot could not be taken. Sets last_trigger_delay."""
+    global last_trigger_delay
     if sample_mode == "EXT_EDGE":
-        do_trigger(pin)
+        spectrometer_thread = clock.start_thread(_spectrometer_callback, args=(spec,), name="spec-sample-thread")
+        clock.sleep(EXT_TRIGGER_ARM_DELAY)
+        do_trigger(external_trigger_pin) # The spectrometer starts integrating trigger_delay after this edge
+        clock.join(spectrometer_thread)
+        # Only a delay that went into this spectrometer's register is known; otherwise it has whatever it powered up with
+        programmed = programmed_trigger_delay is not None and programmed_trigger_delay[0] is spec
+        last_trigger_delay = programmed_trigger_delay[1] if programmed else None
     elif sample_mode == "NORMAL":
         print_cli("Begninning sampling, clearing spectrometer FIFO...")
         spec.integration_time_micros(6000) # Decrease integration time so we clear the FIFO faster
@@ -244,47 +579,410 @@ def do_sample(spec, laser):
 
         print_cli("Setting integration time to " + str(integration_time) + "microseconds")
         spec.integration_time_micros(integration_time)
-        time.sleep(0.5)
-        spectrometer_thread = threading.Thread(target=_spectrometer_callback, name="spec-sample-thread", args=(spectrometer,))
-        spectrometer_thread.start()
+        clock.sleep(0.5)
+        spectrometer_thread = None
+        if not software_trigger_delay: # Fire the laser during the integration period
+            spectrometer_thread = clock.start_thread(_spectrometer_callback, args=(spec,), name="spec-sample-thread")
 
         try:
             laser.fire()
         except LaserCommandError as e:
             print_cli("!!! ERROR encountered while firing laser: " + str(e))
+            if spectrometer_thread is not None:
+                clock.join(spectrometer_thread)
             return None
+        fired = clock.monotonic()
 
-        spectrometer_thread.join()
-        #Yup, fire the laser during the integration period somehow
+        if spectrometer_thread is None: # Start integrating software_trigger_delay after the pulse
+            clock.sleep(software_trigger_delay / 1e6)
+            spectrometer_thread = clock.start_thread(_spectrometer_callback, args=(spec,), name="spec-sample-thread")
+        clock.join(spectrometer_thread)
+        last_trigger_delay = 1e6 * (_integration_start - fired)
     else:  # no other modes planning to be used
         print_cli("This mode is currently unavailable, please try EXT_EDGE or NORMAL mode.")
+        return None
+    return _wavelengths, _intensities
+
+def do_sample(spec, laser):
+    """Performs a LIBS sample using the current spectrometer and laser settings."""
+    data = acquire_shot(spec, laser)
+    if data is None:
         return
 
     print_cli("Sample finished, saving data...")
-    timestamp = str(time.time())  # gets time immediately after integrating
-    data = _wavelengths, _intensities
-    with open(SAMPLES_PATH + str(timestamp) + "_SAMPLE.pickle", 'ab') as file:
-        pickle.dump(data, file)
-    print_cli("Sample saved.")
-
-# Takes a sample from the spectrometer without the laser firing
-def get_spectrum(spec):
+    settings = acquisition_settings(spec, laser, "libs")
+    timestamp = str(clock.time())  # gets time immediately after integrating
+    publish_spectrum(_wavelengths, _intensities)
+    name = SAMPLES_PATH + str(timestamp) + "_SAMPLE" + SAMPLE_FORMATS[sample_format]
+    filename = gate_shot(spec, _intensities, name)
+    remember_shot(_wavelengths, _intensities, float(timestamp), filename != name)
+    if filename is not None:
+        save_sample(filename, data, settings, float(timestamp))
+        print_cli("Sample saved.")
+    if auto_exposure_enabled:
+        adjust_exposure(spec, _intensities)
+
+def do_burst(spec, laser, count):
+    """Performs count LIBS samples back to back. Stops early if sample_abort is set (e.g. by 'laser stop')."""
+    sample_abort.clear()
+    for i in range(count):
+        if sample_abort.is_set():
+            print_cli("!!! Burst aborted after " + str(i) + " of " + str(count) + " samples.")
+            return i
+        print_cli("*** Burst sample " + str(i + 1) + " of " + str(count))
+        do_sample(spec, laser)
+    return count
+
+def do_delay_series(spec, laser, delays, shots):
+    """Takes shots samples at each trigger delay in delays (microseconds) into a delay_series.DelaySeries, which is saved
+    to SAMPLES_PATH once done (or aborted by 'laser stop'). The trigger delay is put back afterwards. Returns the series."""
+    import delay_series
+    series = delay_series.DelaySeries(spec.wavelengths(), delays, shots)
+
+    def take_shot():
+        data = acquire_shot(spec, laser)
+        if data is None:
+            return None
+        publish_spectrum(*data)
+        timestamp = clock.time()
+        remember_shot(data[0], data[1], timestamp)
+        return data[1], last_trigger_delay, timestamp
+
+    previous = trigger_delay
+    sample_abort.clear()
+    try:
+        delay_series.acquire(series, lambda delay: set_trigger_delay(spec, delay), take_shot, sample_abort, print_cli)
+    finally:
+        set_trigger_delay(spec, previous)
+        filename = SAMPLES_PATH + str(clock.time()) + "_SERIES" + delay_series.EXTENSION
+        series.save(filename)
+        print_cli("*** Delay series of " + str(len(series)) + " shots saved to " + filename)
+    return series
+
+def current_settings():
+    """Returns a dictionary of the acquisition settings in effect."""
+    return {"integration_time": integration_time, "sample_mode": sample_mode, "external_trigger_pin": external_trigger_pin}
+
+def acquisition_settings(spec, laser, source):
+    """Returns the settings a sample was taken with, to be catalogued with it (see sample_catalog.SETTINGS). source is
+    "libs" for laser shots and "spectrum" for spectra taken without firing the laser."""
+    settings = {"source": source, "integration_time": integration_time, "sample_mode": sample_mode,
+                "trigger_delay": last_trigger_delay if source == "libs" else None,
+                "serial": getattr(spec, "serial_number", None)}
+    if laser is not None:
+        settings.update(rep_rate=getattr(laser, "repRate", None), pulse_width=getattr(laser, "pulseWidth", None),
+                        pulse_mode=getattr(laser, "pulseMode", None), burst_count=getattr(laser, "burstCount", None))
+    return settings
+
+def process_spectrum(wavelengths, intensities):
+    """Runs a copy of a raw spectrum through the processing pipeline. Returns the processed (wavelengths, intensities),
+    or the raw ones if no pipeline is loaded."""
+    if pipeline is None:
+        return wavelengths, intensities
+    import numpy as np
+    import spectral_pipeline
+    try:
+        return pipeline.process(np.array(intensities, dtype=np.float64), wavelengths)
+    except spectral_pipeline.PipelineError as e:
+        print_cli("!!! Processing failed: " + str(e))
+        return wavelengths, intensities
+
+def load_pipeline(filename, spec):
+    """Loads a processing pipeline configuration (see spectral_pipeline.py). Returns the pipeline or None on error."""
+    import spectral_pipeline
+    try:
+        p = spectral_pipeline.Pipeline.load(filename)
+    except (OSError, ValueError, spectral_pipeline.PipelineError) as e:
+        print_cli("!!! Could not load pipeline " + filename + ": " + str(e))
+        return None
+    if spec is not None:
+        spectral_pipeline.configure_for(p, spec)
+    print_cli("*** Loaded pipeline: " + ", ".join(s.name for s in p.stages))
+    return p
+
+def publish_spectrum(wavelengths, intensities):
+    """Processes a spectrum and sends it to remote viewers if streaming is enabled."""
+    if stream_publisher is None:
+        return
+    wavelengths, intensities = process_spectrum(wavelengths, intensities)
+    try:
+        stream_publisher.publish(wavelengths, intensities, current_settings())
+    except OSError as e:
+        debug_log("Failed to stream spectrum: " + str(e))
+
+def save_sample(filename, data, settings=None, timestamp=None):
+    """Saves a (wavelengths, intensities) sample to filename, through sample_writer if one has been set. settings are
+    the acquisition settings it was taken with and timestamp the clock.time() it was acquired at, for the catalog."""
+    if sample_writer is not None:
+        sample_writer(filename, data, settings, timestamp)
+        return
+    write_sample_file(filename, data, settings, timestamp)
+
+def write_sample_file(filename, data, settings=None, timestamp=None):
+    """Writes a sample in the format given by the file extension: compressed for .lsc, pickled otherwise, and adds it
+    to the index and the catalog."""
+    if filename.endswith(SAMPLE_FORMATS["lsc"]):
+        import spectrum_codec
+        spectrum_codec.save_sample(filename, data[0], data[1])
+    else:
+        with open(filename, 'ab') as file:
+            pickle.dump(data, file)
+    index_sample(filename, data)
+    catalog_sample(filename, data, settings, timestamp)
+
+def get_sample_index(components=None, rebuild=False):
+    """Returns the similarity index of the saved samples, loading it from INDEX_PATH (or building it, compressed to
+    components PCA components if given) the first time. Samples saved since it was last loaded are added to it."""
+    global sample_index
+    import spectral_index
+    if sample_index is not None and not rebuild:
+        return sample_index
+    index = None
+    if not rebuild and pathlib.Path(INDEX_PATH, "meta.json").exists():
+        try:
+            index = spectral_index.SpectralIndex.load(INDEX_PATH)
+        except (OSError, ValueError, KeyError, spectral_index.SpectralIndexError) as e:
+            print_cli("!!! Could not load the sample index, rebuilding it: " + str(e))
+    if index is None:
+        print_cli("*** Indexing the samples in " + SAMPLES_PATH + "...")
+        index, failed = spectral_index.build(SAMPLES_PATH, INDEX_PATH, components)
+    else:
+        added, failed = index.update(SAMPLES_PATH)
+    if failed:
+        print_cli("!!! " + str(failed) + " sample files could not be read and are not indexed.")
+    sample_index = index
+    return index
+
+def get_recent_spectra():
+    global recent_spectra
+    if recent_spectra is None:
+        import spectrum_ring
+        recent_spectra = spectrum_ring.SpectrumRing(RECENT_CAPACITY)
+    return recent_spectra
+
+def remember_shot(wavelengths, intensities, timestamp, flagged=False):
+    """Keeps a shot in recent_spectra, with the acquisition settings it was taken with."""
+    import spectrum_ring
+    get_recent_spectra().push(wavelengths, intensities, timestamp, integration_time, last_trigger_delay,
+                              spectrum_ring.FLAGGED if flagged else 0)
+
+def recent_command(args):
+    """Runs the 'recent' command on the shots kept in memory. args are its arguments: [list] [N], diff [AGE] [AGE],
+    export AGE FILE, replay AGE, dump [FILE], size N or clear. Ages count back from the newest shot, which is 0."""
+    global recent_spectra
+    ring = get_recent_spectra()
+    action, rest = (args[0], args[1:]) if args and not args[0].isdigit() else ("list", args)
+    try:
+        if action == "list":
+            for line in ring.lines(int(rest[0]) if rest else 10):
+                print_cli(line)
+            print_cli("*** " + str(len(ring)) + " of the last " + str(ring.capacity) + " shots are in memory.")
+        elif action == "diff":
+            a, b = (int(rest[0]) if rest else 0), (int(rest[1]) if len(rest) > 1 else 1)
+            diff = ring.diff(a, b)
+            peak = int(abs(diff).argmax())
+            print_cli("Shot " + str(a) + " - shot " + str(b) + ": largest difference " + str(round(diff[peak], 1)) +
+                      " at " + str(round(ring.wavelengths[peak], 2)) + " nm, mean " + str(round(diff.mean(), 2)) +
+                      ", RMS " + str(round(float((diff ** 2).mean()) ** 0.5, 2)))
+        elif action == "export":
+            if len(rest) < 2:
+                print_cli("!!! Invalid command: Recent Export command expects a shot age and a file name.")
+                return
+            ring.export(int(rest[0]), rest[1])
+            print_cli("*** Shot " + rest[0] + " exported to " + rest[1])
+        elif action == "replay":
+            if stream_publisher is None:
+                print_cli("!!! Streaming is not enabled, start libs_cli with --stream to replay shots to viewers.")
+                return
+            age = int(rest[0]) if rest else 0
+            publish_spectrum(ring.wavelengths, ring.spectrum(age))
+            print_cli("*** Shot " + str(age) + " sent to stream viewers.")
+        elif action == "dump":
+            import run_archive
+            filename = rest[0] if rest else SAMPLES_PATH + str(clock.time()) + "_RECENT" + run_archive.EXTENSION
+            print_cli("*** " + str(ring.dump(filename)) + " shots written to " + filename)
+        elif action == "size":
+            import spectrum_ring
+            capacity = int(rest[0])
+            recent_spectra = spectrum_ring.SpectrumRing(capacity)
+            print_cli("*** The last " + str(capacity) + " shots will be kept in memory (cleared).")
+        elif action == "clear":
+            ring.clear()
+            print_cli("*** Recent shots cleared.")
+        else:
+            print_cli("!!! Invalid command: Recent command expected one of: " + ", ".join(RECENT_ACTIONS))
+    except IndexError as e:
+        print_cli("!!! " + str(e) if len(ring) else "!!! No shots have been taken yet.")
+    except ValueError as e:
+        print_cli("!!! Invalid argument: " + str(e))
+    except OSError as e:
+        print_cli("!!! " + str(e))
+
+def get_watchdog():
+    """The laser safety watchdog, created on first use. It follows whatever laser is connected."""
+    global watchdog
+    if watchdog is None:
+        import laser_watchdog
+        watchdog = laser_watchdog.LaserWatchdog(lambda: laser, GPIO, interface_config.Laser_GPIO_pin, clock,
+                                                log=print_cli, log_path=LOG_PATH + "WATCHDOG.log", enable=True)
+    return watchdog
+
+def watchdog_command(args):
+    """Runs the 'watchdog' command. args are its arguments: show, start, stop, reset or set QUANTITY VALUE."""
+    w = get_watchdog()
+    action = args[0] if args else "show"
+    if action == "show":
+        for line in w.report():
+            print_cli(line)
+    elif action == "start":
+        w.start()
+        print_cli("*** Laser watchdog running.")
+    elif action == "stop":
+        w.stop()
+        print_cli("*** Laser watchdog stopped, the laser is NOT being monitored.")
+    elif action == "reset":
+        w.reset()
+        print_cli("*** Laser watchdog reset. Use 'laser arm' to power and arm the laser again.")
+    elif action == "set":
+        if len(args) != 3:
+            print_cli("!!! Invalid command: Watchdog Set command expects a quantity and a limit (or 'off').")
+            return
+        try:
+            w.set_limit(args[1], args[2])
+        except ValueError as e:
+            print_cli("!!! Invalid argument: " + str(e))
+            return
+        print_cli("*** " + args[1] + " limit set to " + args[2])
+    else:
+        print_cli("!!! Invalid command: Watchdog command expected one of: " + ", ".join(WATCHDOG_ACTIONS))
+
+def index_sample(filename, data):
+    """Adds a newly saved sample to the similarity index, if it has been loaded. Samples saved before that are picked up
+    when it is loaded."""
+    if sample_index is None or not filename.startswith(SAMPLES_PATH) or "/" in filename[len(SAMPLES_PATH):]:
+        return
+    try:
+        sample_index.add(filename[len(SAMPLES_PATH):], data[0], data[1])
+    except (OSError, ValueError) as e:
+        debug_log("Failed to index " + filename + ": " + str(e))
+
+def get_sample_catalog():
+    """Returns the catalog of the saved samples, opening (or creating) it at CATALOG_PATH the first time."""
+    global sample_catalog
+    if sample_catalog is None or sample_catalog.path != CATALOG_PATH:
+        import sample_catalog as catalog_module
+        pathlib.Path(CATALOG_PATH).parent.mkdir(parents=True, exist_ok=True)
+        sample_catalog = catalog_module.Catalog(CATALOG_PATH)
+    return sample_catalog
+
+def catalog_sample(filename, data, settings=None, timestamp=None):
+    """Adds a newly saved sample to the catalog with the settings and time it was taken with. Without a timestamp it
+    is read from the file name, which only works for the names libs_cli gives samples itself. Samples outside
+    SAMPLES_PATH are not catalogued."""
+    global catalog_failure
+    import sqlite3
+    import sample_catalog as catalog_module
+    if not filename.startswith(SAMPLES_PATH) or "/" in filename[len(SAMPLES_PATH):]:
+        return
+    try:
+        get_sample_catalog().add(filename[len(SAMPLES_PATH):], data[0], data[1], settings, timestamp)
+        catalog_failure = None
+    except (OSError, ValueError, sqlite3.Error, catalog_module.CatalogError) as e:
+        debug_log("Failed to catalog " + filename + ": " + str(e))
+        if str(e) != catalog_failure:
+            print_cli("!!! Samples are saved but not catalogued (" + CATALOG_PATH + "): " + str(e))
+        catalog_failure = str(e)
+
+def find_samples(args):
+    """Runs the 'find' command: lists the catalogued samples matching the query terms in args (see sample_catalog.py),
+    or with 'backfill [PROCESSES]' adds the samples in SAMPLES_PATH that are not catalogued yet."""
+    import sqlite3
+    import sample_catalog as catalog_module
+    try:
+        catalog = get_sample_catalog()
+        if args[0:1] == ["backfill"]:
+            print_cli("*** Cataloguing the samples in " + SAMPLES_PATH + "...")
+            start = time.perf_counter()
+            added, failed = catalog_module.backfill(catalog, SAMPLES_PATH, int(args[1]) if len(args) > 1 else None,
+                                                    log=print_cli)
+            print_cli("*** " + str(added) + " samples catalogued in " + str(round(time.perf_counter() - start, 1)) +
+                      " s, " + str(len(catalog)) + " in the catalog.")
+            if failed:
+                print_cli("!!! " + str(failed) + " sample files could not be read and are not catalogued.")
+            return
+        conditions, lines, limit = catalog_module.parse_query(args)
+        start = time.perf_counter()
+        rows = catalog.find(conditions, lines, limit)
+        elapsed = time.perf_counter() - start
+    except ValueError as e:
+        print_cli("!!! Invalid argument: " + str(e))
+        return
+    except (OSError, sqlite3.Error, catalog_module.CatalogError) as e:
+        print_cli("!!! Sample catalog error: " + str(e))
+        return
+    for row in rows:
+        print_cli(catalog_module.describe(row))
+    print_cli("*** " + str(len(rows)) + " samples found" + (" (limit reached)" if len(rows) == limit else "") +
+              " in " + str(round(1000 * elapsed, 1)) + " ms.")
+
+def search_samples(args):
+    """Prints the saved samples most similar to a sample file, or to the last sample taken. args are the arguments of the
+    'search' command: [K] [FILE], or 'rebuild' [COMPONENTS]."""
+    k = 10
+    filename = None
+    if args[0:1] == ["rebuild"]:
+        try:
+            components = int(args[1]) if len(args) > 1 else None
+        except ValueError:
+            print_cli("!!! Invalid argument: Search Rebuild command expected a number of PCA components.")
+            return
+        index = get_sample_index(components, rebuild=True)
+        print_cli("*** Indexed " + str(len(index)) + " samples.")
+        return
+    for a in args:
+        if a.isdigit() and int(a) > 0:
+            k = int(a)
+        else:
+            filename = a
+    if filename is None:
+        if _wavelengths is None:
+            print_cli("!!! Invalid command: Search command expects a sample file when no sample has been taken yet.")
+            return
+        wavelengths, intensities = _wavelengths, _intensities
+    else:
+        import spectrum_codec
+        if not pathlib.Path(filename).exists() and pathlib.Path(SAMPLES_PATH, filename).exists():
+            filename = SAMPLES_PATH + filename
+        try:
+            wavelengths, intensities = spectrum_codec.load_sample(filename)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, spectrum_codec.CodecError) as e:
+            print_cli("!!! Could not read " + filename + ": " + str(e))
+            return
+    index = get_sample_index()
+    start = time.perf_counter()
+    results = index.search(wavelengths, intensities, k)
+    elapsed = time.perf_counter() - start
+    for name, similarity in results:
+        print_cli("{:.4f}  {}".format(similarity, name))
+    print_cli("*** Searched " + str(len(index)) + " samples in " + str(round(1000 * elapsed, 1)) + " ms.")
+
+# Takes a sample from the spectrometer without the laser firing. Asks for the file name unless one is given.
+def get_spectrum(spec, filename=None):
     wavelengths, intensities = spec.spectrum()
-    timestamp = time.time()
-    timestamp = str(timestamp)
+    publish_spectrum(wavelengths, intensities)
+    timestamp = clock.time()
     data = wavelengths, intensities
-    filename = "SAMPLE_" + timestamp + ".pickle"
-    f = input("Save sample as [" + filename + "]:")
-    log_input(f)
-    if f != "":
-        filename = f
-    with open("samples/" + filename, 'ab') as file:
-        pickle.dump(data, file)
+    if filename is None:
+        filename = "SAMPLE_" + str(timestamp) + SAMPLE_FORMATS[sample_format]
+        f = ask("Save sample as [" + filename + "]:")
+        if f != "":
+            filename = f
+    save_sample(SAMPLES_PATH + filename, data, acquisition_settings(spec, None, "spectrum"), timestamp)
     #save_sample_csv("samples/" + filename, wavelengths, intensities)
 
 def give_status(spec, l):
     """Prints out a status report of the spectrometer and laser. Also saves the report to a file"""
-    s = "Status at: " + str(time.time()) + "\n"
+    s = "Status at: " + str(clock.time()) + "\n"
     
     if check_spectrometer(spec, False):
         s += "Spectrometer is not connected.\n"
@@ -300,352 +998,554 @@ def give_status(spec, l):
     else:
         s += "Laser:\n"
         s += str(l.get_status())
+        if telemetry:
+            s += "\nTelemetry:\n"
+            for k in sorted(telemetry):
+                s += "\t" + k + ": " + str(telemetry[k]) + "\n"
 
     cli_print(s)
 
 def command_loop():
-    global running, spectrometer, laser, external_trigger_pin, laserSingleShot, sample_mode, integration_time
-    # make the below global variables? currently moved to here since it seems unnecessary
+    global running, integration_time
     integration_time = 6000 # This is the default value the spectrometer is set to 
-    mode = "NORMAL"
-    software_trigger_delay = 0  # delays laser firing time?? is this what it means?
 
     while running:
         c = input("?").strip() # Get a command from the user and remove any extra whitespace
         log_input("?" + c)
-        parts = c.split() # split the command up into the command and any arguments
-        
-        if c == "help": # check to see what command we were given
-            give_help()
+        try:
+            handle_command(c)
+        except KeyboardInterrupt: # Ctrl-C is the blocking loop's 'cancel', the command runs in the foreground
+            sample_abort.set()
+            print_cli("!!! Cancelled.")
+
+def handle_command(c):
+    """Parses and runs a single command line. Used by command_loop and by the event loop in libs_async."""
+    global running, spectrometer, laser, external_trigger_pin, laserSingleShot, sample_mode, integration_time, sample_format, auto_exposure_enabled, pipeline
+    mode = sample_mode
+    parts = c.split() # split the command up into the command and any arguments
+    
+    if c == "help": # check to see what command we were given
+        give_help()
 
-        elif c == "spectrometer spectrum":
-            if check_spectrometer(spectrometer):
-                continue
-            get_spectrum(spectrometer)
+    elif parts[0:2] == ["spectrometer", "spectrum"]:
+        if check_spectrometer(spectrometer):
+            return
+        get_spectrum(spectrometer, parts[2] if len(parts) > 2 else None)
  
-        elif c == "spectrometer dump_registers":
-            if check_spectrometer(spectrometer):
-                continue
-            dump_settings_register(spectrometer)
-
-        elif c == "spectrometer query_settings":
-            if check_spectrometer(spectrometer):
-                continue
-            query_settings(spectrometer)
-
-        elif parts[0:3] == ["spectrometer","set","trigger_delay"]:
-            if check_spectrometer(spectrometer):
-                continue
-            if len(parts) < 4:
-                print_cli("!!! Invalid command: Set Trigger Delay command expects at least 1 argument.")
-                continue
+    elif parts[0:2] == ["spectrometer", "dump_registers"]:
+        if check_spectrometer(spectrometer):
+            return
+        for_each_device(spectrometer, dump_settings_register, parts[2:3] == ["refresh"])
+
+    elif parts[0:2] == ["spectrometer", "query_settings"]:
+        if check_spectrometer(spectrometer):
+            return
+        for_each_device(spectrometer, query_settings, parts[2:3] == ["refresh"])
+
+    elif parts[0:2] == ["spectrometer", "auto_exposure"]:
+        if check_spectrometer(spectrometer):
+            return
+        target = None
+        if len(parts) > 2:
             try:
-                t = int(parts[3]) # t is the time in microseconds to delay
-                set_trigger_delay(spectrometer, t)
-                software_trigger_delay = t
+                target = float(parts[2])
+                if not 0 < target < 1:
+                    raise ValueError()
             except ValueError:
-                print_cli("!!! Invalid argument: Set Trigger Delay command expected an integer.")
-                continue
-
-        elif parts[0:3] == ["spectrometer","set","integration_time"]:
-            if check_spectrometer(spectrometer):
-                continue
-            if len(parts) < 4:
-                print_cli("!!! Invalid command: Set Integration Time command expects at least 1 argument.")
-                continue
-            try:
-                t = int(parts[3])
-                set_integration_time(spectrometer, t)
-            except ValueError:
-                print_cli("!!! Invalid argument: Set Integration Time command expected an integer!")
-                continue
-            except SeaBreezeError as e:
-                print_cli("!!! " + str(e))
-                continue
-
-        elif parts[0:3] == ["spectrometer","set","sample_mode"]:
-            if check_spectrometer(spectrometer):
-                continue
-            if len(parts) < 4:
-                print_cli("!!! Invalid command: Set Sample Mode command expects at least 1 argument.")
-                continue
-
-            if parts[3] == "NORMAL" or parts[3] == "EXT_LEVEL" or parts[3] == "EXT_SYNC" or parts[3] == "EXT_EDGE":
-                set_sample_mode(spectrometer, parts[3])
-                mode = parts[3]
-            else:
-                print_cli("!!! Invalid argument: Set Sample Mode command expected one of: NORMAL, EXT_SYNC, EXT_LEVEL, EXT_EDGE")
-                continue
-
-        elif c == "spectrometer get integration_time":
-            if check_spectrometer(spectrometer):
-                continue
-            print_cli("Spectrometer integration time set to " + str(integration_time) + " microseconds.")
-            continue
-
-        elif c == "status":
-            give_status(spectrometer, laser)
-            continue
-
-        elif parts[0:4] == ["set","external_trigger_pin"]:
-            if len(parts) < 3:
-                print_cli("!!! Invalid command: Set external trigger pin command expects at least 1 argument.")
-                continue
-            try:
-                pin = parts[2]
-                if not pin.startswith("P8_") or pin.startswith("P9_"):
-                    raise ValueError("Invalid pin!")
-                set_external_trigger_pin(spectrometer, pin)
-                external_trigger_pin = pin
-            except:
-                cli_print("!!! " + pin + " is not a valid pin name! Should follow format such as: P8_22 or P9_16 (these are examples).")
-                continue
-
-        elif c == "get external_trigger_pin":
-            print_cli("External trigger pin is set to: " + external_trigger_pin)
-            continue
-
-        elif parts[0:3] == ["spectrometer","connect"]:
-            if len(parts) == 2:
-                spectrometer = auto_connect_spectrometer()
-            elif len(parts) == 3:
-                spectrometer = connect_spectrometer(parts[2])
-
-        elif c == "laser connect":
+                print_cli("!!! Invalid argument: Auto Exposure command expected a target fraction of saturation between 0 and 1.")
+                return
+        try:
+            run_auto_exposure(spectrometer, target)
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+            return
+
+    elif c == "spectrometer diff_registers":
+        if check_spectrometer(spectrometer):
+            return
+        for_each_device(spectrometer, diff_settings_register)
+
+    elif parts[0:3] == ["spectrometer","set","trigger_delay"]:
+        if check_spectrometer(spectrometer):
+            return
+        if len(parts) < 4:
+            print_cli("!!! Invalid command: Set Trigger Delay command expects at least 1 argument.")
+            return
+        try:
+            t = float(parts[3]) # t is the time in microseconds to delay
+            t = set_trigger_delay(spectrometer, t)
+        except ValueError:
+            print_cli("!!! Invalid argument: Set Trigger Delay command expected a number of microseconds from 0 to " +
+                      str(flame_registers.MAX_TRIGGER_DELAY) + ".")
+            return
+        print_cli("*** Trigger delay set to " + str(t) + " microseconds" +
+                  (" (in software, sample mode is NORMAL)." if sample_mode == "NORMAL" else "."))
+
+    elif c == "spectrometer get trigger_delay":
+        print_cli("Trigger delay set to " + str(trigger_delay) + " microseconds." + ("" if last_trigger_delay is None else
+                  " The last sample was taken " + str(round(last_trigger_delay, 1)) + " microseconds after the laser pulse."))
+
+    elif parts[0:3] == ["spectrometer","set","integration_time"]:
+        if check_spectrometer(spectrometer):
+            return
+        if len(parts) < 4:
+            print_cli("!!! Invalid command: Set Integration Time command expects at least 1 argument.")
+            return
+        try:
+            t = int(parts[3])
+            set_integration_time(spectrometer, t)
+        except ValueError:
+            print_cli("!!! Invalid argument: Set Integration Time command expected an integer!")
+            return
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+            return
+
+    elif parts[0:3] == ["spectrometer","set","sample_mode"]:
+        if check_spectrometer(spectrometer):
+            return
+        if len(parts) < 4:
+            print_cli("!!! Invalid command: Set Sample Mode command expects at least 1 argument.")
+            return
+
+        if parts[3] == "NORMAL" or parts[3] == "EXT_LEVEL" or parts[3] == "EXT_SYNC" or parts[3] == "EXT_EDGE":
+            set_sample_mode(spectrometer, parts[3])
+            mode = parts[3]
+        else:
+            print_cli("!!! Invalid argument: Set Sample Mode command expected one of: NORMAL, EXT_SYNC, EXT_LEVEL, EXT_EDGE")
+            return
+
+    elif c == "spectrometer get integration_time":
+        if check_spectrometer(spectrometer):
+            return
+        print_cli("Spectrometer integration time set to " + str(integration_time) + " microseconds.")
+        return
+
+    elif c == "status":
+        give_status(spectrometer, laser)
+        return
+
+    elif parts[0:2] == ["set","external_trigger_pin"]:
+        if len(parts) < 3:
+            print_cli("!!! Invalid command: Set external trigger pin command expects at least 1 argument.")
+            return
+        try:
+            pin = parts[2]
+            if not (pin.startswith("P8_") or pin.startswith("P9_")):
+                raise ValueError("Invalid pin!")
+            set_external_trigger_pin(pin)
+        except:
+            cli_print("!!! " + pin + " is not a valid pin name! Should follow format such as: P8_22 or P9_16 (these are examples).")
+            return
+
+    elif c == "get external_trigger_pin":
+        print_cli("External trigger pin is set to: " + external_trigger_pin)
+        return
+
+    elif parts[0:2] == ["set", "sample_format"]:
+        if len(parts) < 3 or parts[2] not in SAMPLE_FORMATS:
+            print_cli("!!! Invalid argument: Set sample format command expected one of: " + ", ".join(sorted(SAMPLE_FORMATS)))
+            return
+        sample_format = parts[2]
+        print_cli("*** Samples will be saved as " + sample_format + " (" + SAMPLE_FORMATS[sample_format] + ")")
+
+    elif c == "get sample_format":
+        print_cli("Samples are saved as: " + sample_format)
+
+    elif parts[0:2] == ["set", "auto_exposure"]:
+        if len(parts) < 3 or parts[2] not in ("on", "off"):
+            print_cli("!!! Invalid argument: Set auto exposure command expected on or off.")
+            return
+        auto_exposure_enabled = parts[2] == "on"
+        if auto_exposure_enabled and not check_spectrometer(spectrometer, False):
+            get_exposure_control(spectrometer).reset()
+        print_cli("*** Exposure checks between samples are " + parts[2] + ". Laser shots are only graded, " +
+                  "'spectrometer auto_exposure' sets the integration time on a continuous source.")
+
+    elif c == "get auto_exposure":
+        print_cli("Exposure checks between samples are " + ("on" if auto_exposure_enabled else "off"))
+
+    elif parts[0:2] == ["pipeline", "load"]:
+        if len(parts) < 3:
+            print_cli("!!! Invalid command: Pipeline Load command expects a configuration file.")
+            return
+        p = load_pipeline(parts[2], spectrometer)
+        if p:
+            pipeline = p
+
+    elif c == "quality show":
+        gate = get_quality_gate(spectrometer)
+        for line in gate.report():
+            print_cli(line)
+        for name, value in sorted(gate.thresholds().items()):
+            print_cli("\t" + name + " = " + ("off" if value is None else str(value)))
+
+    elif c == "quality reset":
+        get_quality_gate(spectrometer).reset()
+        print_cli("*** Quality tally cleared.")
+
+    elif parts[0:2] == ["quality", "action"]:
+        import shot_quality
+        if len(parts) != 3 or parts[2] not in shot_quality.ACTIONS:
+            print_cli("!!! Invalid argument: Quality Action command expected one of: " + ", ".join(shot_quality.ACTIONS))
+            return
+        get_quality_gate(spectrometer).action = parts[2]
+        print_cli("*** Shots that fail the quality checks will be " + {"drop": "dropped", "flag": "saved flagged", "off": "saved as usual"}[parts[2]] + ".")
+
+    elif parts[0:2] == ["quality", "set"]:
+        if len(parts) != 4:
+            print_cli("!!! Invalid command: Quality Set command expects a threshold name and a value (or 'off').")
+            return
+        try:
+            get_quality_gate(spectrometer).set_threshold(parts[2], parts[3])
+        except ValueError as e:
+            print_cli("!!! Invalid argument: " + str(e))
+            return
+        print_cli("*** " + parts[2] + " set to " + parts[3])
+
+    elif parts[0:1] == ["search"]:
+        search_samples(parts[1:])
+
+    elif parts[0:1] == ["recent"]:
+        recent_command(parts[1:])
+
+    elif parts[0:1] == ["watchdog"]:
+        watchdog_command(parts[1:])
+
+    elif parts[0:1] == ["find"]:
+        find_samples(parts[1:])
+
+    elif c == "pipeline off":
+        pipeline = None
+        print_cli("*** Spectra will be streamed unprocessed.")
+
+    elif c == "pipeline show":
+        if pipeline is None:
+            print_cli("No pipeline loaded.")
+            return
+        import json
+        print_cli(json.dumps(pipeline.config(), indent=4))
+
+    elif c == "pipeline timing":
+        if pipeline is None:
+            print_cli("No pipeline loaded.")
+            return
+        for line in pipeline.timing_report():
+            print_cli(line)
+
+    elif c == "pipeline dark":
+        if check_spectrometer(spectrometer):
+            return
+        if pipeline is None or pipeline.stage("dark") is None:
+            print_cli("!!! The loaded pipeline has no dark stage.")
+            return
+        try:
+            pipeline.stage("dark").set_dark(spectrometer.intensities())
+            print_cli("*** Dark spectrum captured.")
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+
+    elif parts[0:2] == ["spectrometer","connect"]:
+        unwatch_spectrometer() # Whatever connects next replaces the current spectrometer
+        if len(parts) == 2:
+            spectrometer = auto_connect_spectrometer()
+        elif parts[2] == "all":
+            spectrometer = connect_all_spectrometers()
+        elif len(parts) == 3:
+            spectrometer = connect_spectrometer(parts[2])
+
+    elif parts[0:2] == ["laser", "connect"]:
+        if len(parts) > 2:
+            port = parts[2]
+        else:
             port = user_select_port()
-            if not port:
-                cli_print("!!! Aborting connect laser.")
-                continue
-            laser = Laser()
-            print_cli("Connecting to laser...")
-            laser.connect(port)
-            print_cli("Refreshing settings...")
-            laser.refresh_parameters()
-            s = laser.get_status()
-            if not s:
-                cli_print("!!! Failed to connect to laser!")
-                continue
-            cli_print("Laser Status:")
-            cli_print("ID: " + laser.get_laser_ID() + "\n")
-            cli_print(str(s))
-            print_cli("Rep rate: " + str(laser.repRate) + "Hz")
-            print_cli("Pulse width: " + str(laser.pulseWidth) + "s")
-            print_cli("Pulse mode: " + str(laser.pulseMode))
-            print_cli("Burst count: " + str(laser.burstCount))
-        elif c == "laser arm":
-            if check_laser(laser):
-                continue
-            try:
-                if laser.arm():
-                    print_cli("*** Laser ARMED")
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while arming laser: " + str(e))
-                continue
-        elif c == "laser disarm":
-            if check_laser(laser):
-                continue
-            try:
-                if laser.disarm():
-                    print_cli("*** Laser DISARMED")
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while disarming laser: " + str(e))
-                continue
-        elif c == "laser status":
-            if check_laser(laser):
-                print_cli("Laser is not connected.")
-                continue
-            s = laser.get_status()
-            print_cli(str(s))
-            print_cli("Rep rate: " + str(laser.repRate) + "Hz")
-            print_cli("Pulse width: " + str(laser.pulseWidth) + "s")
-            print_cli("Pulse mode: " + str(laser.pulseMode))
-            print_cli("Burst count: " + str(laser.burstCount))
-        elif c == "laser fire":
-            if check_laser(laser):
-                continue
-            laser.fire()
+        if not port:
+            cli_print("!!! Aborting connect laser.")
+            return
+        l = connect_laser(port)
+        if l:
+            laser = serialize_laser(l)
+            get_watchdog().start()
+            print_cli("*** Laser watchdog running, see 'watchdog show'.")
+    elif c == "laser arm":
+        if check_laser(laser):
+            return
+        w = get_watchdog()
+        if not w.power_on(): # The enable line only goes high here, when the operator asks for it
+            print_cli("!!! Laser watchdog tripped: " + w.tripped.reason + ". Check the laser, then use 'watchdog reset' and arm it again.")
+            return
+        try:
+            if laser.arm():
+                print_cli("*** Laser ARMED")
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while arming laser: " + str(e))
+            return
+    elif c == "laser disarm":
+        if check_laser(laser):
+            return
+        try:
+            if laser.disarm():
+                print_cli("*** Laser DISARMED")
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while disarming laser: " + str(e))
+        finally:
+            get_watchdog().power_off()
+    elif c == "laser status":
+        if check_laser(laser):
+            print_cli("Laser is not connected.")
+            return
+        s = laser.get_status()
+        print_cli(str(s))
+        print_cli("Rep rate: " + str(laser.repRate) + "Hz")
+        print_cli("Pulse width: " + str(laser.pulseWidth) + "s")
+        print_cli("Pulse mode: " + str(laser.pulseMode))
+        print_cli("Burst count: " + str(laser.burstCount))
+    elif c == "laser fire":
+        if check_laser(laser):
+            return
+        laser.fire()
+
+    elif c == "laser stop":
+        sample_abort.set()
+        if check_laser(laser):
+            return
+        laser.emergency_stop()
+
+    elif parts[0:3] == ["laser","set","rep_rate"]: # TODO: Add check to see if this is within the repetition rate.
+        if check_laser(laser):
+            return
+        
+        if len(parts) < 4:
+            print_cli("!!! Set Laser Rep Rate expects a number argument!")
+            return
+        try:
+            rate = float(parts[3])
+            if rate < 0:
+                raise ValueError("Repetition Rate must be positive!")
+            laser.set_repetition_rate(rate)
+        except ValueError:
+            print_cli("!!! Set Laser Rep Rate expects a positive float argument! You did not enter a float value!")
+            return
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while commanding laser! " + str(e))
+            return
+       
+    elif parts[0:3] == ["laser", "get", "rep_rate"]:
+        if check_laser(laser):
+            return
 
-        elif c == "laser stop":
-            if check_laser(laser):
-                continue
-            laser.emergency_stop()
+        try:
+            r = laser.get_repetition_rate()
+            print_cli("Laser repetition rate set to: " + str(r) + "Hz")
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while commanding laser! " + str(e))
+            return
+
+    elif parts[0:3] == ["laser", "get", "pulse_mode"]:
+        if check_laser(laser):
+            return
+        try:
+            r = laser.get_pulse_mode()
+            s = "UNKOWN"
+            if r == 0:
+                s = "CONTINUOUS"
+            elif r == 1:
+                s = "SINGLE"
+            elif r == 2:
+                s = "BURST"
+
+            print_cli("Laser is set to fire in " + s + " mode.")
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while commanding laser! " + str(e))
+            return
+
+    elif parts[0:3] == ["laser","set","pulse_mode"]:
+        if check_laser(laser):
+            return
+        if len(parts) < 4:
+            print_cli("!!! Set Laser Pulse Mode expects one of the following arguments: CONTINUOUS, SINGLE, BURST!")
+            return
+        else:
+            if parts[3] == "CONTINUOUS":
+                laser.set_pulse_mode(0)
+                laserSingleShot = True
 
-        elif parts[0:3] == ["laser","set","rep_rate"]: # TODO: Add check to see if this is within the repetition rate.
-            if check_laser(laser):
-                continue
+            elif parts[3] == "SINGLE":
+                laser.set_pulse_mode(1)
+                laserSingleShot = True
             
-            if len(parts) < 4:
-                print_cli("!!! Set Laser Rep Rate expects a number argument!")
-                continue
-            try:
-                rate = float(parts[3])
-                if rate < 0:
-                    raise ValueError("Repetition Rate must be positive!")
-                laser.set_repetition_rate(rate)
-            except ValueError:
-                print_cli("!!! Set Laser Rep Rate expects a positive float argument! You did not enter a float value!")
-                continue
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while commanding laser! " + str(e))
-                continue
-       
-        elif parts[0:3] == ["laser", "get", "rep_rate"]:
-            if check_laser(laser):
-                continue
+            elif parts[3] == "BURST":
+                laser.set_pulse_mode(2)
+                laserSingleShot = False
+    
+    elif parts[0:3] == ["laser","set","burst_count"]:
+        if check_laser(laser):
+            return
 
-            try:
-                r = laser.get_repetition_rate()
-                print_cli("Laser repetition rate set to: " + str(r) + "Hz")
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while commanding laser! " + str(e))
-                continue
-
-        elif parts[0:3] == ["laser", "get", "pulse_mode"]:
-            if check_laser(laser):
-                continue
-            try:
-                r = laser.get_pulse_mode()
-                s = "UNKOWN"
-                if r == 0:
-                    s = "CONTINUOUS"
-                elif r == 1:
-                    s = "SINGLE"
-                elif r == 2:
-                    s = "BURST"
-
-                print_cli("Laser is set to fire in " + s + " mode.")
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while commanding laser! " + str(e))
-                continue
-
-        elif parts[0:3] == ["laser","set","pulse_mode"]:
-            if check_laser(laser):
-                continue
-            if len(parts) < 4:
-                print_cli("!!! Set Laser Pulse Mode expects one of the following arguments: CONTINUOUS, SINGLE, BURST!")
-                continue
-            else:
-                if parts[3] == "CONTINUOUS":
-                    laser.set_pulse_mode(0)
-                    laserSingleShot = True
-
-                elif parts[3] == "SINGLE":
-                    laser.set_pulse_mode(1)
-                    laserSingleShot = True
-                
-                elif parts[3] == "BURST":
-                    laser.set_pulse_mode(2)
-                    laserSingleShot = False
-        
-        elif parts[0:3] == ["laser","set","burst_count"]:
-            if check_laser(laser):
-                continue
+        if len(parts) < 4:
+            print_cli("!!! Set Laser Burst Count expects an integer argument!")
+            return
 
-            if len(parts) < 4:
-                print_cli("!!! Set Laser Burst Count expects an integer argument!")
-                continue
+        if laser.pulseMode != 2:
+            print_cli("!!! Please set Laser Pulse Mode to BURST before setting the burst count!")
+            return
+        try:
+            burst_count = int(parts[3])
+            if burst_count < 0:
+                raise ValueError("Burst Count must be positive!")
+            laser.set_burst_count(burst_count)
+        except ValueError:
+            print_cli("!!! Set Laser Burst Count expects a positive integer argument! You did not enter an integer.")
+            return
+
+    elif parts[0:3] == ["laser", "get", "burst_count"]:
+        if check_laser(laser):
+            return
 
-            if laser.pulseMode != 2:
-                print_cli("!!! Please set Laser Pulse Mode to BURST before setting the burst count!")
-                continue
-            try:
-                burst_count = int(parts[3])
-                if burst_count < 0:
-                    raise ValueError("Burst Count must be positive!")
-                laser.set_burst_count(burst_count)
-            except ValueError:
-                print_cli("!!! Set Laser Burst Count expects a positive integer argument! You did not enter an integer.")
-                continue
+        try:
+            r = laser.get_burst_count()
+            print_cli("Laser set to " + str(r) + " pulses per sample")
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while commanding laser! " + str(e))
 
-        elif parts[0:3] == ["laser", "get", "burst_count"]:
-            if check_laser(laser):
-                continue
+    elif parts[0:3] == ["laser","set","pulse_width"]:
+        if check_laser(laser):
+            return
+            
+        if len(parts) < 4:
+            print_cli("!!! Set Laser Pulse Width expects a positive float argument!")
+            return
+        try:
+            width = float(parts[3])
+            laser.set_pulse_width(width)
+        except ValueError:
+            print_cli("!!! Set Laser Pulse Width expects a float argument! You did not enter a float.")
+            return
+        except LaserCommandError as e:
+            print_cli("!!! Error encountered while commanding laser! " + str(e))
+            return
 
-            try:
-                r = laser.get_burst_count()
-                print_cli("Laser set to " + str(r) + " pulses per sample")
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while commanding laser! " + str(e))
-
-        elif parts[0:3] == ["laser","set","pulse_width"]:
-            if check_laser(laser):
-                continue
-                
-            if len(parts) < 4:
-                print_cli("!!! Set Laser Pulse Width expects a positive float argument!")
-                continue
-            try:
-                width = float(parts[3])
-                laser.set_pulse_width(width)
-            except ValueError:
-                print_cli("!!! Set Laser Pulse Width expects a float argument! You did not enter a float.")
-                continue
-            except LaserCommandError as e:
-                print_cli("!!! Error encountered while commanding laser! " + str(e))
-                continue
-
-        elif parts[0:3] == ["laser", "get", "pulse_width"]:
-            if check_laser(laser):
-                continue
-            try:
-                r = laser.get_pulse_width()
-            except LaserCommandError as e:
-                print_cli("!!! Error while commanding laser: " + str(e))
-                continue
-            if not r:
-                print_cli("!!! Error while querying the laser for pulse width!")
-                continue
-            print_cli("Laser pulse width is set to: " + str(r))
-
-        elif parts[0:3] == ["laser","get","fet_temp"]:
-            if check_laser(laser):
-                continue
-            t = laser.get_fet_temp()
-            print_cli("Laser FET temperature: " + str(t))
-
-        elif parts[0:3] == ["laser", "get", "shot_count"]:
-            shot_count = laser.get_system_shot_count()
-            print_cli("The laser shot count is at " + str(shot_count) + " shots.")
-        
-        elif parts[0:3] == ["laser", "get", "diode_current"]:
-            diode_current = laser.get_diode_current()
-            print_cli("The laser's diode current is " + str(diode_current) + " Amps")
+    elif parts[0:3] == ["laser", "get", "pulse_width"]:
+        if check_laser(laser):
+            return
+        try:
+            r = laser.get_pulse_width()
+        except LaserCommandError as e:
+            print_cli("!!! Error while commanding laser: " + str(e))
+            return
+        if not r:
+            print_cli("!!! Error while querying the laser for pulse width!")
+            return
+        print_cli("Laser pulse width is set to: " + str(r))
+
+    elif parts[0:3] == ["laser","get","fet_temp"]:
+        if check_laser(laser):
+            return
+        t = laser.get_fet_temp()
+        print_cli("Laser FET temperature: " + str(t))
+
+    elif parts[0:3] == ["laser", "get", "shot_count"]:
+        if check_laser(laser):
+            return
+        shot_count = laser.get_system_shot_count()
+        print_cli("The laser shot count is at " + str(shot_count) + " shots.")
+    
+    elif parts[0:3] == ["laser", "get", "diode_current"]:
+        if check_laser(laser):
+            return
+        diode_current = laser.get_diode_current()
+        print_cli("The laser's diode current is " + str(diode_current) + " Amps")
+
+    elif c == "do_libs_sample":
+        if check_laser(laser) or check_spectrometer(spectrometer):
+            return
+        try:
+            do_sample(spectrometer, laser)
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+            return
+        except LaserCommandError as e:
+            print_cli("!!! Error while commanding laser! " + str(e))
 
-        elif c == "do_libs_sample":
-            if check_laser(laser) or check_spectrometer(spectrometer):
-                continue
-            try:
-                do_sample(spectrometer, laser)
-            except SeaBreezeError as e:
-                print_cli("!!! " + str(e))
-                continue
-            except LaserCommandError as e:
-                print_cli("!!! Error while commanding laser! " + str(e))
-        
-        elif c == "do_trigger":
-            do_trigger(external_trigger_pin)
-            print_cli("Triggered " + external_trigger_pin + ".") 
+    elif parts[0:1] == ["do_libs_burst"]:
+        if check_laser(laser) or check_spectrometer(spectrometer):
+            return
+        if len(parts) < 2:
+            print_cli("!!! Invalid command: LIBS Burst command expects a sample count argument.")
+            return
+        try:
+            count = int(parts[1])
+            if count < 1:
+                raise ValueError("Sample count must be positive!")
+        except ValueError:
+            print_cli("!!! Invalid argument: LIBS Burst command expected a positive integer.")
+            return
+        try:
+            do_burst(spectrometer, laser, count)
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+        except LaserCommandError as e:
+            print_cli("!!! Error while commanding laser! " + str(e))
+    
+    elif parts[0:1] == ["do_delay_series"]:
+        if check_laser(laser) or check_spectrometer(spectrometer):
+            return
+        if len(parts) < 4:
+            print_cli("!!! Invalid command: Delay Series command expects START STOP STEP (microseconds) and optionally a shot count.")
+            return
+        try:
+            import delay_series
+            delays = delay_series.delay_steps(float(parts[1]), float(parts[2]), float(parts[3]))
+            shots = int(parts[4]) if len(parts) > 4 else 1
+            if shots < 1:
+                raise ValueError("Shot count must be positive!")
+            for d in (delays[0], delays[-1]):
+                flame_registers.trigger_delay_cycles(d)
+            delay_series.check_size(len(delays), shots, len(spectrometer.wavelengths()))
+        except ValueError as e:
+            print_cli("!!! Invalid argument: " + str(e))
+            return
+        try:
+            do_delay_series(spectrometer, laser, delays, shots)
+        except SeaBreezeError as e:
+            print_cli("!!! " + str(e))
+        except LaserCommandError as e:
+            print_cli("!!! Error while commanding laser! " + str(e))
+
+    elif c == "cancel": # Only reaches here when nothing can be running alongside (libs_async handles it itself)
+        print_cli("!!! Nothing to cancel. Without the event loop (--blocking) acquisitions run in the foreground, press Ctrl-C to cancel one.")
+
+    elif c == "do_trigger":
+        do_trigger(external_trigger_pin)
+        print_cli("Triggered " + external_trigger_pin + ".") 
        
-        elif c == "exit" or c == "quit":
-            if spectrometer:
-                spectrometer.close()
-            if laser:
-                laser.disconnect()
-            running = False
-        else:
-            print_cli("!!! Invalid command. Enter the 'help' command for usage information")
+    elif c == "exit" or c == "quit":
+        if spectrometer:
+            spectrometer.close()
+        if laser:
+            laser.disconnect()
+        running = False
+    else:
+        print_cli("!!! Invalid command. Enter the 'help' command for usage information")
 
 # Root commands allow the user to specify which instrument (laser or spectrometer) they are interacting with, or interact with other aspects of the program
-ROOT_COMMANDS = ["help", "exit", "quit", "laser", "spectrometer", "set", "get", "status", "do_libs_sample", "do_trigger"]
+ROOT_COMMANDS = ["help", "exit", "quit", "laser", "spectrometer", "set", "get", "status", "do_libs_sample", "do_libs_burst", "do_delay_series", "do_trigger", "cancel", "pipeline", "search", "quality", "recent", "watchdog", "find"]
 
 # Actions are things that the user can do to the laser and spectrometer
-SPECTROMETER_ACTIONS = ["spectrum", "set", "get", "connect", "status", "dump_registers", "query_settings"]
+SPECTROMETER_ACTIONS = ["spectrum", "set", "get", "connect", "status", "dump_registers", "query_settings", "diff_registers", "auto_exposure"]
 LASER_ACTIONS = ["connect", "status", "arm", "disarm", "fire", "set", "get", "stop"]
+PIPELINE_ACTIONS = ["load", "off", "show", "timing", "dark"]
+QUALITY_ACTIONS = ["show", "reset", "action", "set"]
+RECENT_ACTIONS = ["list", "diff", "export", "replay", "dump", "size", "clear"]
+WATCHDOG_ACTIONS = ["show", "start", "stop", "reset", "set"]
+FIND_TERMS = ["backfill", "line=", "since=", "until=", "limit=", "source=", "flagged=", "integration_time=", "sample_mode=",
+              "trigger_delay=", "rep_rate=", "pulse_width=", "pulse_mode=", "burst_count=", "serial=", "max_intensity>",
+              "total_counts>", "signal>", "noise<", "line_count>"]
 
 # Properties are things that can be get and/or set by the user
 SPECTROMETER_PROPERTIES = ["sample_mode", "trigger_delay", "integration_time"]
 LASER_PROPERTIES = ["diode_current", "fet_temp", "pulse_width", "rep_rate", "pulse_mode", "burst_count", "shot_count"]
-ROOT_PROPERTIES = ["external_trigger_pin"]
+ROOT_PROPERTIES = ["external_trigger_pin", "sample_format", "auto_exposure"]
 
 def tab_completer(text, state):
     text = readline.get_line_buffer()
@@ -710,6 +1610,58 @@ def tab_completer(text, state):
                 else:
                     state -= 1
 
+    elif root == "pipeline":
+        if len(parts) < 2:
+            parts[1] = ""
+
+        for a in PIPELINE_ACTIONS:
+            if a.startswith(parts[1]):
+                if not state:
+                    return a
+                else:
+                    state -= 1
+
+    elif root == "quality":
+        if len(parts) < 2:
+            parts[1] = ""
+
+        for a in QUALITY_ACTIONS:
+            if a.startswith(parts[1]):
+                if not state:
+                    return a
+                else:
+                    state -= 1
+
+    elif root == "recent":
+        if len(parts) < 2:
+            parts[1] = ""
+
+        for a in RECENT_ACTIONS:
+            if a.startswith(parts[1]):
+                if not state:
+                    return a
+                else:
+                    state -= 1
+
+    elif root == "watchdog":
+        if len(parts) < 2:
+            parts[1] = ""
+
+        for a in WATCHDOG_ACTIONS:
+            if a.startswith(parts[1]):
+                if not state:
+                    return a
+                else:
+                    state -= 1
+
+    elif root == "find":
+        for t in FIND_TERMS: # Completes the term being typed, any number of them can be given
+            if t.startswith(parts[-1]):
+                if not state:
+                    return t
+                else:
+                    state -= 1
+
     elif action in ["get", "set"] and root == "laser":
         if len(parts) < 3:
             parts[2] = ""
@@ -754,17 +1706,45 @@ def main():
     parser.add_argument("--laser-dev", "-l", help="Specify the USB device for the laser.", nargs=1, default=None)
     parser.add_argument("--config", "-c", help="Read test configuration from the specified JSON file.", nargs=1, default=None)
     parser.add_argument("--no-interact", "-n", help="Do not run in interactive mode. Usually used when a pre-written test configuration file is being used.", dest="interactive", action="store_false", default=True)
+    parser.add_argument("--blocking", "-b", help="Use the old blocking command loop instead of the asyncio event loop.", action="store_true", default=False)
+    parser.add_argument("--stream", help="Stream every acquired spectrum to remote viewers (core_ui.py --subscribe) on [HOST:]PORT.", metavar="ADDRESS", nargs=1, default=None)
+    parser.add_argument("--server", help="Run headless, serving the CLI commands as JSON-RPC on ADDRESS (unix:/path/to/socket or tcp:host:port).", metavar="ADDRESS", nargs=1, default=None)
     a = parser.parse_args()
     
     command_log = open(LOG_PATH + "LOG_" + str(int(time.time())) + ".log", "w")
+    global device_manager
+    device_manager = DeviceManager(on_change=device_change)
+    threading.Thread(target=start_hardware, name="driver-load-thread", daemon=True).start()
     GPIO.setup(external_trigger_pin, GPIO.OUT)
     GPIO.output(external_trigger_pin, GPIO.HIGH)
+
+    if a.stream:
+        global stream_publisher
+        import spectrum_stream
+        host, port = spectrum_stream.parse_address(a.stream[0])
+        if host.isdigit() and port == spectrum_stream.DEFAULT_PORT:
+            host, port = "0.0.0.0", int(host) # Only a port number was given
+        stream_publisher = spectrum_stream.SpectrumPublisher(host, port)
+        print_cli("*** Streaming spectra on " + str(stream_publisher.address))
     
-    if a.interactive:
+    if a.server:
+        import libs_server
+        libs_server.LibsServer(sys.modules[__name__]).serve(a.server[0])
+    elif a.interactive:
         readline.parse_and_bind("tab: complete")
         readline.set_completer(tab_completer)
-        command_loop()
-
+        if a.blocking:
+            command_loop()
+        else:
+            import libs_async
+            libs_async.LibsEventLoop(sys.modules[__name__]).run()
+
+    if stream_publisher:
+        stream_publisher.close()
+    if watchdog is not None:
+        watchdog.stop()
+    unwatch_spectrometer()
+    device_manager.stop()
     GPIO.cleanup()
     command_log.close()
     
@@ -0,0 +1,363 @@
+"""
+libs_server.py
+
+Headless control server for libs_cli. Exposes the CLI commands as JSON-RPC 2.0 over a Unix or TCP socket, one JSON
+object per line. Any number of clients can connect and read status, but only the session holding control (see
+acquire_control) may change settings, fire the laser or take samples. Lines printed while a command runs are streamed
+back to the caller as "output" notifications before the final response. Nobody is at a terminal to answer questions, so
+a command that would ask one fails with PROMPT_ERROR; give the answer as an argument instead ('spectrometer spectrum
+NAME', 'laser connect PORT'). A command that raises fails with INTERNAL_ERROR.
+
+'laser stop' and 'cancel' never wait for the command that is running: they end it between shots and stop the laser on
+a thread of their own, and any session may send them, with or without control.
+
+Example session:
+    -> {"jsonrpc": "2.0", "id": 1, "method": "acquire_control"}
+    <- {"jsonrpc": "2.0", "id": 1, "result": true}
+    -> {"jsonrpc": "2.0", "id": 2, "method": "set", "params": {"device": "spectrometer", "property": "integration_time", "value": 6000}}
+    <- {"jsonrpc": "2.0", "method": "output", "params": {"id": 2, "line": "*** Integration time set to 6000 microseconds."}}
+    <- {"jsonrpc": "2.0", "id": 2, "result": {"ok": true, "output": ["*** Integration time set to 6000 microseconds."]}}
+
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+CONTROL_ERROR = -32000 # Server defined: the session does not hold control
+PROMPT_ERROR = -32001 # Server defined: the command stopped to ask a question, which nobody is there to answer
+
+class RPCError(Exception):
+    """Raised by LibsClient when the server answers with an error."""
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+class Session():
+    """One connected client."""
+    def __init__(self, number, writer):
+        self.number = number
+        self.writer = writer
+
+    def send(self, message):
+        self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+class LibsServer():
+    """Serves the libs_cli command set over JSON-RPC.
+
+    cli is the libs_cli module (or anything with the same handle_command/output_listeners interface). Commands are run
+    one at a time on a single worker thread, in the order they arrive, apart from the STOP_COMMANDS (see stop).
+    """
+    # Methods that change the state of the hardware and therefore need control of the session
+    CONTROLLED_METHODS = ["release_control", "connect", "set", "fire", "do_libs_sample", "command"]
+    # Command lines that would ask the operator a question, with the argument that answers it up front
+    PROMPTING_COMMANDS = {"spectrometer spectrum": "a file name", "laser connect": "a serial port"}
+    # Command lines that are handled as soon as they arrive instead of queueing behind the running command
+    STOP_COMMANDS = ["laser stop", "cancel"]
+
+    def __init__(self, cli):
+        self.cli = cli
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(1)
+        self.stop_executor = ThreadPoolExecutor(1) # Reserved for 'laser stop' so it never queues behind a command
+        self.queued = 0 # Commands submitted to the worker thread and not finished yet
+        self.controller = None
+        self.servers = []
+        self.session_count = 0
+        self.requests = set() # Requests being handled, kept referenced until they finish
+        self.methods = {"acquire_control": self.acquire_control,
+                        "release_control": self.release_control,
+                        "connect": self.connect,
+                        "set": self.set,
+                        "get": self.get,
+                        "fire": self.fire,
+                        "do_libs_sample": self.do_libs_sample,
+                        "status": self.status,
+                        "command": self.command}
+
+    def listen(self, address):
+        """Starts listening on address ("unix:/path" or "tcp:host:port"). Returns the bound socket address."""
+        asyncio.set_event_loop(self.loop)
+        kind, _, rest = address.partition(":")
+        if kind == "unix":
+            coro = asyncio.start_unix_server(self._client, path=rest)
+        elif kind == "tcp":
+            host, _, port = rest.rpartition(":")
+            coro = asyncio.start_server(self._client, host, int(port))
+        else:
+            raise ValueError("Unknown server address " + address + ", expected unix:/path or tcp:host:port")
+        server = self.loop.run_until_complete(coro)
+        self.servers.append(server)
+        self.cli.prompt_input = self._refuse_prompt
+        return server.sockets[0].getsockname()
+
+    def serve(self, address):
+        """Listens on address and serves requests until the 'exit' command is run or the process is interrupted."""
+        bound = self.listen(address)
+        self.cli.print_cli("*** Serving JSON-RPC on " + str(bound))
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops listening and shuts down the worker thread."""
+        for server in self.servers:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
+        self.servers = []
+        self.cli.prompt_input = None
+        self.executor.shutdown(wait=True)
+        self.stop_executor.shutdown(wait=True)
+        self.loop.close()
+
+    async def _client(self, reader, writer):
+        self.session_count += 1
+        session = Session(self.session_count, writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Requests are handled concurrently so a stop is read while this session's command is still running.
+                # Commands still run in the order they arrive, on the one worker thread.
+                task = asyncio.ensure_future(self._respond(session, line))
+                self.requests.add(task)
+                task.add_done_callback(self.requests.discard)
+        except ConnectionError:
+            pass
+        finally:
+            if self.controller is session:
+                self.controller = None
+            writer.close()
+
+    async def _respond(self, session, line):
+        response = await self.handle_request(session, line)
+        if response is not None:
+            session.send(response)
+        try:
+            await session.writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_request(self, session, line):
+        """Handles one JSON-RPC request line. Returns the response object, or None for notifications."""
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError:
+            return _error(None, PARSE_ERROR, "Parse error")
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return _error(None, INVALID_REQUEST, "Invalid request")
+
+        rid = request.get("id")
+        method = request["method"]
+        params = request.get("params", {})
+        if method not in self.methods:
+            return _error(rid, METHOD_NOT_FOUND, "Method not found: " + method)
+        if not isinstance(params, dict):
+            return _error(rid, INVALID_PARAMS, "params must be an object")
+        stop = method == "command" and " ".join(str(params.get("line")).split()) in self.STOP_COMMANDS
+        if method in self.CONTROLLED_METHODS and self.controller is not session and not stop:
+            return _error(rid, CONTROL_ERROR, "This session does not have control. Call acquire_control first.")
+
+        try:
+            result = await self.methods[method](session, rid, params)
+        except RPCError as e: # Including INVALID_PARAMS, raised by the methods while they check their params
+            return _error(rid, e.code, str(e))
+        except Exception as e: # A failing command must not take the session (or the server) down
+            return _error(rid, INTERNAL_ERROR, "Internal error: " + type(e).__name__ + ": " + str(e))
+
+        if not self.cli.running:
+            self.loop.call_soon(self.loop.stop)
+        if rid is None:
+            return None
+        return {"jsonrpc": "2.0", "id": rid, "result": result}
+
+    async def run_command(self, session, rid, line):
+        """Runs a CLI command line on the worker thread, streaming its output to session."""
+        self.queued += 1
+        try:
+            return await self.loop.run_in_executor(self.executor, self._run_command, session, rid, line)
+        finally:
+            self.queued -= 1
+
+    async def stop(self, session, rid, line):
+        """Handles 'laser stop' or 'cancel' right away: the running command is asked to end after the current shot and,
+        for 'laser stop', emergency_stop() is sent from the stop thread, the way libs_async's event loop does it."""
+        output = []
+        def report(txt):
+            output.append(txt)
+            if rid is not None:
+                session.send({"jsonrpc": "2.0", "method": "output", "params": {"id": rid, "line": txt}})
+        self.cli.sample_abort.set()
+        if line == "cancel":
+            report("*** Cancelling the running command after the current shot..." if self.queued else
+                   "*** Nothing to cancel.")
+        elif self.cli.laser is None:
+            report("!!! This command requires the laser to be connected! Use 'laser connect' first!")
+        else:
+            start = time.monotonic()
+            try:
+                await self.loop.run_in_executor(self.stop_executor, self.cli.laser.emergency_stop)
+                report("*** Laser stopped (" + str(round((time.monotonic() - start) * 1000, 1)) + " ms)")
+            except Exception as e:
+                report("!!! Emergency stop failed: " + type(e).__name__ + ": " + str(e))
+        return {"ok": not any(l.startswith("!!!") for l in output), "output": output}
+
+    def _run_command(self, session, rid, line):
+        output = []
+        def listener(txt):
+            output.append(txt)
+            if rid is not None:
+                message = {"jsonrpc": "2.0", "method": "output", "params": {"id": rid, "line": txt}}
+                self.loop.call_soon_threadsafe(session.send, message)
+        self.cli.output_listeners.append(listener)
+        try:
+            self.cli.log_input("?" + line)
+            self.cli.handle_command(line)
+        finally:
+            self.cli.output_listeners.remove(listener)
+        ok = not any(l.startswith("!!!") for l in output)
+        return {"ok": ok, "output": output}
+
+    @staticmethod
+    def _refuse_prompt(text):
+        """prompt_input hook for the CLI: there is no terminal to answer questions on."""
+        raise RPCError(PROMPT_ERROR, "The command asked '" + text.strip() + "', which cannot be answered over JSON-RPC. " +
+                       "Give the answer as an argument of the command instead.")
+
+    # RPC methods ______________________________________________________________________________________________________
+
+    async def acquire_control(self, session, rid, params):
+        if self.controller is not None and self.controller is not session:
+            raise RPCError(CONTROL_ERROR, "Session " + str(self.controller.number) + " already has control.")
+        self.controller = session
+        return True
+
+    async def release_control(self, session, rid, params):
+        self.controller = None
+        return True
+
+    async def connect(self, session, rid, params):
+        device = _param(params, "device")
+        if device == "spectrometer":
+            line = "spectrometer connect"
+            if params.get("serial"):
+                line += " " + str(params["serial"])
+        elif device == "laser":
+            line = "laser connect " + str(_param(params, "port"))
+        else:
+            raise _invalid_params("device must be 'spectrometer' or 'laser'")
+        return await self.run_command(session, rid, line)
+
+    async def set(self, session, rid, params):
+        line = self._property_command("set", params) + " " + str(_param(params, "value"))
+        return await self.run_command(session, rid, line)
+
+    async def get(self, session, rid, params):
+        return await self.run_command(session, rid, self._property_command("get", params))
+
+    async def fire(self, session, rid, params):
+        return await self.run_command(session, rid, "laser fire")
+
+    async def do_libs_sample(self, session, rid, params):
+        return await self.run_command(session, rid, "do_libs_sample")
+
+    async def status(self, session, rid, params):
+        return await self.run_command(session, rid, "status")
+
+    async def command(self, session, rid, params):
+        line = " ".join(str(_param(params, "line")).split())
+        if line in self.STOP_COMMANDS:
+            return await self.stop(session, rid, line)
+        if line in self.PROMPTING_COMMANDS:
+            raise RPCError(PROMPT_ERROR, "'" + line + "' asks for " + self.PROMPTING_COMMANDS[line] +
+                           ", give it as an argument: '" + line + " ...'")
+        return await self.run_command(session, rid, line)
+
+    def _property_command(self, action, params):
+        device = params.get("device", "root")
+        prop = _param(params, "property")
+        if device == "spectrometer":
+            valid = self.cli.SPECTROMETER_PROPERTIES
+        elif device == "laser":
+            valid = self.cli.LASER_PROPERTIES
+        elif device == "root":
+            valid = self.cli.ROOT_PROPERTIES
+        else:
+            raise _invalid_params("device must be 'spectrometer', 'laser' or 'root'")
+        if prop not in valid:
+            raise _invalid_params("unknown " + str(device) + " property " + str(prop))
+        if device == "root":
+            return action + " " + prop
+        return device + " " + action + " " + prop
+
+def _invalid_params(message):
+    return RPCError(INVALID_PARAMS, "Invalid params: " + message)
+
+def _param(params, name):
+    """params[name], or INVALID_PARAMS if it is missing."""
+    if name not in params:
+        raise _invalid_params("missing '" + name + "'")
+    return params[name]
+
+def _error(rid, code, message):
+    return {"jsonrpc": "2.0", "id": rid, "error": {"code": code, "message": message}}
+
+class LibsClient():
+    """Minimal blocking client for LibsServer, for scripts and tests.
+
+    address uses the same format as the server: "unix:/path" or "tcp:host:port".
+    """
+    def __init__(self, address, timeout=None):
+        kind, _, rest = address.partition(":")
+        if kind == "unix":
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(rest)
+        elif kind == "tcp":
+            host, _, port = rest.rpartition(":")
+            self.sock = socket.create_connection((host, int(port)), timeout)
+        else:
+            raise ValueError("Unknown server address " + address)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    def call(self, method, on_output=None, **params):
+        """Calls method and returns its result. on_output, if given, is called with each streamed output line.
+        Raises RPCError if the server returns an error."""
+        with self.lock:
+            rid = self.next_id
+            self.next_id += 1
+            request = {"jsonrpc": "2.0", "id": rid, "method": method, "params": params}
+            self.file.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.file.flush()
+            while True:
+                line = self.file.readline()
+                if not line:
+                    raise ConnectionError("Server closed the connection")
+                message = json.loads(line.decode("utf-8"))
+                if message.get("method") == "output":
+                    if on_output is not None:
+                        on_output(message["params"]["line"])
+                    continue
+                if message.get("id") != rid:
+                    continue
+                if "error" in message:
+                    raise RPCError(message["error"]["code"], message["error"]["message"])
+                return message["result"]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
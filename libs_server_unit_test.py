@@ -0,0 +1,162 @@
+import unittest
+import os
+import tempfile
+import threading
+import time
+import libs_server
+
+class MockLaser():
+    def __init__(self):
+        self.stops = 0
+
+    def emergency_stop(self):
+        self.stops += 1
+
+class MockCli():
+    """Stands in for the libs_cli module: echoes every command it is given."""
+    SPECTROMETER_PROPERTIES = ["sample_mode", "trigger_delay", "integration_time"]
+    LASER_PROPERTIES = ["rep_rate"]
+    ROOT_PROPERTIES = ["external_trigger_pin"]
+
+    def __init__(self):
+        self.running = True
+        self.output_listeners = []
+        self.commands = []
+        self.prompt_input = None
+        self.sample_abort = threading.Event()
+        self.laser = MockLaser()
+
+    def print_cli(self, txt):
+        for listener in self.output_listeners:
+            listener(txt)
+
+    def log_input(self, txt):
+        pass
+
+    def handle_command(self, c):
+        self.commands.append(c)
+        if c.startswith("laser fire"):
+            self.print_cli("!!! This command requires the laser to be connected! Use 'laser connect' first!")
+        elif c == "laser get diode_current":
+            raise AttributeError("'NoneType' object has no attribute 'get_diode_current'")
+        elif c == "spectrometer set integration_time -1":
+            raise ValueError("integration time must be positive")
+        elif c == "do_libs_burst":
+            self.print_cli("aborted" if self.sample_abort.wait(5) else "finished")
+        elif c == "ask":
+            self.print_cli("answer was " + self.prompt_input("Name? "))
+        else:
+            self.print_cli("ran " + c)
+            self.print_cli("done")
+
+class TestLibsServer(unittest.TestCase):
+    def start(self, address):
+        self.cli = MockCli()
+        self.server = libs_server.LibsServer(self.cli)
+        bound = self.server.listen(address)
+        self.thread = threading.Thread(target=self.server.loop.run_forever)
+        self.thread.start()
+        return bound
+
+    def tearDown(self):
+        self.server.loop.call_soon_threadsafe(self.server.loop.stop)
+        self.thread.join()
+        self.server.close()
+
+    def test_tcp_commands_and_streaming(self):
+        host, port = self.start("tcp:127.0.0.1:0")[:2]
+        client = libs_server.LibsClient("tcp:" + host + ":" + str(port), timeout=5)
+        self.assertTrue(client.call("acquire_control"))
+        lines = []
+        result = client.call("set", on_output=lines.append, device="spectrometer", property="integration_time", value=6000)
+        self.assertTrue(result["ok"])
+        self.assertEqual(lines, ["ran spectrometer set integration_time 6000", "done"])
+        self.assertEqual(result["output"], lines)
+        self.assertFalse(client.call("fire")["ok"])
+        for i in range(200):
+            client.call("status")
+        self.assertEqual(self.cli.commands.count("status"), 200)
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("get", device="spectrometer", property="bogus")
+        self.assertEqual(e.exception.code, libs_server.INVALID_PARAMS)
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("set", device="spectrometer", property="integration_time")
+        self.assertEqual(e.exception.code, libs_server.INVALID_PARAMS)
+        self.assertIn("missing 'value'", str(e.exception))
+        with self.assertRaises(libs_server.RPCError) as e: # Raised by the command itself, not by its params
+            client.call("set", device="spectrometer", property="integration_time", value=-1)
+        self.assertEqual(e.exception.code, libs_server.INTERNAL_ERROR)
+        self.assertIn("ValueError: integration time must be positive", str(e.exception))
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("self_destruct")
+        self.assertEqual(e.exception.code, libs_server.METHOD_NOT_FOUND)
+        client.close()
+
+    def test_exclusive_control(self):
+        path = os.path.join(tempfile.mkdtemp(), "libs.sock")
+        self.start("unix:" + path)
+        a = libs_server.LibsClient("unix:" + path, timeout=5)
+        b = libs_server.LibsClient("unix:" + path, timeout=5)
+        self.assertTrue(a.call("acquire_control"))
+        with self.assertRaises(libs_server.RPCError) as e:
+            b.call("acquire_control")
+        self.assertEqual(e.exception.code, libs_server.CONTROL_ERROR)
+        with self.assertRaises(libs_server.RPCError):
+            b.call("do_libs_sample")
+        self.assertTrue(b.call("get", device="laser", property="rep_rate")["ok"]) # Reading is allowed without control
+        a.close() # Control is released when the controlling session disconnects
+        for i in range(100):
+            try:
+                b.call("acquire_control")
+                break
+            except libs_server.RPCError:
+                time.sleep(0.01)
+        self.assertTrue(b.call("acquire_control"))
+        self.assertTrue(b.call("do_libs_sample")["ok"])
+        b.close()
+
+    def test_failing_and_prompting_commands(self):
+        host, port = self.start("tcp:127.0.0.1:0")[:2]
+        client = libs_server.LibsClient("tcp:" + host + ":" + str(port), timeout=5)
+        self.assertTrue(client.call("acquire_control"))
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("command", line="laser get diode_current")
+        self.assertEqual(e.exception.code, libs_server.INTERNAL_ERROR)
+        self.assertIn("AttributeError", str(e.exception))
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("command", line="ask")
+        self.assertEqual(e.exception.code, libs_server.PROMPT_ERROR)
+        with self.assertRaises(libs_server.RPCError) as e:
+            client.call("command", line="spectrometer  spectrum")
+        self.assertEqual(e.exception.code, libs_server.PROMPT_ERROR)
+        self.assertNotIn("spectrometer spectrum", self.cli.commands) # Refused before it ran
+        self.assertTrue(client.call("command", line="spectrometer spectrum named.pickle")["ok"])
+        self.assertTrue(client.call("status")["ok"]) # The session survived
+        client.close()
+
+    def test_stop_does_not_wait_for_the_running_command(self):
+        host, port = self.start("tcp:127.0.0.1:0")[:2]
+        address = "tcp:" + host + ":" + str(port)
+        a = libs_server.LibsClient(address, timeout=5)
+        b = libs_server.LibsClient(address, timeout=5)
+        self.assertTrue(a.call("acquire_control"))
+        results = []
+        burst = threading.Thread(target=lambda: results.append(a.call("command", line="do_libs_burst")))
+        burst.start()
+        while "do_libs_burst" not in self.cli.commands:
+            time.sleep(0.001)
+        stopped = b.call("command", line="laser  stop") # Without control, and before the burst has ended
+        self.assertTrue(stopped["ok"])
+        self.assertTrue(stopped["output"][0].startswith("*** Laser stopped"))
+        self.assertEqual(self.cli.laser.stops, 1)
+        burst.join()
+        self.assertEqual(results[0]["output"], ["aborted"])
+        self.assertEqual(b.call("command", line="cancel")["output"], ["*** Nothing to cancel."])
+        self.assertNotIn("laser stop", self.cli.commands)
+        self.cli.laser = None
+        self.assertFalse(b.call("command", line="laser stop")["ok"])
+        a.close()
+        b.close()
+
+if __name__ == "__main__":
+    unittest.main()
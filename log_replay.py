@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+"""
+log_replay.py
+
+Replays an operator session from a libs_cli command log (logs/LOG_*.log), so a real session can be rerun as a load test
+or as the reproduction case of a throughput regression. Every command of the log is run through libs_cli.handle_command
+in order, and the answers the operator typed at prompts (the port to connect to, the name to save a spectrum as) are
+given back to the prompts that ask for them.
+
+The log has one line per event, each starting with the clock time it happened at:
+    <time>?:?<command>    a command typed at the prompt (log_input)
+    <time>?:<answer>      an answer typed at a prompt inside a command
+    <time>>: <text>       output (cli_print); lines without a prefix continue the output before them
+    <time>D:<text>        a debug message (debug_log)
+Logs written before log_input recorded milliseconds have whole second command times, which is as precise as original
+pacing can be for them.
+
+Pacing:
+    original     each command is issued as long after the first as it was in the session (later, if the commands
+                 before it took longer than they did then)
+    compressed   the same, with the gaps between commands divided by --speed and idle gaps cut to --max-gap first
+    fast         each command as soon as the one before it has finished
+
+With --hardware simulated (the default) the session runs against testing_utils.SimulatedLaser and
+SimulatedSpectrometer on a clock.VirtualClock, so the 2 s settling sleeps and the pacing itself take no real time and a
+long session replays in seconds; commands that would open real devices ('laser connect', 'spectrometer connect') are
+skipped. Samples are written to a temporary directory. With --hardware real the session runs against whatever the log's
+own connect commands open, in real time.
+
+Each command's latency is reported both in wall time (what the host spent on it) and in clock time (what it would have
+taken on the hardware, which is the same thing with real hardware). Commands run one after another, like
+'libs_cli.py --blocking', so a 'cancel' that interrupted a burst in the session only runs once the burst has finished.
+
+Usage:
+    python3 log_replay.py LOG [--pacing original|compressed|fast] [--speed N] [--max-gap SECONDS]
+                              [--hardware simulated|real] [--out FILE.csv] [--echo]
+
+"""
+import builtins
+import collections
+import contextlib
+import io
+import os
+import re
+import sys
+import time
+
+PACING = ["original", "compressed", "fast"]
+LINE = re.compile(r"^(\d+(?:\.\d*)?)(\?:|>: ?|D:)(.*)$")
+SIMULATED_SKIP = ["laser connect", "spectrometer connect"] # Would open real devices
+STOP = ["exit", "quit"]
+
+Entry = collections.namedtuple("Entry", "time kind text")
+Entry.__doc__ = """One event of a command log: clock time, kind ("command", "answer", "output" or "debug") and text."""
+
+Command = collections.namedtuple("Command", "time line answers output")
+Command.__doc__ = """A command of the session: when it was typed, the command line, the answers given to its prompts and
+the output it printed then."""
+
+Result = collections.namedtuple("Result", "index offset line latency clock_latency errors skipped")
+Result.__doc__ = """The replay of a command: its index, seconds from the first command in the session, the command line,
+wall and clock seconds it took, the error lines (starting with "!!!") it printed, and whether it was skipped."""
+
+def parse_log(lines):
+    """[Entry] of the lines of a command log. Output spanning several lines is joined into one entry."""
+    entries = []
+    for line in lines:
+        line = line.rstrip("\n")
+        m = LINE.match(line)
+        if m is None:
+            if entries and entries[-1].kind == "output": # Continuation of multi-line output
+                entries[-1] = entries[-1]._replace(text=entries[-1].text + "\n" + line)
+            continue
+        t, prefix, text = float(m.group(1)), m.group(2), m.group(3)
+        if prefix == "?:":
+            if text.startswith("?"):
+                entries.append(Entry(t, "command", text[1:].strip()))
+            else:
+                entries.append(Entry(t, "answer", text))
+        elif prefix == "D:":
+            entries.append(Entry(t, "debug", text))
+        else:
+            entries.append(Entry(t, "output", text))
+    return entries
+
+def commands(entries):
+    """[Command] of the session in entries. Empty command lines are left out; answers and output typed or printed
+    before the first command are ignored."""
+    session = []
+    for e in entries:
+        if e.kind == "command":
+            if e.text:
+                session.append(Command(e.time, e.text, [], []))
+        elif session and e.kind == "answer":
+            session[-1].answers.append(e.text)
+        elif session and e.kind == "output":
+            session[-1].output.append(e.text)
+    return session
+
+def load(path):
+    with open(path) as f:
+        return commands(parse_log(f))
+
+def schedule(session, pacing="original", speed=1.0, max_gap=1.0):
+    """Seconds after the start of the replay that each command is due, for the pacing."""
+    if pacing not in PACING:
+        raise ValueError("Pacing must be one of " + ", ".join(PACING))
+    if speed <= 0:
+        raise ValueError("Speed must be positive")
+    due = []
+    for i, c in enumerate(session):
+        if pacing == "fast" or i == 0:
+            due.append(0.0)
+        elif pacing == "original":
+            due.append(c.time - session[0].time)
+        else:
+            due.append(due[-1] + min(c.time - session[i - 1].time, max_gap) / speed)
+    return due
+
+@contextlib.contextmanager
+def answering(answers):
+    """Makes input() return answers in order (then "", taking the prompt's default) instead of reading the terminal."""
+    pending = list(answers)
+    original = builtins.input
+
+    def reply(prompt=""):
+        return pending.pop(0) if pending else ""
+
+    builtins.input = reply
+    try:
+        yield
+    finally:
+        builtins.input = original
+
+def replay(cli, session, pacing="original", speed=1.0, max_gap=1.0, skip=(), echo=False, log=print):
+    """Runs session (see commands()) through cli.handle_command, paced on cli.clock. Commands starting with one of skip
+    are not run. Stops at 'exit' or 'quit'. Returns a [Result] per command."""
+    due = schedule(session, pacing, speed, max_gap)
+    errors = []
+
+    def listener(line):
+        if line.startswith("!!!"):
+            errors.append(line)
+
+    cli.output_listeners.append(listener)
+    results = []
+    start = cli.clock.monotonic()
+    try:
+        for i, (c, at) in enumerate(zip(session, due)):
+            if c.line in STOP:
+                break
+            wait = start + at - cli.clock.monotonic()
+            if wait > 0:
+                cli.clock.sleep(wait)
+            offset = c.time - session[0].time
+            if any(c.line == s or c.line.startswith(s + " ") for s in skip):
+                results.append(Result(i, offset, c.line, 0.0, 0.0, [], True))
+                continue
+            del errors[:]
+            began, began_clock = time.perf_counter(), cli.clock.monotonic()
+            with answering(c.answers), contextlib.redirect_stdout(sys.stdout if echo else io.StringIO()):
+                cli.log_input("?" + c.line)
+                try:
+                    cli.handle_command(c.line)
+                except Exception as e: # Keep going, a failing command is part of what a replay is for
+                    errors.append("!!! " + type(e).__name__ + ": " + str(e))
+            results.append(Result(i, offset, c.line, time.perf_counter() - began, cli.clock.monotonic() - began_clock,
+                                  list(errors), False))
+            if errors and log is not None:
+                log("!!! " + c.line + ": " + errors[0][4:].strip())
+    finally:
+        cli.output_listeners.remove(listener)
+    return results
+
+def command_name(line):
+    """The command without its arguments, e.g. 'do_libs_burst' for 'do_libs_burst 20', to group latencies by."""
+    words = []
+    for word in line.split()[:3]:
+        if any(ch.isdigit() or ch in "./:" for ch in word):
+            break
+        words.append(word)
+    return " ".join(words[:2]) or line
+
+def report(results, recorded=None, elapsed=None):
+    """Lines summarising results: latency per command name, then the slowest commands, for printing."""
+    run = [r for r in results if not r.skipped]
+    lines = []
+    if recorded is not None and elapsed is not None:
+        lines.append(str(len(run)) + " commands replayed (" + str(len(results) - len(run)) + " skipped) in " +
+                     str(round(elapsed, 2)) + " s, the session took " + str(round(recorded, 2)) + " s" +
+                     (" (" + str(round(recorded / elapsed, 1)) + "x real time)" if elapsed > 0 else ""))
+    groups = collections.OrderedDict()
+    for r in run:
+        groups.setdefault(command_name(r.line), []).append(r)
+    lines.append("command".ljust(28) + "count".rjust(6) + "mean ms".rjust(10) + "median ms".rjust(11) +
+                 "max ms".rjust(10) + "clock s".rjust(10) + "errors".rjust(8))
+    for name, group in groups.items():
+        latencies = sorted(1e3 * r.latency for r in group)
+        lines.append(name[:27].ljust(28) + str(len(group)).rjust(6) +
+                     str(round(sum(latencies) / len(latencies), 2)).rjust(10) +
+                     str(round(latencies[len(latencies) // 2], 2)).rjust(11) + str(round(latencies[-1], 2)).rjust(10) +
+                     str(round(sum(r.clock_latency for r in group) / len(group), 3)).rjust(10) +
+                     str(sum(1 for r in group if r.errors)).rjust(8))
+    slowest = sorted(run, key=lambda r: r.latency, reverse=True)[:5]
+    if slowest:
+        lines.append("slowest:")
+        for r in slowest:
+            lines.append("  #" + str(r.index) + " at +" + str(round(r.offset, 1)) + " s  " + r.line + "  " +
+                         str(round(1e3 * r.latency, 2)) + " ms")
+    return lines
+
+def write_csv(path, results):
+    import csv
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["index", "offset_s", "command", "latency_ms", "clock_latency_s", "errors", "skipped"])
+        for r in results:
+            writer.writerow([r.index, round(r.offset, 3), r.line, round(1e3 * r.latency, 3), round(r.clock_latency, 6),
+                             " | ".join(r.errors), int(r.skipped)])
+
+def simulate(cli):
+    """Points libs_cli at simulated hardware on a VirtualClock, with samples and the log kept out of the real ones."""
+    import tempfile
+    import testing_utils
+    from clock import VirtualClock
+    cli.clock = VirtualClock()
+    laser = testing_utils.SimulatedLaser(0.002, cli.clock.sleep, cli.clock.monotonic)
+    cli.laser = laser
+    cli.spectrometer = testing_utils.SimulatedSpectrometer(laser, sleep=cli.clock.sleep, now=cli.clock.monotonic)
+    cli.command_log = io.StringIO()
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    cli.SAMPLES_PATH = workdir + "/samples/"
+    cli.INDEX_PATH = workdir + "/index/"
+    cli.CATALOG_PATH = cli.INDEX_PATH + "catalog.sqlite"
+    os.makedirs(cli.SAMPLES_PATH)
+    return workdir
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Replays the commands of a libs_cli command log and reports their latency.",
+                            prog="log_replay.py")
+    parser.add_argument("log", help="Command log to replay (logs/LOG_*.log).")
+    parser.add_argument("--pacing", choices=PACING, default="original")
+    parser.add_argument("--speed", type=float, default=10.0, help="Compressed pacing: divide the gaps by this.")
+    parser.add_argument("--max-gap", type=float, default=1.0, help="Compressed pacing: longest gap in seconds, before --speed.")
+    parser.add_argument("--hardware", choices=["simulated", "real"], default="simulated")
+    parser.add_argument("--out", help="Write the latency of every command to this CSV file.", default=None)
+    parser.add_argument("--echo", help="Print the output of the replayed commands.", action="store_true", default=False)
+    a = parser.parse_args()
+
+    session = load(a.log)
+    if not session:
+        print("!!! No commands in " + a.log)
+        return 1
+    with contextlib.redirect_stdout(io.StringIO()): # The GPIO stand-in prints on import
+        import libs_cli
+    skip = ()
+    if a.hardware == "simulated":
+        print("*** Replaying against simulated hardware, samples go to " + simulate(libs_cli))
+        skip = SIMULATED_SKIP
+    else:
+        libs_cli.command_log = open(libs_cli.LOG_PATH + "REPLAY_" + str(int(time.time())) + ".log", "w")
+        libs_cli.load_drivers()
+        libs_cli.GPIO.setup(libs_cli.external_trigger_pin, libs_cli.GPIO.OUT)
+        libs_cli.GPIO.output(libs_cli.external_trigger_pin, libs_cli.GPIO.HIGH)
+    start = time.perf_counter()
+    results = replay(libs_cli, session, a.pacing, a.speed, a.max_gap, skip, a.echo)
+    elapsed = time.perf_counter() - start
+    for line in report(results, session[len(results) - 1].time - session[0].time if results else 0.0, elapsed):
+        print(line)
+    if a.out:
+        write_csv(a.out, results)
+    if libs_cli.watchdog is not None:
+        libs_cli.watchdog.stop()
+    if a.hardware == "real":
+        libs_cli.GPIO.cleanup()
+        libs_cli.command_log.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import unittest
+import contextlib
+import io
+import clock
+import log_replay
+
+missing = None
+try:
+    with contextlib.redirect_stdout(io.StringIO()):
+        import libs_cli
+except ImportError as e: # libs_cli needs pyserial and, on Linux, Adafruit_BBIO
+    libs_cli = None
+    missing = str(e)
+
+LOG = """1600000000?:?spectrometer set integration_time 8000
+1600000000>: *** Integration time set to 8000
+1600000003.250D:Taking sample
+1600000003.25?:?spectrometer spectrum
+1600000004?:my_spectrum.pickle
+1600000010?:?laser status
+1600000010>: Laser Status:
+ID: QC-1234
+1600000010>: Armed: False
+1600000070.5?:?
+1600000070.5?:?laser fire
+1600000071?:?exit
+""".splitlines(True)
+
+class MockCli():
+    """Stands in for the libs_cli module: records the commands and the answers to the prompts they show."""
+    def __init__(self):
+        self.clock = clock.VirtualClock()
+        self.output_listeners = []
+        self.ran = [] # (clock time, command, answer)
+
+    def log_input(self, txt):
+        pass
+
+    def handle_command(self, c):
+        answer = input("Prompt: ") if c == "spectrometer spectrum" else None
+        self.ran.append((self.clock.monotonic(), c, answer))
+        self.clock.sleep(0.5)
+        if c == "laser fire":
+            for listener in self.output_listeners:
+                listener("!!! The laser is not armed.")
+
+class TestLogReplay(unittest.TestCase):
+    def test_parse(self):
+        session = log_replay.commands(log_replay.parse_log(LOG))
+        self.assertEqual([c.line for c in session], ["spectrometer set integration_time 8000", "spectrometer spectrum",
+                                                      "laser status", "laser fire", "exit"])
+        self.assertEqual(session[1].time, 1600000003.25)
+        self.assertEqual(session[1].answers, ["my_spectrum.pickle"])
+        self.assertEqual(session[2].output, ["Laser Status:\nID: QC-1234", "Armed: False"])
+        self.assertEqual(log_replay.schedule(session, "original"), [0, 3.25, 10, 70.5, 71])
+        self.assertEqual(log_replay.schedule(session, "compressed", 2, 5), [0, 1.625, 4.125, 6.625, 6.875])
+        self.assertEqual(log_replay.schedule(session, "fast"), [0] * 5)
+        self.assertEqual(log_replay.command_name("spectrometer set integration_time 8000"), "spectrometer set")
+        self.assertEqual(log_replay.command_name("do_libs_burst 20"), "do_libs_burst")
+
+    def test_replay(self):
+        cli = MockCli()
+        session = log_replay.commands(log_replay.parse_log(LOG))
+        results = log_replay.replay(cli, session, "original", skip=["laser status"], log=None)
+        self.assertEqual(cli.ran, [(0, "spectrometer set integration_time 8000", None),
+                                   (3.25, "spectrometer spectrum", "my_spectrum.pickle"), (70.5, "laser fire", None)])
+        self.assertEqual(len(results), 4) # Stopped at exit
+        self.assertTrue(results[2].skipped)
+        self.assertEqual(results[3].errors, ["!!! The laser is not armed."])
+        self.assertEqual(results[3].clock_latency, 0.5)
+        self.assertEqual(cli.output_listeners, [])
+        cli = MockCli()
+        log_replay.replay(cli, session, "fast", log=None)
+        self.assertEqual([t for t, c, a in cli.ran], [0, 0.5, 1.0, 1.5]) # Each as soon as the last finished
+        lines = log_replay.report(results, 71, 0.01)
+        self.assertIn("3 commands replayed (1 skipped)", lines[0])
+        self.assertTrue(any(line.startswith("laser fire") and line.endswith("1") for line in lines))
+
+    @unittest.skipIf(libs_cli is None, "libs_cli cannot be imported: " + str(missing))
+    def test_simulated_session(self):
+        real_clock = libs_cli.clock
+        try:
+            log_replay.simulate(libs_cli)
+            session = log_replay.commands(log_replay.parse_log(LOG))
+            results = log_replay.replay(libs_cli, session, "original", skip=log_replay.SIMULATED_SKIP, log=None)
+            self.assertEqual(results[-1].errors, [])
+            self.assertEqual(libs_cli.integration_time, 8000)
+            self.assertGreaterEqual(libs_cli.clock.monotonic(), 70.5)
+            self.assertIn("?:?laser fire", libs_cli.command_log.getvalue())
+        finally:
+            libs_cli.clock = real_clock
+            libs_cli.laser = libs_cli.spectrometer = None
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+#!/usr/bin/python3
+"""
+resample.py
+
+Resampling spectra onto a uniform wavelength grid, so that spectra from different units (or from one unit before and
+after a recalibration) line up pixel for pixel and can be compared, averaged or fed to a model directly.
+
+Every output point is a weighted sum of a few input pixels, so resampling is a product with a sparse grid x pixels
+matrix. The weights only depend on the wavelength calibration and the grid, so they are computed once per spectrometer
+and cached by serial number (by a hash of the calibration when there is no serial number); a whole run is then
+resampled with one matrix product. Two methods:
+    linear    interpolation between the pixels either side of each grid point, points outside the measured range get
+              the value of the nearest end pixel (like np.interp); best when the grid is at least as fine as the pixels
+    average   the mean of the pixels each grid bin covers, weighted by how much of each pixel falls in the bin; for
+              grids coarser than the pixels, where interpolation would skip pixels and keep all of their noise
+    auto      linear if the grid step is at most the median pixel spacing, average otherwise
+
+The weights are kept in CSR form (indptr, indices, weights). The product uses scipy.sparse when scipy is installed, and
+otherwise gathers the pixels each output needs and sums them with np.add.reduceat, which gives the same result.
+
+Usage:
+    python3 resample.py RUN OUT.lsr START STOP STEP [METHOD]   (resample a run archive or samples directory)
+    python3 resample.py bench [SHOTS]
+
+"""
+import collections
+import hashlib
+import sys
+import threading
+import time
+
+import numpy as np
+
+try:
+    import scipy.sparse as sparse
+except ImportError:
+    sparse = None
+
+METHODS = ["auto", "linear", "average"]
+CACHE_SIZE = 16 # Resamplers kept, one per (device, grid, method)
+CHUNK = 256 # Shots resampled at a time without scipy, to bound the gathered array
+
+def uniform_grid(start, stop, step):
+    """start, start + step, ... up to and including stop (nm), the grid convention of the pipeline and the index."""
+    return np.arange(start, stop + step / 2, step)
+
+def linear_weights(wavelengths, grid):
+    """CSR (indptr, indices, weights) of linear interpolation, two entries per grid point."""
+    x = np.clip(grid, wavelengths[0], wavelengths[-1])
+    left = np.clip(np.searchsorted(wavelengths, x, side="right") - 1, 0, len(wavelengths) - 2)
+    fraction = (x - wavelengths[left]) / (wavelengths[left + 1] - wavelengths[left])
+    indices = np.column_stack([left, left + 1]).ravel()
+    weights = np.column_stack([1.0 - fraction, fraction]).ravel()
+    return np.arange(0, 2 * len(grid) + 1, 2), indices, weights
+
+def edges(centres):
+    """Bin edges halfway between centres, the outer ones as far out as the neighbouring half spacing."""
+    middle = (centres[1:] + centres[:-1]) / 2
+    return np.concatenate([[2 * centres[0] - middle[0]], middle, [2 * centres[-1] - middle[-1]]])
+
+def average_weights(wavelengths, grid):
+    """CSR (indptr, indices, weights) of the overlap weighted mean of the pixels covered by each grid bin. Bins outside
+    the measured range take the nearest end pixel."""
+    pixel_edges, bin_edges = edges(wavelengths), edges(grid)
+    lo, hi = bin_edges[:-1], bin_edges[1:]
+    first = np.searchsorted(pixel_edges[1:], lo, side="right") # First pixel ending after the bin starts
+    last = np.searchsorted(pixel_edges[:-1], hi, side="left") # One past the last pixel starting before it ends
+    outside = last <= first
+    first[outside] = np.clip(first[outside], 0, len(wavelengths) - 1)
+    last[outside] = first[outside] + 1
+    counts = last - first
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    rows = np.repeat(np.arange(len(grid)), counts)
+    indices = np.repeat(first, counts) + np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    overlap = np.minimum(pixel_edges[indices + 1], hi[rows]) - np.maximum(pixel_edges[indices], lo[rows])
+    overlap[np.repeat(outside, counts)] = 1.0
+    overlap = np.maximum(overlap, 0.0)
+    total = np.add.reduceat(overlap, indptr[:-1])
+    total[total == 0] = 1.0
+    return indptr, indices, overlap / total[rows]
+
+class Resampler():
+    """Resamples spectra measured at wavelengths (sorted ascending) onto grid."""
+    def __init__(self, wavelengths, grid, method="auto"):
+        if method not in METHODS:
+            raise ValueError("Resampling method must be one of " + ", ".join(METHODS))
+        self.wavelengths = np.array(wavelengths, dtype=np.float64)
+        self.grid = np.asarray(grid, dtype=np.float64)
+        if len(self.wavelengths) < 2 or not len(self.grid):
+            raise ValueError("Resampling needs at least 2 pixels and a non-empty grid")
+        if method == "auto":
+            step = np.median(np.diff(self.grid)) if len(self.grid) > 1 else 0.0
+            method = "linear" if step <= np.median(np.diff(self.wavelengths)) else "average"
+        self.method = method
+        weights = linear_weights if method == "linear" else average_weights
+        self.indptr, self.indices, self.weights = weights(self.wavelengths, self.grid)
+        counts = np.diff(self.indptr)
+        self.width = int(counts[0]) if np.all(counts == counts[0]) else None # Entries per row, if they all have as many
+        self.matrix = None
+        if sparse is not None:
+            self.matrix = sparse.csr_matrix((self.weights, self.indices, self.indptr),
+                                            shape=(len(self.grid), len(self.wavelengths)))
+
+    def __call__(self, spectra, out=None):
+        """Resamples a spectrum, or a shots x pixels batch, to float64. The result is written to out if given."""
+        data = np.asarray(spectra)
+        single = data.ndim == 1
+        data = np.atleast_2d(data)
+        if data.shape[1] != len(self.wavelengths):
+            raise ValueError("Spectra have " + str(data.shape[1]) + " pixels, the calibration has " +
+                             str(len(self.wavelengths)))
+        if out is None:
+            out = np.empty((len(data), len(self.grid)))
+        target = out.reshape(len(data), len(self.grid))
+        if self.matrix is not None:
+            target[:] = self.matrix.dot(data.astype(np.float64, copy=False).T).T
+        else:
+            data = data.astype(np.float64, copy=False)
+            for start in range(0, len(data), CHUNK):
+                block, result = data[start:start + CHUNK], target[start:start + CHUNK]
+                if self.method == "linear": # Left pixel plus the fraction of the step to the right one, in place
+                    scratch = np.take(block, self.indices[1::2], axis=1)
+                    np.take(block, self.indices[0::2], axis=1, out=result)
+                    scratch -= result
+                    scratch *= self.weights[1::2]
+                    result += scratch
+                    continue
+                products = np.take(block, self.indices, axis=1) * self.weights
+                if self.width is not None: # Strided sums beat reduceat when every row has as many entries
+                    result[:] = products[:, 0::self.width]
+                    for k in range(1, self.width):
+                        result += products[:, k::self.width]
+                else:
+                    result[:] = np.add.reduceat(products, self.indptr[:-1], axis=1)
+        return out[0] if single and out.ndim == 2 else out
+
+_cache = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+def calibration_key(wavelengths):
+    return hashlib.sha1(np.ascontiguousarray(wavelengths, dtype="<f8").tobytes()).hexdigest()
+
+def get_resampler(wavelengths, start, stop, step, method="auto", serial=None):
+    """The Resampler from wavelengths to uniform_grid(start, stop, step), built once and cached by serial number (or by
+    calibration). A cached one is rebuilt if the device's calibration has changed since."""
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    key = (serial if serial is not None else calibration_key(wavelengths), float(start), float(stop), float(step), method)
+    with _cache_lock:
+        resampler = _cache.get(key)
+        if resampler is not None and np.array_equal(resampler.wavelengths, wavelengths):
+            _cache.move_to_end(key)
+            return resampler
+    resampler = Resampler(wavelengths, uniform_grid(start, stop, step), method)
+    with _cache_lock:
+        _cache[key] = resampler
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return resampler
+
+def for_spectrometer(spec, start, stop, step, method="auto"):
+    """get_resampler for a seabreeze Spectrometer (or a DeviceGroup), cached by its serial number."""
+    return get_resampler(spec.wavelengths(), start, stop, step, method, getattr(spec, "serial_number", None))
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+def resample_run(run, out, start, stop, step, method="auto", batch=1000, log=print):
+    """Resamples every shot of a run (see run_archive.open_run) into a new float64 run archive."""
+    import run_archive
+    if not len(run):
+        raise ValueError("Run is empty")
+    run[0]
+    resampler = get_resampler(run.wavelengths, start, stop, step, method)
+    with run_archive.RunArchiveWriter(out, resampler.grid, "<f8") as writer:
+        for first in range(0, len(run), batch):
+            last = min(first + batch, len(run))
+            if hasattr(run, "intensities"):
+                block = run.intensities[first:last]
+            else:
+                block = np.array([run[i][1] for i in range(first, last)])
+            writer.append_many(resampler(block), run.timestamps[first:last])
+            log("Resampled " + str(last) + " / " + str(len(run)) + " shots")
+    return len(run)
+
+def bench(shots=10000):
+    import spectrum_codec
+    wavelengths, spectra = spectrum_codec._synthetic_shots(shots)
+    print(str(shots) + " shots of " + str(spectra.shape[1]) + " pixels, " +
+          ("scipy.sparse" if sparse is not None else "numpy reduceat (scipy not installed)"))
+    for method, step in (("linear", 0.2), ("average", 1.0)):
+        clear_cache()
+        start = time.perf_counter()
+        resampler = get_resampler(wavelengths, 200, 790, step, method, serial="BENCH")
+        weights = time.perf_counter() - start
+        start = time.perf_counter()
+        get_resampler(wavelengths, 200, 790, step, method, serial="BENCH")
+        cached = time.perf_counter() - start
+        start = time.perf_counter()
+        resampler(spectra)
+        elapsed = time.perf_counter() - start
+        print(method.ljust(8) + ": " + str(len(resampler.grid)) + " points, weights " + str(round(1e3 * weights, 1)) +
+              " ms (cached " + str(round(1e6 * cached, 1)) + " us), run " + str(round(elapsed, 3)) + " s")
+    start = time.perf_counter()
+    for s in spectra:
+        np.interp(resampler.grid, wavelengths, s)
+    print("np.interp one shot at a time: " + str(round(time.perf_counter() - start, 3)) + " s")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    elif len(sys.argv) >= 6:
+        import run_archive
+        resample_run(run_archive.open_run(sys.argv[1]), sys.argv[2], float(sys.argv[3]), float(sys.argv[4]),
+                     float(sys.argv[5]), sys.argv[6] if len(sys.argv) > 6 else "auto")
+    else:
+        print(__doc__)
@@ -0,0 +1,44 @@
+import unittest
+import numpy as np
+import resample
+
+class TestResample(unittest.TestCase):
+    def setUp(self):
+        resample.clear_cache()
+        self.wavelengths = 200.0 + 0.2 * np.arange(1000) + 2e-5 * np.arange(1000) ** 2 # Uneven, like a calibration
+        self.spectra = np.random.RandomState(3).uniform(0, 1000, (20, 1000))
+
+    def test_linear_matches_interp(self):
+        r = resample.get_resampler(self.wavelengths, 190, 240, 0.1, "linear")
+        out = r(self.spectra)
+        self.assertEqual(out.shape, (20, len(r.grid)))
+        for row, spectrum in zip(out, self.spectra):
+            np.testing.assert_allclose(row, np.interp(r.grid, self.wavelengths, spectrum))
+        np.testing.assert_allclose(r(self.spectra[4]), out[4])
+
+    def test_average_preserves_mean_and_constants(self):
+        r = resample.get_resampler(self.wavelengths, 201, 210, 1.0, "auto")
+        self.assertEqual(r.method, "average")
+        np.testing.assert_allclose(np.add.reduceat(r.weights, r.indptr[:-1]), 1.0)
+        np.testing.assert_allclose(r(np.full(1000, 7.0)), 7.0)
+        inside = (self.wavelengths > 202.5) & (self.wavelengths < 203.5) # Whole pixels in the 203 nm bin
+        self.assertAlmostEqual(r(self.spectra[0])[2], self.spectra[0][inside].mean(), delta=100)
+
+    def test_cached_by_serial_until_recalibrated(self):
+        a = resample.get_resampler(self.wavelengths, 200, 300, 0.5, serial="FLMT00001")
+        self.assertIs(resample.get_resampler(self.wavelengths, 200, 300, 0.5, serial="FLMT00001"), a)
+        self.assertIsNot(resample.get_resampler(self.wavelengths, 200, 300, 0.25, serial="FLMT00001"), a)
+        b = resample.get_resampler(self.wavelengths + 0.05, 200, 300, 0.5, serial="FLMT00001")
+        self.assertIsNot(b, a)
+        self.assertIs(resample.get_resampler(self.wavelengths + 0.05, 200, 300, 0.5), resample.get_resampler(
+            self.wavelengths + 0.05, 200, 300, 0.5))
+
+    def test_numpy_fallback_matches_sparse_layout(self):
+        r = resample.get_resampler(self.wavelengths, 200, 400, 0.7, "average")
+        dense = np.zeros((len(r.grid), len(self.wavelengths)))
+        for i in range(len(r.grid)):
+            dense[i, r.indices[r.indptr[i]:r.indptr[i + 1]]] = r.weights[r.indptr[i]:r.indptr[i + 1]]
+        np.testing.assert_allclose(r(self.spectra), np.dot(self.spectra, dense.T))
+
+if __name__ == "__main__":
+    unittest.main()
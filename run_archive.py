@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+"""
+run_archive.py
+
+Fast access to runs of many shots without loading them.
+
+A run archive (.lsr) is a single file holding a fixed size header, the wavelengths, then one fixed size record per shot
+(timestamp followed by the intensities). Opening one only reads the header; the records are memory-mapped, so a shot is
+read from disk the first time it is looked at and memory use does not grow with the size of the run.
+
+A plain samples directory (.pickle or .lsc files) can be browsed the same way with SampleDirectory, which only lists the
+directory when opened and loads each file on demand. ShotPrefetcher loads the shots around the one being looked at on a
+background thread so scrubbing through either kind of run stays smooth.
+
+Usage:
+    python3 run_archive.py pack SAMPLES_DIR OUT.lsr [--dtype u2|f8]
+    python3 run_archive.py info RUN
+    python3 run_archive.py bench [SHOTS]
+
+"""
+import collections
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import spectrum_codec
+
+MAGIC = b"LSR1"
+EXTENSION = ".lsr"
+# magic, dtype, pixels, shot count, header size (the wavelengths start here)
+HEADER = struct.Struct("<4s4sIQI")
+HEADER_SIZE = 64
+SAMPLE_EXTENSIONS = (".pickle", spectrum_codec.EXTENSION)
+
+def record_dtype(dtype, pixels):
+    return np.dtype([("timestamp", "<f8"), ("intensities", np.dtype(dtype), (pixels,))])
+
+class RunArchiveWriter():
+    """Appends shots to a run archive, creating it if needed."""
+    def __init__(self, path, wavelengths, dtype="<u2"):
+        self.path = path
+        self.wavelengths = np.asarray(wavelengths, dtype="<f8")
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.record = record_dtype(self.dtype, len(self.wavelengths))
+        if os.path.exists(path):
+            archive = RunArchive(path)
+            if archive.dtype != self.dtype or not np.array_equal(archive.wavelengths, self.wavelengths):
+                raise ValueError(path + " holds shots with different wavelengths or dtype")
+            self.count = len(archive)
+            self.file = open(path, "r+b")
+            self.file.seek(self._data_offset() + self.count * self.record.itemsize)
+        else:
+            self.count = 0
+            self.file = open(path, "w+b")
+            self._write_header()
+            self.file.seek(HEADER_SIZE)
+            self.file.write(self.wavelengths.tobytes())
+
+    def _data_offset(self):
+        return HEADER_SIZE + self.wavelengths.nbytes
+
+    def _write_header(self):
+        header = HEADER.pack(MAGIC, self.dtype.str.encode("ascii").ljust(4), len(self.wavelengths), self.count, HEADER_SIZE)
+        self.file.seek(0)
+        self.file.write(header.ljust(HEADER_SIZE, b"\0"))
+
+    def _check_exact(self, stored, intensities):
+        """Raises ValueError unless the intensities came through the conversion to the archive dtype unchanged."""
+        if not np.array_equal(stored, intensities, equal_nan=True): # Processed runs may hold NaN
+            raise ValueError("Shots do not fit in " + str(self.dtype) + " exactly, pack with --dtype f8")
+
+    def append(self, intensities, timestamp=None):
+        """Adds a shot. Raises ValueError if the intensities cannot be stored exactly in the archive dtype."""
+        rec = np.zeros(1, self.record)
+        rec["timestamp"] = time.time() if timestamp is None else timestamp
+        rec["intensities"] = intensities
+        self._check_exact(rec["intensities"][0], intensities)
+        self.file.write(rec.tobytes())
+        self.count += 1
+
+    def append_many(self, intensities, timestamps):
+        """Adds a 2-D array of shots in one write. Raises ValueError, having written nothing, if there is not one
+        timestamp per shot or the shots cannot be stored exactly in the archive dtype."""
+        intensities = np.asarray(intensities)
+        timestamps = np.asarray(timestamps, dtype="<f8")
+        if intensities.ndim != 2 or intensities.shape[1] != len(self.wavelengths):
+            raise ValueError("Expected shots x " + str(len(self.wavelengths)) + " intensities, got " + str(intensities.shape))
+        if timestamps.shape != (len(intensities),):
+            raise ValueError(str(len(intensities)) + " shots but " + str(timestamps.size) + " timestamps")
+        recs = np.zeros(len(intensities), self.record)
+        recs["timestamp"] = timestamps
+        recs["intensities"] = intensities
+        self._check_exact(recs["intensities"], intensities)
+        self.file.write(recs.tobytes())
+        self.count += len(intensities)
+
+    def close(self):
+        """Updates the shot count in the header and closes the file. Shots are not visible to readers until then."""
+        self._write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class RunArchive():
+    """Read only, memory-mapped view of a run archive. Indexing gives (timestamp, intensities) without copying."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, dtype, pixels, count, offset = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(path + " is not a run archive")
+        self.dtype = np.dtype(dtype.decode("ascii").strip())
+        self.wavelengths = np.memmap(path, "<f8", "r", offset, (pixels,))
+        self.records = np.memmap(path, record_dtype(self.dtype, pixels), "r", offset + 8 * pixels, (count,)) \
+            if count else np.zeros(0, record_dtype(self.dtype, pixels))
+        self.timestamps = self.records["timestamp"]
+        self.intensities = self.records["intensities"] # 2-D, shots x pixels
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.timestamps[i], self.intensities[i]
+
+    def name(self, i):
+        return os.path.basename(self.path) + "[" + str(i) + "]"
+
+_TIMESTAMP = re.compile(r"(\d+(?:\.\d+)?)")
+
+def sample_time(name):
+    """Sample files are named after the time they were taken, e.g. 1583271321.234_SAMPLE.pickle or SAMPLE_1583271321.23.pickle"""
+    m = _TIMESTAMP.search(name)
+    return float(m.group(1)) if m else 0.0
+
+class SampleDirectory():
+    """A directory of sample files, indexed by listing the directory only. Files are loaded when a shot is accessed."""
+    def __init__(self, path, cache_size=64):
+        self.path = path
+        names = [e.name for e in os.scandir(path) if e.is_file() and e.name.endswith(SAMPLE_EXTENSIONS)]
+        names.sort(key=lambda n: (sample_time(n), n))
+        self.names = names
+        self.timestamps = np.array([sample_time(n) for n in names])
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.wavelengths = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        with self.lock:
+            if i in self.cache:
+                self.cache.move_to_end(i)
+                return self.timestamps[i], self.cache[i]
+        wavelengths, intensities = spectrum_codec.load_sample(os.path.join(self.path, self.names[i]))
+        with self.lock:
+            if self.wavelengths is None:
+                self.wavelengths = wavelengths
+            self.cache[i] = intensities
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.timestamps[i], intensities
+
+    def name(self, i):
+        return self.names[i]
+
+def open_run(path):
+    """Opens a run archive file or a samples directory."""
+    if os.path.isdir(path):
+        return SampleDirectory(path)
+    return RunArchive(path)
+
+class ShotPrefetcher():
+    """Fetches shots from a run for a viewer, loading the radius shots on either side of the last one asked for on a
+    background thread."""
+    def __init__(self, run, radius=8):
+        self.run = run
+        self.radius = radius
+        self.wanted = None
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self._prefetch_loop, name="prefetch-thread", daemon=True)
+        self.thread.start()
+
+    def get(self, i):
+        """Returns (timestamp, intensities) of shot i and starts prefetching its neighbours."""
+        shot = self.run[i]
+        with self.condition:
+            self.wanted = i
+            self.condition.notify()
+        return shot
+
+    def _prefetch_loop(self):
+        while True:
+            with self.condition:
+                while self.running and self.wanted is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                center = self.wanted
+                self.wanted = None
+            for offset in range(1, self.radius + 1):
+                for i in (center + offset, center - offset):
+                    if self.wanted is not None or not self.running:
+                        break # The viewer has moved on, start again around the new position
+                    if 0 <= i < len(self.run):
+                        timestamp, intensities = self.run[i]
+                        intensities.max() # Touch the data so memory-mapped pages are read in now
+                if self.wanted is not None:
+                    break
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+def pack(directory, out, dtype="u2"):
+    """Packs a samples directory into a run archive. Returns the number of shots written."""
+    run = SampleDirectory(directory, cache_size=1)
+    if not len(run):
+        raise ValueError("No samples found in " + directory)
+    run[0]
+    with RunArchiveWriter(out, run.wavelengths, dtype) as writer:
+        for i in range(len(run)):
+            timestamp, intensities = run[i]
+            writer.append(intensities, timestamp)
+    return len(run)
+
+def bench(shots=10000, pixels=3648):
+    """Times opening a run and scrubbing through it, for an archive and for a directory of .lsc files."""
+    d = tempfile.mkdtemp()
+    wavelengths, spectra = spectrum_codec._synthetic_shots(100, pixels)
+    path = os.path.join(d, "run" + EXTENSION)
+    with RunArchiveWriter(path, wavelengths) as writer:
+        for start in range(0, shots, 100):
+            writer.append_many(spectra[:min(100, shots - start)], np.arange(start, min(start + 100, shots)))
+    samples = os.path.join(d, "samples")
+    os.mkdir(samples)
+    encoded = spectrum_codec.encode(wavelengths, spectra[0])
+    for i in range(shots):
+        with open(os.path.join(samples, str(1.6e9 + i) + "_SAMPLE" + spectrum_codec.EXTENSION), "wb") as f:
+            f.write(encoded)
+
+    for label, target in (("archive", path), ("directory", samples)):
+        start = time.perf_counter()
+        run = open_run(target)
+        opened = time.perf_counter() - start
+        prefetcher = ShotPrefetcher(run)
+        start = time.perf_counter()
+        for i in range(0, len(run), max(1, len(run) // 500)):
+            prefetcher.get(i)[1].max()
+        scrub = (time.perf_counter() - start) / 500
+        prefetcher.close()
+        print(label.ljust(9) + ": " + str(len(run)) + " shots, open " + str(round(1000 * opened, 1)) + " ms, " +
+              str(round(1000 * scrub, 2)) + " ms per shot while scrubbing")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "pack":
+        dtype = sys.argv[5] if len(sys.argv) >= 6 and sys.argv[4] == "--dtype" else "u2"
+        print("Packed " + str(pack(sys.argv[2], sys.argv[3], dtype)) + " shots into " + sys.argv[3])
+    elif len(sys.argv) >= 3 and sys.argv[1] == "info":
+        run = open_run(sys.argv[2])
+        print(str(len(run)) + " shots")
+        if len(run):
+            print("First: " + run.name(0) + ", last: " + run.name(len(run) - 1))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
+    else:
+        print(__doc__)
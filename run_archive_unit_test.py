@@ -0,0 +1,54 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import run_archive
+
+class TestRunArchive(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "run" + run_archive.EXTENSION)
+        self.wavelengths = np.linspace(200, 1025, 64)
+        rng = np.random.RandomState(7)
+        self.shots = rng.randint(0, 2 ** 16, (10, 64))
+        self.timestamps = 1600000000.0 + np.arange(10) * 0.1 + 1e-6
+
+    def test_append_many_round_trip(self):
+        with run_archive.RunArchiveWriter(self.path, self.wavelengths) as writer:
+            writer.append_many(self.shots[:6], self.timestamps[:6])
+        with run_archive.RunArchiveWriter(self.path, self.wavelengths) as writer: # Appends to the existing run
+            writer.append(self.shots[6], self.timestamps[6])
+            writer.append_many(self.shots[7:], self.timestamps[7:])
+        run = run_archive.RunArchive(self.path)
+        self.assertEqual(len(run), 10)
+        self.assertEqual(run.dtype, np.dtype("<u2"))
+        np.testing.assert_array_equal(run.wavelengths, self.wavelengths)
+        np.testing.assert_array_equal(run.intensities, self.shots)
+        np.testing.assert_array_equal(run.timestamps, self.timestamps) # Exact, not approximately
+        timestamp, intensities = run[3]
+        self.assertEqual(timestamp, self.timestamps[3])
+        np.testing.assert_array_equal(intensities, self.shots[3])
+
+        processed = self.shots / 7.0
+        processed[0, 0] = np.nan
+        path = self.path + ".f8" + run_archive.EXTENSION
+        with run_archive.RunArchiveWriter(path, self.wavelengths, "<f8") as writer:
+            writer.append(processed[0], self.timestamps[0]) # NaN passes the same check one shot at a time
+            writer.append_many(processed[1:], self.timestamps[1:])
+        np.testing.assert_array_equal(run_archive.RunArchive(path).intensities, processed)
+
+    def test_append_many_rejects_bad_shots(self):
+        with run_archive.RunArchiveWriter(self.path, self.wavelengths) as writer:
+            writer.append_many(self.shots[:2], self.timestamps[:2])
+            self.assertRaises(ValueError, writer.append_many, self.shots[:3], self.timestamps[:2])
+            self.assertRaises(ValueError, writer.append_many, self.shots[:3], self.timestamps[:1]) # Not broadcast
+            self.assertRaises(ValueError, writer.append_many, self.shots[:3, :60], self.timestamps[:3])
+            self.assertRaises(ValueError, writer.append_many, self.shots[:3] + 0.5, self.timestamps[:3])
+            self.assertRaises(ValueError, writer.append_many, self.shots[:3] - 2 ** 16, self.timestamps[:3])
+            self.assertRaises(ValueError, writer.append, self.shots[2] + 0.5)
+        run = run_archive.RunArchive(self.path) # Nothing was written by the rejected calls
+        self.assertEqual(len(run), 2)
+        self.assertEqual(os.path.getsize(self.path), run_archive.HEADER_SIZE + 8 * 64 + 2 * (8 + 2 * 64))
+        np.testing.assert_array_equal(run.intensities, self.shots[:2])
+
+if __name__ == "__main__":
+    unittest.main()
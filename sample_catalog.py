@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+"""
+sample_catalog.py
+
+A SQLite catalog of the saved samples, so they can be found by how they were taken and what they look like instead of
+only by the timestamp in their file name. Every sample libs_cli saves gets a row with the acquisition settings in
+effect (integration time, trigger mode and delay, laser rep rate, pulse width, pulse mode and burst count, spectrometer
+serial number) and a few features of the spectrum (maximum intensity, total counts, signal above the dark level, noise,
+number of emission lines). The emission lines found in it are kept in a second table, one row per line, so samples can
+be searched for a line at a given wavelength.
+
+The columns searched on are indexed (time, the settings, the features, and line wavelength), so a query over a catalog
+of hundreds of thousands of samples is a B-tree lookup rather than a scan of the files.
+
+Lines are the local maxima more than LINE_RATIO times the continuum noise (the scaled median absolute deviation, as in
+shot_quality.py) above the dark level (the median), the LINES highest of them, each placed between pixels by fitting a
+parabola through the maximum and its neighbours.
+
+Samples saved before the catalog existed are added with backfill(), which reads them and extracts their features on a
+pool of worker processes; their settings were never recorded and are left empty.
+
+Samples are catalogued by file name, relative to their samples directory. libs_cli keeps its catalog in
+index/catalog.sqlite, next to the similarity index (see spectral_index.py).
+
+Query terms (the 'find' command in libs_cli, and find below):
+    COLUMN=VALUE, COLUMN!=VALUE, COLUMN<VALUE, COLUMN<=VALUE, COLUMN>VALUE, COLUMN>=VALUE
+                   for any column in SETTINGS or FEATURES, or flagged, source
+    line=WAVELENGTH[~TOLERANCE]
+                   has an emission line within TOLERANCE nm (default LINE_TOLERANCE) of WAVELENGTH
+    since=TIME, until=TIME
+                   taken at or after / at or before TIME, as a Unix time or YYYY-MM-DD[THH:MM[:SS]] in local time
+    limit=N        at most N samples, newest first (default DEFAULT_LIMIT)
+
+Usage:
+    python3 sample_catalog.py backfill SAMPLES_DIR CATALOG [PROCESSES]
+    python3 sample_catalog.py find CATALOG [TERM...]
+    python3 sample_catalog.py bench [SAMPLES]
+
+"""
+import collections
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+import spectrum_codec
+from run_archive import SAMPLE_EXTENSIONS, sample_time
+from shot_quality import FLAG_SUFFIX, MAD_SCALE
+
+VERSION = 1
+LINES = 20 # Emission lines recorded per sample, the highest ones
+LINE_RATIO = 10.0 # Lines must stand this many times the continuum noise above the dark level
+LINE_TOLERANCE = 0.5 # nm, for line= terms without a tolerance
+DEFAULT_LIMIT = 50
+CHUNK = 64 # Sample files read per task when back-filling
+
+SETTINGS = collections.OrderedDict([("integration_time", "INTEGER"), ("sample_mode", "TEXT"), ("trigger_delay", "REAL"),
+                                    ("rep_rate", "REAL"), ("pulse_width", "REAL"), ("pulse_mode", "INTEGER"),
+                                    ("burst_count", "INTEGER"), ("serial", "TEXT")])
+FEATURES = collections.OrderedDict([("max_intensity", "REAL"), ("total_counts", "REAL"), ("signal", "REAL"),
+                                    ("noise", "REAL"), ("line_count", "INTEGER")])
+COLUMNS = ["name", "timestamp", "source", "flagged"] + list(SETTINGS) + list(FEATURES)
+OPERATORS = ["<=", ">=", "!=", "=", "<", ">"]
+TERM = re.compile(r"^(\w+)(<=|>=|!=|=|<|>)(.+)$")
+TIME_FORMATS = ["%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, timestamp REAL, source TEXT,
+    flagged INTEGER, """ + ", ".join(c + " " + t for c, t in list(SETTINGS.items()) + list(FEATURES.items())) + """);
+CREATE TABLE IF NOT EXISTS lines (sample INTEGER NOT NULL REFERENCES samples(id) ON DELETE CASCADE,
+    wavelength REAL NOT NULL, height REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS samples_timestamp ON samples(timestamp);
+CREATE INDEX IF NOT EXISTS samples_exposure ON samples(integration_time, sample_mode, trigger_delay);
+CREATE INDEX IF NOT EXISTS samples_laser ON samples(rep_rate, pulse_width, burst_count);
+CREATE INDEX IF NOT EXISTS samples_serial ON samples(serial, timestamp);
+CREATE INDEX IF NOT EXISTS samples_max_intensity ON samples(max_intensity);
+CREATE INDEX IF NOT EXISTS samples_total_counts ON samples(total_counts);
+CREATE INDEX IF NOT EXISTS samples_signal ON samples(signal);
+CREATE INDEX IF NOT EXISTS lines_wavelength ON lines(wavelength);
+CREATE INDEX IF NOT EXISTS lines_sample ON lines(sample);
+"""
+
+class CatalogError(Exception):
+    pass
+
+def features(wavelengths, intensities, lines=LINES, ratio=LINE_RATIO):
+    """Summary features of a spectrum, as a dict of the FEATURES plus "lines", [(wavelength, height above the dark
+    level)] of its emission lines sorted by wavelength."""
+    w = np.asarray(wavelengths, dtype=np.float64)
+    y = np.asarray(intensities, dtype=np.float64)
+    dark = np.median(y)
+    above = y - dark
+    noise = max(MAD_SCALE * float(np.median(np.abs(above))), 1.0)
+    middle = above[1:-1]
+    peaks = np.flatnonzero((middle > above[:-2]) & (middle >= above[2:]) & (middle > ratio * noise)) + 1
+    peaks = peaks[np.argsort(above[peaks])[::-1][:lines]]
+    left, centre, right = above[peaks - 1], above[peaks], above[peaks + 1]
+    curvature = left - 2 * centre + right
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offset = np.where(curvature < 0, 0.5 * (left - right) / curvature, 0.0)
+    found = np.interp(peaks + offset, np.arange(len(w)), w)
+    order = np.argsort(found)
+    return {"max_intensity": float(y.max()), "total_counts": float(y.sum()),
+            "signal": float(np.clip(above, 0, None).sum()), "noise": noise, "line_count": len(peaks),
+            "lines": [(float(found[i]), float(centre[i])) for i in order]}
+
+def source_of(name):
+    """"libs" for samples taken by do_sample (TIME_SAMPLE), "spectrum" for spectra saved without firing the laser
+    (SAMPLE_TIME), None if the name does not tell."""
+    if "_SAMPLE" in name:
+        return "libs"
+    if name.startswith("SAMPLE_"):
+        return "spectrum"
+    return None
+
+def parse_time(text):
+    """Unix time of a Unix time or a YYYY-MM-DD[THH:MM[:SS]] local time."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for f in TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(text, f))
+        except ValueError:
+            pass
+    raise ValueError("Cannot read " + text + " as a time, expected a Unix time or YYYY-MM-DD[THH:MM[:SS]]")
+
+def parse_query(terms):
+    """(conditions, lines, limit) of query terms (see the module docstring): conditions as [(column, operator, value)],
+    lines as [(wavelength, tolerance)]."""
+    conditions, lines, limit = [], [], DEFAULT_LIMIT
+    for term in terms:
+        m = TERM.match(term)
+        if m is None:
+            raise ValueError("Cannot read query term " + term + ", expected e.g. integration_time=6000 or line=589.0")
+        column, op, value = m.groups()
+        if column == "line":
+            if op != "=":
+                raise ValueError("line terms take =, e.g. line=589.0~0.3")
+            wavelength, _, tolerance = value.partition("~")
+            lines.append((float(wavelength), float(tolerance) if tolerance else LINE_TOLERANCE))
+        elif column in ("since", "until"):
+            conditions.append(("timestamp", ">=" if column == "since" else "<=", parse_time(value)))
+        elif column == "limit":
+            limit = int(value)
+        elif column in COLUMNS:
+            if SETTINGS.get(column, FEATURES.get(column)) in ("INTEGER", "REAL") or column == "flagged":
+                value = float(value)
+            conditions.append((column, op, value))
+        else:
+            raise ValueError("Unknown column " + column + ", expected one of " +
+                             ", ".join(COLUMNS[1:] + ["line", "since", "until", "limit"]))
+    return conditions, lines, limit
+
+class Catalog():
+    """The catalog at path, created if it does not exist. Safe to use from several threads."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL") # Readers do not wait for the writer, and commits are cheap
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("PRAGMA foreign_keys=ON")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, VERSION):
+                raise CatalogError("Unsupported catalog version " + str(version))
+            self.db.executescript(SCHEMA)
+            self.db.execute("PRAGMA user_version=" + str(VERSION))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+
+    def __contains__(self, name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM samples WHERE name=?", (name,)).fetchone() is not None
+
+    def names(self):
+        with self.lock:
+            return set(r[0] for r in self.db.execute("SELECT name FROM samples"))
+
+    def add_many(self, rows):
+        """Adds (name, timestamp, settings, features) rows in one transaction, replacing samples of the same name.
+        settings and features are dicts; missing settings are left empty. Returns the number added."""
+        insert = "INSERT INTO samples (" + ", ".join(COLUMNS) + ") VALUES (" + ", ".join("?" * len(COLUMNS)) + ")"
+        count = 0
+        with self.lock, self.db:
+            for name, timestamp, settings, f in rows:
+                settings = settings or {}
+                self.db.execute("DELETE FROM samples WHERE name=?", (name,)) # Its lines go with it
+                values = [name, timestamp, settings.get("source", source_of(name)), int(FLAG_SUFFIX in name)]
+                values += [settings.get(c) for c in SETTINGS] + [f[c] for c in FEATURES]
+                sample = self.db.execute(insert, values).lastrowid
+                self.db.executemany("INSERT INTO lines (sample, wavelength, height) VALUES (?, ?, ?)",
+                                    [(sample, w, h) for w, h in f["lines"]])
+                count += 1
+        return count
+
+    def add(self, name, wavelengths, intensities, settings=None, timestamp=None):
+        """Adds a sample from its spectrum and the settings it was taken with (keys of SETTINGS, and "source"). Without
+        a timestamp, the time in the sample's name is used (0 if it has none)."""
+        return self.add_many([(name, sample_time(name) if timestamp is None else timestamp, settings,
+                               features(wavelengths, intensities))])
+
+    def remove(self, name):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM samples WHERE name=?", (name,))
+
+    def find(self, conditions=(), lines=(), limit=DEFAULT_LIMIT):
+        """Samples matching every condition (column, operator, value) and having every line (wavelength, tolerance), as
+        a list of dicts of COLUMNS, newest first."""
+        where, params = [], []
+        for column, op, value in conditions:
+            if column not in COLUMNS or op not in OPERATORS:
+                raise ValueError("Invalid condition " + str(column) + " " + str(op))
+            where.append(column + " " + op + " ?")
+            params.append(value)
+        for wavelength, tolerance in lines:
+            where.append("id IN (SELECT sample FROM lines WHERE wavelength BETWEEN ? AND ?)")
+            params += [wavelength - tolerance, wavelength + tolerance]
+        query = "SELECT " + ", ".join(COLUMNS) + " FROM samples" + (" WHERE " + " AND ".join(where) if where else "") + \
+            " ORDER BY timestamp DESC LIMIT ?"
+        with self.lock:
+            return [dict(r) for r in self.db.execute(query, params + [int(limit)])]
+
+    def lines_of(self, name):
+        """[(wavelength, height)] of a sample's emission lines."""
+        with self.lock:
+            return [tuple(r) for r in self.db.execute("SELECT wavelength, height FROM lines JOIN samples ON "
+                                                      "lines.sample = samples.id WHERE name=? ORDER BY wavelength",
+                                                      (name,))]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def describe(row):
+    """One line summary of a row returned by find, for the CLI."""
+    taken = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["timestamp"])) if row["timestamp"] else "?"
+    settings = [c + "=" + str(row[c]) for c in SETTINGS if row[c] is not None]
+    return row["name"] + "  " + taken + "  max " + str(int(row["max_intensity"])) + ", " + \
+        str(row["line_count"]) + " lines" + ("  FLAGGED" if row["flagged"] else "") + \
+        ("  " + " ".join(settings) if settings else "")
+
+def _extract(directory, names):
+    """Worker task of backfill: (name, timestamp, None, features) of each readable sample, and the unreadable count."""
+    rows, failed = [], 0
+    for name in names:
+        try:
+            wavelengths, intensities = spectrum_codec.load_sample(os.path.join(directory, name))
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError, spectrum_codec.CodecError):
+            failed += 1
+            continue
+        rows.append((name, sample_time(name), None, features(wavelengths, intensities)))
+    return rows, failed
+
+def backfill(catalog, directory, processes=None, chunk=CHUNK, log=print):
+    """Adds the sample files in directory that are not in the catalog yet, reading them on processes worker processes
+    (default one per CPU, 1 reads them in this one). Returns (added, unreadable)."""
+    known = catalog.names()
+    names = sorted(e.name for e in os.scandir(directory)
+                   if e.is_file() and e.name.endswith(SAMPLE_EXTENSIONS) and e.name not in known)
+    chunks = [names[i:i + chunk] for i in range(0, len(names), chunk)]
+    added = failed = 0
+    if processes == 1 or len(chunks) <= 1:
+        results = (_extract(directory, c) for c in chunks)
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(processes)
+        results = pool.map(_extract, [directory] * len(chunks), chunks)
+    try:
+        for rows, unreadable in results: # In order, as they are done; the inserts stay in this process
+            added += catalog.add_many(rows)
+            failed += unreadable
+            if log is not None and len(chunks) > 1:
+                log("Catalogued " + str(added) + " / " + str(len(names)) + " samples")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return added, failed
+
+def bench(samples=2000):
+    import shutil
+    import tempfile
+    wavelengths, spectra = spectrum_codec._synthetic_shots(200)
+    directory = tempfile.mkdtemp()
+    try:
+        for i in range(samples):
+            with open(os.path.join(directory, str(1600000000.0 + i) + "_SAMPLE.pickle"), "wb") as f:
+                pickle.dump((wavelengths, spectra[i % len(spectra)]), f)
+        start = time.perf_counter()
+        for s in spectra:
+            features(wavelengths, s)
+        print("features: " + str(round(1e3 * (time.perf_counter() - start) / len(spectra), 3)) + " ms per sample")
+        for processes in (1, None):
+            catalog = Catalog(os.path.join(directory, "bench" + str(processes) + ".sqlite"))
+            start = time.perf_counter()
+            backfill(catalog, directory, processes, log=None)
+            print("backfill of " + str(samples) + " samples, " + ("1 process" if processes == 1 else
+                  str(os.cpu_count()) + " processes") + ": " + str(round(time.perf_counter() - start, 2)) + " s")
+        start = time.perf_counter()
+        for i in range(100):
+            catalog.add(str(1700000000.0 + i) + "_SAMPLE.pickle", wavelengths, spectra[i], {"integration_time": 6000})
+        print("add: " + str(round(10 * (time.perf_counter() - start), 2)) + " ms per sample, with its commit")
+        line = features(wavelengths, spectra[0])["lines"][0][0]
+        for terms in (["max_intensity>20000"], ["line=" + str(round(line, 1))], ["integration_time=6000", "limit=10"]):
+            conditions, lines, limit = parse_query(terms)
+            start = time.perf_counter()
+            for i in range(100):
+                found = catalog.find(conditions, lines, limit)
+            print("find " + " ".join(terms) + ": " + str(len(found)) + " samples in " +
+                  str(round(10 * (time.perf_counter() - start), 3)) + " ms")
+        catalog.close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "backfill":
+        catalog = Catalog(sys.argv[3])
+        added, failed = backfill(catalog, sys.argv[2], int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        print(str(added) + " samples added, " + str(len(catalog)) + " in the catalog" +
+              (", " + str(failed) + " unreadable" if failed else ""))
+    elif len(sys.argv) >= 3 and sys.argv[1] == "find":
+        catalog = Catalog(sys.argv[2])
+        for row in catalog.find(*parse_query(sys.argv[3:])):
+            print(describe(row))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        print(__doc__)
@@ -0,0 +1,71 @@
+import unittest
+import os
+import pickle
+import tempfile
+import sample_catalog
+import spectrum_codec
+import testing_utils
+
+class TestSampleCatalog(unittest.TestCase):
+    def setUp(self):
+        self.samples = tempfile.mkdtemp()
+        self.catalog = sample_catalog.Catalog(os.path.join(tempfile.mkdtemp(), "catalog.sqlite"))
+        self.spec = testing_utils.SimulatedSpectrometer(sleep=lambda s: None) # Without a laser every shot has lines
+        self.dark = testing_utils.SimulatedSpectrometer(testing_utils.SimulatedLaser(), sleep=lambda s: None)
+        self.wavelengths = self.spec.wavelengths()
+
+    def tearDown(self):
+        self.catalog.close()
+
+    def test_features_find_the_emission_lines(self):
+        f = sample_catalog.features(self.wavelengths, self.spec.intensities())
+        found = [w for w, h in f["lines"]]
+        for centre, height in testing_utils.SIMULATED_LINES:
+            self.assertLess(min(abs(w - centre) for w in found), 0.05)
+        self.assertEqual(f["line_count"], len(testing_utils.SIMULATED_LINES))
+        self.assertEqual(found, sorted(found))
+        dark = sample_catalog.features(self.wavelengths, self.dark.intensities()) # The laser never fired
+        self.assertEqual(dark["line_count"], 0)
+
+    def test_queries(self):
+        for i, t in enumerate((6000, 6000, 12000)):
+            self.catalog.add(str(1600000000.0 + i) + "_SAMPLE.pickle", self.wavelengths, self.spec.intensities(),
+                             {"integration_time": t, "sample_mode": "NORMAL", "serial": "SIM00001"})
+        self.catalog.add("SAMPLE_1600000010.0_FLAGGED.pickle", self.wavelengths, self.dark.intensities())
+        self.assertEqual(len(self.catalog), 4)
+        find = lambda *terms: [r["name"] for r in self.catalog.find(*sample_catalog.parse_query(terms))]
+        self.assertEqual(find("integration_time=6000"), ["1600000001.0_SAMPLE.pickle", "1600000000.0_SAMPLE.pickle"])
+        self.assertEqual(find("line=589.0", "limit=1"), ["1600000002.0_SAMPLE.pickle"])
+        self.assertEqual(len(find("line=589.0~0.1", "line=393.4")), 3)
+        self.assertEqual(find("line=500"), [])
+        self.assertEqual(find("flagged=1"), ["SAMPLE_1600000010.0_FLAGGED.pickle"])
+        self.assertEqual(find("source=spectrum", "max_intensity<5000"), ["SAMPLE_1600000010.0_FLAGGED.pickle"])
+        self.assertEqual(len(find("since=1600000001", "until=1600000002.5")), 2)
+        self.assertRaises(ValueError, sample_catalog.parse_query, ["colour=red"])
+        self.assertRaises(ValueError, sample_catalog.parse_query, ["line>589"])
+        row = self.catalog.find([("name", "=", "1600000000.0_SAMPLE.pickle")])[0]
+        self.assertEqual((row["serial"], row["source"], row["rep_rate"]), ("SIM00001", "libs", None))
+        self.assertIn("integration_time=6000", sample_catalog.describe(row))
+        self.catalog.add("1600000000.0_SAMPLE.pickle", self.wavelengths, self.dark.intensities()) # Replaced, lines too
+        self.assertEqual(len(self.catalog), 4)
+        self.assertEqual(self.catalog.lines_of("1600000000.0_SAMPLE.pickle"), [])
+
+    def test_backfill(self):
+        for i in range(10):
+            name = os.path.join(self.samples, str(1600000000.0 + i) + "_SAMPLE")
+            if i % 2:
+                spectrum_codec.save_sample(name + ".lsc", self.wavelengths, self.spec.intensities())
+            else:
+                with open(name + ".pickle", "wb") as f:
+                    pickle.dump((self.wavelengths, self.spec.intensities()), f)
+        with open(os.path.join(self.samples, "broken_SAMPLE.pickle"), "wb") as f:
+            f.write(b"not a sample")
+        self.assertEqual(sample_catalog.backfill(self.catalog, self.samples, 2, chunk=3, log=None), (10, 1))
+        self.assertEqual(sample_catalog.backfill(self.catalog, self.samples, 1, log=None), (0, 1))
+        rows = self.catalog.find()
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0]["timestamp"], 1600000009.0)
+        self.assertTrue(all(r["line_count"] == 6 and r["integration_time"] is None for r in rows))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+#!/usr/bin/python3
+"""
+sample_sync.py
+
+Incremental sample sync, replacing the scp of the whole samples/ directory. Both sides keep a manifest (size, mtime and
+SHA-1 of every file) and only files that are new or changed are transferred. Files are written to a .part file first,
+so an interrupted transfer continues from where it stopped the next time the sync is run. Many small files can also be
+packed into one gzip compressed tar bundle so the USB network link sees one stream instead of hundreds (an interrupted
+bundle is requested again as a whole).
+
+Usage:
+    python3 sample_sync.py serve [DIR] [--port PORT]           (on the BeagleBone)
+    python3 sample_sync.py pull HOST[:PORT] [DIR] [--bundle]    (on the PC)
+    python3 sample_sync.py local SRC DST [--bundle]
+    python3 sample_sync.py manifest DIR
+
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tarfile
+from argparse import ArgumentParser
+
+MANIFEST_NAME = ".sync_manifest.json"
+PART_SUFFIX = ".part"
+DEFAULT_PORT = 5557
+CHUNK_SIZE = 64 * 1024
+
+class SyncError(Exception):
+    pass
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_manifest(root):
+    """Returns the manifest saved in root, or an empty one."""
+    try:
+        with open(os.path.join(root, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(root, manifest):
+    path = os.path.join(root, MANIFEST_NAME)
+    with open(path + PART_SUFFIX, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(path + PART_SUFFIX, path)
+
+def build_manifest(root, previous=None):
+    """Scans root and returns {relative path: {"size", "mtime", "sha1"}}. Files whose size and mtime match previous are
+    not hashed again, so rescanning a large directory is cheap."""
+    previous = previous if previous is not None else load_manifest(root)
+    manifest = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name == MANIFEST_NAME or name.endswith(PART_SUFFIX):
+                continue
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            st = os.stat(path)
+            entry = {"size": st.st_size, "mtime": st.st_mtime}
+            old = previous.get(rel)
+            if old and old["size"] == entry["size"] and old["mtime"] == entry["mtime"]:
+                entry["sha1"] = old["sha1"]
+            else:
+                entry["sha1"] = file_hash(path)
+            manifest[rel] = entry
+    return manifest
+
+def update_manifest(root):
+    """Rescans root and saves its manifest. Returns the manifest."""
+    manifest = build_manifest(root)
+    save_manifest(root, manifest)
+    return manifest
+
+def changed_files(source, destination):
+    """Returns the names in the source manifest that are missing from, or differ in, the destination manifest."""
+    return sorted(name for name, entry in source.items()
+                  if name not in destination or destination[name]["sha1"] != entry["sha1"])
+
+def _safe_path(root, name):
+    path = os.path.abspath(os.path.join(root, name))
+    if os.path.isabs(name) or not path.startswith(os.path.abspath(root) + os.sep):
+        raise SyncError("Refusing to write outside of " + root + ": " + name)
+    return path
+
+class LocalSource():
+    """A sample directory on this machine."""
+    def __init__(self, root):
+        self.root = root
+
+    def manifest(self):
+        return update_manifest(self.root)
+
+    def open(self, name, offset=0):
+        f = open(_safe_path(self.root, name), "rb")
+        f.seek(offset)
+        return f
+
+    def bundle(self, names, out):
+        """Writes a tar.gz of names to the file object out."""
+        with tarfile.open(fileobj=out, mode="w|gz") as tar:
+            for name in names:
+                tar.add(_safe_path(self.root, name), arcname=name)
+
+class RemoteSource():
+    """A sample directory served by SyncServer on another machine."""
+    def __init__(self, host, port=DEFAULT_PORT, timeout=30):
+        self.address = (host, port)
+        self.timeout = timeout
+
+    def _request(self, request):
+        sock = socket.create_connection(self.address, self.timeout)
+        f = sock.makefile("rwb")
+        sock.close() # The file object keeps the connection open
+        f.write(json.dumps(request).encode("utf-8") + b"\n")
+        f.flush()
+        reply = json.loads(f.readline().decode("utf-8"))
+        if "error" in reply:
+            f.close()
+            raise SyncError(reply["error"])
+        return f
+
+    def manifest(self):
+        with self._request({"op": "manifest"}) as f:
+            return json.loads(f.read().decode("utf-8"))
+
+    def open(self, name, offset=0):
+        return self._request({"op": "get", "name": name, "offset": offset})
+
+    def bundle(self, names, out):
+        with self._request({"op": "bundle", "names": names}) as f:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+
+def _fetch(source, name, entry, root):
+    """Transfers one file, continuing from an existing .part file if there is one."""
+    path = _safe_path(root, name)
+    part = path + PART_SUFFIX
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > entry["size"]:
+        offset = 0
+    with source.open(name, offset) as src, open(part, "r+b" if offset else "wb") as dst:
+        dst.seek(offset)
+        dst.truncate()
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    if file_hash(part) != entry["sha1"]:
+        os.remove(part)
+        raise SyncError("Checksum mismatch for " + name + ", it will be transferred again on the next sync")
+    os.utime(part, (entry["mtime"], entry["mtime"]))
+    os.replace(part, path)
+    return offset
+
+def _unbundle(source, names, root):
+    """Transfers names as one tar.gz bundle and unpacks it into root."""
+    part = os.path.join(root, ".bundle.tar.gz" + PART_SUFFIX)
+    with open(part, "wb") as out:
+        source.bundle(names, out)
+    wanted = set(names)
+    try:
+        with tarfile.open(part, mode="r:gz") as tar:
+            for member in tar:
+                if member.name not in wanted or not member.isfile():
+                    raise SyncError("Unexpected file in bundle: " + member.name)
+                path = _safe_path(root, member.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with tar.extractfile(member) as src, open(path + PART_SUFFIX, "wb") as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.utime(path + PART_SUFFIX, (member.mtime, member.mtime))
+                os.replace(path + PART_SUFFIX, path)
+    finally:
+        os.remove(part)
+
+def sync(source, root, bundle=False, log=print):
+    """Brings root up to date with source. Returns the list of files that were transferred."""
+    os.makedirs(root, exist_ok=True)
+    remote = source.manifest()
+    names = changed_files(remote, update_manifest(root))
+    if not names:
+        log("Already up to date (" + str(len(remote)) + " files).")
+        return []
+    total = sum(remote[n]["size"] for n in names)
+    log("Transferring " + str(len(names)) + " files (" + str(total) + " bytes)...")
+    if bundle:
+        _unbundle(source, names, root)
+        for name in names:
+            entry = remote[name]
+            path = _safe_path(root, name)
+            os.utime(path, (entry["mtime"], entry["mtime"])) # tar only keeps whole seconds
+            if file_hash(path) != entry["sha1"]:
+                raise SyncError("Checksum mismatch for " + name + ", it will be transferred again on the next sync")
+    else:
+        for name in names:
+            offset = _fetch(source, name, remote[name], root)
+            if offset:
+                log("Resumed " + name + " at byte " + str(offset))
+    update_manifest(root)
+    log("Done.")
+    return names
+
+class SyncServer(socketserver.ThreadingTCPServer):
+    """Serves a sample directory to RemoteSource clients. One JSON request line per connection, answered with a JSON
+    status line followed by the raw data."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, host="0.0.0.0", port=DEFAULT_PORT):
+        self.source = LocalSource(root)
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), SyncRequestHandler)
+
+class SyncRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        source = self.server.source
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            if request["op"] == "manifest":
+                self._reply()
+                self.wfile.write(json.dumps(source.manifest()).encode("utf-8"))
+            elif request["op"] == "get":
+                with source.open(request["name"], int(request.get("offset", 0))) as f:
+                    self._reply()
+                    shutil.copyfileobj(f, self.wfile, CHUNK_SIZE)
+            elif request["op"] == "bundle":
+                self._reply()
+                source.bundle(request["names"], self.wfile)
+            else:
+                self._reply("Unknown op: " + str(request["op"]))
+        except (ValueError, KeyError, OSError, SyncError) as e:
+            self._reply(str(e))
+
+    def _reply(self, error=None):
+        reply = {"error": error} if error else {"ok": True}
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+def main():
+    parser = ArgumentParser(description="Incrementally sync LIBS sample directories.", prog="sample_sync.py")
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("serve", help="Serve a sample directory.")
+    p.add_argument("dir", nargs="?", default="samples/")
+    p.add_argument("--port", "-p", type=int, default=DEFAULT_PORT)
+    p = sub.add_parser("pull", help="Pull new or changed samples from a server.")
+    p.add_argument("address", help="HOST or HOST:PORT")
+    p.add_argument("dir", nargs="?", default="samples/")
+    p.add_argument("--bundle", action="store_true", help="Transfer all files as one compressed bundle.")
+    p = sub.add_parser("local", help="Sync between two local directories.")
+    p.add_argument("src")
+    p.add_argument("dir")
+    p.add_argument("--bundle", action="store_true", help="Transfer all files as one compressed bundle.")
+    p = sub.add_parser("manifest", help="Update and print the manifest of a directory.")
+    p.add_argument("dir")
+    a = parser.parse_args()
+
+    if a.command == "serve":
+        server = SyncServer(a.dir, port=a.port)
+        print("Serving " + a.dir + " on port " + str(a.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    elif a.command == "pull":
+        host, _, port = a.address.partition(":")
+        try:
+            sync(RemoteSource(host, int(port) if port else DEFAULT_PORT), a.dir, a.bundle)
+        except (OSError, SyncError) as e:
+            print("!!! Sync failed: " + str(e))
+            return 1
+    elif a.command == "local":
+        sync(LocalSource(a.src), a.dir, a.bundle)
+    elif a.command == "manifest":
+        print(json.dumps(update_manifest(a.dir), indent=1, sort_keys=True))
+    else:
+        parser.print_help()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
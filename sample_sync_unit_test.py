@@ -0,0 +1,78 @@
+import unittest
+import os
+import tempfile
+import threading
+import sample_sync
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+class CountingSource(sample_sync.LocalSource):
+    """LocalSource that records which files were requested, and from which offset."""
+    def __init__(self, root):
+        sample_sync.LocalSource.__init__(self, root)
+        self.opened = []
+
+    def open(self, name, offset=0):
+        self.opened.append((name, offset))
+        return sample_sync.LocalSource.open(self, name, offset)
+
+class TestSampleSync(unittest.TestCase):
+    def setUp(self):
+        self.src = tempfile.mkdtemp()
+        self.dst = tempfile.mkdtemp()
+        for i in range(20):
+            write(os.path.join(self.src, str(i) + "_SAMPLE.pickle"), os.urandom(1000 + i))
+        write(os.path.join(self.src, "run1", "a.pickle"), b"nested")
+
+    def assertSynced(self):
+        self.assertEqual(sorted(os.listdir(self.dst)), sorted(os.listdir(self.src)))
+        for name in sample_sync.build_manifest(self.src):
+            self.assertEqual(read(os.path.join(self.src, name)), read(os.path.join(self.dst, name)))
+
+    def test_only_changed_files_are_transferred(self):
+        source = CountingSource(self.src)
+        self.assertEqual(len(sample_sync.sync(source, self.dst, log=lambda s: None)), 21)
+        self.assertSynced()
+        self.assertEqual(sample_sync.sync(source, self.dst, log=lambda s: None), [])
+        write(os.path.join(self.src, "3_SAMPLE.pickle"), b"changed")
+        write(os.path.join(self.src, "new_SAMPLE.pickle"), b"new")
+        source.opened = []
+        self.assertEqual(sample_sync.sync(source, self.dst, log=lambda s: None), ["3_SAMPLE.pickle", "new_SAMPLE.pickle"])
+        self.assertEqual(len(source.opened), 2)
+        self.assertSynced()
+
+    def test_resume_interrupted_transfer(self):
+        name = "5_SAMPLE.pickle"
+        data = read(os.path.join(self.src, name))
+        write(os.path.join(self.dst, name + sample_sync.PART_SUFFIX), data[:400])
+        source = CountingSource(self.src)
+        sample_sync.sync(source, self.dst, log=lambda s: None)
+        self.assertIn((name, 400), source.opened)
+        self.assertSynced()
+        self.assertFalse(os.path.exists(os.path.join(self.dst, name + sample_sync.PART_SUFFIX)))
+
+    def test_bundle_over_socket(self):
+        server = sample_sync.SyncServer(self.src, "127.0.0.1", 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            source = sample_sync.RemoteSource("127.0.0.1", server.server_address[1])
+            self.assertEqual(len(sample_sync.sync(source, self.dst, bundle=True, log=lambda s: None)), 21)
+            self.assertSynced()
+            write(os.path.join(self.src, "0_SAMPLE.pickle"), b"changed")
+            self.assertEqual(sample_sync.sync(source, self.dst, log=lambda s: None), ["0_SAMPLE.pickle"])
+            self.assertSynced()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+if __name__ == "__main__":
+    unittest.main()
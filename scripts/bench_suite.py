@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+"""
+Benchmarks the acquisition and data paths against simulated hardware (testing_utils.SimulatedSpectrometer and
+SimulatedLaser), so it runs on any Linux box:
+    synthetic.*   generating test spectra
+    acquire.*     the full do_sample cycle in libs_cli, in virtual time (see clock.py)
+    persist.*     writing and reading samples as pickle, .lsc, CSV and run archives
+    plot.*        the core_ui plot refresh, drawn with the headless Agg backend
+    cli.*         libs_cli command dispatch
+Cases whose modules cannot be imported here (libs_cli needs pyserial and the GPIO library, plot needs matplotlib) are
+skipped and listed as such.
+
+Results are printed and can be written to JSON. --compare checks them against a baseline (by default the committed
+scripts/bench_baseline.json) and exits with status 1 if any case is slower than the baseline by more than the tolerance
+plus its noise, the spread between its best and median run in either measurement. A case that looks slower is measured
+again (--retries times) keeping its best time over all runs, since a busy machine only ever makes runs slower. Timings
+depend on the machine, so refresh the baseline with --save-baseline on the machine it is compared on.
+
+Usage: python3 scripts/bench_suite.py [--filter TEXT] [--repeat N] [--out FILE] [--compare [FILE]] [--tolerance 0.25]
+                                      [--retries 2] [--save-baseline]
+"""
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+import numpy as np
+
+import testing_utils
+
+class Skip(Exception):
+    pass
+
+CASES = [] # (name, setup); setup(workdir) returns the function (or Timed) to time, or raises Skip
+
+def case(name):
+    def register(setup):
+        CASES.append((name, setup))
+        return setup
+    return register
+
+class Timed():
+    """A function to time with reset(), called before every timed run but outside the timing, to restore whatever state
+    the calls use up, and a cap on the calls per run."""
+    def __init__(self, run, reset=None, max_number=1 << 20):
+        self.run = run
+        self.reset = reset
+        self.max_number = max_number
+
+def no_sleep(seconds):
+    pass
+
+def import_libs_cli(workdir):
+    """Imports libs_cli with its log and samples directed into workdir."""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            import libs_cli
+    except ImportError as e:
+        raise Skip("libs_cli cannot be imported: " + str(e))
+    libs_cli.command_log = io.StringIO()
+    libs_cli.SAMPLES_PATH = os.path.join(workdir, "samples") + "/"
+    os.makedirs(libs_cli.SAMPLES_PATH, exist_ok=True)
+    libs_cli.CATALOG_PATH = os.path.join(workdir, "catalog.sqlite")
+    return libs_cli
+
+def quiet(f):
+    """f with its printed output discarded."""
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            f()
+    return run
+
+def sample():
+    spec = testing_utils.SimulatedSpectrometer(sleep=no_sleep)
+    return spec.spectrum()
+
+@case("synthetic.dummy_spectra")
+def bench_dummy_spectra(workdir):
+    try:
+        import pandas
+    except ImportError:
+        raise Skip("pandas is not installed")
+    return lambda: testing_utils.generate_dummy_spectra()
+
+@case("synthetic.simulated_spectrum")
+def bench_simulated_spectrum(workdir):
+    spec = testing_utils.SimulatedSpectrometer(testing_utils.SimulatedLaser(), sleep=no_sleep)
+    return spec.spectrum
+
+@case("acquire.do_sample")
+def bench_do_sample(workdir):
+    from clock import VirtualClock
+    libs_cli = import_libs_cli(workdir)
+    libs_cli.clock = VirtualClock() # Skips the 2.5 s of sleeps in every sample, leaving the work done around them
+    laser = testing_utils.SimulatedLaser(0.002, libs_cli.clock.sleep, libs_cli.clock.monotonic)
+    spec = testing_utils.SimulatedSpectrometer(laser, sleep=libs_cli.clock.sleep)
+    libs_cli.spectrometer = spec
+    libs_cli.sample_mode = "NORMAL"
+    return quiet(lambda: libs_cli.do_sample(spec, laser))
+
+@case("persist.pickle_write")
+def bench_pickle_write(workdir):
+    data = sample()
+    path = os.path.join(workdir, "sample.pickle")
+    def run():
+        with open(path, "wb") as f:
+            pickle.dump(data, f)
+    return run
+
+@case("persist.pickle_read")
+def bench_pickle_read(workdir):
+    import spectrum_codec
+    path = os.path.join(workdir, "read.pickle")
+    with open(path, "wb") as f:
+        pickle.dump(sample(), f)
+    return lambda: spectrum_codec.load_sample(path)
+
+@case("persist.lsc_write")
+def bench_lsc_write(workdir):
+    import spectrum_codec
+    wavelengths, intensities = sample()
+    path = os.path.join(workdir, "sample.lsc")
+    return lambda: spectrum_codec.save_sample(path, wavelengths, intensities)
+
+@case("persist.lsc_read")
+def bench_lsc_read(workdir):
+    import spectrum_codec
+    path = os.path.join(workdir, "read.lsc")
+    spectrum_codec.save_sample(path, *sample())
+    return lambda: spectrum_codec.load_sample(path)
+
+@case("persist.csv_write")
+def bench_csv_write(workdir):
+    libs_cli = import_libs_cli(workdir)
+    wavelengths, intensities = sample()
+    path = os.path.join(workdir, "sample.csv")
+    return lambda: libs_cli.save_sample_csv(path, wavelengths, intensities)
+
+@case("persist.csv_export")
+def bench_csv_export(workdir):
+    try:
+        import pandas
+    except ImportError:
+        raise Skip("pandas is not installed")
+    from spectrum_view import SpectrumView
+    wavelengths, intensities = sample()
+    view = SpectrumView()
+    view.set_wavelengths(wavelengths)
+    view.update(intensities)
+    path = os.path.join(workdir, "export.csv")
+    return lambda: view.to_dataframe().to_csv(path, index=None, header=True)
+
+@case("persist.archive_append")
+def bench_archive_append(workdir):
+    import run_archive
+    wavelengths, intensities = sample()
+    path = os.path.join(workdir, "run.lsr")
+    writers = [run_archive.RunArchiveWriter(path, wavelengths)]
+    def start_over(): # Before every run, so the benchmark does not fill the disk
+        writers[0].close()
+        os.remove(path)
+        writers[0] = run_archive.RunArchiveWriter(path, wavelengths)
+    return Timed(lambda: writers[0].append(intensities), start_over, max_number=1024)
+
+@case("persist.archive_read")
+def bench_archive_read(workdir):
+    import run_archive
+    wavelengths, intensities = sample()
+    path = os.path.join(workdir, "read.lsr")
+    writer = run_archive.RunArchiveWriter(path, wavelengths)
+    for i in range(100):
+        writer.append(intensities)
+    writer.close()
+    archive = run_archive.RunArchive(path)
+    counter = iter(range(1 << 62))
+    return lambda: np.array(archive[next(counter) % 100][1])
+
+@case("plot.refresh")
+def bench_plot_refresh(workdir):
+    try:
+        import matplotlib
+    except ImportError:
+        raise Skip("matplotlib is not installed")
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from spectrum_view import SpectrumView
+    spec = testing_utils.SimulatedSpectrometer(sleep=no_sleep)
+    fig = Figure(figsize=(5, 5), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    view = SpectrumView()
+    view.set_wavelengths(spec.wavelengths())
+    view.update(spec.intensities())
+    line, = ax.plot(view.x, view.y)
+    def run(): # core_ui's draw_spectrum
+        view.update(spec.intensities())
+        line.set_data(view.x, view.y)
+        ax.relim()
+        ax.autoscale_view()
+        canvas.draw()
+    return run
+
+@case("cli.dispatch")
+def bench_cli_dispatch(workdir):
+    libs_cli = import_libs_cli(workdir)
+    commands = ["get sample_format", "get auto_exposure", "quality show", "pipeline show", "not_a_command"]
+    def run():
+        for c in commands:
+            libs_cli.handle_command(c)
+    return quiet(run)
+
+def measure(f, repeat, min_time=0.2):
+    """Times f (a function or a Timed) like timeit's autorange: calls per run are doubled until a run takes min_time,
+    then the best and median seconds per call over repeat runs are returned, with the calls per run."""
+    if not isinstance(f, Timed):
+        f = Timed(f)
+    def timed_run(number):
+        if f.reset is not None:
+            f.reset()
+        start = time.perf_counter()
+        for i in range(number):
+            f.run()
+        return time.perf_counter() - start
+    timed_run(1) # Warm up lazy imports and caches
+    number = 1
+    while True:
+        elapsed = timed_run(number)
+        if elapsed >= min_time or number >= f.max_number:
+            break
+        number *= 2
+    times = [elapsed / number]
+    for r in range(repeat - 1):
+        times.append(timed_run(number) / number)
+    times.sort()
+    return times[0], times[len(times) // 2], number
+
+def run_suite(repeat=5, name_filter=None, names=None):
+    results = {"machine": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+                           "processor": platform.processor() or platform.machine()},
+               "time": time.time(), "cases": {}, "skipped": {}}
+    workdir = tempfile.mkdtemp(prefix="libs_bench_")
+    try:
+        for name, setup in CASES:
+            if (name_filter and name_filter not in name) or (names is not None and name not in names):
+                continue
+            try:
+                f = setup(workdir)
+            except Skip as e:
+                results["skipped"][name] = str(e)
+                print(name.ljust(30) + ": skipped, " + str(e))
+                continue
+            best, median, number = measure(f, repeat)
+            results["cases"][name] = {"best": best, "median": median, "number": number}
+            print(name.ljust(30) + ": " + format_time(best) + " best, " + format_time(median) + " median")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def format_time(seconds):
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return str(round(seconds / scale, 2)) + " " + unit
+    return str(round(seconds / 1e-9, 1)) + " ns"
+
+def noise(result):
+    """Relative spread between a case's median and best run."""
+    return result["median"] / result["best"] - 1
+
+def limit(new, old, tolerance):
+    """Slowdown ratio (by best time) beyond which a case counts as a regression: tolerance widened by the noisier of
+    the two measurements."""
+    return 1 + tolerance + max(noise(new), noise(old))
+
+def suspects(results, baseline, tolerance):
+    return sorted(name for name, new in results["cases"].items() if name in baseline["cases"] and
+                  new["best"] / baseline["cases"][name]["best"] > limit(new, baseline["cases"][name], tolerance))
+
+def remeasure(results, names, repeat):
+    """Runs the named cases again, keeping each one's best and median over all measurements."""
+    again = run_suite(repeat, names=names)
+    for name, new in again["cases"].items():
+        old = results["cases"][name]
+        results["cases"][name] = {"best": min(old["best"], new["best"]), "median": min(old["median"], new["median"]),
+                                  "number": new["number"]}
+
+def compare(results, baseline, tolerance):
+    """Prints each case's change against the baseline (by best time) and returns the names of those slower than their
+    limit()."""
+    regressions = []
+    print("\nCompared with the baseline from " + time.strftime("%Y-%m-%d", time.localtime(baseline.get("time", 0))) +
+          " (" + baseline.get("machine", {}).get("platform", "unknown machine") + "):")
+    for name in sorted(set(results["cases"]) | set(baseline["cases"])):
+        new, old = results["cases"].get(name), baseline["cases"].get(name)
+        if new is None:
+            print(name.ljust(30) + ": not run" + (", " + results["skipped"][name] if name in results["skipped"] else ""))
+            continue
+        if old is None:
+            print(name.ljust(30) + ": not in the baseline")
+            continue
+        ratio = new["best"] / old["best"]
+        allowed = limit(new, old, tolerance)
+        flag = ""
+        if ratio > allowed:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(name.ljust(30) + ": " + "{:+.1f}%".format(100 * (ratio - 1)) + " (limit " +
+              "{:+.1f}%".format(100 * (allowed - 1)) + ")" + flag)
+    return regressions
+
+def main():
+    parser = ArgumentParser(description="Benchmarks the acquisition and data paths with simulated hardware.")
+    parser.add_argument("--filter", help="Only run cases whose name contains TEXT.", metavar="TEXT", default=None)
+    parser.add_argument("--repeat", help="Timed runs per case (default 5).", type=int, default=5)
+    parser.add_argument("--out", help="Write the results to FILE as JSON.", metavar="FILE", default=None)
+    parser.add_argument("--compare", help="Compare with a baseline JSON file (default " + os.path.relpath(BASELINE) + ").",
+                        metavar="FILE", nargs="?", const=BASELINE, default=None)
+    parser.add_argument("--tolerance", help="Slowdown beyond which a case is a regression (default 0.25 = 25%%).",
+                        type=float, default=0.25)
+    parser.add_argument("--retries", help="Times a case that looks slower is measured again (default 2).", type=int,
+                        default=2)
+    parser.add_argument("--save-baseline", help="Write the results to the baseline file.", action="store_true")
+    args = parser.parse_args()
+
+    results = run_suite(args.repeat, args.filter)
+    for path in ([args.out] if args.out else []) + ([BASELINE] if args.save_baseline else []):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for attempt in range(args.retries):
+            slower = suspects(results, baseline, args.tolerance)
+            if not slower:
+                break
+            print("\nMeasuring again: " + ", ".join(slower))
+            remeasure(results, slower, args.repeat)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n" + str(len(regressions)) + " regression(s): " + ", ".join(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,5 @@
-scp debian@192.168.6.2:Laser-Spectrometer-Interface-GUI/samples/* ./
+#!/bin/bash
+# Pulls new or changed samples from the BeagleBone into ./samples. Only files that are not already here are transferred.
+# Start the sync server on the BeagleBone first: python3 sample_sync.py serve samples/
+# Extra arguments are passed on, e.g. --bundle to transfer everything as one compressed file.
+python3 "$(dirname "$0")/../sample_sync.py" pull 192.168.6.2 ./samples "$@"
@@ -7,11 +7,10 @@ end
 arg_list = argv();
 input = arg_list{1};
 
-startindex = 0;
-endindex = 3648;
-
-wavelengths = dlmread(input,",",[startindex,0,endindex,0]);
-intensities = dlmread(input,",",[startindex,1,endindex,1]);
+% Every row after the header, so samples of any length (other units, resampled grids) plot whole
+data = dlmread(input,",",1,0);
+wavelengths = data(:,1);
+intensities = data(:,2);
 
 sample = figure();
 plot(wavelengths, intensities);
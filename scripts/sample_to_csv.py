@@ -1,16 +1,16 @@
 #!/usr/local/bin/python3
 import sys
-import pickle
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import spectrum_codec
 
 def convert_pickle_to_csv(input,output):
-    f = open(input,"rb")
     o = open(output,"w")
-    data = pickle.load(f)
+    data = spectrum_codec.load_sample(input) # Handles both .pickle and .lsc samples
     o.write("Wavelengths,Intensities\n")
     for i in range(0,len(data[0])):
         o.write(str(data[0][i]) + "," + str(data[1][i]) + "\n")
     o.close()
-    f.close()
 
 if len(sys.argv) == 2:
     print("Converting file: " + sys.argv[1])
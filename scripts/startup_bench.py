@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+"""
+Measures how long the entry points take to become usable:
+    - libs_cli.py --help
+    - libs_cli.py until the first "?" prompt is printed (in both the asyncio and the --blocking command loops)
+    - core_ui.py until the window is shown and until the plot is ready (needs a display)
+
+Usage: python3 scripts/startup_bench.py [RUNS]
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+def time_until(args, marker, stdin=None):
+    """Starts python with args in the repository root and returns the seconds until marker appears in its output, or
+    None if it exits first. The process is killed once the marker is seen."""
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable] + args, cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    seen = b""
+    elapsed = None
+    while True:
+        c = p.stdout.read(1)
+        if not c:
+            break
+        seen += c
+        if seen.endswith(marker):
+            elapsed = time.perf_counter() - start
+            break
+    if stdin is not None and p.poll() is None:
+        try:
+            p.stdin.write(stdin)
+            p.stdin.close()
+            p.wait(5)
+        except (BrokenPipeError, subprocess.TimeoutExpired):
+            pass
+    if p.poll() is None:
+        p.kill()
+    p.wait()
+    if elapsed is None:
+        print("    output: " + seen.decode(errors="replace").strip().replace("\n", "\n    output: "))
+    return elapsed
+
+def report(label, times):
+    times = [t for t in times if t is not None]
+    if not times:
+        print(label.ljust(28) + ": failed")
+        return
+    print(label.ljust(28) + ": best " + str(round(min(times), 3)) + " s, mean " + str(round(sum(times) / len(times), 3)) + " s")
+
+def main(runs):
+    os.makedirs(os.path.join(ROOT, "logs"), exist_ok=True)
+    report("libs_cli --help", [time_until(["libs_cli.py", "--help"], b"usage:") for i in range(runs)])
+    report("libs_cli first prompt", [time_until(["libs_cli.py"], b"?", b"exit\n") for i in range(runs)])
+    report("libs_cli --blocking prompt", [time_until(["libs_cli.py", "--blocking"], b"?", b"exit\n") for i in range(runs)])
+    if os.name == "posix" and not os.environ.get("DISPLAY"):
+        print("core_ui                     : skipped, no display")
+        return
+    report("core_ui first window", [time_until(["core_ui.py", "--startup-time"], b"First window") for i in range(runs)])
+    report("core_ui plot ready", [time_until(["core_ui.py", "--startup-time"], b"Plot ready") for i in range(runs)])
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
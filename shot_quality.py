@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""
+shot_quality.py
+
+Per-shot quality gate, run on every spectrum before it is saved. A few cheap metrics are computed for a shot, or for a
+whole burst at once, with array operations only:
+    saturated    pixels at or above the saturation level (SATURATED of the detector's maximum count)
+    signal       total counts above the dark level, taken as the median since most pixels see no line
+    peak_ratio   height of the highest peak above the dark level, in units of the continuum noise (scaled median
+                 absolute deviation); a misfire or a shot outside the integration window leaves only noise
+    correlation  Pearson correlation with the previous shot; a missed trigger makes the spectrometer return the frame
+                 still sitting in its FIFO, which is an exact repeat of the last one
+
+A shot fails a check when a metric is past its threshold (None disables a check). Depending on the action, failed shots
+are dropped before they are saved, or saved flagged (see FLAG_SUFFIX), or only counted. The reasons are tallied so
+they can be reviewed with 'quality show' in libs_cli.
+
+Usage:
+    python3 shot_quality.py check SAMPLE_FILE...
+    python3 shot_quality.py bench [SHOTS]
+
+"""
+import collections
+import sys
+import time
+
+import numpy as np
+
+from auto_exposure import SATURATED
+
+ACTIONS = ["drop", "flag", "off"] # off still computes and tallies, but keeps every shot as it is
+REASONS = ["saturated", "low_signal", "no_peak", "duplicate"]
+THRESHOLDS = ["max_saturated", "min_signal", "min_peak_ratio", "max_correlation"]
+FLAG_SUFFIX = "_FLAGGED" # Added to the sample name (before the extension) of shots that are saved flagged
+MAD_SCALE = 1.4826 # Median absolute deviation to standard deviation, for normal noise
+
+def metrics(spectra, previous=None, saturation=65535):
+    """Quality metrics of a spectrum or of a shots x pixels batch, as a dict of arrays with one value per shot. The
+    correlation of the first shot is with previous, or NaN if there is none."""
+    data = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    dark = np.median(data, axis=1)
+    above = data - dark[:, np.newaxis]
+    noise = MAD_SCALE * np.median(np.abs(above), axis=1)
+    peak = above.max(axis=1)
+
+    chain = data if previous is None else np.vstack([np.asarray(previous, dtype=np.float64), data])
+    centred = chain - chain.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt(np.einsum("ij,ij->i", centred, centred))
+    dots = np.einsum("ij,ij->i", centred[1:], centred[:-1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = dots / (norms[1:] * norms[:-1])
+    if previous is None:
+        correlation = np.concatenate([[np.nan], correlation])
+
+    return {"saturated": np.count_nonzero(data >= SATURATED * saturation, axis=1),
+            "signal": np.clip(above, 0, None).sum(axis=1),
+            "peak_ratio": peak / np.maximum(noise, 1.0),
+            "correlation": correlation}
+
+class QualityGate():
+    """Thresholds, the action to take on shots that fail them, and a tally of the reasons shots have failed."""
+    def __init__(self, saturation=65535, max_saturated=0, min_signal=None, min_peak_ratio=10.0,
+                 max_correlation=0.99999, action="flag"):
+        if action not in ACTIONS:
+            raise ValueError("Quality action must be one of " + ", ".join(ACTIONS))
+        self.saturation = saturation
+        self.max_saturated = max_saturated
+        self.min_signal = min_signal
+        self.min_peak_ratio = min_peak_ratio
+        self.max_correlation = max_correlation
+        self.action = action
+        self.reset()
+
+    def reset(self):
+        """Clears the tally, and forgets the previous shot."""
+        self.shots = 0
+        self.failed = 0
+        self.reasons = collections.Counter()
+        self.previous = None
+
+    def thresholds(self):
+        return dict((t, getattr(self, t)) for t in THRESHOLDS)
+
+    def set_threshold(self, name, value):
+        """Sets a threshold by name; value None (or "off") disables the check."""
+        if name not in THRESHOLDS:
+            raise ValueError("Unknown threshold " + name + ", expected one of " + ", ".join(THRESHOLDS))
+        if value == "off":
+            value = None
+        elif value is not None:
+            value = int(value) if name == "max_saturated" else float(value)
+        setattr(self, name, value)
+
+    def reasons_for(self, m):
+        """Lists the reasons each shot fails, given metrics() of a batch."""
+        fails = []
+        if self.max_saturated is not None:
+            fails.append(("saturated", m["saturated"] > self.max_saturated))
+        if self.min_signal is not None:
+            fails.append(("low_signal", m["signal"] < self.min_signal))
+        if self.min_peak_ratio is not None:
+            fails.append(("no_peak", m["peak_ratio"] < self.min_peak_ratio))
+        if self.max_correlation is not None:
+            fails.append(("duplicate", m["correlation"] > self.max_correlation)) # NaN compares False
+        return [[reason for reason, mask in fails if mask[i]] for i in range(len(m["signal"]))]
+
+    def check_batch(self, spectra):
+        """Checks consecutive shots (shots x pixels) and tallies them. Returns (metrics, reasons per shot)."""
+        spectra = np.atleast_2d(spectra)
+        m = metrics(spectra, self.previous, self.saturation)
+        reasons = self.reasons_for(m)
+        self.previous = np.array(spectra[-1], dtype=np.float64)
+        self.shots += len(reasons)
+        for r in reasons:
+            if r:
+                self.failed += 1
+                self.reasons.update(r)
+        return m, reasons
+
+    def check(self, intensities):
+        """Checks one shot and tallies it. Returns (metrics as floats, list of reasons it failed)."""
+        m, reasons = self.check_batch(intensities)
+        return dict((k, float(v[0])) for k, v in m.items()), reasons[0]
+
+    def keep(self, reasons):
+        """True if a shot that failed for reasons should still be saved."""
+        return not reasons or self.action != "drop"
+
+    def report(self):
+        """Lines describing the tally, for the CLI."""
+        lines = [str(self.shots) + " shots checked, " + str(self.failed) + " failed (action: " + self.action + ")"]
+        for reason in REASONS:
+            if self.reasons[reason]:
+                lines.append("\t" + reason + ": " + str(self.reasons[reason]))
+        return lines
+
+def for_spectrometer(spec, **kwargs):
+    """Creates a QualityGate with the saturation level of a seabreeze Spectrometer, kept as .spec."""
+    gate = QualityGate(getattr(spec, "max_intensity", 65535), **kwargs)
+    gate.spec = spec
+    return gate
+
+def flagged_name(filename):
+    """filename with FLAG_SUFFIX inserted before the extension."""
+    stem, dot, extension = filename.rpartition(".")
+    return stem + FLAG_SUFFIX + dot + extension if dot else filename + FLAG_SUFFIX
+
+def bench(shots=1000):
+    import spectrum_codec
+    wavelengths, spectra = spectrum_codec._synthetic_shots(shots)
+    spectra = spectra.astype(np.float64)
+    spectra[::10] = np.random.RandomState(7).normal(1500, 12, (len(spectra[::10]), spectra.shape[1])) # Misfires
+    spectra[5::10] = spectra[4::10][:len(spectra[5::10])] # Stale FIFO frames
+    gate = QualityGate()
+    start = time.perf_counter()
+    for s in spectra:
+        gate.check(s)
+    single = (time.perf_counter() - start) / shots
+    gate.reset()
+    start = time.perf_counter()
+    gate.check_batch(spectra)
+    batch = (time.perf_counter() - start) / shots
+    print(str(spectra.shape[1]) + " pixels: " + str(round(1e6 * single, 1)) + " us/shot one at a time, " +
+          str(round(1e6 * batch, 1)) + " us/shot batched")
+    for line in gate.report():
+        print(line)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "check":
+        import spectrum_codec
+        gate = QualityGate(action="off")
+        for name in sys.argv[2:]:
+            m, reasons = gate.check(spectrum_codec.load_sample(name)[1])
+            print(name + ": " + ", ".join(k + "=" + str(round(v, 5)) for k, v in sorted(m.items())) +
+                  ("  FAILED " + ", ".join(reasons) if reasons else ""))
+        for line in gate.report():
+            print(line)
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        print(__doc__)
@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+import shot_quality
+
+class TestShotQuality(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        x = np.arange(2000)
+        self.dark = rng.normal(1500, 10, (4, 2000))
+        self.shots = self.dark + 20000 * np.exp(-0.5 * ((x - 700) / 2.0) ** 2)
+
+    def test_batch_matches_single_shots(self):
+        batch = shot_quality.metrics(self.shots)
+        previous = None
+        for i, s in enumerate(self.shots):
+            single = shot_quality.metrics(s, previous)
+            for k in batch:
+                np.testing.assert_allclose(single[k], batch[k][i:i + 1])
+            previous = s
+
+    def test_failed_shots_are_tallied(self):
+        gate = shot_quality.QualityGate(action="drop")
+        shots = [self.shots[0], self.shots[0], self.dark[1], np.minimum(self.shots[2] * 4, 65535), self.shots[3]]
+        reasons = [gate.check(s)[1] for s in shots]
+        self.assertEqual(reasons, [[], ["duplicate"], ["no_peak"], ["saturated"], []])
+        self.assertEqual(gate.failed, 3)
+        self.assertEqual(gate.shots, 5)
+        self.assertFalse(gate.keep(["no_peak"]))
+        gate.set_threshold("min_peak_ratio", "off")
+        self.assertEqual(gate.check(self.dark[2])[1], [])
+
+    def test_flagged_name(self):
+        self.assertEqual(shot_quality.flagged_name("samples/1.5_SAMPLE.lsc"), "samples/1.5_SAMPLE_FLAGGED.lsc")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+"""
+spectral_index.py
+
+Similarity search over saved samples. Every sample is resampled onto a common wavelength grid, has its dark level (the
+median) removed and is scaled to unit length, so the cosine similarity of two samples is the dot product of their
+vectors. The vectors are the rows of one contiguous float32 matrix, and a query is a single matrix-vector product and a
+partial sort for the top k, which takes a few milliseconds over tens of thousands of samples.
+
+The vectors can be compressed with PCA to a few dozen components. The basis is fitted once, when the index is built,
+on an evenly spaced subset of the samples; samples added later are projected onto the same basis. That makes the
+matrix and the search an order of magnitude smaller and faster, and mostly keeps the ranking of the best matches.
+
+An index is stored in a directory:
+    meta.json     grid, vector length and format version
+    pca.npz       PCA basis, if the vectors are compressed
+    vectors.f32   the matrix, one row per sample
+    names.txt     sample file names, one per line
+so adding a sample appends to two files instead of rewriting the index.
+
+Usage:
+    python3 spectral_index.py build SAMPLES_DIR INDEX_DIR [COMPONENTS]
+    python3 spectral_index.py update SAMPLES_DIR INDEX_DIR
+    python3 spectral_index.py search INDEX_DIR SAMPLE_FILE [K]
+    python3 spectral_index.py bench [SAMPLES]
+
+"""
+import json
+import os
+import pickle
+import sys
+import threading
+import time
+
+import numpy as np
+
+import resample
+import spectrum_codec
+from run_archive import SAMPLE_EXTENSIONS
+
+VERSION = 1
+DEFAULT_GRID = (200.0, 1000.0, 0.5) # start, stop, step in nm; covers the FLAME-T range
+DEFAULT_K = 10
+FIT_SAMPLES = 2000 # Most samples the PCA basis is fitted on
+BATCH = 256 # Samples loaded and added at a time when updating from a directory
+
+class SpectralIndexError(Exception):
+    pass
+
+def pca_basis(vectors, components):
+    """Top components right singular vectors of vectors (uncentred, so dot products are approximately preserved)."""
+    components = min(components, vectors.shape[0], vectors.shape[1])
+    u, s, vt = np.linalg.svd(np.asarray(vectors, dtype=np.float64), full_matrices=False)
+    return vt[:components].astype(np.float32)
+
+class SpectralIndex():
+    """Unit vectors of samples on a common grid, searchable by cosine similarity. Safe to add to from one thread while
+    searching from another."""
+    def __init__(self, grid=DEFAULT_GRID, basis=None):
+        self.grid_params = tuple(float(g) for g in grid)
+        start, stop, step = self.grid_params
+        self.grid = resample.uniform_grid(start, stop, step)
+        self.basis = basis
+        self.dim = len(basis) if basis is not None else len(self.grid)
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32) # Rows past count are spare capacity
+        self.count = 0
+        self.names = []
+        self.known = set()
+        self.path = None # Directory rows are appended to as they are added, set by save() and load()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, name):
+        return name in self.known
+
+    def vectors(self, wavelengths, spectra):
+        """Index vectors (float32, one row per spectrum) of a spectrum or batch of spectra measured at wavelengths."""
+        data = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        out = resample.get_resampler(wavelengths, *self.grid_params, method="linear")(data)
+        out -= np.median(out, axis=1)[:, np.newaxis]
+        if self.basis is not None:
+            out /= np.maximum(np.linalg.norm(out, axis=1), 1e-12)[:, np.newaxis]
+            out = np.dot(out, self.basis.T.astype(np.float64))
+        out /= np.maximum(np.linalg.norm(out, axis=1), 1e-12)[:, np.newaxis]
+        return out.astype(np.float32)
+
+    def _append(self, names, vectors):
+        need = self.count + len(vectors)
+        if need > len(self.matrix):
+            matrix = np.zeros((max(need, 2 * len(self.matrix), 1024), self.dim), dtype=np.float32)
+            matrix[:self.count] = self.matrix[:self.count]
+            self.matrix = matrix
+        self.matrix[self.count:need] = vectors
+        self.count = need
+        self.names.extend(names)
+        self.known.update(names)
+
+    def add_vectors(self, names, vectors):
+        """Adds precomputed vectors, skipping names that are already indexed. Returns the number added."""
+        with self.lock:
+            keep, seen = [], set()
+            for i, n in enumerate(names):
+                if n not in self.known and n not in seen:
+                    keep.append(i)
+                    seen.add(n)
+            if not keep:
+                return 0
+            names = [names[i] for i in keep]
+            vectors = np.ascontiguousarray(vectors[keep], dtype=np.float32)
+            self._append(names, vectors)
+            if self.path is not None:
+                with open(os.path.join(self.path, "vectors.f32"), "ab") as f:
+                    vectors.tofile(f)
+                with open(os.path.join(self.path, "names.txt"), "a") as f:
+                    f.write("".join(n + "\n" for n in names))
+            return len(names)
+
+    def add(self, name, wavelengths, intensities):
+        """Adds one sample. Returns False if a sample of that name is already indexed."""
+        if name in self.known:
+            return False
+        return self.add_vectors([name], self.vectors(wavelengths, intensities)) == 1
+
+    def search_vector(self, vector, k=DEFAULT_K):
+        """The k rows most similar to an index vector, as [(name, cosine similarity)], most similar first."""
+        with self.lock:
+            count = self.count
+            matrix = self.matrix
+            names = self.names
+        if count == 0:
+            return []
+        scores = np.dot(matrix[:count], vector)
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="mergesort")]
+        return [(names[i], float(scores[i])) for i in top]
+
+    def search(self, wavelengths, intensities, k=DEFAULT_K):
+        """The k indexed samples most similar to a spectrum, as [(name, cosine similarity)], most similar first."""
+        return self.search_vector(self.vectors(wavelengths, intensities)[0], k)
+
+    def update(self, directory, batch=BATCH):
+        """Adds the sample files in directory that are not indexed yet. Returns (added, unreadable)."""
+        names = [n for n in sample_names(directory) if n not in self.known]
+        added = failed = 0
+        for start in range(0, len(names), batch):
+            group, vectors = [], []
+            for name in names[start:start + batch]:
+                try:
+                    wavelengths, intensities = spectrum_codec.load_sample(os.path.join(directory, name))
+                except (OSError, ValueError, EOFError, pickle.UnpicklingError, spectrum_codec.CodecError):
+                    failed += 1
+                    continue
+                group.append(name)
+                vectors.append(self.vectors(wavelengths, intensities)[0])
+            if group:
+                added += self.add_vectors(group, np.array(vectors))
+        return added, failed
+
+    def save(self, path):
+        """Writes the whole index to the directory path; rows added afterwards are appended to it."""
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            with open(os.path.join(path, "meta.json"), "w") as f:
+                json.dump({"version": VERSION, "grid": list(self.grid_params), "dim": self.dim,
+                           "compressed": self.basis is not None}, f)
+            if self.basis is not None:
+                np.savez(os.path.join(path, "pca.npz"), basis=self.basis)
+            self.matrix[:self.count].tofile(os.path.join(path, "vectors.f32"))
+            with open(os.path.join(path, "names.txt"), "w") as f:
+                f.write("".join(n + "\n" for n in self.names))
+            self.path = path
+
+    @classmethod
+    def load(cls, path):
+        """Loads an index saved by save(). Rows added afterwards are appended to it."""
+        try:
+            with open(os.path.join(path, "meta.json")) as f:
+                meta = json.load(f)
+        except ValueError as e:
+            raise SpectralIndexError("Corrupt index metadata: " + str(e))
+        if meta.get("version") != VERSION:
+            raise SpectralIndexError("Unsupported index version " + str(meta.get("version")))
+        basis = np.load(os.path.join(path, "pca.npz"))["basis"] if meta["compressed"] else None
+        index = cls(meta["grid"], basis)
+        if index.dim != meta["dim"]:
+            raise SpectralIndexError("Index vectors have " + str(meta["dim"]) + " values, expected " + str(index.dim))
+        vectors = np.fromfile(os.path.join(path, "vectors.f32"), dtype=np.float32)
+        with open(os.path.join(path, "names.txt")) as f:
+            names = f.read().splitlines()
+        rows = len(vectors) // index.dim
+        count = min(rows, len(names))
+        index._append(names[:count], vectors[:count * index.dim].reshape(count, index.dim))
+        if rows != len(names) or len(vectors) != rows * index.dim:
+            index.save(path) # Interrupted while appending, drop the partial row so later appends line up
+        index.path = path
+        return index
+
+def sample_names(directory):
+    """Names of the sample files in directory, sorted."""
+    return sorted(e.name for e in os.scandir(directory) if e.is_file() and e.name.endswith(SAMPLE_EXTENSIONS))
+
+def build(directory, path=None, components=None, grid=DEFAULT_GRID):
+    """Indexes all samples in directory, compressed to components PCA components if given, and saves the index to path
+    if given. Returns (index, unreadable files)."""
+    index = SpectralIndex(grid)
+    if components:
+        subset = SpectralIndex(grid)
+        names = sample_names(directory)
+        fit = [names[i] for i in np.linspace(0, len(names) - 1, min(len(names), FIT_SAMPLES)).astype(int)] if names else []
+        for name in sorted(set(fit)):
+            try:
+                subset.add(name, *spectrum_codec.load_sample(os.path.join(directory, name)))
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError, spectrum_codec.CodecError):
+                pass
+        if len(subset):
+            index = SpectralIndex(grid, pca_basis(subset.matrix[:len(subset)], components))
+    if path:
+        index.save(path)
+    added, failed = index.update(directory)
+    return index, failed
+
+def _synthetic_library(count, pixels=3648, materials=50, seed=1337):
+    """Yields (names, wavelengths, spectra) batches of noisy samples of a few synthetic materials, each a fixed set of
+    emission lines with random relative intensities. seed only changes the noise and the mix of materials."""
+    lines = np.random.RandomState(1337) # The materials are the same whatever the seed
+    wavelengths = 177.2 + 0.2 * np.arange(pixels)
+    x = np.arange(pixels)
+    templates = np.zeros((materials, pixels))
+    for m in range(materials):
+        for centre, height in zip(lines.randint(200, pixels - 200, 12), lines.uniform(500, 20000, 12)):
+            templates[m] += height * np.exp(-0.5 * ((x - centre) / 1.5) ** 2)
+    rng = np.random.RandomState(seed)
+    for start in range(0, count, 500):
+        n = min(500, count - start)
+        kinds = rng.randint(0, materials, n)
+        spectra = templates[kinds] * rng.uniform(0.3, 2.0, (n, 1)) + rng.normal(1500, 40, (n, pixels))
+        yield ["sample_" + str(start + i) + "_m" + str(kinds[i]) for i in range(n)], wavelengths, spectra
+
+def bench(samples=20000, queries=200, components=32):
+    full = SpectralIndex()
+    start = time.perf_counter()
+    batches = list(_synthetic_library(samples))
+    for names, wavelengths, spectra in batches:
+        full.add_vectors(names, full.vectors(wavelengths, spectra))
+    build_time = time.perf_counter() - start
+    print(str(samples) + " samples indexed in " + str(round(build_time, 2)) + " s (" +
+          str(round(1e3 * build_time / samples, 3)) + " ms/sample), matrix " + str(full.count) + " x " + str(full.dim) +
+          " float32 = " + str(round(full.count * full.dim * 4 / 2 ** 20, 1)) + " MiB")
+
+    compressed = SpectralIndex(basis=pca_basis(full.matrix[:min(samples, FIT_SAMPLES)], components))
+    for names, wavelengths, spectra in batches:
+        compressed.add_vectors(names, compressed.vectors(wavelengths, spectra))
+
+    names, wavelengths, spectra = next(_synthetic_library(queries, seed=42))
+    for label, index in (("full", full), ("pca " + str(components), compressed)):
+        vectors = index.vectors(wavelengths, spectra)
+        start = time.perf_counter()
+        results = [index.search_vector(v, DEFAULT_K) for v in vectors]
+        elapsed = (time.perf_counter() - start) / len(vectors)
+        correct = np.mean([np.mean([r[0].split("_m")[1] == q.split("_m")[1] for r in result])
+                           for q, result in zip(names, results)])
+        print(label.ljust(7) + ": " + str(round(1e3 * elapsed, 2)) + " ms/query, " + str(round(100 * correct, 1)) +
+              "% of the top " + str(DEFAULT_K) + " are the same material")
+
+def main(argv):
+    if len(argv) >= 3 and argv[1] in ("build", "update"):
+        if argv[1] == "build":
+            index, failed = build(argv[2], argv[3], int(argv[4]) if len(argv) > 4 else None)
+        else:
+            index = SpectralIndex.load(argv[3])
+            added, failed = index.update(argv[2])
+        print(str(len(index)) + " samples indexed" + (", " + str(failed) + " unreadable" if failed else ""))
+    elif len(argv) >= 4 and argv[1] == "search":
+        index = SpectralIndex.load(argv[2])
+        start = time.perf_counter()
+        results = index.search(*spectrum_codec.load_sample(argv[3]), k=int(argv[4]) if len(argv) > 4 else DEFAULT_K)
+        elapsed = time.perf_counter() - start
+        for name, similarity in results:
+            print("{:.4f}  {}".format(similarity, name))
+        print("Searched " + str(len(index)) + " samples in " + str(round(1e3 * elapsed, 2)) + " ms")
+    elif len(argv) >= 2 and argv[1] == "bench":
+        bench(int(argv[2]) if len(argv) > 2 else 20000)
+    else:
+        print(__doc__)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,45 @@
+import unittest
+import os
+import tempfile
+import spectral_index
+import spectrum_codec
+
+class TestSpectralIndex(unittest.TestCase):
+    def setUp(self):
+        self.samples = tempfile.mkdtemp()
+        self.path = os.path.join(tempfile.mkdtemp(), "index")
+        self.names, self.wavelengths, self.spectra = next(spectral_index._synthetic_library(40, pixels=1000, materials=4))
+        for i in range(30):
+            spectrum_codec.save_sample(os.path.join(self.samples, self.names[i] + ".lsc"), self.wavelengths, self.spectra[i])
+
+    def test_search_finds_same_material(self):
+        index, failed = spectral_index.build(self.samples, self.path)
+        self.assertEqual((len(index), failed), (30, 0))
+        for i in range(30, 40):
+            results = index.search(self.wavelengths, self.spectra[i], 5)
+            self.assertEqual(len(results), 5)
+            self.assertEqual([s for n, s in results], sorted((s for n, s in results), reverse=True))
+            material = self.names[i].split("_m")[1]
+            self.assertTrue(all(n.split("_m")[1] == material + ".lsc" for n, s in results))
+
+    def test_incremental_add_is_persisted(self):
+        index, failed = spectral_index.build(self.samples, self.path, components=8)
+        self.assertEqual(index.dim, 8)
+        self.assertTrue(index.add("new.lsc", self.wavelengths, self.spectra[35]))
+        self.assertFalse(index.add("new.lsc", self.wavelengths, self.spectra[35]))
+        loaded = spectral_index.SpectralIndex.load(self.path)
+        self.assertEqual(len(loaded), 31)
+        self.assertEqual(loaded.search(self.wavelengths, self.spectra[35], 1)[0][0], "new.lsc")
+        self.assertEqual(loaded.update(self.samples), (0, 0))
+
+    def test_interrupted_append_is_dropped(self):
+        spectral_index.build(self.samples, self.path)
+        with open(os.path.join(self.path, "vectors.f32"), "ab") as f:
+            f.write(b"\0" * 12)
+        index = spectral_index.SpectralIndex.load(self.path)
+        self.assertEqual(len(index), 30)
+        index.add("new.lsc", self.wavelengths, self.spectra[35])
+        self.assertEqual(len(spectral_index.SpectralIndex.load(self.path)), 31)
+
+if __name__ == '__main__':
+    unittest.main()
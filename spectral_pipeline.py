@@ -0,0 +1,373 @@
+#!/usr/bin/python3
+"""
+spectral_pipeline.py
+
+Processing applied to spectra between the spectrometer and whatever looks at them (core_ui's plot, libs_cli's stream,
+offline reprocessing of runs). A Pipeline is a list of stages, each of which works on a whole batch of spectra (a 2-D
+shots x pixels array, or a single 1-D spectrum) at once with array operations, never looping over pixels in Python:
+    dark          subtract a dark spectrum (from a sample file, or captured at run time with set_dark)
+    nonlinearity  divide by the detector's nonlinearity polynomial of the raw counts
+    baseline      subtract the plasma continuum estimated by baseline.py (asls, snip or rolling)
+    savgol        Savitzky-Golay smoothing (or derivative), with the edges padded by repeating the end pixels
+    crop          keep only a wavelength range
+    normalize     divide each spectrum by its max, sum or L2 norm
+    resample      interpolate (or bin-average) onto a regular wavelength grid, see resample.py
+Anything that only depends on the wavelength grid (crop indices, interpolation weights, buffers) is worked out once per
+grid, not per spectrum. float64 spectra are processed in place; spectra of other dtypes are converted first. Stages
+that change the number of pixels write into a buffer that is reused by the next call, so copy the result to keep it.
+
+Pipelines are configured with JSON, e.g.
+    {"stages": [{"stage": "dark", "file": "samples/dark.lsc"}, {"stage": "savgol", "window": 11, "order": 3},
+                {"stage": "crop", "min_wavelength": 300}]}
+so the same file can be loaded by core_ui ("Load Pipeline"), libs_cli ('pipeline load FILE') and this script.
+
+Usage:
+    python3 spectral_pipeline.py process CONFIG RUN OUT.lsr   (processes a run archive or samples directory)
+    python3 spectral_pipeline.py default                        (prints a default configuration)
+    python3 spectral_pipeline.py bench [SHOTS]
+
+"""
+import collections
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+class PipelineError(Exception):
+    pass
+
+class Stage():
+    """Base class of the pipeline stages. params holds the constructor arguments, which are also the JSON config."""
+    name = None
+
+    def __init__(self, **params):
+        self.params = params
+
+    def prepare(self, wavelengths):
+        """Called once per wavelength grid. Returns the wavelengths of the spectra this stage outputs."""
+        return wavelengths
+
+    def apply(self, data):
+        """Processes a 2-D float64 batch, in place where possible. Returns the result (data itself, a view of it, or a
+        reused buffer)."""
+        return data
+
+    def config(self):
+        c = collections.OrderedDict(stage=self.name)
+        c.update(self.params)
+        return c
+
+class DarkSubtract(Stage):
+    name = "dark"
+
+    def __init__(self, file=None, value=0.0):
+        Stage.__init__(self, file=file, value=value)
+        self.dark = None
+        if file is not None:
+            import spectrum_codec
+            self.dark = spectrum_codec.load_sample(file)[1].astype(np.float64)
+
+    def set_dark(self, intensities):
+        """Uses intensities (e.g. a spectrum taken with the laser off) as the dark spectrum from now on."""
+        self.dark = np.array(intensities, dtype=np.float64)
+
+    def prepare(self, wavelengths):
+        if self.dark is not None and len(self.dark) != len(wavelengths):
+            raise PipelineError("Dark spectrum has " + str(len(self.dark)) + " pixels, spectra have " + str(len(wavelengths)))
+        return wavelengths
+
+    def apply(self, data):
+        data -= self.dark if self.dark is not None else self.params["value"]
+        return data
+
+class Nonlinearity(Stage):
+    """corrected = counts / (c0 + c1 counts + c2 counts^2 + ...), the correction Ocean Optics stores in the
+    spectrometer's EEPROM. Leave coefficients out to read them from the spectrometer (see configure_for)."""
+    name = "nonlinearity"
+
+    def __init__(self, coefficients=None):
+        Stage.__init__(self, coefficients=coefficients)
+        self.buffer = None
+
+    def apply(self, data):
+        c = self.params["coefficients"]
+        if not c:
+            return data
+        if self.buffer is None or self.buffer.shape != data.shape:
+            self.buffer = np.empty_like(data)
+        b = self.buffer
+        b.fill(c[-1]) # Horner's method, one pass over the batch per coefficient
+        for k in c[-2::-1]:
+            b *= data
+            b += k
+        data /= b
+        return data
+
+class BaselineSubtract(Stage):
+    """Removes the continuum under the emission lines. Parameters other than method go to the baseline.py method."""
+    name = "baseline"
+
+    def __init__(self, method="snip", **params):
+        import baseline
+        if method not in baseline.METHODS:
+            raise PipelineError("Baseline method must be one of " + ", ".join(sorted(baseline.METHODS)))
+        Stage.__init__(self, method=method, **params)
+        self.estimator = baseline.METHODS[method](**params)
+
+    def apply(self, data):
+        data -= self.estimator.estimate(data)
+        return data
+
+def savgol_coefficients(window, order, deriv=0):
+    """Convolution weights of a Savitzky-Golay filter: the value (or deriv'th derivative, per pixel) at the centre of a
+    least squares polynomial fit over window pixels."""
+    if window % 2 != 1 or window <= order:
+        raise PipelineError("Savitzky-Golay window must be odd and larger than the order")
+    half = window // 2
+    x = np.arange(-half, half + 1, dtype=np.float64)
+    a = x[:, np.newaxis] ** np.arange(order + 1)
+    return np.linalg.pinv(a)[deriv] * math.factorial(deriv)
+
+class SavitzkyGolay(Stage):
+    name = "savgol"
+
+    def __init__(self, window=11, order=3, deriv=0):
+        Stage.__init__(self, window=window, order=order, deriv=deriv)
+        self.coefficients = savgol_coefficients(window, order, deriv)
+        self.padded = None
+        self.term = None
+
+    def apply(self, data):
+        shots, n = data.shape
+        half = len(self.coefficients) // 2
+        if self.padded is None or self.padded.shape != (shots, n + 2 * half):
+            self.padded = np.empty((shots, n + 2 * half))
+            self.term = np.empty((shots, n))
+        p = self.padded
+        p[:, half:half + n] = data
+        p[:, :half] = data[:, :1]
+        p[:, half + n:] = data[:, -1:]
+        np.multiply(p[:, 0:n], self.coefficients[0], out=data)
+        for k in range(1, len(self.coefficients)): # One pass over the batch per filter tap
+            np.multiply(p[:, k:k + n], self.coefficients[k], out=self.term)
+            data += self.term
+        return data
+
+class Crop(Stage):
+    name = "crop"
+
+    def __init__(self, min_wavelength=None, max_wavelength=None):
+        Stage.__init__(self, min_wavelength=min_wavelength, max_wavelength=max_wavelength)
+        self.roi = slice(None)
+
+    def prepare(self, wavelengths):
+        lo, hi = self.params["min_wavelength"], self.params["max_wavelength"]
+        start = np.searchsorted(wavelengths, lo, side="left") if lo is not None else 0
+        stop = np.searchsorted(wavelengths, hi, side="right") if hi is not None else len(wavelengths)
+        self.roi = slice(int(start), int(stop))
+        return wavelengths[self.roi]
+
+    def apply(self, data):
+        return data[:, self.roi]
+
+class Normalize(Stage):
+    name = "normalize"
+    METHODS = ("max", "sum", "l2")
+
+    def __init__(self, method="max"):
+        if method not in self.METHODS:
+            raise PipelineError("Normalize method must be one of " + ", ".join(self.METHODS))
+        Stage.__init__(self, method=method)
+
+    def apply(self, data):
+        method = self.params["method"]
+        if method == "max":
+            norm = data.max(axis=1)
+        elif method == "sum":
+            norm = data.sum(axis=1)
+        else:
+            norm = np.sqrt(np.einsum("ij,ij->i", data, data))
+        norm[norm == 0] = 1.0
+        data /= norm[:, np.newaxis]
+        return data
+
+class Resample(Stage):
+    """Resampling onto start, start + step, ... up to stop (nm), see resample.py for the methods. Points outside the
+    measured range get the value of the nearest end pixel."""
+    name = "resample"
+
+    def __init__(self, start=300.0, stop=1000.0, step=0.5, method="linear"):
+        Stage.__init__(self, start=start, stop=stop, step=step, method=method)
+        import resample
+        if method not in resample.METHODS:
+            raise PipelineError("Resampling method must be one of " + ", ".join(resample.METHODS))
+        self.grid = resample.uniform_grid(start, stop, step)
+        self.resampler = None
+        self.out = None
+
+    def prepare(self, wavelengths):
+        import resample
+        p = self.params
+        self.resampler = resample.get_resampler(wavelengths, p["start"], p["stop"], p["step"], p["method"])
+        return self.grid
+
+    def apply(self, data):
+        shape = (len(data), len(self.grid))
+        if self.out is None or self.out.shape != shape:
+            self.out = np.empty(shape)
+        return self.resampler(data, self.out)
+
+STAGES = dict((s.name, s) for s in (DarkSubtract, Nonlinearity, BaselineSubtract, SavitzkyGolay, Crop, Normalize, Resample))
+
+DEFAULT_CONFIG = {"stages": [{"stage": "nonlinearity"}, {"stage": "savgol", "window": 11, "order": 3},
+                             {"stage": "crop", "min_wavelength": 300}]}
+
+class Pipeline():
+    """A configured list of stages. Keeps the total time spent in each stage, see timing_report()."""
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+        self.wavelengths = None # Input grid the stages were last prepared for
+        self.output_wavelengths = None
+        self.timings = collections.OrderedDict((i, [0.0, 0, 0]) for i in range(len(self.stages))) # seconds, calls, shots
+        self.last_call = None # Seconds the last process() call took in all stages together
+
+    @classmethod
+    def from_config(cls, config):
+        stages = []
+        for s in config.get("stages", []):
+            params = dict(s)
+            name = params.pop("stage", None)
+            if name not in STAGES:
+                raise PipelineError("Unknown pipeline stage " + str(name) + ", expected one of " + ", ".join(sorted(STAGES)))
+            try:
+                stages.append(STAGES[name](**params))
+            except TypeError as e:
+                raise PipelineError("Bad parameters for stage " + name + ": " + str(e))
+        return cls(stages)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_config(json.load(f))
+
+    def config(self):
+        return {"stages": [s.config() for s in self.stages]}
+
+    def stage(self, name):
+        """Returns the first stage with the given name, or None."""
+        for s in self.stages:
+            if s.name == name:
+                return s
+        return None
+
+    def prepare(self, wavelengths):
+        """Works out everything that depends only on the wavelength grid. Done automatically by process() when the grid
+        changes."""
+        w = np.asarray(wavelengths, dtype=np.float64)
+        self.wavelengths = w
+        for s in self.stages:
+            w = s.prepare(w)
+        self.output_wavelengths = w
+        return w
+
+    def process(self, spectra, wavelengths):
+        """Runs spectra (1-D or shots x pixels) through every stage. Returns (output wavelengths, processed spectra) with
+        the same number of dimensions as spectra."""
+        if self.wavelengths is None or (wavelengths is not self.wavelengths and not np.array_equal(wavelengths, self.wavelengths)):
+            self.prepare(wavelengths)
+        data = np.asarray(spectra, dtype=np.float64)
+        single = data.ndim == 1
+        if single:
+            data = data[np.newaxis]
+        if data.shape[1] != len(self.wavelengths):
+            raise PipelineError("Spectra have " + str(data.shape[1]) + " pixels, wavelengths have " + str(len(self.wavelengths)))
+        total = 0.0
+        for i, s in enumerate(self.stages):
+            start = time.perf_counter()
+            data = s.apply(data)
+            elapsed = time.perf_counter() - start
+            t = self.timings[i]
+            t[0] += elapsed
+            t[1] += 1
+            t[2] += len(data)
+            total += elapsed
+        self.last_call = total
+        return self.output_wavelengths, data[0] if single else data
+
+    def timing_report(self):
+        """One line per stage: average time per call and per spectrum."""
+        lines = []
+        for i, s in enumerate(self.stages):
+            seconds, calls, shots = self.timings[i]
+            if calls:
+                lines.append(s.name.ljust(13) + str(round(1e6 * seconds / calls, 1)).rjust(10) + " us/call" +
+                             str(round(1e6 * seconds / shots, 1)).rjust(10) + " us/spectrum")
+            else:
+                lines.append(s.name.ljust(13) + "not run yet")
+        return lines
+
+    def reset_timings(self):
+        for t in self.timings.values():
+            t[:] = [0.0, 0, 0]
+
+def configure_for(pipeline, spec):
+    """Fills in settings that come from the spectrometer, currently the nonlinearity coefficients of nonlinearity
+    stages that were configured without any."""
+    for s in pipeline.stages:
+        if s.name == "nonlinearity" and not s.params["coefficients"]:
+            try:
+                s.params["coefficients"] = list(spec.f.nonlinearity_coefficients.get_nonlinearity_coefficients())
+            except Exception:
+                pass # Not every backend exposes the coefficients; the stage then does nothing
+
+def process_run(pipeline, run, out, batch=32, log=print):
+    """Processes every shot of a run (see run_archive.open_run) into a new float64 run archive."""
+    import run_archive
+    if not len(run):
+        raise PipelineError("Run is empty, there is nothing to process")
+    run[0] # A SampleDirectory only knows its wavelengths once a shot has been loaded
+    wavelengths = np.asarray(run.wavelengths, dtype=np.float64)
+    with run_archive.RunArchiveWriter(out, pipeline.prepare(wavelengths), "<f8") as writer:
+        for start in range(0, len(run), batch):
+            stop = min(start + batch, len(run))
+            if hasattr(run, "intensities"):
+                block = np.array(run.intensities[start:stop], dtype=np.float64)
+            else:
+                block = np.array([run[i][1] for i in range(start, stop)], dtype=np.float64)
+            w, processed = pipeline.process(block, wavelengths)
+            writer.append_many(processed, run.timestamps[start:stop])
+            log("Processed " + str(stop) + " / " + str(len(run)) + " shots")
+    return len(run)
+
+def bench(shots=500):
+    import spectrum_codec
+    wavelengths, spectra = spectrum_codec._synthetic_shots(shots)
+    config = {"stages": [{"stage": "dark", "value": 1500.0}, {"stage": "nonlinearity", "coefficients": [0.95, 1e-6, -1e-11]},
+                         {"stage": "savgol", "window": 11, "order": 3}, {"stage": "crop", "min_wavelength": 300},
+                         {"stage": "normalize", "method": "max"}, {"stage": "resample", "start": 300, "stop": 900, "step": 0.25}]}
+    for label, batch in (("one spectrum at a time", 1), ("batches of 100", 100)):
+        pipeline = Pipeline.from_config(config)
+        start = time.perf_counter()
+        for i in range(0, shots, batch):
+            pipeline.process(spectra[i:i + batch].copy() if batch > 1 else spectra[i].copy(), wavelengths)
+        print(label + ": " + str(round(1e6 * (time.perf_counter() - start) / shots, 1)) + " us per spectrum")
+        for line in pipeline.timing_report():
+            print("    " + line)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 5 and sys.argv[1] == "process":
+        import run_archive
+        pipeline = Pipeline.load(sys.argv[2])
+        try:
+            process_run(pipeline, run_archive.open_run(sys.argv[3]), sys.argv[4])
+        except PipelineError as e:
+            sys.exit("Error: " + str(e))
+        print("\n".join(pipeline.timing_report()))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "default":
+        print(json.dumps(DEFAULT_CONFIG, indent=4))
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+    else:
+        print(__doc__)
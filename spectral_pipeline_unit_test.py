@@ -0,0 +1,65 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import run_archive
+import spectral_pipeline
+
+class TestSpectralPipeline(unittest.TestCase):
+    def setUp(self):
+        self.wavelengths = np.linspace(200, 1000, 3648)
+
+    def test_savgol_keeps_polynomials(self):
+        x = np.arange(3648.0)
+        cubic = 1e-6 * x ** 3 - x + 5
+        p = spectral_pipeline.Pipeline([spectral_pipeline.SavitzkyGolay(11, 3)])
+        w, y = p.process(cubic.copy(), self.wavelengths)
+        np.testing.assert_allclose(y[5:-5], cubic[5:-5], atol=1e-8)
+
+    def test_in_place_batch(self):
+        p = spectral_pipeline.Pipeline.from_config({"stages": [{"stage": "dark", "value": 10.0},
+                                                               {"stage": "normalize", "method": "max"}]})
+        batch = np.random.RandomState(0).rand(4, 3648) * 100 + 10
+        expected = (batch - 10) / (batch - 10).max(axis=1)[:, np.newaxis]
+        w, y = p.process(batch, self.wavelengths)
+        self.assertTrue(np.shares_memory(batch, y))
+        np.testing.assert_allclose(y, expected)
+
+    def test_crop_and_resample(self):
+        p = spectral_pipeline.Pipeline.from_config({"stages": [{"stage": "crop", "min_wavelength": 300},
+                                                               {"stage": "resample", "start": 250, "stop": 950, "step": 0.3}]})
+        s = np.random.RandomState(1).rand(3, 3648)
+        w, y = p.process(s.copy(), self.wavelengths)
+        keep = self.wavelengths >= 300
+        for row, out in zip(s, y):
+            np.testing.assert_allclose(out, np.interp(w, self.wavelengths[keep], row[keep]))
+        self.assertEqual(p.config()["stages"][1]["step"], 0.3)
+
+    def test_bad_config(self):
+        with self.assertRaises(spectral_pipeline.PipelineError):
+            spectral_pipeline.Pipeline.from_config({"stages": [{"stage": "blur"}]})
+        with self.assertRaises(spectral_pipeline.PipelineError):
+            spectral_pipeline.Pipeline.from_config({"stages": [{"stage": "savgol", "window": 4}]})
+
+    def test_process_run(self):
+        p = spectral_pipeline.Pipeline.from_config({"stages": [{"stage": "dark", "value": 10.0}]})
+        folder = tempfile.mkdtemp()
+        with self.assertRaises(spectral_pipeline.PipelineError): # Not an IndexError from the first shot
+            spectral_pipeline.process_run(p, run_archive.open_run(folder), os.path.join(folder, "out.lsr"), log=lambda m: None)
+        self.assertIsNone(p.last_call)
+
+        shots = np.arange(5 * 3648, dtype=np.uint16).reshape(5, 3648) % 1000 + 10
+        path = os.path.join(folder, "run.lsr")
+        with run_archive.RunArchiveWriter(path, self.wavelengths) as writer:
+            writer.append_many(shots, np.arange(5.0))
+        self.assertEqual(spectral_pipeline.process_run(p, run_archive.open_run(path), path + ".out.lsr", batch=2,
+                                                       log=lambda m: None), 5)
+        out = run_archive.RunArchive(path + ".out.lsr")
+        np.testing.assert_array_equal(out.intensities, shots - 10.0)
+        np.testing.assert_array_equal(out.timestamps, np.arange(5.0))
+        self.assertEqual(p.timings[0][1:], [3, 5]) # Three calls, five shots
+        self.assertGreater(p.last_call, 0)
+        self.assertLess(p.last_call, p.timings[0][0]) # The last call only, not the total
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+"""
+spectrum_codec.py
+
+Compact lossless storage for spectra. A pickled FLAME-T sample is two float64 arrays, about 58KB, even though the
+intensities are 16 bit ADC counts. This codec stores:
+    - intensities as uint16 when they are raw counts, or as int32 plus a common offset and scale when they are not
+      (e.g. after dark subtraction), falling back to float64 only if neither represents them exactly,
+    - wavelengths as a cubic fit plus the XOR of each float64 with its predicted value, since they come from the
+      spectrometer's calibration polynomial and only the lowest mantissa bits differ from the fit,
+then zigzag delta codes the integers, byte shuffles everything so the (mostly constant) high bytes sit together and
+compresses the result with a fast codec. Decoding always gives back exactly the arrays that were encoded.
+
+Usage:
+    python3 spectrum_codec.py bench [SHOTS]
+    python3 spectrum_codec.py convert FILE...   (re-encodes pickled samples as .lsc files next to them)
+
+"""
+import pickle
+import struct
+import sys
+import time
+import zlib
+import lzma
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b"LSC1"
+EXTENSION = ".lsc"
+# magic, intensity mode, intensity dtype, codec, level, pixel count, offset, scale, wavelength bytes, intensity bytes
+HEADER = struct.Struct("<4sBBBBIddII")
+
+MODE_U16 = 0 # Raw counts, 0..65535
+MODE_I32 = 1 # (intensities - offset) * scale are integers
+MODE_F64 = 2 # Anything else, stored bit exact
+
+DTYPES = [np.dtype("<f8"), np.dtype("<f4"), np.dtype("<u2"), np.dtype("<i4"), np.dtype("<i8"), np.dtype("<u4")]
+SCALES = (1.0, 2.0, 4.0, 8.0, 10.0, 16.0, 100.0, 1000.0)
+POLY_DEGREE = 3
+
+CODECS = ["none", "zlib", "lzma", "zstd"]
+DEFAULT_CODEC = "zlib"
+DEFAULT_LEVELS = {"none": 0, "zlib": 1, "lzma": 0, "zstd": 3}
+
+class CodecError(Exception):
+    pass
+
+def _compress(data, codec, level):
+    if codec == "none":
+        return bytes(data)
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise CodecError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise CodecError("Unknown codec " + str(codec))
+
+def _decompress(data, codec):
+    if codec == "none":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise CodecError("This sample is zstd compressed, which needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise CodecError("Unknown codec " + str(codec))
+
+def shuffle(a):
+    """Byte shuffle: all first bytes of each element, then all second bytes, ... Returns bytes."""
+    return np.ascontiguousarray(a).view(np.uint8).reshape(-1, a.dtype.itemsize).T.tobytes()
+
+def unshuffle(data, dtype, count):
+    return np.frombuffer(data, np.uint8).reshape(dtype.itemsize, count).T.copy().view(dtype).reshape(count)
+
+def zigzag_delta(q, bits):
+    """Delta codes an int64 array modulo 2**bits and zigzag maps the (signed) deltas to unsigned, so small steps
+    become small numbers. The result fits in an unsigned integer of the given number of bits."""
+    half = 1 << (bits - 1)
+    d = (np.diff(q, prepend=np.int64(0)) + half) % (1 << bits) - half
+    return (d << 1) ^ (d >> 63)
+
+def undo_zigzag_delta(z, bits, signed):
+    d = (z >> 1) ^ -(z & 1)
+    q = np.cumsum(d) & ((1 << bits) - 1)
+    if signed:
+        q[q >= 1 << (bits - 1)] -= 1 << bits
+    return q
+
+def xor_delta(a):
+    """XORs each float64 bit pattern with the one before it."""
+    u = a.view(np.uint64)
+    out = u.copy()
+    out[1:] ^= u[:-1]
+    return out
+
+def undo_xor_delta(u):
+    return np.bitwise_xor.accumulate(u).view(np.float64)
+
+def _wavelength_fit(count, coefficients):
+    return np.polyval(coefficients, np.arange(count, dtype=np.float64))
+
+def encode_wavelengths(wavelengths):
+    """Returns (coefficients, residual) where residual is the XOR of the wavelengths with a cubic fit over pixel index."""
+    coefficients = np.zeros(POLY_DEGREE + 1)
+    if len(wavelengths) > POLY_DEGREE and np.all(np.isfinite(wavelengths)):
+        coefficients = np.polyfit(np.arange(len(wavelengths), dtype=np.float64), wavelengths, POLY_DEGREE)
+    predicted = _wavelength_fit(len(wavelengths), coefficients)
+    return coefficients, wavelengths.view(np.uint64) ^ predicted.view(np.uint64)
+
+def decode_wavelengths(coefficients, residual):
+    predicted = _wavelength_fit(len(residual), coefficients)
+    return (residual ^ predicted.view(np.uint64)).view(np.float64)
+
+def _integer_mode(x):
+    """Returns (mode, offset, scale, integers) for the most compact exact representation of float array x."""
+    if not np.all(np.isfinite(x)) or np.any(np.signbit(x) & (x == 0)): # -0.0 would come back as 0.0
+        return MODE_F64, 0.0, 1.0, None
+    if x.min() >= 0 and x.max() <= 65535 and np.array_equal(np.floor(x), x):
+        return MODE_U16, 0.0, 1.0, x.astype(np.int64)
+    offset = float(x[0] - np.floor(x[0]))
+    for scale in SCALES:
+        q = np.round((x - offset) * scale)
+        if np.abs(q).max() < 2 ** 31 and np.array_equal(q / scale + offset, x):
+            return MODE_I32, offset, scale, q.astype(np.int64)
+    return MODE_F64, 0.0, 1.0, None
+
+def encode(wavelengths, intensities, codec=DEFAULT_CODEC, level=None):
+    """Encodes a spectrum into bytes."""
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    intensities = np.asarray(intensities)
+    if wavelengths.shape != intensities.shape or wavelengths.ndim != 1:
+        raise CodecError("wavelengths and intensities must be 1-D arrays of the same length")
+    if len(intensities) == 0:
+        raise CodecError("Cannot encode an empty spectrum")
+    if intensities.dtype not in DTYPES:
+        raise CodecError("Unsupported intensity dtype " + str(intensities.dtype))
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+
+    mode, offset, scale, q = _integer_mode(intensities.astype(np.float64))
+    if mode == MODE_U16:
+        body = shuffle(zigzag_delta(q, 16).astype(np.uint16))
+    elif mode == MODE_I32:
+        body = shuffle(zigzag_delta(q, 32).astype(np.uint32))
+    else:
+        body = shuffle(xor_delta(intensities.astype(np.float64)))
+
+    coefficients, residual = encode_wavelengths(wavelengths)
+    w = coefficients.astype("<f8").tobytes() + _compress(shuffle(residual), codec, level)
+    i = _compress(body, codec, level)
+    header = HEADER.pack(MAGIC, mode, DTYPES.index(intensities.dtype), CODECS.index(codec), level, len(intensities),
+                         offset, scale, len(w), len(i))
+    return header + w + i
+
+def decode(data):
+    """Decodes bytes from encode() back into (wavelengths, intensities)."""
+    if len(data) < HEADER.size or data[:4] != MAGIC:
+        raise CodecError("Not an encoded spectrum")
+    magic, mode, dtype, codec, level, count, offset, scale, wlen, ilen = HEADER.unpack_from(data)
+    codec = CODECS[codec]
+    start = HEADER.size
+    poly_bytes = 8 * (POLY_DEGREE + 1)
+    coefficients = np.frombuffer(data, "<f8", POLY_DEGREE + 1, start)
+    w = _decompress(data[start + poly_bytes:start + wlen], codec)
+    i = _decompress(data[start + wlen:start + wlen + ilen], codec)
+
+    wavelengths = decode_wavelengths(coefficients, unshuffle(w, np.dtype(np.uint64), count))
+    if mode == MODE_U16:
+        values = undo_zigzag_delta(unshuffle(i, np.dtype(np.uint16), count).astype(np.int64), 16, False).astype(np.float64)
+    elif mode == MODE_I32:
+        values = undo_zigzag_delta(unshuffle(i, np.dtype(np.uint32), count).astype(np.int64), 32, True) / scale + offset
+    else:
+        values = undo_xor_delta(unshuffle(i, np.dtype(np.uint64), count))
+    return wavelengths, values.astype(DTYPES[dtype])
+
+def save_sample(filename, wavelengths, intensities, codec=DEFAULT_CODEC):
+    with open(filename, "wb") as f:
+        f.write(encode(wavelengths, intensities, codec))
+
+def load_sample(filename):
+    """Loads a sample saved either by save_sample or as a pickled (wavelengths, intensities) tuple."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data[:4] == MAGIC:
+        return decode(data)
+    wavelengths, intensities = pickle.loads(data)
+    return np.asarray(wavelengths), np.asarray(intensities)
+
+def _synthetic_shots(n, pixels=3648):
+    """Dark noise plus a continuum and a few emission lines, in 16 bit counts."""
+    rng = np.random.RandomState(1337)
+    x = np.arange(pixels)
+    wavelengths = 177.2 + 0.2 * x - 8.5e-6 * x ** 2
+    base = 1500 + 800 * np.exp(-((x - 1800) / 900.0) ** 2)
+    for c in rng.randint(0, pixels, 25):
+        base = base + rng.randint(500, 40000) * np.exp(-((x - c) / 2.5) ** 2)
+    shots = np.clip(base + rng.normal(0, 12, (n, pixels)), 0, 65535).round()
+    return wavelengths, shots
+
+def bench(shots=200):
+    wavelengths, spectra = _synthetic_shots(shots)
+    raw_bytes = wavelengths.nbytes + spectra[0].nbytes
+    pickled = len(pickle.dumps((wavelengths, spectra[0])))
+    print("Pickled float64 sample: " + str(pickled) + " bytes/shot")
+    for codec in CODECS:
+        if codec == "zstd" and zstandard is None:
+            continue
+        start = time.perf_counter()
+        encoded = [encode(wavelengths, s, codec) for s in spectra]
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        decoded = [decode(e) for e in encoded]
+        decode_time = time.perf_counter() - start
+        assert all(np.array_equal(d[1], s) for d, s in zip(decoded, spectra))
+        size = sum(len(e) for e in encoded) / shots
+        mb = raw_bytes * shots / 1e6
+        print(codec.ljust(5) + ": " + str(int(size)) + " bytes/shot (" + str(round(pickled / size, 1)) + "x smaller), encode " +
+              str(round(mb / encode_time, 1)) + " MB/s, decode " + str(round(mb / decode_time, 1)) + " MB/s")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    elif len(sys.argv) >= 3 and sys.argv[1] == "convert":
+        for name in sys.argv[2:]:
+            w, i = load_sample(name)
+            out = name.rsplit(".", 1)[0] + EXTENSION
+            save_sample(out, w, i)
+            print(name + " -> " + out)
+    else:
+        print(__doc__)
@@ -0,0 +1,56 @@
+import unittest
+import os
+import pickle
+import tempfile
+import numpy as np
+import spectrum_codec
+
+class TestSpectrumCodec(unittest.TestCase):
+    def setUp(self):
+        self.wavelengths, shots = spectrum_codec._synthetic_shots(2)
+        self.counts = shots[0]
+
+    def assertRoundTrip(self, intensities, codec=spectrum_codec.DEFAULT_CODEC):
+        data = spectrum_codec.encode(self.wavelengths, intensities, codec)
+        w, i = spectrum_codec.decode(data)
+        self.assertEqual(w.tobytes(), self.wavelengths.tobytes())
+        self.assertEqual(i.dtype, np.asarray(intensities).dtype)
+        self.assertEqual(i.tobytes(), np.asarray(intensities).tobytes())
+        return data
+
+    def test_raw_counts(self):
+        for codec in ("none", "zlib", "lzma"):
+            data = self.assertRoundTrip(self.counts, codec)
+        self.assertLess(len(data), 10000)
+        extremes = np.zeros(len(self.counts))
+        extremes[1::2] = 65535 # Largest possible jumps between neighbours
+        self.assertRoundTrip(extremes)
+        self.assertRoundTrip(self.counts.astype(np.uint16))
+
+    def test_dark_subtracted(self):
+        dark = self.counts - self.counts[:24].mean()
+        self.assertRoundTrip(dark)
+        self.assertRoundTrip(self.counts / 4.0 - 1000)
+        self.assertRoundTrip(np.random.RandomState(0).normal(0, 1, len(self.counts)))
+        special = dark.copy()
+        special[:3] = (np.nan, np.inf, -0.0)
+        self.assertRoundTrip(special)
+
+    def test_invalid_spectra(self):
+        self.assertRaises(spectrum_codec.CodecError, spectrum_codec.encode, [], np.array([], dtype=np.float64))
+        self.assertRaises(spectrum_codec.CodecError, spectrum_codec.encode, self.wavelengths, self.counts[1:])
+        self.assertRaises(spectrum_codec.CodecError, spectrum_codec.decode, b"not a spectrum")
+
+    def test_load_sample(self):
+        d = tempfile.mkdtemp()
+        pickled = os.path.join(d, "1_SAMPLE.pickle")
+        with open(pickled, "wb") as f:
+            pickle.dump((self.wavelengths, self.counts), f)
+        encoded = os.path.join(d, "1_SAMPLE" + spectrum_codec.EXTENSION)
+        spectrum_codec.save_sample(encoded, self.wavelengths, self.counts)
+        for name in (pickled, encoded):
+            w, i = spectrum_codec.load_sample(name)
+            self.assertTrue(np.array_equal(w, self.wavelengths) and np.array_equal(i, self.counts))
+
+if __name__ == "__main__":
+    unittest.main()
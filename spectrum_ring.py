@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+"""
+spectrum_ring.py
+
+The most recent spectra, kept in memory so the shot before (or the one twenty shots ago) can be overlaid, diffed or
+exported straight away instead of being reloaded from its sample file.
+
+A SpectrumRing holds the last capacity spectra of one wavelength grid in a single capacity x pixels array, with their
+metadata in a structured array alongside it. Both are allocated once (when the first spectrum arrives) and every new
+shot overwrites the oldest one in place, so keeping it up to date costs one row copy per shot and nothing grows.
+Shots are addressed by age: 0 is the newest, 1 the one before it, and so on. If the wavelength grid changes (another
+spectrometer is connected), the ring starts over.
+
+dump() writes the whole ring to a run archive (see run_archive.py), oldest first, for when something interesting has
+just happened and the last few minutes of shots are worth keeping.
+
+Usage:
+    python3 spectrum_ring.py bench [CAPACITY]
+
+"""
+import pickle
+import sys
+import threading
+import time
+
+import numpy as np
+
+META_DTYPE = np.dtype([("sequence", "<i8"), ("timestamp", "<f8"), ("integration_time", "<i8"),
+                       ("trigger_delay", "<f8"), ("flags", "<u4")])
+FLAGGED = 1 # Metadata flag of shots that failed the quality gate (see shot_quality.py)
+
+class SpectrumRing():
+    """The last capacity spectra and their metadata. Safe to push to from one thread while reading from others."""
+    def __init__(self, capacity=256, dtype=np.float32):
+        if capacity < 1:
+            raise ValueError("Ring capacity must be at least 1")
+        self.capacity = int(capacity)
+        self.dtype = np.dtype(dtype) # float32 holds raw counts exactly and halves the memory of float64
+        self.lock = threading.Lock()
+        self.wavelengths = None
+        self.spectra = None
+        self.meta = np.zeros(self.capacity, dtype=META_DTYPE)
+        self.total = 0 # Shots pushed since the ring was last cleared
+        self._source = None # The wavelengths array last pushed with, to skip comparing the same one every shot
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.total = 0
+
+    def _set_wavelengths(self, wavelengths):
+        if wavelengths is self._source:
+            return
+        w = np.array(wavelengths, dtype=np.float64)
+        if self.wavelengths is None or len(w) != len(self.wavelengths) or not np.array_equal(w, self.wavelengths):
+            if self.spectra is None or self.spectra.shape[1] != len(w):
+                self.spectra = np.zeros((self.capacity, len(w)), dtype=self.dtype)
+            self.wavelengths = w
+            self.total = 0
+        self._source = wavelengths
+
+    def push(self, wavelengths, intensities, timestamp=None, integration_time=0, trigger_delay=np.nan, flags=0):
+        """Adds a spectrum as the newest, overwriting the oldest once the ring is full. Returns its sequence number."""
+        with self.lock:
+            self._set_wavelengths(wavelengths)
+            slot = self.total % self.capacity
+            self.spectra[slot] = intensities
+            self.meta[slot] = (self.total, time.time() if timestamp is None else timestamp, integration_time,
+                               np.nan if trigger_delay is None else trigger_delay, flags)
+            self.total += 1
+            return self.total - 1
+
+    def _slot(self, age):
+        if not 0 <= age < len(self):
+            raise IndexError("No shot of age " + str(age) + ", the ring holds " + str(len(self)))
+        return (self.total - 1 - age) % self.capacity
+
+    def get(self, age=0):
+        """(intensities, metadata record) of the shot age shots before the newest, as copies."""
+        with self.lock:
+            slot = self._slot(age)
+            return self.spectra[slot].copy(), self.meta[slot].copy()
+
+    def spectrum(self, age=0):
+        return self.get(age)[0]
+
+    def diff(self, age=0, other=1):
+        """Intensities of shot age minus those of shot other, as float64."""
+        with self.lock:
+            return self.spectra[self._slot(age)].astype(np.float64) - self.spectra[self._slot(other)]
+
+    def ordered(self):
+        """(spectra, metadata) of every shot held, oldest first, as copies."""
+        with self.lock:
+            order = (np.arange(self.total - len(self), self.total)) % self.capacity
+            return self.spectra[order], self.meta[order]
+
+    def export(self, age, path):
+        """Writes one shot as a sample file in the format given by the extension (.lsc, .csv, or pickled otherwise)."""
+        intensities = self.spectrum(age).astype(np.float64)
+        if path.endswith(".lsc"):
+            import spectrum_codec
+            spectrum_codec.save_sample(path, self.wavelengths, intensities)
+        elif path.endswith(".csv"):
+            np.savetxt(path, np.column_stack([self.wavelengths, intensities]), delimiter=",",
+                       header="Wavelengths,Intensities", comments="")
+        else:
+            with open(path, "wb") as f:
+                pickle.dump((self.wavelengths, intensities), f)
+
+    def dump(self, path, dtype="<f4"):
+        """Appends every shot held to the run archive at path, oldest first. Returns the number of shots written."""
+        import run_archive
+        spectra, meta = self.ordered()
+        if not len(spectra):
+            return 0
+        with run_archive.RunArchiveWriter(path, self.wavelengths, dtype) as writer:
+            writer.append_many(spectra, meta["timestamp"])
+        return len(spectra)
+
+    def lines(self, count=10):
+        """Human readable list of the newest count shots, for the CLI."""
+        out = []
+        for age in range(min(count, len(self))):
+            intensities, meta = self.get(age)
+            out.append(str(age).rjust(4) + "  #" + str(meta["sequence"]) + "  " +
+                       time.strftime("%H:%M:%S", time.localtime(meta["timestamp"])) +
+                       "  " + str(meta["integration_time"]) + " us  max " + str(int(intensities.max())) +
+                       ("  FLAGGED" if meta["flags"] & FLAGGED else ""))
+        return out
+
+def bench(capacity=256, shots=5000):
+    import tempfile
+    import os
+    import spectrum_codec
+    wavelengths, spectra = spectrum_codec._synthetic_shots(100)
+    ring = SpectrumRing(capacity)
+    start = time.perf_counter()
+    for i in range(shots):
+        ring.push(wavelengths, spectra[i % 100], i, 6000)
+    push = (time.perf_counter() - start) / shots
+    kept = []
+    start = time.perf_counter()
+    for i in range(shots): # What keeping them in a list of arrays costs, for comparison
+        kept.append(np.array(spectra[i % 100], dtype=np.float32))
+        if len(kept) > capacity:
+            kept.pop(0)
+    listed = (time.perf_counter() - start) / shots
+    print(str(capacity) + " x " + str(spectra.shape[1]) + " ring (" + str(round(ring.spectra.nbytes / 1e6, 1)) +
+          " MB): push " + str(round(1e6 * push, 1)) + " us/shot, list of arrays " + str(round(1e6 * listed, 1)) +
+          " us/shot")
+    start = time.perf_counter()
+    for age in range(capacity):
+        ring.diff(0, age)
+    print("diff: " + str(round(1e6 * (time.perf_counter() - start) / capacity, 1)) + " us")
+    path = os.path.join(tempfile.mkdtemp(), "ring.lsr")
+    start = time.perf_counter()
+    ring.dump(path)
+    print("dump: " + str(round(1e3 * (time.perf_counter() - start), 1)) + " ms for " + str(len(ring)) + " shots")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 256)
+    else:
+        print(__doc__)
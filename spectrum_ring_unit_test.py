@@ -0,0 +1,43 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import run_archive
+import spectrum_ring
+
+class TestSpectrumRing(unittest.TestCase):
+    def setUp(self):
+        self.wavelengths = np.linspace(200, 1000, 50)
+        self.ring = spectrum_ring.SpectrumRing(4)
+        for i in range(6):
+            self.ring.push(self.wavelengths, np.full(50, float(i)), 100.0 + i, 6000, flags=i % 2)
+
+    def test_wraps_around_newest_first(self):
+        self.assertEqual(len(self.ring), 4)
+        self.assertEqual([self.ring.spectrum(age)[0] for age in range(4)], [5, 4, 3, 2])
+        intensities, meta = self.ring.get(1)
+        self.assertEqual((meta["sequence"], meta["timestamp"], meta["flags"]), (4, 104.0, 0))
+        np.testing.assert_array_equal(self.ring.diff(0, 3), 3.0)
+        spectra, meta = self.ring.ordered()
+        np.testing.assert_array_equal(spectra[:, 0], [2, 3, 4, 5])
+        self.assertRaises(IndexError, self.ring.get, 4)
+        buffer = self.ring.spectra
+        self.ring.push(self.wavelengths.copy(), np.zeros(50)) # Same grid, another array: no reallocation
+        self.assertIs(self.ring.spectra, buffer)
+        self.assertEqual(len(self.ring), 4)
+        self.ring.push(self.wavelengths[:40], np.zeros(40)) # Another spectrometer
+        self.assertEqual(len(self.ring), 1)
+
+    def test_dump_and_export(self):
+        d = tempfile.mkdtemp()
+        path = os.path.join(d, "recent" + run_archive.EXTENSION)
+        self.assertEqual(self.ring.dump(path), 4)
+        archive = run_archive.RunArchive(path)
+        np.testing.assert_array_equal(archive.timestamps, [102, 103, 104, 105])
+        np.testing.assert_array_equal(archive.intensities[:, 7], [2, 3, 4, 5])
+        self.ring.export(0, os.path.join(d, "shot.csv"))
+        data = np.loadtxt(os.path.join(d, "shot.csv"), delimiter=",", skiprows=1)
+        np.testing.assert_allclose(data, np.column_stack([self.wavelengths, np.full(50, 5.0)]))
+
+if __name__ == "__main__":
+    unittest.main()
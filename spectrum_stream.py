@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+"""
+spectrum_stream.py
+
+Streams spectra to remote viewers as compact binary frames over TCP. Every frame is a fixed size header followed by a
+payload. Spectrum payloads are the raw intensity buffer, handed to sendmsg() straight from the NumPy array without being
+copied or serialized. Wavelengths are sent once when a viewer subscribes (and again only if they change), optionally
+zlib compressed.
+
+Header layout (little endian, see HEADER):
+    magic        4s  b"LSPF"
+    version      B
+    kind         B   KIND_WAVELENGTHS or KIND_SPECTRUM
+    dtype        B   index into DTYPES
+    compression  B   0 = none, 1 = zlib
+    shot_id      I
+    timestamp    d   time.time() when the frame was published
+    settings     I   CRC32 of the acquisition settings, so viewers can tell when they changed
+    count        I   number of values in the payload
+    length       I   number of payload bytes that follow
+
+Usage:
+    python3 spectrum_stream.py subscribe HOST:PORT
+    python3 spectrum_stream.py bench [FRAMES]
+
+"""
+import collections
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import numpy as np
+
+MAGIC = b"LSPF"
+VERSION = 1
+HEADER = struct.Struct("<4sBBBBIdIII")
+KIND_WAVELENGTHS = 1
+KIND_SPECTRUM = 2
+DTYPES = [np.dtype("<f8"), np.dtype("<f4"), np.dtype("<u2"), np.dtype("<i4")]
+DEFAULT_PORT = 5556
+
+FrameHeader = collections.namedtuple("FrameHeader", "kind dtype compression shot_id timestamp settings count length")
+
+def settings_hash(settings):
+    """Returns a 32 bit hash of a settings dictionary."""
+    if not settings:
+        return 0
+    return zlib.crc32(json.dumps(settings, sort_keys=True, default=str).encode("utf-8")) & 0xFFFFFFFF
+
+def pack_header(kind, array, payload_length, compression=0, shot_id=0, timestamp=0.0, settings=0):
+    return HEADER.pack(MAGIC, VERSION, kind, DTYPES.index(array.dtype), compression, shot_id, timestamp, settings,
+                       array.size, payload_length)
+
+def _send_buffers(sock, buffers):
+    """sendmsg() a list of buffers, retrying on partial sends without copying the data."""
+    buffers = [memoryview(b).cast("B") for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+class SpectrumPublisher():
+    """Accepts viewers on a TCP port and sends them every published spectrum.
+
+    publish() is called from the acquisition path. A viewer that cannot keep up for send_timeout seconds is dropped
+    rather than holding up acquisition.
+    """
+    def __init__(self, host="0.0.0.0", port=DEFAULT_PORT, compress_wavelengths=True, send_timeout=0.5):
+        self.compress_wavelengths = compress_wavelengths
+        self.send_timeout = send_timeout
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(4)
+        self.address = self.listener.getsockname()
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.wavelengths = None
+        self.wavelength_frame = None
+        self.shot_id = 0
+        self.running = True
+        self.accept_thread = threading.Thread(target=self._accept_loop, name="stream-accept-thread", daemon=True)
+        self.accept_thread.start()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.settimeout(self.send_timeout)
+            with self.lock:
+                if self.wavelength_frame is not None and not self._send(conn, self.wavelength_frame):
+                    continue
+                self.subscribers.append(conn)
+
+    def _send(self, conn, buffers):
+        try:
+            _send_buffers(conn, buffers)
+            return True
+        except OSError:
+            conn.close()
+            return False
+
+    def _broadcast(self, buffers):
+        self.subscribers = [c for c in self.subscribers if self._send(c, buffers)]
+
+    def set_wavelengths(self, wavelengths):
+        """Sends wavelengths to every viewer if they differ from the ones already sent."""
+        if self.wavelengths is not None and np.array_equal(self.wavelengths, wavelengths):
+            return
+        self.wavelengths = np.array(wavelengths, dtype="<f8")
+        payload = memoryview(self.wavelengths)
+        compression = 0
+        if self.compress_wavelengths:
+            payload = zlib.compress(self.wavelengths.tobytes())
+            compression = 1
+        header = pack_header(KIND_WAVELENGTHS, self.wavelengths, len(payload), compression, timestamp=time.time())
+        with self.lock:
+            self.wavelength_frame = [header, payload]
+            self._broadcast(self.wavelength_frame)
+
+    def publish(self, wavelengths, intensities, settings=None):
+        """Sends one spectrum to every viewer. Returns the shot id it was sent with."""
+        self.set_wavelengths(wavelengths)
+        intensities = np.asarray(intensities)
+        if intensities.dtype not in DTYPES:
+            intensities = intensities.astype("<f8")
+        intensities = np.ascontiguousarray(intensities)
+        self.shot_id += 1
+        header = pack_header(KIND_SPECTRUM, intensities, intensities.nbytes, shot_id=self.shot_id,
+                             timestamp=time.time(), settings=settings_hash(settings))
+        with self.lock:
+            if self.subscribers:
+                self._broadcast([header, intensities])
+        return self.shot_id
+
+    def close(self):
+        self.running = False
+        self.listener.close()
+        with self.lock:
+            for c in self.subscribers:
+                c.close()
+            self.subscribers = []
+
+class SpectrumSubscriber():
+    """Receives frames from a SpectrumPublisher.
+
+    read_frame() reads into a preallocated buffer, so the intensities array it returns is only valid until the next
+    call. Copy it if it needs to be kept.
+    """
+    def __init__(self, host, port=DEFAULT_PORT, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.header_buffer = bytearray(HEADER.size)
+        self.buffer = bytearray(4096 * 8)
+        self.wavelengths = None
+        self.frames = 0
+        self.latencies = collections.deque(maxlen=100) # Seconds, most recent frames
+        self.arrivals = collections.deque(maxlen=100)
+
+    def _recv_into(self, view):
+        while len(view):
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise ConnectionError("Publisher closed the connection")
+            view = view[n:]
+
+    def read_frame(self):
+        """Blocks until a spectrum arrives. Returns (header, intensities). Wavelength frames are handled internally."""
+        while True:
+            self._recv_into(memoryview(self.header_buffer))
+            magic, version, kind, dtype, compression, shot_id, timestamp, settings, count, length = \
+                HEADER.unpack(self.header_buffer)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Not a spectrum stream, or unsupported version")
+            header = FrameHeader(kind, DTYPES[dtype], compression, shot_id, timestamp, settings, count, length)
+            if length > len(self.buffer):
+                self.buffer = bytearray(length)
+            payload = memoryview(self.buffer)[:length]
+            self._recv_into(payload)
+            if compression == 1:
+                payload = zlib.decompress(payload)
+            values = np.frombuffer(payload, dtype=header.dtype, count=count)
+            if kind == KIND_WAVELENGTHS:
+                self.wavelengths = values.copy()
+                continue
+            now = time.time()
+            self.frames += 1
+            self.latencies.append(now - timestamp)
+            self.arrivals.append(now)
+            return header, values
+
+    def latency(self):
+        """Mean end-to-end latency of recent frames in seconds, or None."""
+        if not self.latencies:
+            return None
+        return sum(self.latencies) / len(self.latencies)
+
+    def frame_rate(self):
+        """Frames per second over recent frames, or None."""
+        if len(self.arrivals) < 2 or self.arrivals[-1] == self.arrivals[0]:
+            return None
+        return (len(self.arrivals) - 1) / (self.arrivals[-1] - self.arrivals[0])
+
+    def close(self):
+        self.sock.close()
+
+def parse_address(address, default_port=DEFAULT_PORT):
+    """Splits "host:port" (or just "host") into (host, port)."""
+    host, _, port = address.rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+def bench(frames=2000, pixels=3648):
+    """Streams frames spectra over loopback and prints latency and frame rate."""
+    publisher = SpectrumPublisher("127.0.0.1", 0)
+    subscriber = SpectrumSubscriber("127.0.0.1", publisher.address[1])
+    while not publisher.subscribers:
+        time.sleep(0.001)
+    wavelengths = np.linspace(200, 1025, pixels)
+    intensities = np.random.randint(0, 2 ** 16, pixels).astype(np.uint16)
+    latencies = []
+    start = time.perf_counter()
+    for i in range(frames):
+        publisher.publish(wavelengths, intensities)
+        header, values = subscriber.read_frame()
+        latencies.append(time.time() - header.timestamp)
+    elapsed = time.perf_counter() - start
+    assert np.array_equal(values, intensities) and np.array_equal(subscriber.wavelengths, wavelengths)
+    latencies.sort()
+    print("Frames: " + str(frames) + " x " + str(intensities.nbytes + HEADER.size) + " bytes")
+    print("Frames/s: " + str(round(frames / elapsed, 1)))
+    print("Latency mean: " + str(round(1e6 * sum(latencies) / frames, 1)) + " us, p99: " +
+          str(round(1e6 * latencies[int(frames * 0.99)], 1)) + " us")
+    subscriber.close()
+    publisher.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "subscribe":
+        s = SpectrumSubscriber(*parse_address(sys.argv[2]))
+        while True:
+            header, values = s.read_frame()
+            print("Shot " + str(header.shot_id) + ": max " + str(values.max()) + ", " +
+                  str(round(1000 * s.latency(), 2)) + " ms, " + str(round(s.frame_rate() or 0, 1)) + " frames/s")
+    elif len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 2000)
+    else:
+        print(__doc__)
@@ -0,0 +1,120 @@
+import unittest
+import socket
+import threading
+import time
+import numpy as np
+import spectrum_stream
+
+class ChunkedSocket():
+    """Accepts at most chunk bytes per sendmsg(), like a socket with a full send buffer."""
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.data = bytearray()
+
+    def sendmsg(self, buffers):
+        budget = self.chunk
+        for b in buffers:
+            part = bytes(b[:budget])
+            self.data += part
+            budget -= len(part)
+            if not budget:
+                break
+        return self.chunk - budget
+
+class TestSpectrumStream(unittest.TestCase):
+    def setUp(self):
+        self.publisher = spectrum_stream.SpectrumPublisher("127.0.0.1", 0, send_timeout=0.2)
+        self.subscribers = []
+
+    def tearDown(self):
+        for s in self.subscribers:
+            s.close()
+        self.publisher.close()
+
+    def subscribe(self):
+        s = spectrum_stream.SpectrumSubscriber("127.0.0.1", self.publisher.address[1], timeout=5)
+        self.subscribers.append(s)
+        count = len(self.subscribers)
+        deadline = time.monotonic() + 5
+        while len(self.publisher.subscribers) < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return s
+
+    def test_partial_sends(self):
+        header = spectrum_stream.pack_header(spectrum_stream.KIND_SPECTRUM, np.zeros(3, "<u2"), 6, shot_id=7)
+        payload = np.arange(3, dtype="<u2")
+        sock = ChunkedSocket(5)
+        spectrum_stream._send_buffers(sock, [header, payload])
+        self.assertEqual(bytes(sock.data), header + payload.tobytes())
+        fields = spectrum_stream.HEADER.unpack(bytes(sock.data[:spectrum_stream.HEADER.size]))
+        self.assertEqual(fields[0], spectrum_stream.MAGIC)
+        self.assertEqual(fields[5:], (7, 0.0, 0, 3, 6))
+
+    def test_frames_round_trip(self):
+        wavelengths = np.linspace(200, 1025, 3648)
+        subscriber = self.subscribe()
+        for dtype in ("<u2", "<f4", "<f8", "<i4"):
+            intensities = (np.arange(3648) % 4000).astype(dtype)
+            shot = self.publisher.publish(wavelengths, intensities, {"integration_time": 6000})
+            header, values = subscriber.read_frame()
+            self.assertEqual((header.kind, header.shot_id, header.count), (spectrum_stream.KIND_SPECTRUM, shot, 3648))
+            self.assertEqual(values.dtype, np.dtype(dtype))
+            np.testing.assert_array_equal(values, intensities)
+        np.testing.assert_array_equal(subscriber.wavelengths, wavelengths)
+        self.assertEqual(header.settings, spectrum_stream.settings_hash({"integration_time": 6000}))
+        self.assertNotEqual(header.settings, spectrum_stream.settings_hash({"integration_time": 8000}))
+
+        self.publisher.publish(wavelengths, np.arange(3648, dtype=np.int64)) # Unsupported dtypes are sent as float64
+        header, values = subscriber.read_frame()
+        self.assertEqual(values.dtype, np.dtype("<f8"))
+        self.assertEqual(header.settings, 0)
+
+        self.publisher.publish(wavelengths + 1, np.zeros(3648, "<u2")) # New calibration, sent again before the spectrum
+        subscriber.read_frame()
+        np.testing.assert_array_equal(subscriber.wavelengths, wavelengths + 1)
+        late = self.subscribe() # Gets the current wavelengths as soon as it connects
+        self.publisher.publish(wavelengths + 1, np.zeros(3648, "<u2"))
+        late.read_frame()
+        np.testing.assert_array_equal(late.wavelengths, wavelengths + 1)
+
+    def test_bad_magic(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        subscriber = spectrum_stream.SpectrumSubscriber("127.0.0.1", listener.getsockname()[1], timeout=5)
+        self.subscribers.append(subscriber)
+        conn, _ = listener.accept()
+        conn.sendall(b"XXXX" + bytes(spectrum_stream.HEADER.size - 4))
+        self.assertRaises(ValueError, subscriber.read_frame)
+        conn.close()
+        listener.close()
+
+    def test_slow_subscriber_is_dropped(self):
+        pixels = 1 << 20 # 8 MB frames, more than the socket buffers hold
+        wavelengths = np.linspace(200, 1025, pixels)
+        intensities = np.ones(pixels)
+        slow = self.subscribe() # Never reads
+        fast = self.subscribe()
+        received = []
+        def read():
+            try:
+                while True:
+                    received.append(fast.read_frame()[0].shot_id)
+            except (OSError, ValueError):
+                pass
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        longest = 0
+        for i in range(6):
+            start = time.monotonic()
+            self.publisher.publish(wavelengths, intensities)
+            longest = max(longest, time.monotonic() - start)
+        self.assertEqual(len(self.publisher.subscribers), 1) # Only the fast one is left
+        self.assertLess(longest, 2.0) # Bounded by send_timeout, not by the slow viewer
+        deadline = time.monotonic() + 10
+        while len(received) < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(received, [1, 2, 3, 4, 5, 6])
+
+if __name__ == "__main__":
+    unittest.main()
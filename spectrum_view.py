@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""
+spectrum_view.py
+
+The spectrum shown in core_ui, kept in arrays that are allocated once per spectrometer instead of once per frame. The
+wavelength axis only changes when a different spectrometer is connected, so the region of interest (wavelengths above
+300nm by default) is found once when it is set, and plotting uses views of the preallocated arrays. A DataFrame is only
+made when the spectrum is exported.
+
+Usage:
+    python3 spectrum_view.py bench [FRAMES]   (compares per-frame allocations with the old pandas data path)
+
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+MIN_WAVELENGTH = 300.0 # nm, shorter wavelengths are cropped from the plot
+COLUMNS = ['Wavelength [nm]', 'Intensity']
+
+class SpectrumView():
+    """Wavelengths and intensities of the current spectrum, with the region of interest [min_wavelength, max_wavelength]
+    available as views through x and y."""
+    def __init__(self, min_wavelength=MIN_WAVELENGTH, max_wavelength=None):
+        self.min_wavelength = min_wavelength
+        self.max_wavelength = max_wavelength
+        self.wavelengths = np.zeros(0)
+        self.intensities = np.zeros(0)
+        self.roi = slice(0, 0)
+        self.count = 0 # Spectra shown since the wavelengths were set
+
+    def set_wavelengths(self, wavelengths):
+        """Sets the wavelength axis (sorted ascending) and finds the region of interest. The arrays are reallocated only
+        if the number of pixels has changed."""
+        if len(wavelengths) != len(self.wavelengths):
+            self.wavelengths = np.empty(len(wavelengths))
+            self.intensities = np.zeros(len(wavelengths))
+        self.wavelengths[:] = wavelengths
+        start = np.searchsorted(self.wavelengths, self.min_wavelength, side="right") if self.min_wavelength is not None else 0
+        stop = np.searchsorted(self.wavelengths, self.max_wavelength, side="right") if self.max_wavelength is not None \
+            else len(self.wavelengths)
+        self.roi = slice(int(start), int(stop))
+        self.count = 0
+
+    def update(self, intensities):
+        """Copies in a new spectrum, one intensity per wavelength."""
+        self.intensities[:] = intensities
+        self.count += 1
+
+    @property
+    def x(self):
+        return self.wavelengths[self.roi]
+
+    @property
+    def y(self):
+        return self.intensities[self.roi]
+
+    def max(self):
+        """Highest intensity in the region of interest, or 0 if it is empty."""
+        return self.y.max() if self.roi.stop > self.roi.start else 0.0
+
+    def to_dataframe(self):
+        """Copies the region of interest into a DataFrame with the columns the CSV export has always used."""
+        import pandas as pd
+        return pd.DataFrame({COLUMNS[0]: self.x, COLUMNS[1]: self.y}, columns=COLUMNS)
+
+def _old_frame(wavelengths, intensities):
+    """The per-frame work update_plot used to do: build a DataFrame, mask it and pull out the columns to plot."""
+    import pandas as pd
+    emission_data = pd.DataFrame(data=np.asarray([wavelengths, intensities]).transpose(), columns=COLUMNS)
+    emission_data = emission_data[emission_data > 300]
+    x, y = emission_data.iloc[0:, 0], emission_data.iloc[0:, 1]
+    return emission_data['Intensity'].max()
+
+def _new_frame(view, intensities):
+    view.update(intensities)
+    x, y = view.x, view.y
+    return view.max()
+
+def _measure(frame, frames):
+    """Returns (mean peak bytes allocated, mean seconds) per call of frame()."""
+    frame() # Warm up caches and lazy imports outside the measurement
+    peak = 0
+    tracemalloc.start()
+    for i in range(frames):
+        tracemalloc.clear_traces() # Also resets the peak
+        frame()
+        peak += tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for i in range(frames):
+        frame()
+    return peak / frames, (time.perf_counter() - start) / frames
+
+def bench(frames=1000, pixels=3648):
+    wavelengths = 177.2 + 0.2 * np.arange(pixels)
+    spectra = np.random.RandomState(1337).normal(1500, 12, (16, pixels))
+    view = SpectrumView()
+    view.set_wavelengths(wavelengths)
+    counter = iter(range(1 << 62))
+    paths = [("numpy views", lambda: _new_frame(view, spectra[next(counter) % 16]))]
+    try:
+        import pandas
+        paths.insert(0, ("pandas", lambda: _old_frame(wavelengths, spectra[next(counter) % 16])))
+    except ImportError:
+        print("pandas is not installed, only measuring the new data path")
+    for label, frame in paths:
+        allocated, seconds = _measure(frame, frames)
+        print(label.ljust(11) + ": " + str(int(allocated)) + " bytes allocated per frame (peak), " +
+              str(round(1e6 * seconds, 1)) + " us per frame")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == "bench":
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        print(__doc__)
@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+import spectrum_view
+
+class TestSpectrumView(unittest.TestCase):
+    def test_region_of_interest(self):
+        view = spectrum_view.SpectrumView()
+        wavelengths = np.linspace(200, 1000, 801)
+        view.set_wavelengths(wavelengths)
+        buffer = view.intensities
+        view.update(np.arange(801.0))
+        self.assertEqual(view.x[0], 301.0) # Cropped, not masked with NaNs
+        self.assertEqual(len(view.x), len(view.y))
+        self.assertEqual(view.y[0], 101.0)
+        self.assertEqual(view.max(), 800.0)
+        view.update(np.zeros(801))
+        self.assertIs(view.intensities, buffer) # No reallocation between frames
+        view.set_wavelengths(wavelengths + 1)
+        self.assertIs(view.intensities, buffer)
+        self.assertEqual(view.count, 0)
+
+    def test_empty_region(self):
+        view = spectrum_view.SpectrumView(max_wavelength=250)
+        view.set_wavelengths(np.linspace(300, 400, 10))
+        view.update(np.ones(10))
+        self.assertEqual(len(view.y), 0)
+        self.assertEqual(view.max(), 0.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
+import math
 import numpy as np
-import pandas as pd
 import random
+import threading
+import time
 
 random.seed(1337)
 
@@ -37,6 +39,176 @@ def generate_dummy_spectra(central_spectra=(500, 730, 380), width=100, bins=1E4,
                     except ZeroDivisionError:
                         val = 1000 / (float(j - i + 0.02) ** 2)
         intensities.append(val)
+    import pandas as pd
     spec_data = np.asarray([wavelengths, intensities]).transpose()
     output_frame = pd.DataFrame(data=spec_data, columns=['Wavelength [nm]', 'Intensity'])
     return output_frame
+
+
+# Lines of the simulated sample: (wavelength in nm, peak counts when the laser fires during the integration)
+SIMULATED_LINES = ((279.55, 9000.0), (393.37, 15000.0), (396.85, 12000.0), (589.0, 25000.0), (656.28, 7000.0), (766.49, 4000.0))
+
+
+def simulated_wavelengths(pixels=3648):
+    """Wavelength calibration of the simulated FLAME-T."""
+    return 177.2 + 0.2 * np.arange(pixels) - 1.5e-6 * np.arange(pixels) ** 2
+
+
+class SimulatedLaser():
+    """Stands in for ujlaser's Laser: remembers its settings and counts shots, so a simulated spectrometer can tell
+    whether the laser fired while it was integrating. fire() takes latency seconds (the serial command) before the
+    shot, slept through sleep; pass a clock.VirtualClock's sleep and monotonic to run it in virtual time. Telemetry
+    reads (get_fet_temp, ...) take telemetry_latency seconds, like a serial round trip, and return the fet_temp,
+    fet_voltage and diode_current attributes, which tests can change."""
+    def __init__(self, latency=0.0, sleep=time.sleep, now=time.perf_counter, telemetry_latency=0.0):
+        self.latency = latency
+        self.telemetry_latency = telemetry_latency
+        self.sleep = sleep
+        self.now = now
+        self.armed = False
+        self.shots = 0
+        self.last_fire = None
+        self.rep_rate = 10.0
+        self.pulse_width = 0.00001
+        self.pulse_mode = 0
+        self.burst_count = 1
+        self.diode_current = 100.0
+        self.fet_temp = 30.0
+        self.fet_voltage = 10.0
+        self.stopped_at = None # now() of the last emergency stop
+
+    def connect(self, port):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def refresh_parameters(self):
+        pass
+
+    def arm(self):
+        self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def fire(self):
+        if self.latency:
+            self.sleep(self.latency)
+        self.shots += 1
+        self.last_fire = self.now()
+
+    def emergency_stop(self):
+        self.armed = False
+        self.stopped_at = self.now()
+
+    def _telemetry(self, value):
+        if self.telemetry_latency:
+            self.sleep(self.telemetry_latency)
+        return value
+
+    def get_status(self):
+        return "Simulated laser, " + ("armed" if self.armed else "disarmed") + ", " + str(self.shots) + " shots"
+
+    def get_system_shot_count(self):
+        return self.shots
+
+    def get_fet_temp(self):
+        return self._telemetry(self.fet_temp)
+
+    def get_fet_voltage(self):
+        return self._telemetry(self.fet_voltage)
+
+    def get_diode_current(self):
+        return self._telemetry(self.diode_current)
+
+    def get_repetition_rate(self):
+        return self.rep_rate
+
+    def set_repetition_rate(self, rate):
+        self.rep_rate = rate
+
+    def get_pulse_width(self):
+        return self.pulse_width
+
+    def set_pulse_width(self, width):
+        self.pulse_width = width
+
+    def get_pulse_mode(self):
+        return self.pulse_mode
+
+    def set_pulse_mode(self, mode):
+        self.pulse_mode = mode
+
+    def get_burst_count(self):
+        return self.burst_count
+
+    def set_burst_count(self, count):
+        self.burst_count = count
+
+
+class SimulatedSpectrometer():
+    """Stands in for a seabreeze Spectrometer. Every acquisition blocks for the integration time (through sleep, which
+    can be replaced) and returns dark counts and read noise, plus emission lines if laser is None or it fired during
+    the integration. wavelengths replaces the FLAME-T calibration, e.g. to simulate units covering other ranges.
+
+    With decay (seconds) the plasma emission dies away exponentially after each shot instead of being all or nothing,
+    and an acquisition sees the part of it emitted during the integration, measured on now (the laser's clock), so
+    acquisitions started some delay after the shot see weaker lines, as in a gate delay series."""
+    def __init__(self, laser=None, pixels=3648, serial_number="SIM00001", seed=1337, sleep=time.sleep, wavelengths=None,
+                 decay=None, now=time.perf_counter):
+        self.laser = laser
+        self.pixels = pixels if wavelengths is None else len(wavelengths)
+        self.serial_number = serial_number
+        self.model = "FLAME-T (simulated)"
+        self.integration_time_micros_limits = (1000, 65000000)
+        self.max_intensity = 65535
+        self.sleep = sleep
+        self.decay = decay
+        self.now = now
+        self.integration_time = 6000
+        self.mode = 0
+        self.rng = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        self._wavelengths = simulated_wavelengths(pixels) if wavelengths is None else np.asarray(wavelengths, dtype=np.float64)
+        self.template = np.zeros(self.pixels)
+        for centre, height in SIMULATED_LINES:
+            self.template += height * np.exp(-0.5 * ((self._wavelengths - centre) / 0.3) ** 2)
+
+    def wavelengths(self):
+        return self._wavelengths
+
+    def integration_time_micros(self, micros):
+        low, high = self.integration_time_micros_limits
+        if not low <= micros <= high:
+            raise ValueError("Integration time " + str(micros) + " is outside " + str(self.integration_time_micros_limits))
+        self.integration_time = int(micros)
+
+    def trigger_mode(self, mode):
+        self.mode = mode
+
+    def intensities(self, correct_dark_counts=False, correct_nonlinearity=False):
+        shots = self.laser.shots if self.laser is not None else None
+        start = self.now()
+        self.sleep(self.integration_time / 1e6)
+        with self.lock:
+            counts = self.rng.normal(1500.0, 12.0, self.pixels)
+            if self.laser is None:
+                counts += self.template
+            elif self.decay is None:
+                if self.laser.shots != shots:
+                    counts += self.template
+            elif self.laser.last_fire is not None:
+                fired = self.laser.last_fire # Seconds since the shot at the start and end of the integration:
+                opened, closed = max(start, fired) - fired, self.now() - fired
+                if closed > 0:
+                    counts += self.template * (math.exp(-opened / self.decay) - math.exp(-closed / self.decay))
+        if correct_dark_counts:
+            counts -= 1500.0
+        return np.clip(np.round(counts), 0, self.max_intensity)
+
+    def spectrum(self, correct_dark_counts=False, correct_nonlinearity=False):
+        return self._wavelengths, self.intensities(correct_dark_counts, correct_nonlinearity)
+
+    def close(self):
+        pass
@@ -0,0 +1,101 @@
+"""
+waterfall.py
+
+Binning for the shot vs. wavelength waterfall view in core_ui. A run of N shots x 3648 pixels is far bigger than the
+screen, so it is reduced to screen resolution before being drawn: blocks of shots and pixels are combined with max()
+(so a single bright shot or narrow line still shows up) and only the visible window is re-binned when zooming.
+
+"""
+import math
+
+import numpy as np
+
+def bin_2d(data, rows, cols):
+    """Reduces a 2-D array to at most rows x cols by taking the max of each block. Returns a float32 array."""
+    n, m = data.shape
+    fr = max(1, int(math.ceil(n / float(rows))))
+    fc = max(1, int(math.ceil(m / float(cols))))
+    out_rows = int(math.ceil(n / float(fr)))
+    out_cols = int(math.ceil(m / float(fc)))
+    out = np.empty((out_rows, out_cols), dtype=np.float32)
+    full_cols = m // fc
+    for r in range(out_rows): # One row of blocks at a time so big memory-mapped runs are never read in all at once
+        block = np.asarray(data[r * fr:(r + 1) * fr])
+        reduced = block.max(axis=0)
+        out[r, :full_cols] = reduced[:full_cols * fc].reshape(full_cols, fc).max(axis=1)
+        if full_cols < out_cols:
+            out[r, full_cols] = reduced[full_cols * fc:].max()
+    return out
+
+class WaterfallBinner():
+    """Produces screen sized images of a window of a run (see run_archive.open_run).
+
+    For memory-mapped run archives every shot in the window is binned. For sample directories, where every shot is a
+    separate file, the shots are decimated instead so that zoomed out views do not have to load the whole run.
+    """
+    def __init__(self, run):
+        self.run = run
+
+    def image(self, shots, pixels, rows, cols):
+        """Returns the image of shots (start, stop) x pixels (start, stop), binned to at most rows x cols."""
+        s0, s1 = max(0, shots[0]), min(len(self.run), shots[1])
+        p0, p1 = pixels
+        if s1 <= s0 or p1 <= p0:
+            return np.zeros((1, 1), dtype=np.float32)
+        if hasattr(self.run, "intensities"):
+            return bin_2d(self.run.intensities[s0:s1, p0:p1], rows, cols)
+        step = max(1, int(math.ceil((s1 - s0) / float(rows))))
+        block = np.array([self.run[i][1][p0:p1] for i in range(s0, s1, step)])
+        return bin_2d(block, rows, cols)
+
+class WaterfallImage():
+    """A fixed size waterfall image that shots are appended to as they arrive.
+
+    Each shot is binned down to cols pixels and max-combined into the current row. When all rows are used, neighbouring
+    rows are merged in pairs and twice as many shots go into each row from then on, so the image always covers every
+    shot since the start with no reallocation.
+    """
+    def __init__(self, pixels, rows=512, cols=1024):
+        self.pixels = pixels
+        self.fc = max(1, int(math.ceil(pixels / float(cols))))
+        self.cols = int(math.ceil(pixels / float(self.fc)))
+        self.rows = rows
+        self.data = np.zeros((rows, self.cols), dtype=np.float32)
+        self.padded = np.zeros(self.cols * self.fc, dtype=np.float32)
+        self.shots_per_row = 1
+        self.row = 0 # Row currently being filled
+        self.shots_in_row = 0
+        self.shots = 0
+
+    def append(self, intensities):
+        """Adds one spectrum to the image."""
+        if self.shots_in_row == self.shots_per_row:
+            self.row += 1
+            self.shots_in_row = 0
+            if self.row == self.rows:
+                self._halve()
+        self.padded[:self.pixels] = intensities
+        self.padded[self.pixels:] = self.padded[self.pixels - 1]
+        binned = self.padded.reshape(self.cols, self.fc).max(axis=1)
+        if self.shots_in_row == 0:
+            self.data[self.row] = binned
+        else:
+            np.maximum(self.data[self.row], binned, out=self.data[self.row])
+        self.shots_in_row += 1
+        self.shots += 1
+
+    def _halve(self):
+        half = self.rows // 2
+        np.maximum(self.data[0:2 * half:2], self.data[1:2 * half:2], out=self.data[:half])
+        self.row = half
+        if self.rows % 2: # The odd row out has no pair: it becomes the next row, already half full
+            self.data[half] = self.data[self.rows - 1]
+            self.shots_in_row = self.shots_per_row
+            self.data[half + 1:] = 0
+        else:
+            self.data[half:] = 0
+        self.shots_per_row *= 2
+
+    def image(self):
+        """Returns a view of the rows filled so far."""
+        return self.data[:self.row + 1]
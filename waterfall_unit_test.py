@@ -0,0 +1,68 @@
+import unittest
+import numpy as np
+import waterfall
+
+def block_max(data, fr, fc):
+    """Reference binning: the max of every fr x fc block, the last ones being smaller."""
+    n, m = data.shape
+    return np.array([[data[r:r + fr, c:c + fc].max() for c in range(0, m, fc)] for r in range(0, n, fr)])
+
+class ShotList():
+    """A run without an intensities array, like run_archive.SampleDirectory."""
+    def __init__(self, shots):
+        self.shots = shots
+        self.loaded = []
+
+    def __len__(self):
+        return len(self.shots)
+
+    def __getitem__(self, i):
+        self.loaded.append(i)
+        return float(i), self.shots[i]
+
+class RunLike():
+    def __init__(self, shots):
+        self.intensities = shots
+
+    def __len__(self):
+        return len(self.intensities)
+
+class TestWaterfall(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(3)
+
+    def test_bin_2d(self):
+        data = self.rng.randint(0, 1000, (7, 10))
+        out = waterfall.bin_2d(data, 3, 4)
+        self.assertEqual(out.dtype, np.float32)
+        np.testing.assert_array_equal(out, block_max(data, 3, 3)) # ceil(7 / 3) x ceil(10 / 4)
+        np.testing.assert_array_equal(waterfall.bin_2d(data, 100, 100), data) # Never scaled up
+        data[6, 9] = 5000 # A single bright pixel survives any amount of binning
+        self.assertEqual(waterfall.bin_2d(data, 1, 1)[0, 0], 5000)
+
+    def test_binner_window(self):
+        shots = self.rng.randint(0, 1000, (40, 12))
+        image = waterfall.WaterfallBinner(RunLike(shots)).image((10, 50), (2, 12), 8, 5)
+        np.testing.assert_array_equal(image, block_max(shots[10:40, 2:12], 4, 2))
+        run = ShotList(shots)
+        image = waterfall.WaterfallBinner(run).image((0, 40), (0, 12), 10, 12)
+        self.assertEqual(run.loaded, list(range(0, 40, 4))) # Decimated, not every file loaded
+        np.testing.assert_array_equal(image, shots[::4])
+        self.assertEqual(waterfall.WaterfallBinner(run).image((5, 5), (0, 12), 10, 12).shape, (1, 1))
+
+    def test_rollover(self):
+        pixels, cols = 10, 4
+        for rows in (1, 4, 5):
+            shots = self.rng.rand(60, pixels)
+            image = waterfall.WaterfallImage(pixels, rows, cols)
+            self.assertEqual((image.fc, image.cols), (3, 4))
+            for n in range(1, 61):
+                image.append(shots[n - 1])
+                per_row = image.shots_per_row
+                expected = block_max(shots[:n], per_row, image.fc)
+                np.testing.assert_array_equal(image.image(), expected.astype(np.float32), "rows=%d n=%d" % (rows, n))
+                self.assertLessEqual(len(image.image()), rows)
+            self.assertEqual(image.shots, 60)
+
+if __name__ == "__main__":
+    unittest.main()